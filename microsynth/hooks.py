@@ -80,6 +80,7 @@ doctype_list_js = {
 jenv = {
     "methods": [
         "get_price_list_rate:microsynth.microsynth.jinja.get_price_list_rate",
+        "prefetch_price_list_rates:microsynth.microsynth.jinja.prefetch_price_list_rates",
         "get_destination_classification:microsynth.microsynth.jinja.get_destination_classification",
         "get_yearly_order_sum:microsynth.microsynth.portfolio.get_yearly_order_sum",
         "get_sales_volume:microsynth.microsynth.portfolio.get_sales_volume",
@@ -167,10 +168,17 @@ jenv = {
 # }
 doc_events = {
     "Customer": {
-        "validate": "microsynth.microsynth.shipping.validate_customer_shipping_items"
+        "validate": "microsynth.microsynth.shipping.validate_customer_shipping_items",
+        "on_update": "microsynth.microsynth.doctype.contact_search_index.contact_search_index.customer_on_update"
     },
     "Contact": {
-        "after_insert": "microsynth.microsynth.marketing.lock_contact"
+        "after_insert": "microsynth.microsynth.marketing.lock_contact",
+        "on_update": "microsynth.microsynth.doctype.contact_search_index.contact_search_index.contact_on_update",
+        "on_trash": "microsynth.microsynth.doctype.contact_search_index.contact_search_index.contact_on_trash",
+        "after_rename": "microsynth.microsynth.doctype.contact_search_index.contact_search_index.contact_after_rename"
+    },
+    "Address": {
+        "on_update": "microsynth.microsynth.doctype.contact_search_index.contact_search_index.address_on_update"
     },
     "Payment Reminder": {
         "after_insert": "microsynth.microsynth.payment_reminder.extend_values",
@@ -198,8 +206,18 @@ doc_events = {
     },
     "Sales Invoice": {
         "before_save": "microsynth.microsynth.taxes.set_alternative_tax_template",
-        "on_submit": "microsynth.microsynth.credits.sales_invoice_on_submit",
-        "on_cancel": "microsynth.microsynth.credits.cancel_credit_journal_entry"
+        "on_submit": [
+            "microsynth.microsynth.credits.sales_invoice_on_submit",
+            "microsynth.microsynth.doctype.revenue_fact.revenue_fact.update_revenue_facts"
+        ],
+        "on_cancel": [
+            "microsynth.microsynth.credits.cancel_credit_journal_entry",
+            "microsynth.microsynth.doctype.revenue_fact.revenue_fact.update_revenue_facts"
+        ]
+    },
+    "Payment Entry": {
+        "on_submit": "microsynth.microsynth.credits.update_deposit_credit_account_balances",
+        "on_cancel": "microsynth.microsynth.credits.update_deposit_credit_account_balances"
     },
     "Communication": {
         "after_insert": "microsynth.microsynth.email_handler.communication_on_insert"
@@ -218,6 +236,31 @@ doc_events = {
     "Item": {
         "before_save": "microsynth.microsynth.utils.item_before_save",
     },
+    "Item Price": {
+        "on_update": [
+            "microsynth.microsynth.pricing.clear_item_price_cache",
+            "microsynth.microsynth.jinja.clear_price_list_rate_cache"
+        ],
+        "on_trash": [
+            "microsynth.microsynth.pricing.clear_item_price_cache",
+            "microsynth.microsynth.jinja.clear_price_list_rate_cache"
+        ]
+    },
+    "Price List": {
+        "on_update": "microsynth.microsynth.jinja.clear_price_list_rate_cache",
+        "on_trash": "microsynth.microsynth.jinja.clear_price_list_rate_cache"
+    },
+    "Tax Matrix": {
+        "on_update": "microsynth.microsynth.taxes.clear_compiled_tax_matrix"
+    },
+    "Sales Taxes and Charges Template": {
+        "on_update": "microsynth.microsynth.taxes.clear_compiled_tax_matrix",
+        "on_trash": "microsynth.microsynth.taxes.clear_compiled_tax_matrix",
+        "after_rename": "microsynth.microsynth.taxes.clear_compiled_tax_matrix"
+    },
+    "Country": {
+        "on_update": "microsynth.microsynth.taxes.clear_compiled_tax_matrix"
+    },
     "Purchase Receipt": {
         "on_submit": "microsynth.microsynth.purchasing.purchase_receipt_before_submit"
     },
@@ -2,7 +2,9 @@ import frappe
 import traceback
 import re
 
-from microsynth.microsynth.seqblatt import process_label_status_change
+from microsynth.microsynth.seqblatt import process_label_status_change, get_labels_by_barcode_and_item
+from microsynth.microsynth.doctype.label_range.label_range import get_label_range_index, get_label_range, find_interval
+from microsynth.microsynth.doctype.sequencing_label.sequencing_label import get_label_number, LABEL_NUMBER_MAX
 
 @frappe.whitelist()
 def get_unused_labels(contacts, items):
@@ -54,6 +56,21 @@ def get_label_status(labels):
     if not labels or len(labels) == 0:
         return {'success': True, 'messages': []}
     try:
+        # prefetch the existing Items and all matching Sequencing Labels with one query each
+        # (keys are compared case-insensitive like the database does)
+        def get_key(barcode, item):
+            return (str(barcode).lower(), str(item).lower())
+
+        complete_labels = [ label for label in labels if label.get('item') and label.get('barcode') ]
+        requested_items = list({ label['item'] for label in complete_labels })
+        existing_items = set()
+        if len(requested_items) > 0:
+            existing_items = { i['name'].lower() for i in frappe.get_all("Item", filters={'name': ['IN', requested_items]}, fields=['name']) }
+        pairs = list({ (label['barcode'], label['item']) for label in complete_labels if str(label['item']).lower() in existing_items })
+        sequencing_labels_by_key = {}
+        for sequencing_label in get_labels_by_barcode_and_item(pairs, ['status', 'registered', 'contact', 'registered_to']):
+            sequencing_labels_by_key.setdefault(get_key(sequencing_label['barcode'], sequencing_label['item']), []).append(sequencing_label)
+
         messages_to_return = []
         for label in labels:
             if not 'item' in label or not label['item'] or not 'barcode' in label or not label['barcode']:
@@ -64,7 +81,7 @@ def get_label_status(labels):
                     'internal_message': f"Label '{label['barcode']}' does not exist."  # Item and Barcode are both mandatory.
                 })
                 continue
-            if not frappe.db.exists("Item", label['item']):
+            if not str(label['item']).lower() in existing_items:
                 messages_to_return.append({
                     'query': label,
                     'label': None,
@@ -72,20 +89,8 @@ def get_label_status(labels):
                     'internal_message': f"Label '{label['barcode']}' does not exist."  # f"The given Item '{label['item']}' does not exist in the ERP."
                 })
                 continue
-            item_condition = f"AND `item` = {label['item']}"
             item_string = f" and Item Code {label['item']}"
-            sql_query = f"""
-                SELECT `item`,
-                    `label_id` AS `barcode`,
-                    `status`,
-                    `registered`,
-                    `contact`,
-                    `registered_to`
-                FROM `tabSequencing Label`
-                WHERE `label_id` = '{label['barcode']}'
-                    {item_condition}
-                ;"""
-            sequencing_labels = frappe.db.sql(sql_query, as_dict=True)
+            sequencing_labels = sequencing_labels_by_key.get(get_key(label['barcode'], label['item']), [])
             if len(sequencing_labels) > 1:
                 frappe.log_error(f"Found {len(sequencing_labels)} labels for the given barcode {label['barcode']}{item_string}.", "webshop.get_label_status")
                 messages_to_return.append({
@@ -125,16 +130,11 @@ def get_label_ranges():
     bench execute microsynth.microsynth.api.webshop.label.get_label_ranges
     """
     ranges_to_return = []
-    try:  # range is also a SQL key word and needs therefore to be surrounded by backticks:
-        label_ranges = frappe.get_all("Label Range", fields=['item_code', 'prefix', '`range`'])
-        for label_range in label_ranges:
-            ranges = label_range['range'].split(',')
-            for r in ranges:
-                parts = r.split('-')
-                start = int(parts[0].strip())
-                end = int(parts[1].strip())
+    try:
+        for item_code, label_range in get_label_range_index().items():
+            for start, end in label_range['ranges']:
                 ranges_to_return.append({
-                    "item": label_range['item_code'],
+                    "item": item_code,
                     "prefix": label_range['prefix'],
                     "barcode_start_range": start,
                     "barcode_end_range": end
@@ -146,51 +146,57 @@ def get_label_ranges():
     return {'success': True, 'message': 'OK', 'internal_message': 'OK', 'ranges': ranges_to_return}
 
 
-def is_next_barcode(first_barcode, second_barcode):
+BARCODE_PATTERN = re.compile("([a-zA-Z]+)([0-9]+)")
+REGISTERED_LABELS_BATCH_SIZE = 10000
+
+
+def parse_barcode(barcode):
     """
-    Check if second_barcode follows immediatly after first_barcode
+    Split the given barcode into a tuple (prefix, number) or return None if it is not a valid barcode
     """
     try:
-        first_int = int(first_barcode)
-        second_int = int(second_barcode)
-        return first_int + 1 == second_int
+        return ("", int(barcode))
     except Exception:
         try:
-            # compile a regex
-            cre = re.compile("([a-zA-Z]+)([0-9]+)")
             # match it to group text and numbers separately into a tuple
-            first_split = cre.match(first_barcode).groups()
-            second_split = cre.match(second_barcode).groups()
-            # check if label prefixes are identical
-            if first_split[0] == second_split[0]:
-                return int(first_split[1]) + 1 == int(second_split[1])
-            else:
-                return False
+            split = BARCODE_PATTERN.match(barcode).groups()
+            return (split[0], int(split[1]))
         except Exception:
-            return False
+            return None
 
 
-def partition_into_ranges(sequencing_labels):
+def follows(first_parsed, second_parsed):
     """
-    Takes a list of dictionaries of labels sorted by barcode ascending and returns a list of dictionary of barcode ranges.
+    Check if the parsed second barcode follows immediatly after the parsed first barcode (identical prefixes)
     """
-    ranges = []
-    if len(sequencing_labels) < 1:
-        return ranges
-    current_range_barcode = sequencing_labels[0]['barcode']
-    barcode_range = {
-        'registered_to': sequencing_labels[0]['registered_to'],
-        'item': sequencing_labels[0]['item'],
-        'barcode_start_range': current_range_barcode,
-        'barcode_end_range': current_range_barcode
-    }
-    for i, label in enumerate(sequencing_labels):
-        if i == 0:
-            continue  # do not consider the first label a second time
-        if label['registered_to'] != barcode_range['registered_to'] or label['item'] != barcode_range['item'] or not is_next_barcode(current_range_barcode, label['barcode']):
+    return (first_parsed is not None and second_parsed is not None
+            and first_parsed[0] == second_parsed[0]
+            and first_parsed[1] + 1 == second_parsed[1])
+
+
+def is_next_barcode(first_barcode, second_barcode):
+    """
+    Check if second_barcode follows immediatly after first_barcode
+    """
+    return follows(parse_barcode(first_barcode), parse_barcode(second_barcode))
+
+
+def iterate_ranges(sequencing_labels):
+    """
+    Takes an iterable of dictionaries of labels sorted by barcode ascending and yields dictionaries of barcode ranges.
+    Only the current range is kept in memory and every barcode is parsed only once.
+    """
+    barcode_range = None
+    current_range_barcode = None
+    current_parsed = None
+    for label in sequencing_labels:
+        parsed = parse_barcode(label['barcode'])
+        if barcode_range and (label['registered_to'] != barcode_range['registered_to'] or label['item'] != barcode_range['item'] or not follows(current_parsed, parsed)):
             # finish current barcode_range
             barcode_range['barcode_end_range'] = current_range_barcode
-            ranges.append(barcode_range)
+            yield barcode_range
+            barcode_range = None
+        if not barcode_range:
             # start a new barcode_range
             barcode_range = {
                 'registered_to': label['registered_to'],
@@ -199,14 +205,69 @@ def partition_into_ranges(sequencing_labels):
                 'barcode_end_range': label['barcode']
             }
         current_range_barcode = label['barcode']
-    # finish last barcode_range
-    barcode_range['barcode_end_range'] = current_range_barcode
-    if not barcode_range in ranges:
-        # add last barcode_range
-        ranges.append(barcode_range)
+        current_parsed = parsed
+    if barcode_range:
+        # finish last barcode_range
+        barcode_range['barcode_end_range'] = current_range_barcode
+        yield barcode_range
+
+
+def partition_into_ranges(sequencing_labels):
+    """
+    Takes a list of dictionaries of labels sorted by barcode ascending and returns a list of dictionary of barcode ranges.
+    """
+    ranges = []
+    seen = set()
+    last_range = None
+    for barcode_range in iterate_ranges(sequencing_labels):
+        if last_range:
+            ranges.append(last_range)
+            seen.add(tuple(last_range.values()))
+        last_range = barcode_range
+    # the last range is only added if it is not identical to a previous one (duplicate barcodes)
+    if last_range and not tuple(last_range.values()) in seen:
+        ranges.append(last_range)
     return ranges
 
 
+def iterate_unused_registered_labels(contacts, batch_size=REGISTERED_LABELS_BATCH_SIZE):
+    """
+    Yield the unused Sequencing Labels registered to the given Contacts sorted by barcode.
+    Labels are fetched in batches using keyset pagination to limit memory usage.
+    """
+    last_barcode = None
+    last_name = None
+    while True:
+        if last_barcode is None:
+            keyset_condition = ""
+        else:
+            keyset_condition = """AND (`label_id` > %(last_barcode)s
+                    OR (`label_id` = %(last_barcode)s AND `name` > %(last_name)s))"""
+        batch = frappe.db.sql(f"""
+            SELECT `name`,
+                `item`,
+                `label_id` AS `barcode`,
+                `registered_to`
+            FROM `tabSequencing Label`
+            WHERE `status` = 'unused'
+                AND `registered_to` IN %(contacts)s
+                {keyset_condition}
+            ORDER BY `label_id` ASC, `name` ASC
+            LIMIT %(batch_size)s
+            ;""", {
+                'contacts': contacts,
+                'last_barcode': last_barcode,
+                'last_name': last_name,
+                'batch_size': batch_size
+            }, as_dict=True)
+        for label in batch:
+            yield label
+        if len(batch) < batch_size:
+            break
+        last_barcode = batch[-1]['barcode']
+        last_name = batch[-1]['name']
+
+
 @frappe.whitelist()
 def get_registered_label_ranges(contacts):
     """
@@ -216,19 +277,9 @@ def get_registered_label_ranges(contacts):
     if not contacts or len(contacts) == 0:
         return {'success': False, 'message': "Failed to get registered label ranges.", 'internal_message': "Please provide at least one Contact", 'ranges': None}
     try:
-        sql_query = """
-            SELECT `item`,
-                `label_id` AS `barcode`,
-                `registered_to`
-            FROM `tabSequencing Label`
-            WHERE `status` = 'unused'
-                AND `registered_to` IN ({})
-            ORDER BY `label_id` ASC
-            ;""".format(','.join(['%s'] * len(contacts)))
-        sequencing_labels = frappe.db.sql(sql_query, contacts, as_dict=True)
-        if len(sequencing_labels) == 0:
+        ranges = partition_into_ranges(iterate_unused_registered_labels(contacts))
+        if len(ranges) == 0:
             return {'success': True, 'message': 'OK', 'internal_message': 'No sequencing labels found.', 'ranges': []}
-        ranges = partition_into_ranges(sequencing_labels)
         return {'success': True, 'message': 'OK', 'internal_message': 'OK', 'ranges': ranges}
     except Exception as err:
         msg = f"Error fetching registered label ranges for contacts {contacts}: {err}. Check ERP Error Log for details."
@@ -236,36 +287,63 @@ def get_registered_label_ranges(contacts):
         return {'success': False, 'message': "Failed to get registered label ranges.", 'internal_message': msg, 'ranges': None}
 
 
+def benchmark_registered_label_ranges(number_of_labels=100000, validate=True):
+    """
+    Partition a synthetic contact with the given number of unused labels (two Items, prefixed barcodes with gaps)
+    and check that the ranges cover exactly the given labels.
+
+    bench execute microsynth.microsynth.api.webshop.label.benchmark_registered_label_ranges --kwargs "{'number_of_labels': 100000}"
+    """
+    import random
+    import time
+    random.seed(42)
+    labels = []
+    number = 1
+    while len(labels) < number_of_labels:
+        number += random.choice([1, 1, 1, 1, 1, 1, 1, 1, 2, 50])     # mostly consecutive with occasional gaps
+        labels.append({
+            'item': '6030' if (number // 1000) % 2 == 0 else '6031',
+            'barcode': f"MY{number:06d}",
+            'registered_to': 'BENCHMARK'
+        })
+
+    start = time.perf_counter()
+    ranges = partition_into_ranges(iter(labels))
+    duration = time.perf_counter() - start
+    print(f"Partitioned {len(labels)} labels into {len(ranges)} ranges in {duration:.6f} seconds")
+
+    if validate:
+        start_validation = time.perf_counter()
+        covered = []
+        for r in ranges:
+            first = int(BARCODE_PATTERN.match(r['barcode_start_range']).groups()[1])
+            last = int(BARCODE_PATTERN.match(r['barcode_end_range']).groups()[1])
+            covered.extend((r['item'], f"MY{n:06d}") for n in range(first, last + 1))
+        is_equal = covered == [(l['item'], l['barcode']) for l in labels]
+        print(f"Validation: {time.perf_counter() - start_validation:.6f} seconds, ranges cover exactly the given labels: {is_equal}")
+        return is_equal
+    return None
+
+
 def check_label_range(item, prefix, first_int, second_int):
     """
     Check if the given integers are both in the range of the Label Range of the given Item.
     """
-    if not frappe.db.exists("Label Range", item):
+    label_range = get_label_range(item)
+    if not label_range:
         frappe.throw(f"There is no Label Range in the ERP for the given Item Code '{item}'.")
-    label_range = frappe.get_doc("Label Range", item)
-    if label_range.prefix and label_range.prefix != prefix:
-        frappe.throw(f"The Label Range of the given Item Code '{item}' has prefix '{label_range.prefix}' "
+    if label_range['prefix'] and label_range['prefix'] != prefix:
+        frappe.throw(f"The Label Range of the given Item Code '{item}' has prefix '{label_range['prefix']}' "
                      f"but the given barcode_start_range and barcode_end_range have prefix '{prefix}'.")
-    start_is_in_range = False
-    end_is_in_range = False
-    ranges = label_range.range.split(',')
-    for r in ranges:
-        parts = r.split('-')
-        start = int(parts[0].strip())
-        end = int(parts[1].strip())
-        if start <= first_int <= end:
-            start_is_in_range = True
-        if start <= second_int <= end:
-            end_is_in_range = True
-    if not (start_is_in_range and end_is_in_range):
+    if not (find_interval(label_range, first_int) and find_interval(label_range, second_int)):
         frappe.throw(f"Either {first_int} or {second_int} or both are out of range for the Label Range of the given Item '{item}'.")
 
 
-def check_and_unfold_label_range(barcode_start_range, barcode_end_range, item):
+def parse_label_range(barcode_start_range, barcode_end_range, item):
     """
-    Returns a list of all barcode labels from barcode_start_range to barcode_end_range (including both)
+    Check the given label range and return its prefix, the length of its number part and its numeric bounds
 
-    bench execute microsynth.microsynth.webshop.check_and_unfold_label_range --kwargs "{'barcode_start_range': 'MY00001', 'barcode_end_range': 'MY00011', 'item': None}"
+    bench execute microsynth.microsynth.api.webshop.label.parse_label_range --kwargs "{'barcode_start_range': 'MY00001', 'barcode_end_range': 'MY00011', 'item': None}"
     """
     try:
         number_length = len(barcode_start_range)
@@ -287,17 +365,20 @@ def check_and_unfold_label_range(barcode_start_range, barcode_end_range, item):
         second_int = int(second_split[1])
     if first_int > second_int:
         frappe.throw(f"The given barcode_start_range must be smaller or equal than the given barcode_end_range.")
+    if second_int > LABEL_NUMBER_MAX:
+        frappe.throw(f"The given barcode_end_range exceeds the largest supported label number {LABEL_NUMBER_MAX}.")
     if item:
         check_label_range(item, prefix, first_int, second_int)
-    barcodes = []
-    for n in range(first_int, second_int + 1):
-        barcodes.append(f"{prefix}{n:0{number_length}d}" if prefix else f"{n:0{number_length}d}")
-    return barcodes
+    return prefix, number_length, first_int, second_int
+
+
+def format_barcode(prefix, number_length, number):
+    return f"{prefix}{number:0{number_length}d}" if prefix else f"{number:0{number_length}d}"
 
 
 def check_and_get_sequencing_labels(registered_to, item, barcode_start_range, barcode_end_range):
     """
-    Check the given parameters, check and unfold the given label range, return the Sequencing Labels as a list of dictionaries
+    Check the given parameters, check the given label range, return the Sequencing Labels as a list of dictionaries
 
     bench execute microsynth.microsynth.webshop.check_and_get_sequencing_labels --kwargs "{'registered_to': '215856', 'item': '3000', 'barcode_start_range': '96858440', 'barcode_end_range': '96858444'}"
     """
@@ -306,12 +387,13 @@ def check_and_get_sequencing_labels(registered_to, item, barcode_start_range, ba
     if item:
         if not frappe.db.exists("Item", item):
             return {'success': False, 'message': "Failed to get sequencing labels.", 'internal_message': f"The given Item '{item}' does not exist in the ERP.", 'ranges': None}
-        item_condition = f"AND `item` = %s"
+        item_condition = f"AND `item` = %(item)s"
     else:
         item_condition = ""
     # check given label range
-    barcodes = check_and_unfold_label_range(barcode_start_range, barcode_end_range, item)
+    prefix, number_length, first_int, second_int = parse_label_range(barcode_start_range, barcode_end_range, item)
 
+    # select on the numeric bounds instead of unfolding all barcodes
     sql_query = f"""
         SELECT `name`,
             `item`,
@@ -321,10 +403,19 @@ def check_and_get_sequencing_labels(registered_to, item, barcode_start_range, ba
             `contact`,
             `registered_to`
         FROM `tabSequencing Label`
-        WHERE `label_id` IN ({','.join(['%s'] * len(barcodes))})
+        WHERE `label_number` BETWEEN %(first_int)s AND %(second_int)s
+            AND `label_id` LIKE %(prefix)s
             {item_condition}
         ;"""
-    return frappe.db.sql(sql_query, barcodes + ([item] if item else []), as_dict=True)
+    sequencing_labels = frappe.db.sql(sql_query, {
+        'first_int': first_int,
+        'second_int': second_int,
+        'prefix': f"{prefix}%",
+        'item': item
+    }, as_dict=True)
+    # only keep exact barcodes of the range (same prefix and zero padding as the unfolded range)
+    return [label for label in sequencing_labels
+            if label['barcode'].lower() == format_barcode(prefix, number_length, get_label_number(label['barcode'])).lower()]
 
 
 @frappe.whitelist()
@@ -105,20 +105,240 @@ def get_applicable_customer_credits(customer, company, credit_accounts):
 
 def get_credit_account_balance(credit_account_id):
     """
-    Get the current balance of the given Credit Account.
-    """
-    credit_account_doc = frappe.get_doc("Credit Account", credit_account_id)
-    filters = {
-        'credit_account': credit_account_id,
-        'company': credit_account_doc.company,
-        'customer': credit_account_doc.customer,
-        'exclude_unpaid_deposits': True
-    }
-    transactions = build_transactions_with_running_balance(filters)
+    Get the current balance of the given Credit Account from the Credit Account Balance ledger.
+    Falls back to computing (and storing) the balance if the ledger has no entry yet.
+
+    bench execute microsynth.microsynth.credits.get_credit_account_balance --kwargs "{'credit_account_id': 'CA-000003'}"
+    """
+    balances = frappe.db.sql("""
+        SELECT `balance`
+        FROM `tabCredit Account Balance`
+        WHERE `credit_account` = %(credit_account)s
+        ORDER BY `date` DESC
+        LIMIT 1
+        """, {'credit_account': credit_account_id}, as_dict=True)
+
+    if len(balances) > 0:
+        return round(flt(balances[0]['balance']), 2)
+
+    return update_credit_account_balance(credit_account_id)
+
+
+def get_credit_account_balances(credit_account_ids):
+    """
+    Get the current balances of the given Credit Accounts from the Credit Account Balance ledger with a single query.
+    Returns a dictionary Credit Account ID -> balance.
+
+    bench execute microsynth.microsynth.credits.get_credit_account_balances --kwargs "{'credit_account_ids': ['CA-000003', 'CA-000004']}"
+    """
+    credit_account_ids = list(set(credit_account_ids or []))
+    if len(credit_account_ids) == 0:
+        return {}
 
-    current_balance = transactions[-1].get('balance') if len(transactions) > 0 else 0.0
+    balances = frappe.db.sql("""
+        SELECT `tabCredit Account Balance`.`credit_account`,
+            `tabCredit Account Balance`.`balance`
+        FROM `tabCredit Account Balance`
+        JOIN (
+            SELECT `credit_account`, MAX(`date`) AS `date`
+            FROM `tabCredit Account Balance`
+            WHERE `credit_account` IN %(credit_accounts)s
+            GROUP BY `credit_account`
+        ) AS `latest` ON `latest`.`credit_account` = `tabCredit Account Balance`.`credit_account`
+            AND `latest`.`date` = `tabCredit Account Balance`.`date`
+        """, {'credit_accounts': credit_account_ids}, as_dict=True)
 
-    return round(current_balance, 2)
+    result = { b['credit_account']: round(flt(b['balance']), 2) for b in balances }
+    for credit_account_id in credit_account_ids:
+        if credit_account_id not in result:
+            result[credit_account_id] = update_credit_account_balance(credit_account_id)
+    return result
+
+
+def compute_credit_account_balance(credit_account_id):
+    """
+    Compute the balance of the given Credit Account with a single aggregate query.
+    Applies the same rules as build_transactions_with_running_balance with 'exclude_unpaid_deposits':
+    deposits only count once paid, allocations count as soon as the invoice is submitted.
+
+    bench execute microsynth.microsynth.credits.compute_credit_account_balance --kwargs "{'credit_account_id': 'CA-000003'}"
+    """
+    credit_account = frappe.get_value("Credit Account", credit_account_id, ['company', 'customer'], as_dict=True)
+    if not credit_account:
+        frappe.throw(f"Credit Account '{credit_account_id}' does not exist.", "credits.compute_credit_account_balance")
+
+    balance = frappe.db.sql("""
+        SELECT SUM(`raw`.`net_amount`) AS `balance`
+        FROM (
+            SELECT `tabSales Invoice Item`.`net_amount` AS `net_amount`
+            FROM `tabSales Invoice Item`
+            JOIN `tabSales Invoice` ON `tabSales Invoice Item`.`parent` = `tabSales Invoice`.`name`
+            WHERE
+                `tabSales Invoice`.`docstatus` = 1
+                AND `tabSales Invoice Item`.`item_code` = %(credit_item)s
+                AND `tabSales Invoice`.`customer` = %(customer)s
+                AND `tabSales Invoice`.`company` = %(company)s
+                AND `tabSales Invoice`.`credit_account` = %(credit_account)s
+                AND `tabSales Invoice`.`status` IN ('Paid', 'Return', 'Credit Note Issued')
+
+            UNION ALL SELECT
+                (IF(`tabSales Invoice`.`is_return` = 1, 1, -1) * `tabSales Invoice Customer Credit`.`allocated_amount`) AS `net_amount`
+            FROM `tabSales Invoice Customer Credit`
+            JOIN `tabSales Invoice` ON `tabSales Invoice Customer Credit`.`parent` = `tabSales Invoice`.`name`
+            JOIN `tabSales Invoice` AS `deposit_invoice` ON `deposit_invoice`.`name` = `tabSales Invoice Customer Credit`.`sales_invoice`
+            WHERE
+                `tabSales Invoice`.`docstatus` = 1
+                AND `tabSales Invoice`.`customer` = %(customer)s
+                AND `tabSales Invoice`.`company` = %(company)s
+                AND `deposit_invoice`.`credit_account` = %(credit_account)s
+        ) AS `raw`
+        """, {
+            'credit_item': frappe.get_value("Microsynth Settings", "Microsynth Settings", "credit_item"),
+            'customer': credit_account['customer'],
+            'company': credit_account['company'],
+            'credit_account': credit_account_id
+        }, as_dict=True)
+
+    return round(flt(balance[0]['balance']) if len(balance) > 0 else 0.0, 2)
+
+
+def update_credit_account_balance(credit_account_id, snapshot_date=None):
+    """
+    Recompute the balance of the given Credit Account and store it in the daily snapshot of the Credit Account Balance ledger.
+    There is at most one ledger entry per Credit Account and day, later updates on the same day overwrite the snapshot.
+
+    bench execute microsynth.microsynth.credits.update_credit_account_balance --kwargs "{'credit_account_id': 'CA-000003'}"
+    """
+    snapshot_date = getdate(snapshot_date or today())
+    balance = compute_credit_account_balance(credit_account_id)
+
+    existing = frappe.get_all("Credit Account Balance",
+                              filters={'credit_account': credit_account_id, 'date': snapshot_date},
+                              fields=['name'])
+    if len(existing) > 0:
+        frappe.db.set_value("Credit Account Balance", existing[0]['name'], 'balance', balance, update_modified=True)
+    else:
+        credit_account = frappe.get_value("Credit Account", credit_account_id, ['company', 'customer', 'currency'], as_dict=True)
+        frappe.get_doc({
+            'doctype': "Credit Account Balance",
+            'credit_account': credit_account_id,
+            'company': credit_account['company'],
+            'customer': credit_account['customer'],
+            'currency': credit_account['currency'],
+            'date': snapshot_date,
+            'balance': balance
+        }).insert(ignore_permissions=True)
+    return balance
+
+
+def get_affected_credit_accounts(sales_invoice):
+    """
+    Return the set of Credit Accounts whose balance depends on the given Sales Invoice:
+    the Credit Account of a deposit invoice (or its return) and the Credit Accounts of all allocated deposit invoices.
+    """
+    credit_accounts = set()
+    if sales_invoice.get('credit_account'):
+        credit_accounts.add(sales_invoice.get('credit_account'))
+
+    deposit_invoices = [ credit.sales_invoice for credit in (sales_invoice.get('customer_credits') or []) if credit.sales_invoice ]
+    if len(deposit_invoices) > 0:
+        for deposit_invoice in frappe.get_all("Sales Invoice",
+                                              filters=[['name', 'IN', deposit_invoices]],
+                                              fields=['credit_account']):
+            if deposit_invoice['credit_account']:
+                credit_accounts.add(deposit_invoice['credit_account'])
+    return credit_accounts
+
+
+def update_credit_account_balances(sales_invoice):
+    """
+    Update the Credit Account Balance ledger for all Credit Accounts affected by the given Sales Invoice.
+    Errors are logged and must not block the submission or cancellation of the Sales Invoice,
+    the ledger is corrected by reconcile_credit_account_balances.
+    """
+    if type(sales_invoice) == str:
+        sales_invoice = frappe.get_doc("Sales Invoice", sales_invoice)
+    for credit_account_id in get_affected_credit_accounts(sales_invoice):
+        try:
+            update_credit_account_balance(credit_account_id)
+        except Exception as err:
+            frappe.log_error(f"Unable to update the balance of Credit Account '{credit_account_id}' for Sales Invoice '{sales_invoice.name}': {err}\n\n{frappe.get_traceback()}",
+                             "credits.update_credit_account_balances")
+
+
+def update_deposit_credit_account_balances(payment_entry, event=None):
+    """
+    Update the Credit Account Balance ledger for paid deposit invoices (deposits only count once they are paid).
+    Called on_submit and on_cancel of a Payment Entry, see hooks.py
+    """
+    sales_invoices = [ ref.reference_name for ref in payment_entry.references if ref.reference_doctype == "Sales Invoice" ]
+    if len(sales_invoices) == 0:
+        return
+    deposit_invoices = frappe.get_all("Sales Invoice",
+                                      filters=[['name', 'IN', sales_invoices], ['credit_account', 'is', 'set']],
+                                      fields=['name'])
+    for deposit_invoice in deposit_invoices:
+        update_credit_account_balances(deposit_invoice['name'])
+
+
+def rebuild_credit_account_balances():
+    """
+    Recompute the current balance of all Credit Accounts and store it in the Credit Account Balance ledger.
+
+    bench execute microsynth.microsynth.credits.rebuild_credit_account_balances
+    """
+    credit_accounts = frappe.get_all("Credit Account", fields=['name'])
+    for i, credit_account in enumerate(credit_accounts):
+        update_credit_account_balance(credit_account['name'])
+        if i % 100 == 0:
+            frappe.db.commit()
+            print(f"{i}/{len(credit_accounts)}: {credit_account['name']}")
+    frappe.db.commit()
+
+
+def reconcile_credit_account_balances(repair=True):
+    """
+    Check the Credit Account Balance ledger against the Customer Credits report and log all differences.
+    With repair=True, differing ledger entries are overwritten with the balance from the report.
+
+    Should be run by a daily cronjob in the evening:
+    30 16 * * * cd /home/frappe/frappe-bench && /usr/local/bin/bench --site erp.microsynth.local execute microsynth.microsynth.credits.reconcile_credit_account_balances
+
+    bench execute microsynth.microsynth.credits.reconcile_credit_account_balances --kwargs "{'repair': False}"
+    """
+    credit_accounts = frappe.get_all("Credit Account", fields=['name', 'company', 'customer'])
+    differences = []
+
+    for credit_account in credit_accounts:
+        filters = {
+            'credit_account': credit_account['name'],
+            'company': credit_account['company'],
+            'customer': credit_account['customer'],
+            'exclude_unpaid_deposits': True
+        }
+        transactions = build_transactions_with_running_balance(filters)
+        report_balance = round(transactions[-1].get('balance') if len(transactions) > 0 else 0.0, 2)
+        ledger_balance = get_credit_account_balance(credit_account['name'])
+
+        if abs(report_balance - ledger_balance) >= 0.01:
+            differences.append({
+                'credit_account': credit_account['name'],
+                'ledger_balance': ledger_balance,
+                'report_balance': report_balance
+            })
+            if cint(repair):
+                update_credit_account_balance(credit_account['name'])
+
+    if len(differences) > 0:
+        details = "\n".join([ f"{d['credit_account']}: ledger {d['ledger_balance']:.2f}, report {d['report_balance']:.2f}" for d in differences ])
+        frappe.log_error(f"{len(differences)} Credit Account Balance(s) differ from the Customer Credits report:\n{details}",
+                         "credits.reconcile_credit_account_balances")
+    frappe.db.commit()
+
+    return {
+        'checked': len(credit_accounts),
+        'differences': differences
+    }
 
 
 def get_credit_accounts(sales_order_id):
@@ -432,6 +652,7 @@ def sales_invoice_on_submit(sales_invoice, event=None):
         frappe.get_value("Microsynth Settings", "Microsynth Settings", "credit_item"))
     validate_invoice_credit_account(sales_invoice, credit_item, event)
     book_credit(sales_invoice, credit_item, event)
+    update_credit_account_balances(sales_invoice)
 
 
 def reverse_credit(sales_invoice, net_amount):
@@ -522,6 +743,8 @@ def cancel_credit_journal_entry(sales_invoice, event=None):
     if type(sales_invoice) == str:
         sales_invoice = frappe.get_doc("Sales Invoice", sales_invoice)
 
+    update_credit_account_balances(sales_invoice)
+
     if flt(sales_invoice.total_customer_credit) <= 0:            # if this invoice has no applied customer credit, skip
         return None
 
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Microsynth, libracore and contributors and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Contact Search Index', {
+	// refresh: function(frm) {
+
+	// }
+});
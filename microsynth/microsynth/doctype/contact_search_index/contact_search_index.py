@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Microsynth, libracore and contributors and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+import hashlib
+import time
+import unicodedata
+from frappe.model.document import Document
+from frappe.utils import cint, cstr, now
+
+# searchable fields: (Customer Finder filter = index column, trigram code or None if only searched with LIKE)
+SEARCH_FIELDS = [
+    ('contact_name', '01'),
+    ('contact_full_name', '02'),
+    ('contact_email', '03'),
+    ('customer', '04'),
+    ('contact_institute', '05'),
+    ('contact_institute_key', '06'),
+    ('contact_department', '07'),
+    ('contact_group_leader', '08'),
+    ('address_city', '09'),
+    ('address_street', '10'),
+    ('tax_id', '11'),
+    ('address_country', None),
+    ('price_list', None),
+    ('account_manager', None)
+]
+INDEX_COLUMNS = ['name', 'creation', 'modified', 'modified_by', 'owner', 'docstatus',
+                 'contact', 'customer_id', 'address', 'address_type', 'status', 'contact_classification',
+                 'customer_status', 'customer_disabled', 'first_name', 'last_name', 'trigrams'] + [f[0] for f in SEARCH_FIELDS]
+FULLTEXT_INDEX = "trigrams_fulltext"
+INDEX_BATCH_SIZE = 1000
+CANDIDATE_LIMIT = 200
+
+
+class ContactSearchIndex(Document):
+    pass
+
+
+def normalize_search_value(value):
+    """
+    Lower case, remove accents and everything that is not a letter or a digit: "Müller-Lüdenscheidt" -> "mullerludenscheidt"
+    """
+    if not value:
+        return ""
+    value = unicodedata.normalize('NFKD', cstr(value))
+    return "".join(c for c in value if c.isalnum()).lower()
+
+
+def get_trigrams(value):
+    """
+    Returns the set of trigrams of a normalized value
+    """
+    return set(value[i:i + 3] for i in range(len(value) - 2))
+
+
+def get_similarity(value_1, value_2):
+    """
+    Jaccard similarity of the trigrams of two normalized values between 0 and 1
+    """
+    if not value_1 or not value_2:
+        return 0
+    if value_1 == value_2:
+        return 1
+    trigrams_1 = get_trigrams(value_1)
+    trigrams_2 = get_trigrams(value_2)
+    if not trigrams_1 or not trigrams_2:
+        return 0
+    return len(trigrams_1 & trigrams_2) / len(trigrams_1 | trigrams_2)
+
+
+def get_match_score(query, value):
+    """
+    Rank of a normalized value containing the normalized query: exact matches first, then prefix matches, then by covered length
+    """
+    if not value:
+        return 0
+    score = len(query) / len(value)
+    if value == query:
+        score += 2
+    elif value.startswith(query):
+        score += 1
+    return score
+
+
+def get_trigram_tokens(code, value):
+    """
+    Returns the FULLTEXT tokens of a normalized value. The code prefix keeps the fields apart and
+    prevents that tokens are dropped as stopwords or for being shorter than innodb_ft_min_token_size.
+    """
+    return ["{0}{1}".format(code, trigram) for trigram in sorted(get_trigrams(value))]
+
+
+def has_fulltext_index():
+    return len(frappe.db.sql("""
+        SHOW INDEX FROM `tabContact Search Index` WHERE `Key_name` = %(key)s;
+        """, {'key': FULLTEXT_INDEX})) > 0
+
+
+def get_index_name(contact, customer_id):
+    """
+    Returns the name of the Contact Search Index row of a Contact-Customer link
+    """
+    key = "|".join([contact or "", customer_id or ""])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def get_index_row(source, timestamp, user):
+    """
+    Build the Contact Search Index row of a source row from the Contact/Customer/Address join
+    """
+    row = {
+        'name': get_index_name(source['contact'], source['customer_id']),
+        'creation': timestamp,
+        'modified': timestamp,
+        'modified_by': user,
+        'owner': user,
+        'docstatus': 0,
+        'contact': source['contact'],
+        'customer_id': source['customer_id'],
+        'address': source['address'],
+        'address_type': source['address_type'],
+        'status': source['status'],
+        'contact_classification': source['contact_classification'],
+        'customer_status': source['customer_status'],
+        'customer_disabled': cint(source['customer_disabled']),
+        'first_name': normalize_search_value(source['first_name'])[:140],
+        'last_name': normalize_search_value(source['last_name'])[:140]
+    }
+    tokens = []
+    for fieldname, code in SEARCH_FIELDS:
+        # Data fields are limited to 140 characters, the trigrams cover the full value
+        value = normalize_search_value(source[fieldname])
+        row[fieldname] = value[:140]
+        if code:
+            tokens += get_trigram_tokens(code, value)
+    row['trigrams'] = " ".join(tokens)
+    return row
+
+
+def get_index_sources(contacts):
+    """
+    Returns the searchable values of the given Contacts from the same join as the Customer Finder used before:
+    one source per Contact-Customer link, a Contact without Customer has one source without Customer.
+    """
+    if not contacts:
+        return []
+    return frappe.db.sql("""
+        SELECT
+            `tabContact`.`name` AS `contact`,
+            `tabContact`.`name` AS `contact_name`,
+            `tabContact`.`full_name` AS `contact_full_name`,
+            `tabContact`.`first_name` AS `first_name`,
+            `tabContact`.`last_name` AS `last_name`,
+            `tabContact`.`email_id` AS `contact_email`,
+            `tabContact`.`institute` AS `contact_institute`,
+            `tabContact`.`institute_key` AS `contact_institute_key`,
+            `tabContact`.`department` AS `contact_department`,
+            `tabContact`.`group_leader` AS `contact_group_leader`,
+            `tabContact`.`status` AS `status`,
+            `tabContact`.`contact_classification` AS `contact_classification`,
+            `tabContact`.`customer_status` AS `customer_status`,
+            `tabContact`.`address` AS `address`,
+            `tabAddress`.`address_type` AS `address_type`,
+            `tabAddress`.`country` AS `address_country`,
+            `tabAddress`.`city` AS `address_city`,
+            `tabAddress`.`address_line1` AS `address_street`,
+            `tabCustomer`.`name` AS `customer_id`,
+            `tabCustomer`.`customer_name` AS `customer`,
+            `tabCustomer`.`disabled` AS `customer_disabled`,
+            `tabCustomer`.`default_price_list` AS `price_list`,
+            `tabCustomer`.`tax_id` AS `tax_id`,
+            `tabCustomer`.`account_manager` AS `account_manager`
+        FROM `tabContact`
+        LEFT JOIN `tabDynamic Link` AS `tDLA` ON `tDLA`.`parent` = `tabContact`.`name`
+                                            AND `tDLA`.`parenttype`  = "Contact"
+                                            AND `tDLA`.`link_doctype` = "Customer"
+        LEFT JOIN `tabCustomer` ON `tabCustomer`.`name` = `tDLA`.`link_name`
+        LEFT JOIN `tabAddress` ON `tabContact`.`address` = `tabAddress`.`name`
+        WHERE `tabContact`.`name` IN %(contacts)s
+        ORDER BY `tabContact`.`name` ASC, `tDLA`.`idx` ASC;
+        """, {'contacts': contacts}, as_dict=True)
+
+
+def write_index_rows(sources):
+    """
+    Insert or replace the index rows of the given sources, returns the names of the rows
+    """
+    timestamp = now()
+    user = frappe.session.user
+    rows = [get_index_row(source, timestamp, user) for source in sources]
+    if not rows:
+        return []
+    frappe.db.sql("""
+        REPLACE INTO `tabContact Search Index` ({columns})
+        VALUES {values};
+        """.format(
+            columns=", ".join("`{0}`".format(c) for c in INDEX_COLUMNS),
+            values=", ".join(["({0})".format(", ".join(["%s"] * len(INDEX_COLUMNS)))] * len(rows))),
+        [row[c] for row in rows for c in INDEX_COLUMNS])
+    return [row['name'] for row in rows]
+
+
+def update_contact_search_index(contacts):
+    """
+    Refresh the Contact Search Index of the given Contacts, removes the rows of deleted Contacts and removed Customer links
+    """
+    contacts = list(set(contacts or []))
+    for i in range(0, len(contacts), INDEX_BATCH_SIZE):
+        batch = contacts[i:i + INDEX_BATCH_SIZE]
+        names = write_index_rows(get_index_sources(batch))
+        frappe.db.sql(f"""
+            DELETE FROM `tabContact Search Index`
+            WHERE `contact` IN %(contacts)s
+                {"AND `name` NOT IN %(names)s" if names else ""};
+            """, {'contacts': batch, 'names': names})
+
+
+def rebuild_contact_search_index():
+    """
+    Rebuild the Contact Search Index of all Contacts. Changes done without saving a document (e.g. frappe.db.set_value)
+    are not caught by the hooks, therefore run it nightly by a cronjob:
+
+    bench execute microsynth.microsynth.doctype.contact_search_index.contact_search_index.rebuild_contact_search_index
+
+    The rows are replaced in place and the orphaned rows (not written since the start) are deleted at the end,
+    all in one transaction, so that the Customer Finder keeps searching the complete previous index meanwhile.
+    """
+    start_time = time.perf_counter()
+    start = now()
+    last_contact = ""
+    count = 0
+    while True:
+        contacts = [c['name'] for c in frappe.db.sql("""
+            SELECT `name`
+            FROM `tabContact`
+            WHERE `name` > %(last_contact)s
+            ORDER BY `name` ASC
+            LIMIT %(limit)s;
+            """, {'last_contact': last_contact, 'limit': INDEX_BATCH_SIZE}, as_dict=True)]
+        if not contacts:
+            break
+        count += len(write_index_rows(get_index_sources(contacts)))
+        last_contact = contacts[-1]
+    frappe.db.sql("""DELETE FROM `tabContact Search Index` WHERE `modified` < %(start)s;""", {'start': start})
+    frappe.db.commit()
+    print(f"Indexed {count} Contact-Customer links in {time.perf_counter() - start_time:.1f} s.")
+
+
+def contact_on_update(contact, event=None):
+    """
+    Called on_update of a Contact, see hooks.py
+    """
+    update_contact_search_index([contact.name])
+
+
+def contact_on_trash(contact, event=None):
+    frappe.db.sql("""DELETE FROM `tabContact Search Index` WHERE `contact` = %(contact)s;""", {'contact': contact.name})
+
+
+def contact_after_rename(contact, event, old, new, merge=False):
+    frappe.db.sql("""DELETE FROM `tabContact Search Index` WHERE `contact` = %(old)s;""", {'old': old})
+    update_contact_search_index([new])
+
+
+def has_changed(doc, fieldnames):
+    before = doc.get_doc_before_save()
+    if not before:
+        return True
+    return any(cstr(doc.get(f)) != cstr(before.get(f)) for f in fieldnames)
+
+
+def address_on_update(address, event=None):
+    """
+    Called on_update of an Address, refreshes the Contacts using this Address
+    """
+    if not has_changed(address, ['address_type', 'country', 'city', 'address_line1']):
+        return
+    contacts = frappe.get_all("Contact", filters={'address': address.name}, fields=['name'])
+    update_contact_search_index([c['name'] for c in contacts])
+
+
+def customer_on_update(customer, event=None):
+    """
+    Called on_update of a Customer, refreshes the Contacts linked to this Customer
+    """
+    if not has_changed(customer, ['customer_name', 'disabled', 'default_price_list', 'tax_id', 'account_manager']):
+        return
+    contacts = frappe.db.sql("""
+        SELECT `parent`
+        FROM `tabDynamic Link`
+        WHERE `parenttype` = "Contact"
+            AND `link_doctype` = "Customer"
+            AND `link_name` = %(customer)s;
+        """, {'customer': customer.name}, as_dict=True)
+    update_contact_search_index([c['parent'] for c in contacts])
+
+
+def search_contacts(filters, start=0, page_length=None):
+    """
+    Returns the names of the Contact Search Index rows (Contact-Customer links) matching the Customer Finder filters,
+    best matches first.
+
+    Every text filter matches if its normalized value is contained in the normalized field. Trigram fields are
+    preselected with the FULLTEXT index, without the index (pure Python fallback) the normalized columns are scanned.
+    """
+    conditions = []
+    values = {}
+    queries = {}
+    tokens = []
+    if not filters.get('include_disabled'):
+        conditions.append("`customer_id` IS NOT NULL AND `customer_disabled` = 0")
+    if filters.get('customer_id'):
+        conditions.append("`customer_id` = %(customer_id)s")
+        values['customer_id'] = filters.get('customer_id')
+    for filter_name, column in [('contact_status', 'status'),
+                                ('contact_classification', 'contact_classification'),
+                                ('customer_status', 'customer_status')]:
+        if filters.get(filter_name):
+            conditions.append(f"`{column}` = %({filter_name})s")
+            values[filter_name] = filters.get(filter_name)
+    for fieldname, code in SEARCH_FIELDS:
+        if not filters.get(fieldname):
+            continue
+        query = normalize_search_value(filters.get(fieldname))[:140]
+        queries[fieldname] = query
+        conditions.append(f"`{fieldname}` LIKE %({fieldname})s")
+        values[fieldname] = f"%{query}%"
+        if code:
+            tokens += ["+{0}".format(t) for t in get_trigram_tokens(code, query)]
+    if tokens and has_fulltext_index():
+        conditions.append("MATCH (`trigrams`) AGAINST (%(tokens)s IN BOOLEAN MODE)")
+        values['tokens'] = " ".join(tokens)
+
+    columns = ", ".join(["`name`", "`contact`", "`customer_id`"] + [f"`{fieldname}`" for fieldname in queries])
+    matches = frappe.db.sql(f"""
+        SELECT {columns}
+        FROM `tabContact Search Index`
+        WHERE {" AND ".join(conditions) or "TRUE"};
+        """, values, as_dict=True)
+
+    for match in matches:
+        match['score'] = sum(get_match_score(query, match[fieldname]) for fieldname, query in queries.items())
+    matches.sort(key=lambda m: (-m['score'], m['contact'], m['customer_id'] or ""))
+    end = (cint(start) + cint(page_length)) if page_length else None
+    return [m['name'] for m in matches[cint(start):end]]
+
+
+def get_potential_duplicates(contact):
+    """
+    Returns the Contacts that are not disabled and have the same address type and the same email or first and last name
+    (compared normalized) as the given Contact document
+    """
+    address_type = frappe.get_value("Address", contact.address, "address_type")
+    email = normalize_search_value(contact.email_id)[:140]
+    first_name = normalize_search_value(contact.first_name)[:140]
+    last_name = normalize_search_value(contact.last_name)[:140]
+    conditions = []
+    if email:
+        conditions.append("`tabContact Search Index`.`contact_email` = %(email)s")
+    if first_name or last_name:
+        conditions.append("(`tabContact Search Index`.`first_name` = %(first_name)s AND `tabContact Search Index`.`last_name` = %(last_name)s)")
+    if not address_type or not conditions:
+        return []
+    return frappe.db.sql(f"""
+        SELECT DISTINCT `tabContact`.`name`,
+            `tabContact`.`first_name`,
+            `tabContact`.`last_name`,
+            `tabContact`.`institute`
+        FROM `tabContact Search Index`
+        JOIN `tabContact` ON `tabContact`.`name` = `tabContact Search Index`.`contact`
+        WHERE `tabContact Search Index`.`status` != 'Disabled'
+            AND ({" OR ".join(conditions)})
+            AND `tabContact Search Index`.`address_type` = %(address_type)s
+            AND `tabContact Search Index`.`contact` != %(contact)s
+        ORDER BY `tabContact`.`name` ASC;
+        """, {
+            'email': email,
+            'first_name': first_name,
+            'last_name': last_name,
+            'address_type': address_type,
+            'contact': contact.name
+        }, as_dict=True)
+
+
+def get_similar_contacts(contact_id, limit=10, min_similarity=0.5):
+    """
+    Returns Contacts with the same address type and a similar name or the same email as the given Contact, most similar first.
+
+    bench execute microsynth.microsynth.doctype.contact_search_index.contact_search_index.get_similar_contacts --kwargs "{'contact_id': '215856'}"
+    """
+    entry = frappe.db.sql("""
+        SELECT `contact`, `contact_full_name`, `contact_email`, `address_type`
+        FROM `tabContact Search Index`
+        WHERE `contact` = %(contact)s
+        LIMIT 1;
+        """, {'contact': contact_id}, as_dict=True)
+    if not entry or not entry[0]['address_type']:
+        return []
+    entry = entry[0]
+    values = {
+        'contact': contact_id,
+        'address_type': entry['address_type'],
+        'email': entry['contact_email'] or None,
+        'full_name': entry['contact_full_name'],
+        'limit': CANDIDATE_LIMIT
+    }
+    tokens = get_trigram_tokens('02', entry['contact_full_name'] or "")
+    if tokens and has_fulltext_index():
+        # any trigram of the name, the most relevant first
+        values['tokens'] = " ".join(tokens)
+        name_condition = "MATCH (`trigrams`) AGAINST (%(tokens)s IN BOOLEAN MODE)"
+        order = "MATCH (`trigrams`) AGAINST (%(tokens)s IN BOOLEAN MODE) DESC"
+    else:
+        name_condition = "`contact_full_name` = %(full_name)s"
+        order = "`contact` ASC"
+    candidates = frappe.db.sql(f"""
+        SELECT `contact`, `contact_full_name`, `contact_email`
+        FROM `tabContact Search Index`
+        WHERE `address_type` = %(address_type)s
+            AND `status` != 'Disabled'
+            AND `contact` != %(contact)s
+            AND ({name_condition} OR `contact_email` = %(email)s)
+        ORDER BY {order}
+        LIMIT %(limit)s;
+        """, values, as_dict=True)
+
+    similarities = {}
+    for candidate in candidates:
+        similarity = get_similarity(entry['contact_full_name'], candidate['contact_full_name'])
+        if entry['contact_email'] and entry['contact_email'] == candidate['contact_email']:
+            similarity = 1
+        if similarity >= min_similarity and similarity > similarities.get(candidate['contact'], 0):
+            similarities[candidate['contact']] = similarity
+    similar = [{'name': contact, 'similarity': similarity} for contact, similarity in similarities.items()]
+    similar.sort(key=lambda s: (-s['similarity'], s['name']))
+    similar = similar[:cint(limit)]
+    if not similar:
+        return []
+    details = {c['name']: c for c in frappe.db.sql("""
+        SELECT `name`, `first_name`, `last_name`, `institute`
+        FROM `tabContact`
+        WHERE `name` IN %(contacts)s;
+        """, {'contacts': [s['name'] for s in similar]}, as_dict=True)}
+    for s in similar:
+        s.update(details.get(s['name'], {}))
+    return similar
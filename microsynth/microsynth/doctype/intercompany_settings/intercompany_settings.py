@@ -3,9 +3,15 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
+import frappe
 from frappe.model.document import Document
 
 class IntercompanySettings(Document):
     def validate(self):
         # ToDo: validate that one company can only occur once in the settings child table
         pass
+
+    def on_update(self):
+        # intercompany customers are excluded from the Revenue Facts
+        frappe.enqueue("microsynth.microsynth.doctype.revenue_fact.revenue_fact.rebuild_revenue_facts",
+            queue='long', timeout=3600)
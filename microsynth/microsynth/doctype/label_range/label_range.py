@@ -3,8 +3,105 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
-# import frappe
+import frappe
+from bisect import bisect_right
 from frappe.model.document import Document
 
+LABEL_RANGE_INDEX_KEY = "label_range_index"
+
+
 class LabelRange(Document):
-	pass
+	def validate(self):
+		# make sure the range string can be parsed before it is used by the webshop
+		if self.range:
+			for start, end in parse_range(self.range):
+				if start > end:
+					frappe.throw(f"Invalid range '{start}-{end}': The start must be smaller or equal than the end.")
+
+	def on_update(self):
+		clear_label_range_index()
+
+	def on_trash(self):
+		clear_label_range_index()
+
+	def after_rename(self, old, new, merge=False):
+		clear_label_range_index()
+
+
+def parse_range(range_string):
+	"""
+	Parse a range string like "123-345, 500-1000" into a list of (start, end) tuples of integers.
+	"""
+	ranges = []
+	for r in (range_string or "").split(','):
+		parts = r.split('-')
+		if len(parts) != 2:
+			frappe.throw(f"Unable to parse range '{r.strip()}'. Please define ranges as \"123-345, 500-1000\".")
+		try:
+			ranges.append((int(parts[0].strip()), int(parts[1].strip())))
+		except ValueError:
+			frappe.throw(f"Unable to parse range '{r.strip()}'. Please define ranges as \"123-345, 500-1000\".")
+	return ranges
+
+
+def merge_intervals(ranges):
+	"""
+	Merge overlapping or adjacent (start, end) tuples into a sorted list of disjoint intervals.
+	"""
+	merged = []
+	for start, end in sorted(ranges):
+		if merged and start <= merged[-1][1] + 1:
+			merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+		else:
+			merged.append((start, end))
+	return merged
+
+
+def build_label_range_index():
+	"""
+	Parse all Label Ranges into a dictionary item_code -> {prefix, ranges, starts, ends}.
+	ranges keeps the defined order, starts and ends are the sorted disjoint intervals used for bisection.
+
+	bench execute microsynth.microsynth.doctype.label_range.label_range.build_label_range_index
+	"""
+	index = {}
+	# range is also a SQL key word and needs therefore to be surrounded by backticks:
+	for label_range in frappe.get_all("Label Range", fields=['item_code', 'prefix', '`range`']):
+		ranges = parse_range(label_range['range'])
+		merged = merge_intervals(ranges)
+		index[label_range['item_code']] = {
+			'prefix': label_range['prefix'],
+			'ranges': ranges,
+			'starts': [m[0] for m in merged],
+			'ends': [m[1] for m in merged]
+		}
+	return index
+
+
+def get_label_range_index():
+	"""
+	Return the cached Label Range index, build it if necessary
+	"""
+	return frappe.cache().get_value(LABEL_RANGE_INDEX_KEY, generator=build_label_range_index)
+
+
+def clear_label_range_index():
+	frappe.cache().delete_value(LABEL_RANGE_INDEX_KEY)
+
+
+def get_label_range(item):
+	"""
+	Return the index entry of the Label Range of the given Item or None
+	"""
+	return get_label_range_index().get(item)
+
+
+def find_interval(label_range, number):
+	"""
+	Return the (start, end) interval of the given index entry containing the given number or None. O(log n)
+	"""
+	i = bisect_right(label_range['starts'], number) - 1
+	if i >= 0 and number <= label_range['ends'][i]:
+		return (label_range['starts'][i], label_range['ends'][i])
+	return None
+
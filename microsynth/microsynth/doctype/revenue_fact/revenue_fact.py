@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Microsynth, libracore and contributors and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+import hashlib
+from frappe.model.document import Document
+from frappe.utils import flt, getdate, now
+
+# Base net amount of a Sales Invoice Item in the company currency, corrected for additional discounts
+# and including payments with customer credits (same as in the Sales Overview and the Revenue Export)
+BASE_NET_AMOUNT_SQL = """
+    IF (`tabSales Invoice`.`total` <> 0,
+        IF (`tabSales Invoice`.`is_return` = 1,
+            (`tabSales Invoice Item`.`amount` * (`tabSales Invoice`.`total`  - (`tabSales Invoice`.`discount_amount` + `tabSales Invoice`.`total_customer_credit`)) / `tabSales Invoice`.`total`) * `tabSales Invoice`.`conversion_rate`,
+            (`tabSales Invoice Item`.`amount` * (`tabSales Invoice`.`total`  - (`tabSales Invoice`.`discount_amount` - `tabSales Invoice`.`total_customer_credit`)) / `tabSales Invoice`.`total`) * `tabSales Invoice`.`conversion_rate`
+        ),
+        0
+    )"""
+
+# invoices in EUR of a CHF company or in CHF of a EUR company are converted back with the invoice conversion rate
+CONVERTED_CONDITION_SQL = """
+    ((`tabCompany`.`default_currency` = "CHF" AND `tabSales Invoice`.`currency` = "EUR")
+     OR (`tabCompany`.`default_currency` = "EUR" AND `tabSales Invoice`.`currency` = "CHF"))"""
+
+
+class RevenueFact(Document):
+    pass
+
+
+def get_revenue_fact_name(company, territory, item_group, year, month):
+    """
+    Returns the name of the Revenue Fact of the given key, same as SHA1(CONCAT_WS(...)) in rebuild_revenue_facts
+    """
+    key = "|".join([company or "", territory or "", item_group or "", str(year), str(month)])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def get_intercompany_customers():
+    return [entry['customer'] for entry in frappe.get_all("Intercompany Settings Company", fields=['customer']) if entry['customer']]
+
+
+def rebuild_revenue_facts(year=None):
+    """
+    Rebuild the Revenue Facts from all submitted Sales Invoices (of the given year).
+    Runs in the background after saving the Intercompany Settings and has to be run after changing the credit item in the Microsynth Settings.
+
+    bench execute microsynth.microsynth.doctype.revenue_fact.revenue_fact.rebuild_revenue_facts --kwargs "{'year': 2026}"
+    """
+    values = {
+        'credit_item': frappe.get_value("Microsynth Settings", "Microsynth Settings", "credit_item") or "",
+        'intercompany_customers': get_intercompany_customers(),
+        'now': now(),
+        'user': frappe.session.user
+    }
+    intercompany_condition = ""
+    if values['intercompany_customers']:
+        intercompany_condition = "AND `tabSales Invoice`.`customer` NOT IN %(intercompany_customers)s"
+    year_condition = ""
+    if year:
+        values['year'] = int(year)
+        year_condition = "AND `tabSales Invoice`.`posting_date` BETWEEN CONCAT(%(year)s, '-01-01') AND CONCAT(%(year)s, '-12-31')"
+        frappe.db.sql("""DELETE FROM `tabRevenue Fact` WHERE `year` = %(year)s;""", values)
+    else:
+        frappe.db.sql("""DELETE FROM `tabRevenue Fact`;""")
+
+    frappe.db.sql(f"""
+        INSERT INTO `tabRevenue Fact`
+            (`name`, `creation`, `modified`, `modified_by`, `owner`, `docstatus`,
+             `company`, `territory`, `item_group`, `year`, `month`,
+             `base_net_amount`, `converted_amount`, `exchange_rate_amount`, `qty`)
+        SELECT
+            SHA1(CONCAT_WS('|', `tabSales Invoice`.`company`, IFNULL(`tabSales Invoice`.`territory`, ''), IFNULL(`tabSales Invoice Item`.`item_group`, ''),
+                 YEAR(`tabSales Invoice`.`posting_date`), MONTH(`tabSales Invoice`.`posting_date`))),
+            %(now)s, %(now)s, %(user)s, %(user)s, 0,
+            `tabSales Invoice`.`company`,
+            IFNULL(`tabSales Invoice`.`territory`, ''),
+            IFNULL(`tabSales Invoice Item`.`item_group`, ''),
+            YEAR(`tabSales Invoice`.`posting_date`),
+            MONTH(`tabSales Invoice`.`posting_date`),
+            SUM({BASE_NET_AMOUNT_SQL}),
+            SUM(IF({CONVERTED_CONDITION_SQL}, IFNULL(({BASE_NET_AMOUNT_SQL}) / `tabSales Invoice`.`conversion_rate`, 0), 0)),
+            SUM(IF({CONVERTED_CONDITION_SQL}, 0, {BASE_NET_AMOUNT_SQL})),
+            SUM(`tabSales Invoice Item`.`qty`)
+        FROM `tabSales Invoice Item`
+        JOIN `tabSales Invoice` ON `tabSales Invoice Item`.`parent` = `tabSales Invoice`.`name`
+        JOIN `tabCompany` ON `tabCompany`.`name` = `tabSales Invoice`.`company`
+        WHERE
+            `tabSales Invoice`.`docstatus` = 1
+            AND (`tabSales Invoice`.`invoicing_method` != 'Intercompany' or `tabSales Invoice`.`invoicing_method` is null)
+            {intercompany_condition}
+            AND `tabSales Invoice Item`.`item_code` <> %(credit_item)s
+            {year_condition}
+        GROUP BY
+            `tabSales Invoice`.`company`,
+            IFNULL(`tabSales Invoice`.`territory`, ''),
+            IFNULL(`tabSales Invoice Item`.`item_group`, ''),
+            YEAR(`tabSales Invoice`.`posting_date`),
+            MONTH(`tabSales Invoice`.`posting_date`);
+        """, values)
+    frappe.db.commit()
+
+
+def get_base_net_amount(sales_invoice, item):
+    """
+    Python version of BASE_NET_AMOUNT_SQL for a Sales Invoice Item
+    """
+    total = flt(sales_invoice.total)
+    if total == 0:
+        return 0
+    if sales_invoice.is_return:
+        net_total = total - (flt(sales_invoice.discount_amount) + flt(sales_invoice.total_customer_credit))
+    else:
+        net_total = total - (flt(sales_invoice.discount_amount) - flt(sales_invoice.total_customer_credit))
+    return (flt(item.amount) * net_total / total) * flt(sales_invoice.conversion_rate)
+
+
+def update_revenue_facts(sales_invoice, event=None):
+    """
+    Add the revenue of a submitted Sales Invoice to the Revenue Facts or remove it when the Sales Invoice is cancelled.
+    Called on_submit and on_cancel of a Sales Invoice, see hooks.py
+    """
+    if sales_invoice.invoicing_method == "Intercompany":
+        return
+    intercompany_customers = get_intercompany_customers()
+    if intercompany_customers and (not sales_invoice.customer or sales_invoice.customer in intercompany_customers):
+        return
+    sign = -1 if event == "on_cancel" else 1
+    credit_item = frappe.get_value("Microsynth Settings", "Microsynth Settings", "credit_item") or ""
+    company_currency = frappe.get_cached_value("Company", sales_invoice.company, "default_currency")
+    converted = ((company_currency == "CHF" and sales_invoice.currency == "EUR")
+                 or (company_currency == "EUR" and sales_invoice.currency == "CHF"))
+    posting_date = getdate(sales_invoice.posting_date)
+
+    facts = {}
+    for item in sales_invoice.items:
+        if not item.item_code or item.item_code == credit_item:
+            continue
+        key = (sales_invoice.company, sales_invoice.territory or "", item.item_group or "", posting_date.year, posting_date.month)
+        if not key in facts:
+            facts[key] = {'base_net_amount': 0, 'converted_amount': 0, 'exchange_rate_amount': 0, 'qty': 0}
+        base_net_amount = get_base_net_amount(sales_invoice, item)
+        facts[key]['base_net_amount'] += sign * base_net_amount
+        if converted:
+            if flt(sales_invoice.conversion_rate):
+                facts[key]['converted_amount'] += sign * base_net_amount / flt(sales_invoice.conversion_rate)
+        else:
+            facts[key]['exchange_rate_amount'] += sign * base_net_amount
+        facts[key]['qty'] += sign * flt(item.qty)
+
+    timestamp = now()
+    user = frappe.session.user
+    for (company, territory, item_group, year, month), amounts in facts.items():
+        frappe.db.sql("""
+            INSERT INTO `tabRevenue Fact`
+                (`name`, `creation`, `modified`, `modified_by`, `owner`, `docstatus`,
+                 `company`, `territory`, `item_group`, `year`, `month`,
+                 `base_net_amount`, `converted_amount`, `exchange_rate_amount`, `qty`)
+            VALUES (%(name)s, %(now)s, %(now)s, %(user)s, %(user)s, 0,
+                    %(company)s, %(territory)s, %(item_group)s, %(year)s, %(month)s,
+                    %(base_net_amount)s, %(converted_amount)s, %(exchange_rate_amount)s, %(qty)s)
+            ON DUPLICATE KEY UPDATE
+                `base_net_amount` = `base_net_amount` + VALUES(`base_net_amount`),
+                `converted_amount` = `converted_amount` + VALUES(`converted_amount`),
+                `exchange_rate_amount` = `exchange_rate_amount` + VALUES(`exchange_rate_amount`),
+                `qty` = `qty` + VALUES(`qty`),
+                `modified` = VALUES(`modified`),
+                `modified_by` = VALUES(`modified_by`);
+            """, {
+                'name': get_revenue_fact_name(company, territory, item_group, year, month),
+                'now': timestamp,
+                'user': user,
+                'company': company,
+                'territory': territory,
+                'item_group': item_group,
+                'year': year,
+                'month': month,
+                'base_net_amount': amounts['base_net_amount'],
+                'converted_amount': amounts['converted_amount'],
+                'exchange_rate_amount': amounts['exchange_rate_amount'],
+                'qty': amounts['qty']
+            })
+
+
+def get_revenue_facts(year, company=None, territories=None, item_groups=None):
+    """
+    Returns the Revenue Facts of the given year summed up per Company, Item Group and month
+    """
+    conditions = ""
+    values = {'year': int(year)}
+    if company:
+        conditions += " AND `company` = %(company)s"
+        values['company'] = company
+    if territories:
+        conditions += " AND `territory` IN %(territories)s"
+        values['territories'] = territories
+    if item_groups:
+        conditions += " AND `item_group` IN %(item_groups)s"
+        values['item_groups'] = item_groups
+    return frappe.db.sql(f"""
+        SELECT
+            `company`,
+            `item_group`,
+            `month`,
+            SUM(`base_net_amount`) AS `base_net_amount`,
+            SUM(`converted_amount`) AS `converted_amount`,
+            SUM(`exchange_rate_amount`) AS `exchange_rate_amount`,
+            SUM(`qty`) AS `qty`
+        FROM `tabRevenue Fact`
+        WHERE `year` = %(year)s
+            {conditions}
+        GROUP BY `company`, `item_group`, `month`;
+        """, values, as_dict=True)
@@ -3,8 +3,23 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
-# import frappe
+import re
 from frappe.model.document import Document
 
+# label_number is a Float column (decimal(18,6)) and holds numbers with up to 12 digits exactly
+LABEL_NUMBER_MAX = 999999999999
+
 class SequencingLabel(Document):
-	pass
+	def validate(self):
+		self.label_number = get_label_number(self.label_id)
+
+
+def get_label_number(label_id):
+	"""
+	Return the trailing number of the given barcode as integer (0 if there is none, None if it exceeds LABEL_NUMBER_MAX)
+	"""
+	match = re.search("([0-9]+)$", label_id or "")
+	if not match:
+		return 0
+	number = int(match.group(1))
+	return number if number <= LABEL_NUMBER_MAX else None
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Microsynth, libracore and contributors and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('SLIMS Sync Log', {
+	// refresh: function(frm) {
+
+	// }
+});
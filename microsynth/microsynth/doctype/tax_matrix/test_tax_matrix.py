@@ -3,8 +3,101 @@
 # See license.txt
 from __future__ import unicode_literals
 
-# import frappe
+import frappe
 import unittest
+from datetime import date
+from unittest.mock import patch
+from microsynth.microsynth.taxes import bump_tax_matrix_version, find_tax_template, get_alternative_tax_template
+
+TEST_COMPANY = "_Test Tax Matrix Company"
+
+# (country, category, sales_taxes_template) in the order of the Tax Matrix
+TEST_ENTRIES = [
+	("Germany", "Material", "_Test DE Material"),
+	("EU", "Material", "_Test EU Material"),
+	("%", "Material", "_Test World Material"),
+	("%", "Service", "_Test World Service"),
+	("Switzerland", "Service", "_Test CH Service"),
+	("EU", "Service", "_Test EU Service")
+]
+
+# (tax_template, alternative_tax_template, valid_from)
+TEST_ALTERNATIVES = [
+	("_Test World Material", "_Test World Material 2024", date(2024, 1, 1)),
+	("_Test World Material", "_Test World Material 2018", date(2018, 1, 1)),
+	("_Test World Material", "_Test World Material 2011", date(2011, 1, 1)),
+	("_Test EU Material", "_Test EU Material 2020", date(2020, 7, 1))
+]
+
+TEST_COUNTRIES = {'Germany': 1, 'France': 1, 'Switzerland': 0, 'Japan': 0}
+
+
+def find_tax_template_by_sql(company, country, category):
+	"""
+	Tax Matrix lookup as it was done before the Tax Matrix was compiled
+	"""
+	if frappe.get_value("Country", country, "eu"):
+		eu_pattern = """ OR `country` = "EU" """
+	else:
+		eu_pattern = ""
+	records = frappe.db.sql("""SELECT `sales_taxes_template`
+		FROM `tabTax Matrix Entry`
+		WHERE `company` = %(company)s
+			AND (`country` = %(country)s OR `country` = "%%" {eu_pattern})
+			AND `category` = %(category)s
+		ORDER BY `idx` ASC;""".format(eu_pattern=eu_pattern),
+		{'company': company, 'country': country, 'category': category}, as_dict=True)
+	return records[0]['sales_taxes_template'] if records else None
+
+
+def get_alternative_tax_template_by_sql(tax_template, valid_date):
+	"""
+	Alternative tax template lookup as it was done before, ordered so that the latest valid one is taken
+	"""
+	records = frappe.db.sql("""SELECT `alternative_tax_template`
+		FROM `tabAlternative Tax Template`
+		WHERE `tax_template` = %(tax_template)s
+			AND `valid_from` <= %(date)s
+		ORDER BY `valid_from` DESC, `idx` ASC;""",
+		{'tax_template': tax_template, 'date': valid_date}, as_dict=True)
+	return records[0]['alternative_tax_template'] if records else tax_template
+
 
 class TestTaxMatrix(unittest.TestCase):
-	pass
+	def setUp(self):
+		for idx, (country, category, template) in enumerate(TEST_ENTRIES, 1):
+			frappe.db.sql("""INSERT INTO `tabTax Matrix Entry`
+				(`name`, `parent`, `parenttype`, `parentfield`, `idx`, `company`, `country`, `category`, `sales_taxes_template`)
+				VALUES (%s, "Tax Matrix", "Tax Matrix", "taxes", %s, %s, %s, %s, %s);""",
+				(frappe.generate_hash(length=10), 1000 + idx, TEST_COMPANY, country, category, template))
+		for idx, (template, alternative, valid_from) in enumerate(TEST_ALTERNATIVES, 1):
+			frappe.db.sql("""INSERT INTO `tabAlternative Tax Template`
+				(`name`, `parent`, `parenttype`, `parentfield`, `idx`, `tax_template`, `alternative_tax_template`, `valid_from`)
+				VALUES (%s, "Tax Matrix", "Tax Matrix", "alternative_tax_templates", %s, %s, %s, %s);""",
+				(frappe.generate_hash(length=10), 1000 + idx, template, alternative, valid_from))
+		for country, eu in TEST_COUNTRIES.items():
+			frappe.db.sql("""UPDATE `tabCountry` SET `eu` = %s WHERE `name` = %s;""", (eu, country))
+		bump_tax_matrix_version()
+
+	def tearDown(self):
+		frappe.db.rollback()
+		bump_tax_matrix_version()
+
+	def test_find_tax_template(self):
+		for country in TEST_COUNTRIES:
+			for category in ["Material", "Service"]:
+				with patch.object(frappe, "get_value", side_effect=lambda doctype, name, field, country=country: "Company" if doctype == "Customer" else country):
+					compiled = find_tax_template(TEST_COMPANY, "_Test Customer", "_Test Address", category)
+				self.assertEqual(compiled, find_tax_template_by_sql(TEST_COMPANY, country, category), f"{country=}, {category=}")
+		self.assertEqual(find_tax_template_by_sql(TEST_COMPANY, "Germany", "Material"), "_Test DE Material")
+		self.assertEqual(find_tax_template_by_sql(TEST_COMPANY, "France", "Material"), "_Test EU Material")
+		self.assertEqual(find_tax_template_by_sql(TEST_COMPANY, "Japan", "Material"), "_Test World Material")
+		self.assertEqual(find_tax_template_by_sql(TEST_COMPANY, "Switzerland", "Service"), "_Test World Service")
+
+	def test_get_alternative_tax_template(self):
+		for template in ["_Test World Material", "_Test EU Material", "_Test DE Material"]:
+			for valid_date in [date(2010, 12, 31), date(2011, 1, 1), date(2017, 12, 31), date(2018, 1, 1),
+							   date(2020, 6, 30), date(2020, 7, 1), date(2023, 12, 31), date(2024, 1, 1), date(2030, 1, 1)]:
+				self.assertEqual(get_alternative_tax_template(template, valid_date),
+					get_alternative_tax_template_by_sql(template, valid_date), f"{template=}, {valid_date=}")
+		self.assertEqual(get_alternative_tax_template("_Test World Material", date(2019, 5, 1)), "_Test World Material 2018")
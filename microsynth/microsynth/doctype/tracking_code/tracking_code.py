@@ -6,11 +6,15 @@ from __future__ import unicode_literals
 import frappe
 import requests
 import csv
+import itertools
 import os
 import re
 from datetime import datetime
 from frappe.model.document import Document
-from microsynth.microsynth.shipping import get_shipping_item, TRACKING_URLS
+from frappe.utils import cint
+from microsynth.microsynth.shipping import get_shipping_item, set_tracking_code_delivery_dates, TRACKING_URLS
+
+TRACKING_IMPORT_CHUNK_SIZE = 1000
 
 
 class TrackingCode(Document):
@@ -163,21 +167,20 @@ def prepare_tracking_log(file_id):
     return file_path
 
 
-@frappe.whitelist()
-def parse_dhl_file(file_id, expected_line_length=15):
+class TrackingFileError(Exception):
+    pass
+
+
+def iterate_dhl_rows(file_path, expected_line_length=15):
     """
-    bench execute microsynth.microsynth.doctype.tracking_code.tracking_code.parse_dhl_file --kwargs "{'file_id': '0f69f96ed0'}"
+    Yields (tracking_number, delivery_datetime, error) for the delivered shipments of a DHL file
     """
-    file_path = prepare_tracking_log(file_id)
-    error_str = ""
-    counter = 0
     with open(file_path) as file:
         csv_reader = csv.reader((x.replace('\0', '') for x in file), delimiter=',')  # replace NULL bytes (throwing an error)
         next(csv_reader)  # skip header
         for line in csv_reader:
             if len(line) != expected_line_length:
-                msg = f"Line '{line}' has length {len(line)}, but expected length {expected_line_length}."
-                return {'success': False, 'message': msg}
+                raise TrackingFileError(f"Line '{line}' has length {len(line)}, but expected length {expected_line_length}.")
             tracking_number = line[1].strip()
             datetime_str = line[2].strip()
             status = line[3].strip()
@@ -190,26 +193,13 @@ def parse_dhl_file(file_id, expected_line_length=15):
             except Exception as e:
                 frappe.log_error(f"File path: {file_path}\nError: {e}", "parse_dhl_file")
                 continue
-            error = add_delivery_date_to_tracking_code(tracking_number, delivery_datetime)
-            if error:
-                error_str += f"<br>{error}"
-            else:
-                counter += 1
-    if error_str:
-        return {'success': True, 'message': f"Completed with the following problems: {error_str}"}
-    else:
-        return {'success': True, 'message': f"Successfully processed {counter} tracking codes"}
+            yield tracking_number, delivery_datetime, None
 
 
-@frappe.whitelist()
-def parse_ups_file(file_id):
+def iterate_ups_rows(file_path):
     """
-    bench execute microsynth.microsynth.doctype.tracking_code.tracking_code.parse_ups_file --kwargs "{'file_id': '0f69f96ed0'}"
+    Yields (tracking_number, delivery_datetime, error) for the delivered shipments of a UPS file
     """
-    file_path = prepare_tracking_log(file_id)
-    error_str = ""
-    counter = 0
-
     with open(file_path, encoding="utf-8-sig") as file:
         csv_reader = csv.DictReader(
             (x.replace('\0', '') for x in file),  # replace NULL bytes (throwing an error)
@@ -226,10 +216,7 @@ def parse_ups_file(file_id):
             if field not in csv_reader.fieldnames
         ]
         if missing_columns:
-            return {
-                "success": False,
-                "message": f"Missing required column(s): {', '.join(missing_columns)}"
-            }
+            raise TrackingFileError(f"Missing required column(s): {', '.join(missing_columns)}")
 
         for row in csv_reader:
             tracking_number = row.get("Tracking Number")
@@ -247,8 +234,8 @@ def parse_ups_file(file_id):
                     "%m/%d/%Y"
                 )
             except Exception:
-                error_str += (
-                    f"<br>Invalid delivery date "
+                yield None, None, (
+                    f"Invalid delivery date "
                     f"'{delivery_date_str}' for tracking number "
                     f"'{tracking_number}'"
                 )
@@ -262,33 +249,19 @@ def parse_ups_file(file_id):
             except Exception:
                 # no valid time -> use 00:00 from delivery_date instead
                 delivery_time = delivery_date
-            delivery_datetime = datetime.combine(delivery_date.date(), delivery_time.time())
-            error = add_delivery_date_to_tracking_code(tracking_number, delivery_datetime)
-            if error:
-                error_str += f"<br>{error}"
-            else:
-                counter += 1
-    if error_str:
-        return {'success': True, 'message': f"Completed with the following problems: {error_str}"}
-    else:
-        return {'success': True, 'message': f"Successfully processed {counter} tracking codes"}
+            yield tracking_number, datetime.combine(delivery_date.date(), delivery_time.time()), None
 
 
-@frappe.whitelist()
-def parse_fedex_file(file_id, expected_line_length=89):
+def iterate_fedex_rows(file_path, expected_line_length=89):
     """
-    bench execute microsynth.microsynth.doctype.tracking_code.tracking_code.parse_fedex_file --kwargs "{'file_id': '0f69f96ed0'}"
+    Yields (tracking_number, delivery_datetime, error) for the delivered shipments of a FedEx file
     """
-    file_path = prepare_tracking_log(file_id)
-    error_str = ""
-    counter = 0
     with open(file_path) as file:
         csv_reader = csv.reader((x.replace('\0', '') for x in file), delimiter=',')  # replace NULL bytes (throwing an error)
         next(csv_reader)  # skip header
         for line in csv_reader:
             if len(line) != expected_line_length:
-                msg = f"Line '{line}' has length {len(line)}, but expected length {expected_line_length}."
-                return {'success': False, 'message': msg}
+                raise TrackingFileError(f"Line '{line}' has length {len(line)}, but expected length {expected_line_length}.")
             tracking_number = line[0]
             date_str = line[21]
             if not date_str:
@@ -300,26 +273,13 @@ def parse_fedex_file(file_id, expected_line_length=89):
             except Exception:
                 # no valid time -> use 00:00 from delivery_date instead
                 delivery_time = delivery_date
-            delivery_datetime = datetime.combine(delivery_date.date(), delivery_time.time())
-            error = add_delivery_date_to_tracking_code(tracking_number, delivery_datetime)
-            if error:
-                error_str += f"<br>{error}"
-            else:
-                counter += 1
-    if error_str:
-        return {'success': True, 'message': f"Completed with the following problems: {error_str}"}
-    else:
-        return {'success': True, 'message': f"Successfully processed {counter} tracking codes"}
+            yield tracking_number, datetime.combine(delivery_date.date(), delivery_time.time()), None
 
 
-@frappe.whitelist()
-def parse_ems_file(file_id, expected_line_length=36):
+def iterate_ems_rows(file_path, expected_line_length=36):
     """
-    bench execute microsynth.microsynth.doctype.tracking_code.tracking_code.parse_ems_file --kwargs "{'file_id': '0f69f96ed0'}"
+    Yields (tracking_number, delivery_datetime, error) for the delivered shipments of an EMS file
     """
-    file_path = prepare_tracking_log(file_id)
-    error_str = ""
-    counter = 0
     with open(file_path) as file:
         csv_reader = csv.reader((x.replace('\0', '') for x in file), delimiter=';')  # replace NULL bytes (throwing an error)
         next(csv_reader)  # skip header
@@ -327,8 +287,7 @@ def parse_ems_file(file_id, expected_line_length=36):
             if len(line) == 0:
                 continue
             if len(line) != expected_line_length:
-                msg = f"Line '{line}' has length {len(line)}, but expected length {expected_line_length}."
-                return {'success': False, 'message': msg}
+                raise TrackingFileError(f"Line '{line}' has length {len(line)}, but expected length {expected_line_length}.")
             if line[22] != 'Zugestellt':
                 # skip if shipment is not yet delivered
                 continue
@@ -342,17 +301,188 @@ def parse_ems_file(file_id, expected_line_length=36):
             except Exception as e:
                 frappe.log_error(f"File path: {file_path}\nError: {e}", "parse_ems_file")
                 continue
-            error = add_delivery_date_to_tracking_code(tracking_number, delivery_datetime)
-            if error:
-                error_str += f"<br>{error}"
+            yield tracking_number, delivery_datetime, None
+
+
+def get_tracking_code_key(tracking_code):
+    # compare like the database collation: case-insensitive and ignoring trailing spaces
+    return (tracking_code or "").rstrip(" ").lower()
+
+
+def import_delivery_date_chunk(rows):
+    """
+    Set the delivery dates of a chunk of (tracking_number, delivery_datetime, error) rows.
+    Resolves all tracking numbers with one query and writes the new delivery dates in bulk.
+    Returns the number of processed rows and the error string, same as add_delivery_date_to_tracking_code row by row.
+    """
+    tracking_numbers = list({tracking_number for tracking_number, delivery_datetime, error in rows if tracking_number and not error})
+    tracking_codes = {}
+    if len(tracking_numbers) > 0:
+        for tc in frappe.db.sql("""
+                SELECT `name`, `tracking_code`, `delivery_date`
+                FROM `tabTracking Code`
+                WHERE `tracking_code` IN %(tracking_numbers)s
+                ORDER BY `modified` DESC;
+                """, {'tracking_numbers': tracking_numbers}, as_dict=True):
+            tracking_codes.setdefault(get_tracking_code_key(tc['tracking_code']), []).append(
+                {'name': tc['name'], 'tracking_code': tc['tracking_code'], 'delivery_date': tc['delivery_date']})
+
+    counter = 0
+    error_str = ""
+    deliveries = {}
+    for tracking_number, delivery_datetime, error in rows:
+        if not error:
+            matches = tracking_codes.get(get_tracking_code_key(tracking_number)) if tracking_number else None
+            if not matches:
+                error = f"Found no Tracking Code for 'tracking_code={tracking_number!r}'. Going to skip."
             else:
-                counter += 1
+                for tracking_code in matches:
+                    # Check if there is already a delivery_datetime stored
+                    if tracking_code['delivery_date']:
+                        # yes: compare it and report an error if it differs
+                        if tracking_code['delivery_date'] != delivery_datetime:
+                            error = f"Tracking Code '{tracking_code=}' has already delivery date {tracking_code['delivery_date']} and should now be {delivery_datetime}. Going to skip."
+                            break
+                    else:
+                        # no: store it
+                        tracking_code['delivery_date'] = delivery_datetime
+                        deliveries[tracking_code['name']] = delivery_datetime
+        if error:
+            error_str += f"<br>{error}"
+        else:
+            counter += 1
+    set_tracking_code_delivery_dates(deliveries)
+    return counter, error_str
+
+
+def import_delivery_dates(rows, chunk_size=TRACKING_IMPORT_CHUNK_SIZE):
+    """
+    Shared import of carrier tracking files: Reads the given iterable of (tracking_number, delivery_datetime, error)
+    in chunks and stores the delivery dates. Returns the summary for the Shipping Times report.
+    """
+    counter = 0
+    error_str = ""
+    chunk = []
+    try:
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                chunk_counter, chunk_errors = import_delivery_date_chunk(chunk)
+                counter += chunk_counter
+                error_str += chunk_errors
+                chunk = []
+    except TrackingFileError as err:
+        # the rows before the invalid line are stored nevertheless
+        import_delivery_date_chunk(chunk)
+        return {'success': False, 'message': str(err)}
+    chunk_counter, chunk_errors = import_delivery_date_chunk(chunk)
+    counter += chunk_counter
+    error_str += chunk_errors
     if error_str:
         return {'success': True, 'message': f"Completed with the following problems: {error_str}"}
     else:
         return {'success': True, 'message': f"Successfully processed {counter} tracking codes"}
 
 
+@frappe.whitelist()
+def parse_dhl_file(file_id, expected_line_length=15):
+    """
+    bench execute microsynth.microsynth.doctype.tracking_code.tracking_code.parse_dhl_file --kwargs "{'file_id': '0f69f96ed0'}"
+    """
+    file_path = prepare_tracking_log(file_id)
+    return import_delivery_dates(iterate_dhl_rows(file_path, cint(expected_line_length)))
+
+
+@frappe.whitelist()
+def parse_ups_file(file_id):
+    """
+    bench execute microsynth.microsynth.doctype.tracking_code.tracking_code.parse_ups_file --kwargs "{'file_id': '0f69f96ed0'}"
+    """
+    file_path = prepare_tracking_log(file_id)
+    return import_delivery_dates(iterate_ups_rows(file_path))
+
+
+@frappe.whitelist()
+def parse_fedex_file(file_id, expected_line_length=89):
+    """
+    bench execute microsynth.microsynth.doctype.tracking_code.tracking_code.parse_fedex_file --kwargs "{'file_id': '0f69f96ed0'}"
+    """
+    file_path = prepare_tracking_log(file_id)
+    return import_delivery_dates(iterate_fedex_rows(file_path, cint(expected_line_length)))
+
+
+@frappe.whitelist()
+def parse_ems_file(file_id, expected_line_length=36):
+    """
+    bench execute microsynth.microsynth.doctype.tracking_code.tracking_code.parse_ems_file --kwargs "{'file_id': '0f69f96ed0'}"
+    """
+    file_path = prepare_tracking_log(file_id)
+    return import_delivery_dates(iterate_ems_rows(file_path, cint(expected_line_length)))
+
+
+def benchmark_tracking_file_import(number_of_rows=100000, legacy_rows=1000):
+    """
+    Write a synthetic DHL file with the given number of rows (existing tracking codes with and without
+    delivery date and unknown ones) and import it with import_delivery_dates. The first legacy_rows rows are also
+    imported row by row with add_delivery_date_to_tracking_code to compare the result and the throughput.
+    All changes are rolled back.
+
+    bench execute microsynth.microsynth.doctype.tracking_code.tracking_code.benchmark_tracking_file_import --kwargs "{'number_of_rows': 100000}"
+    """
+    import random
+    import tempfile
+    import time
+
+    existing = frappe.db.sql("""
+        SELECT `tracking_code`, `delivery_date`
+        FROM `tabTracking Code`
+        ORDER BY `creation` DESC
+        LIMIT %(limit)s;
+        """, {'limit': number_of_rows // 2}, as_dict=True)
+    random.seed(42)
+    lines = []
+    for i in range(number_of_rows):
+        if existing and i % 2 == 0:
+            tc = random.choice(existing)
+            delivery_date = tc['delivery_date'] or datetime(2026, 10, 1, 9, 30)
+            lines.append([str(i), tc['tracking_code'], delivery_date.strftime('%d/%m/%Y %H:%M'), 'Shipment delivered ok'] + [''] * 11)
+        else:
+            lines.append([str(i), f"{random.randint(0, 10**10 - 1):010d}", "01/10/2026 09:30", 'Shipment delivered ok'] + [''] * 11)
+
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False, newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Nr', 'Waybill', 'Date', 'Status'] + [f"Column {c}" for c in range(11)])
+        writer.writerows(lines)
+        file_path = file.name
+    try:
+        # legacy: one query and one save per row
+        start = time.perf_counter()
+        legacy_counter = 0
+        legacy_errors = ""
+        for tracking_number, delivery_datetime, error in itertools.islice(iterate_dhl_rows(file_path), legacy_rows):
+            error = add_delivery_date_to_tracking_code(tracking_number, delivery_datetime)
+            if error:
+                legacy_errors += f"<br>{error}"
+            else:
+                legacy_counter += 1
+        legacy_duration = time.perf_counter() - start
+        frappe.db.rollback()
+
+        chunked_counter, chunked_errors = import_delivery_date_chunk(list(itertools.islice(iterate_dhl_rows(file_path), legacy_rows)))
+        frappe.db.rollback()
+        print(f"Legacy import of {legacy_rows} rows: {legacy_duration:.2f} seconds ({legacy_rows / legacy_duration:.0f} rows/s), "
+              f"same result as chunked import: {legacy_counter == chunked_counter and legacy_errors == chunked_errors}")
+
+        start = time.perf_counter()
+        result = import_delivery_dates(iterate_dhl_rows(file_path))
+        duration = time.perf_counter() - start
+        frappe.db.rollback()
+        print(f"Chunked import of {number_of_rows} rows: {duration:.2f} seconds ({number_of_rows / duration:.0f} rows/s), "
+              f"success: {result['success']}, message length: {len(result['message'])}")
+    finally:
+        os.remove(file_path)
+
+
 def add_delivery_date_to_tracking_code(tracking_code, delivery_datetime):
     tracking_codes = frappe.get_all("Tracking Code", filters={'tracking_code': tracking_code}, fields=['name', 'tracking_code', 'delivery_date'])
     if len(tracking_codes) == 0:
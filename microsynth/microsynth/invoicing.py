@@ -57,7 +57,7 @@ from microsynth.microsynth.credits import (
     get_total_credit,
     get_credit_accounts,
     get_applicable_customer_credits,
-    get_credit_account_balance,
+    get_credit_account_balances,
     create_full_return
 )
 from microsynth.microsynth.jinja import get_destination_classification
@@ -92,7 +92,8 @@ def print_invoices():
     """
     companies = frappe.db.get_all("Company", fields=['name'])
     for company in companies:
-        async_create_invoices('Post', company['name'], None)
+        # process the work units one after the other to return only after all invoices are printed
+        async_create_invoices('Post', company['name'], None, parallel=False)
 
 
 def get_tax_templates(delivery_notes):
@@ -126,14 +127,18 @@ def make_collective_invoices(delivery_notes):
     invoices = []
 
     if len(delivery_notes) > 0:
+        # fetch all required Delivery Note values at once
+        dn_values = { dn['name']: dn for dn in frappe.get_all("Delivery Note",
+            filters={'name': ['IN', delivery_notes]},
+            fields=['name', 'customer', 'company', 'taxes_and_charges', 'product_type', 'total']) }
 
         customers = []
         companies = []
         for d in delivery_notes:
-            cust = frappe.db.get_value("Delivery Note", d, "customer")
+            cust = dn_values[d]['customer']
             if cust not in customers:
                 customers.append(cust)
-            comp = frappe.db.get_value("Delivery Note", d, "company")
+            comp = dn_values[d]['company']
             if comp not in companies:
                 companies.append(comp)
 
@@ -147,31 +152,35 @@ def make_collective_invoices(delivery_notes):
 
         customer = customers[0]
         company = companies[0]
+        customer_credits = frappe.get_value("Customer", customer, "customer_credits")
+        total_credits = {}      # credit type -> total credit, does not change before the invoices are created
 
         # check if there are multiple tax templates
-        taxes = get_tax_templates(delivery_notes)
-        product_types = get_product_types(delivery_notes)
+        taxes = []
+        product_types = set()
+        for d in delivery_notes:
+            if dn_values[d]['taxes_and_charges'] not in taxes:
+                taxes.append(dn_values[d]['taxes_and_charges'])
+            product_types.add('Project' if dn_values[d]['product_type'] == 'Project' else '')
 
         # create one invoice per tax template
         for tax in taxes:
             for product_type in product_types:
                 filtered_dns = []
                 for d in delivery_notes:
-                    taxes_and_charges = frappe.db.get_value("Delivery Note", d, "taxes_and_charges")
-                    d_product_type = frappe.db.get_value("Delivery Note", d, "product_type")
+                    taxes_and_charges = dn_values[d]['taxes_and_charges']
+                    d_product_type = dn_values[d]['product_type']
                     prod_type_fit = d_product_type == product_type or (d_product_type != 'Project' and product_type == '')
                     if taxes_and_charges == tax and prod_type_fit:
-                        total = frappe.get_value("Delivery Note", d, "total")
-                        if product_type == 'Project':
-                            credit = get_total_credit(customer, company, 'Project')
-                        else:
-                            credit = get_total_credit(customer, company, 'Standard')
-                        customer_credits = frappe.get_value("Customer", customer, "customer_credits")
+                        total = dn_values[d]['total']
+                        credit_type = 'Project' if product_type == 'Project' else 'Standard'
+                        if credit_type not in total_credits:
+                            total_credits[credit_type] = get_total_credit(customer, company, credit_type)
+                        credit = total_credits[credit_type]
                         if credit is not None and customer_credits == 'Credit Account':
                             # there is some credit - check if it is sufficient
                             if total <= credit:
                                 filtered_dns.append(d)
-                                credit = credit - total
                             else:
                                 frappe.log_error("Delivery Note '{0}': \nInsufficient credit for customer {1}".format(d, customer), "invocing.async_create_invoices")
                         else:
@@ -251,289 +260,743 @@ def fetch_sales_order_credit_accounts(delivery_note_id):
     return sales_order_credit_accounts
 
 
-def async_create_invoices(mode, company, customer, is_monthly_collective_run=False):
+CLOSED_SALES_ORDER_ALLOWED_ITEMS = ['0969', '0975']
+
+
+def build_invoicing_plan(all_invoiceable):
     """
-    TODO: Rename this function and all its calls since it is not asynchronous itself
-    run
-    bench execute microsynth.microsynth.invoicing.async_create_invoices --kwargs "{ 'mode': 'Electronic', 'company': 'Microsynth AG', 'customer': '1234' }"
+    Prefetch all data required to decide how to invoice the given invoiceable Delivery Notes
+    (as returned by the Invoiceable Services report) with a handful of queries instead of several queries per Delivery Note.
+
+    Returns a dictionary with the keys
+    - delivery_notes: Delivery Note ID -> header values, items and Sales Order IDs
+    - sales_orders: Sales Order ID -> status, allowed items and Credit Accounts
+    - credit_accounts: Credit Account ID -> status, Product Types and balance
+    - active_credit_accounts: Customer ID -> list of active Credit Account IDs
+    - email_templates: cache for Email Templates, see get_plan_email_template
     """
-    # TODO: Refactor this function
-    credit_account_cache = {}
-    send_balance_warnings = datetime.today().weekday() == 1  # only on Tuesdays
-    # # Not implemented exceptions to catch cases that are not yet developed
-    # if company != "Microsynth AG":
-    #     frappe.throw("Not implemented: async_create_invoices for company '{0}'".format(company))
-    #     return
-    if mode not in ["Post", "Electronic", "Collective", "CarloErba"]:
-        frappe.throw("Not implemented: async_create_invoices for mode '{0}'".format(mode))
-        return
-    if is_monthly_collective_run and mode != "Collective":
-        frappe.throw(f"async_create_invoices with is_monthly_collective_run=True can only be executed in mode 'Collective', not in mode '{mode}'")
-        return
+    plan = {
+        'delivery_notes': {},
+        'sales_orders': {},
+        'credit_accounts': {},
+        'active_credit_accounts': {},
+        'email_templates': {}
+    }
+    delivery_note_ids = [ dn.get('delivery_note') for dn in all_invoiceable ]
+    if len(delivery_note_ids) == 0:
+        return plan
+
+    for dn in frappe.db.sql("""
+        SELECT `name`, `total`, `grand_total`, `web_order_id`, `language`
+        FROM `tabDelivery Note`
+        WHERE `name` IN %(delivery_notes)s
+        """, {'delivery_notes': delivery_note_ids}, as_dict=True):
+        dn['items'] = []
+        dn['sales_order_ids'] = set()
+        plan['delivery_notes'][dn['name']] = dn
+
+    for item in frappe.db.sql("""
+        SELECT `parent`, `item_code`, `qty`, `against_sales_order`
+        FROM `tabDelivery Note Item`
+        WHERE `parent` IN %(delivery_notes)s
+        ORDER BY `parent`, `idx` ASC
+        """, {'delivery_notes': delivery_note_ids}, as_dict=True):
+        dn = plan['delivery_notes'][item['parent']]
+        dn['items'].append(item)
+        if item['against_sales_order']:
+            dn['sales_order_ids'].add(item['against_sales_order'])
+
+    sales_order_ids = list({ so_id for dn in plan['delivery_notes'].values() for so_id in dn['sales_order_ids'] })
+    if len(sales_order_ids) > 0:
+        for so in frappe.db.sql("""
+            SELECT `name`, `status`
+            FROM `tabSales Order`
+            WHERE `name` IN %(sales_orders)s
+            """, {'sales_orders': sales_order_ids}, as_dict=True):
+            so['allowed_items'] = []
+            so['credit_accounts'] = []
+            plan['sales_orders'][so['name']] = so
+
+        # only required for Closed Sales Orders, but cheap enough to fetch in one go
+        for item in frappe.db.sql("""
+            SELECT `parent`, `item_code`, `qty`
+            FROM `tabSales Order Item`
+            WHERE `parent` IN %(sales_orders)s
+                AND `item_code` IN %(allowed_items)s
+            ORDER BY `parent`, `idx` ASC
+            """, {'sales_orders': sales_order_ids, 'allowed_items': CLOSED_SALES_ORDER_ALLOWED_ITEMS}, as_dict=True):
+            plan['sales_orders'][item['parent']]['allowed_items'].append(item)
+
+        for link in frappe.db.sql("""
+            SELECT `parent`, `credit_account`
+            FROM `tabCredit Account Link`
+            WHERE `parent` IN %(sales_orders)s
+                AND `parenttype` = 'Sales Order'
+            ORDER BY `parent`, `idx` ASC
+            """, {'sales_orders': sales_order_ids}, as_dict=True):
+            plan['sales_orders'][link['parent']]['credit_accounts'].append(link['credit_account'])
+
+    customers = list({ dn.get('customer') for dn in all_invoiceable })
+    credit_account_ids = { ca for so in plan['sales_orders'].values() for ca in so['credit_accounts'] }
+    for account in frappe.get_all("Credit Account",
+                                  filters={'customer': ['IN', customers], 'status': 'Active'},
+                                  fields=['name', 'customer'],
+                                  order_by='modified desc'):
+        plan['active_credit_accounts'].setdefault(account['customer'], []).append(account['name'])
+        credit_account_ids.add(account['name'])
+
+    if len(credit_account_ids) > 0:
+        credit_account_ids = list(credit_account_ids)
+        for account in frappe.get_all("Credit Account",
+                                      filters={'name': ['IN', credit_account_ids]},
+                                      fields=['name', 'status']):
+            account['product_types'] = []
+            plan['credit_accounts'][account['name']] = account
+
+        for product_type in frappe.db.sql("""
+            SELECT `parent`, `product_type`
+            FROM `tabProduct Type Link`
+            WHERE `parent` IN %(credit_accounts)s
+                AND `parenttype` = 'Credit Account'
+            ORDER BY `parent`, `idx` ASC
+            """, {'credit_accounts': credit_account_ids}, as_dict=True):
+            if product_type['product_type']:
+                plan['credit_accounts'][product_type['parent']]['product_types'].append(product_type['product_type'])
+
+        for credit_account_id, balance in get_credit_account_balances(credit_account_ids).items():
+            plan['credit_accounts'][credit_account_id]['balance'] = balance
+
+    return plan
+
+
+def get_plan_email_template(plan, template_name):
+    """
+    Return the Email Template with the given name, loading it at most once per invoicing plan.
+    """
+    if template_name not in plan['email_templates']:
+        plan['email_templates'][template_name] = frappe.get_doc("Email Template", template_name)
+    return plan['email_templates'][template_name]
+
+
+def get_plan_sales_order_credit_accounts(plan, so_id):
+    """
+    Return the Credit Accounts of the given Sales Order that are not Disabled and have credit left.
+    Equivalent to fetch_sales_order_credit_accounts but based on the prefetched invoicing plan.
+    """
+    sales_order_credit_accounts = []
+    for credit_account_id in plan['sales_orders'][so_id]['credit_accounts']:
+        credit_account = plan['credit_accounts'].get(credit_account_id)
+        if (credit_account and credit_account['status'] != 'Disabled'
+            and credit_account.get('balance', 0) >= 0.01
+            and credit_account_id not in sales_order_credit_accounts):
+            sales_order_credit_accounts.append(credit_account_id)
+    return sales_order_credit_accounts
+
 
-    # Standard processing
-    if (mode in ["Post", "Electronic"]):
-        # individual invoices
-        if mode == "Electronic":
-            all_invoiceable = get_invoiceable_services(filters={'company': company, 'customer': customer})
+def plan_delivery_note(dn, plan, mode):
+    """
+    Decide how to invoice the given invoiceable Delivery Note in mode 'Post' or 'Electronic' without any side effects.
+
+    Returns a dictionary with
+    - action: 'error', 'close_delivery_note', 'unable_to_invoice', 'skip', 'punchout_invoice', 'insufficient_credit' or 'invoice'
+    - reason: explanation for all actions except 'invoice' and 'punchout_invoice'
+    - reopen_sales_order: Closed Sales Order that has to be reopened for invoicing and closed again afterwards
+    - notifications: reasons for "Unable to invoice Delivery Note" emails to send
+    - warnings: messages to log
+    - credit, total: only for action 'insufficient_credit'
+    """
+    delivery_note_id = dn.get('delivery_note')
+    decision = {
+        'delivery_note': delivery_note_id,
+        'customer': dn.get('customer'),
+        'action': None,
+        'reason': None,
+        'reopen_sales_order': None,
+        'notifications': [],
+        'warnings': []
+    }
+    dn_data = plan['delivery_notes'][delivery_note_id]
+
+    # Check if Sales Order is Closed.
+    if len(dn_data['sales_order_ids']) > 1:
+        decision.update({'action': 'error', 'reason': f"Delivery Note '{delivery_note_id}': Multiple Sales Orders found: {', '.join(list(dn_data['sales_order_ids']))}"})
+        return decision
+    elif len(dn_data['sales_order_ids']) == 0:
+        decision.update({'action': 'error', 'reason': f"Delivery Note '{delivery_note_id}': No Sales Order found."})
+        return decision
+    so_id = next(iter(dn_data['sales_order_ids']))
+    so_data = plan['sales_orders'][so_id]
+
+    if so_data['status'] == 'Closed':
+        if dn_data['grand_total'] == 0:
+            # skip invoicing for Delivery Notes with grand total 0 that are linked to a Closed Sales Order.
+            decision.update({'action': 'close_delivery_note', 'reason': f"Sales Order {so_id} is Closed and Delivery Note {delivery_note_id} has a grand total of 0."})
+            return decision
+        allowed_items = CLOSED_SALES_ORDER_ALLOWED_ITEMS
+        # Check if Delivery Note contains Item 0969 or 0975 with a lower quantity than on the Sales Order,
+        # open the Sales Order before invoicing and close it again afterwards.
+        dn_allowed_items = [ item for item in dn_data['items'] if item['item_code'] in allowed_items ]
+        if len(dn_allowed_items) > 0:
+            dn_qty_allowed_item = dn_allowed_items[0]['qty']
+            for so_item in so_data['allowed_items']:
+                if so_item['qty'] > dn_qty_allowed_item:
+                    decision['reopen_sales_order'] = so_id
+                    break
+                else:
+                    decision['notifications'].append(
+                        f"Sales Order {so_id} is Closed and contains one of the items allowing invoicing anyway ({', '.join(allowed_items)}), "
+                        f"but invoicing is not permitted because the quantity of Item {so_item['item_code']} in Delivery Note {delivery_note_id} "
+                        f"was not reduced compared to Sales Order {so_id} and it is therefore not clear why Sales Order {so_id} was Closed."
+                    )
+        else:
+            decision.update({'action': 'unable_to_invoice',
+                             'reason': f"Sales Order {so_id} of Delivery Note {delivery_note_id} is Closed and the Delivery Note does not contain Item {' or '.join(allowed_items)} that would allow invoicing anyway."})
+            return decision
+
+    if cint(dn.get('is_punchout') == 1) and mode != "Electronic":  # should never be true anymore due to filtering out punchout Delivery Notes
+        # All punchout invoices must be send electronically
+        decision['warnings'].append("Cannot invoice {0}: \nPunchout invoices must be send electronically".format(delivery_note_id))
+        decision.update({'action': 'skip', 'reason': "Punchout invoices must be send electronically"})
+        return decision
+
+    # process punchout orders separately
+    if cint(dn.get('is_punchout') == 1):
+        decision['action'] = 'punchout_invoice'
+        return decision
+
+    # If DN has Product Type Project, ensure there is no Active Project Credit Account for the Customer
+    # that was omitted from the enabled_credit_accounts. If such exists, skip the whole DN.
+    sales_order_credit_accounts = get_plan_sales_order_credit_accounts(plan, so_id)
+    if dn.get('product_type') == 'Project':
+        for account in plan['active_credit_accounts'].get(dn.get('customer'), []):
+            if 'Project' in plan['credit_accounts'][account]['product_types'] and account not in sales_order_credit_accounts:
+                decision.update({'action': 'unable_to_invoice',
+                                 'reason': f"Delivery Note '{delivery_note_id}': Customer {dn.get('customer')} has an active Project Credit Account {account} which is not included in the Sales Order credit accounts."})
+                return decision
+
+    # Customers with customer_credits = "Credit Account" should receive an email if the credits are not sufficient to cover the invoice
+    if dn.get('customer_credits') == 'Credit Account':
+        credit = 0.0
+        # Get balance of all sales order credit accounts and store the sum in 'credit'
+        # Skip credit accounts that do not apply to this Delivery Notes product type and log an error
+        for credit_account_id in sales_order_credit_accounts:
+            ca_product_types = plan['credit_accounts'][credit_account_id]['product_types']
+            if dn.get('product_type') and ca_product_types:
+                if dn.get('product_type') not in ca_product_types:
+                    decision['warnings'].append(f"WARNING: Delivery Note '{delivery_note_id}': Credit Account '{credit_account_id}' is not applicable for product type '{dn.get('product_type')}'. Please check manually.")
+                credit += plan['credit_accounts'][credit_account_id]['balance']
+
+        if dn_data['total'] > credit:
+            decision.update({'action': 'insufficient_credit',
+                             'reason': f"Insufficient credit: total {dn_data['total']} > credit {round(credit, 2)}",
+                             'total': dn_data['total'],
+                             'credit': round(credit, 2)})
+            return decision
+
+    # only process DN that are invoiced individually, not collective billing
+    if cint(dn.get('collective_billing')) != 0:
+        decision.update({'action': 'skip', 'reason': "Collective billing"})
+    elif mode == "Post":
+        if dn.get('invoicing_method') == "Post":
+            decision['action'] = 'invoice'
         else:
-            # exclude punchout invoices, because punchout invoices must be send electronically
-            all_invoiceable = get_invoiceable_services(filters={'company': company, 'customer': customer, 'exclude_punchout': 1})
-        count = 0
-        insufficient_credit_warnings = {}
+            decision.update({'action': 'skip', 'reason': f"Invoicing method {dn.get('invoicing_method')} is not processed in mode Post"})
+    elif dn.get('invoicing_method').upper() == "CARLO ERBA":
+        # do not process Carlo Erba invoices with electronic and Post invoices
+        decision.update({'action': 'skip', 'reason': "Carlo Erba invoices are processed separately"})
+    elif dn.get('invoicing_method') not in ["Email", "Paynet", "ARIBA", "GEP", "Chorus"]:
+        decision.update({'action': 'skip', 'reason': f"Invoicing method {dn.get('invoicing_method')} is not processed in mode Electronic"})
+    else:
+        decision['action'] = 'invoice'
+    return decision
 
-        for dn in all_invoiceable:
-            try:
-                # Check if Sales Order is Closed.
-                opened_sales_order = None
-                so_id, dn_doc = fetch_sales_order_id(dn.get('delivery_note'))
-                so_status = frappe.get_value("Sales Order", so_id, "status")
-                if so_status == 'Closed':
-                    if dn_doc.grand_total == 0:
-                        # close the Delivery Note
-                        dn_doc.update_status('Closed')
-                        continue  # skip invoicing for Delivery Notes with grand total 0 that are linked to a Closed Sales Order.
-                    allowed_items = ['0969', '0975']
-                    # Check if Delivery Note contains Item 0969 or 0975 with a lower quantity than on the Sales Order,
-                    # open the Sales Order before invoicing and close it again afterwards.
-                    contains_allowed_item = False
-                    dn_qty_allowed_item = None
-                    for item in dn_doc.items:
-                        if item.item_code in allowed_items:
-                            contains_allowed_item = True
-                            dn_qty_allowed_item = item.qty
-                            break
-                    if contains_allowed_item:
-                        so_doc = frappe.get_doc("Sales Order", so_id)
-                        for so_item in so_doc.items:
-                            if so_item.item_code in allowed_items:
-                                if so_item.qty > dn_qty_allowed_item:
-                                    # reopen Sales Order
-                                    so_doc.update_status('To Bill')
-                                    opened_sales_order = so_doc.name
-                                    break
-                                else:
-                                    reason = (
-                                        f"Sales Order {so_id} is Closed and contains one of the items allowing invoicing anyway ({', '.join(allowed_items)}), "
-                                        f"but invoicing is not permitted because the quantity of Item {so_item.item_code} in Delivery Note {dn_doc.name} "
-                                        f"was not reduced compared to Sales Order {so_id} and it is therefore not clear why Sales Order {so_id} was Closed."
-                                    )
-                                    email_template = frappe.get_doc("Email Template", "Unable to invoice Delivery Note")
-                                    rendered_subject = frappe.render_template(email_template.subject, {'delivery_note_id': dn_doc.name})
-                                    rendered_message = frappe.render_template(email_template.response, {'delivery_note_id': dn_doc.name, 'reason': reason})
-                                    send_email_from_template(email_template, rendered_message, rendered_subject)
-                                    #frappe.log_error(f"{reason} Going to skip invoicing. Send an automatic email.", "invoicing.async_create_invoices")
-                    else:
-                        # send and log an error and skip invoicing
-                        reason = f"Sales Order {so_id} of Delivery Note {dn_doc.name} is Closed and the Delivery Note does not contain Item {' or '.join(allowed_items)} that would allow invoicing anyway."
-                        email_template = frappe.get_doc("Email Template", "Unable to invoice Delivery Note")
-                        rendered_subject = frappe.render_template(email_template.subject, {'delivery_note_id': dn_doc.name})
-                        rendered_message = frappe.render_template(email_template.response, {'delivery_note_id': dn_doc.name, 'reason': reason})
-                        send_email_from_template(email_template, rendered_message, rendered_subject)
-                        #frappe.log_error(f"{reason} Going to skip invoicing. Send an automatic email.", "invoicing.async_create_invoices")
-                        continue
 
-                # # TODO: implement for other export categories
-                # if dn.region != "CH":
-                #     continue
+def get_individual_invoiceable_services(mode, company, customer, customers=None):
+    """
+    Return the Delivery Notes to invoice individually in mode 'Post' or 'Electronic'.
+    """
+    if mode == "Electronic":
+        return get_invoiceable_services(filters={'company': company, 'customer': customer, 'customers': customers})
+    else:
+        # exclude punchout invoices, because punchout invoices must be send electronically
+        return get_invoiceable_services(filters={'company': company, 'customer': customer, 'customers': customers, 'exclude_punchout': 1})
 
-                # TODO: implement for other product types. Requires setting the income accounts.
-                # if dn.product_type not in ["Oligos", "Labels", "Sequencing"]:
-                #     continue
-                delivery_note_id = dn.get('delivery_note')
 
-                if cint(dn.get('is_punchout') == 1) and mode != "Electronic":  # should never be true anymore due to filtering out punchout Delivery Notes above
-                    # All punchout invoices must be send electronically
-                    frappe.log_error("Cannot invoice {0}: \nPunchout invoices must be send electronically".format(delivery_note_id), "invoicing.async_create_invoices")
-                    continue
+def plan_invoices(mode, company, customer=None):
+    """
+    Dry run of async_create_invoices for mode 'Post' or 'Electronic': Return the planned decision for each invoiceable Delivery Note.
 
-                # process punchout orders separately
-                if cint(dn.get('is_punchout') == 1):
-                    si = make_punchout_invoice(delivery_note_id)
-                    if si:
-                        transmit_sales_invoice(si)
-                    continue
+    bench execute microsynth.microsynth.invoicing.plan_invoices --kwargs "{ 'mode': 'Electronic', 'company': 'Microsynth AG', 'customer': '1234' }"
+    """
+    if mode not in ["Post", "Electronic"]:
+        frappe.throw(f"Not implemented: plan_invoices for mode '{mode}'")
+    all_invoiceable = get_individual_invoiceable_services(mode, company, customer)
+    plan = build_invoicing_plan(all_invoiceable)
+    decisions = []
+    for dn in all_invoiceable:
+        decision = plan_delivery_note(dn, plan, mode)
+        decisions.append({ k: v for k, v in decision.items() if v not in (None, []) })
+    return decisions
 
-                # If DN has Product Type Project, ensure there is no Active Project Credit Account for the Customer
-                # that was omitted from the enabled_credit_accounts. If such exists, skip the whole DN.
-                sales_order_credit_accounts = None
-                if dn.get('product_type') == 'Project':
-                    skip_dn = False
-                    customer_active_accounts = frappe.get_all("Credit Account", filters={
-                        'customer': dn.get('customer'),
-                        'status': 'Active'
-                    }, fields=['name'])
-                    sales_order_credit_accounts = fetch_sales_order_credit_accounts(delivery_note_id)
-
-                    for account in customer_active_accounts:
-                        if account['name'] not in credit_account_cache:
-                            credit_account_cache[account['name']] = frappe.get_doc("Credit Account", account['name'])
-                        credit_account_doc = credit_account_cache[account['name']]
-                        acc_ptypes = [pt.product_type for pt in credit_account_doc.product_types if getattr(pt, 'product_type', None)]
-                        if 'Project' in acc_ptypes and account['name'] not in sales_order_credit_accounts:
-                            reason = f"Delivery Note '{delivery_note_id}': Customer {dn.get('customer')} has an active Project Credit Account {account['name']} which is not included in the Sales Order credit accounts."
-                            email_template = frappe.get_doc("Email Template", "Unable to invoice Delivery Note")
-                            rendered_subject = frappe.render_template(email_template.subject, {'delivery_note_id': delivery_note_id})
-                            rendered_message = frappe.render_template(email_template.response, {'delivery_note_id': delivery_note_id, 'reason': reason})
-                            send_email_from_template(email_template, rendered_message, rendered_subject)
-                            #frappe.log_error(f"{reason} Going to skip invoicing. Send an automatic email.", "invoicing.async_create_invoices")
-                            skip_dn = True
-                            break
-                    if skip_dn:
-                        # do not invoice this Delivery Note
-                        continue
 
-                requires_balance_warning = frappe.get_value("Customer", dn.get('customer'), "customer_credits") == 'Credit Account'
-                # Customers with customer_credits = "Credit Account" should receive an email if the credits are not sufficient to cover the invoice
-                if requires_balance_warning:
-                    credit = 0.0
-                    if sales_order_credit_accounts is None:  # avoid fetching again
-                        sales_order_credit_accounts = fetch_sales_order_credit_accounts(delivery_note_id)
-                    # Get balance of all sales order credit accounts and store the sum in 'credit'
-                    # Skip credit accounts that do not apply to this Delivery Notes product type and log an error
-                    for credit_account_id in sales_order_credit_accounts:
-                        if credit_account_id not in credit_account_cache:
-                            credit_account_cache[credit_account_id] = frappe.get_doc("Credit Account", credit_account_id)
-                        credit_account_doc = credit_account_cache[credit_account_id]
-                        ca_product_types = [pt.product_type for pt in credit_account_doc.product_types if getattr(pt, 'product_type', None)]
-
-                        if dn.get('product_type') and ca_product_types:
-                            if dn.get('product_type') not in ca_product_types:
-                                msg = f"WARNING: Delivery Note '{delivery_note_id}': Credit Account '{credit_account_id}' is not applicable for product type '{dn.get('product_type')}'. Please check manually."
-                                frappe.log_error(msg, "invoicing.async_create_invoices")
-                            credit += get_credit_account_balance(credit_account_id)
-
-                    total = frappe.get_value("Delivery Note", delivery_note_id, "total")
-                    if total > credit:
-                        if send_balance_warnings:
-                            dn_customer = dn.get('customer')
-                            if not dn_customer in insufficient_credit_warnings:
-                                insufficient_credit_warnings[dn_customer] = {}
-                            insufficient_credit_warnings[dn_customer][delivery_note_id] = {'total': total,
-                                                                                    'currency': dn.get('currency'),
-                                                                                    'credit': round(credit, 2),
-                                                                                    'customer_name': dn.get('customer_name'),
-                                                                                    'web_order_id': dn_doc.web_order_id,
-                                                                                    'language': dn_doc.language}
-                        continue
+def send_unable_to_invoice_email(plan, delivery_note_id, reason):
+    email_template = get_plan_email_template(plan, "Unable to invoice Delivery Note")
+    rendered_subject = frappe.render_template(email_template.subject, {'delivery_note_id': delivery_note_id})
+    rendered_message = frappe.render_template(email_template.response, {'delivery_note_id': delivery_note_id, 'reason': reason})
+    send_email_from_template(email_template, rendered_message, rendered_subject)
 
-                # only process DN that are invoiced individually, not collective billing
-                if cint(dn.get('collective_billing')) == 0:
-                    if mode == "Post":
-                        if dn.get('invoicing_method') == "Post":
-                            si = make_invoice(delivery_note_id)
-                            transmit_sales_invoice(si)
-                            count += 1
-                            # if count >= 20 and company != "Microsynth AG":
-                            #     break
-                    else:
-                        # TODO process other invoicing methods
-
-                        if dn.get('invoicing_method').upper() == "CARLO ERBA":
-                            # do not process Carlo Erba invoices with electronic and Post invoices
-                            continue
 
-                        if dn.get('invoicing_method') not in ["Email", "Paynet", "ARIBA", "GEP", "Chorus"]:
-                            continue
+def refresh_plan_credit_account_balances(plan, delivery_note_id):
+    """
+    Reload the balances of the Credit Accounts of the Sales Order of an invoiced Delivery Note into the invoicing plan,
+    because the new Sales Invoice might have consumed credit that later Delivery Notes would otherwise count again.
+    """
+    credit_account_ids = set()
+    for so_id in plan['delivery_notes'][delivery_note_id]['sales_order_ids']:
+        credit_account_ids.update(plan['sales_orders'][so_id]['credit_accounts'])
+    for credit_account_id, balance in get_credit_account_balances(list(credit_account_ids)).items():
+        plan['credit_accounts'][credit_account_id]['balance'] = balance
 
-                        # TODO there seems to be an issue here: both branches ("Post"/ not "Post") do the same
-                        if dn.get('invoicing_method') != "Post":
-                            si = make_invoice(delivery_note_id)
-                            transmit_sales_invoice(si)
-                            count += 1
 
-            except Exception as err:
-                message = f"Cannot invoice {dn.get('delivery_note')}: \n{err}\n{traceback.format_exc()}"
-                frappe.log_error(message, "invoicing.async_create_invoices")
-                #print(message)
-            finally:
-                if opened_sales_order:
-                    # Close previously opened Sales Order
-                    so_id, dn_doc = fetch_sales_order_id(dn.get('delivery_note'))
-                    so_doc = frappe.get_doc("Sales Order", so_id)
-                    so_doc.update_status('Closed')
-
-        if send_balance_warnings:
-            for dn_customer, warnings in insufficient_credit_warnings.items():  # should contain always one customer
-                try:
-                    if len(warnings) < 1:
-                        continue
-                    language = 'en'
-                    dn_details = ""
-
-                    for delivery_note, values in warnings.items():
-                        currency = values['currency']
-                        dn_details += f"""{f"Web Order ID {values['web_order_id']} / " if values['web_order_id'] else ''}{delivery_note}: {values['total']} {currency}<br>"""
-                        customer_name = values['customer_name']
-                        credit = values['credit']
-                        language = values['language']  # This will take the language of the arbitrary last Delivery Note, but we do not support multiple languages at once.
-
-                    if language == 'de':
-                        email_template = frappe.get_doc("Email Template", "Aufgebrauchtes Guthaben")
-                    elif language == 'en':
-                        email_template = frappe.get_doc("Email Template", "Insufficient credit")
-                    elif language == 'fr':
-                        email_template = frappe.get_doc("Email Template", "Crédit utilisé")
-                    else:
-                        email_template = frappe.get_doc("Email Template", "Insufficient credit")
-
-                    rendered_subject = frappe.render_template(email_template.subject, {'customer_id': dn_customer, 'company': company})
-                    values_to_render = {
-                        'customer_id': dn_customer,
-                        'customer_name': customer_name,
-                        'credit': credit,
-                        'currency': currency,
-                        'company': company,
-                        'dn_details': dn_details
-                    }
-                    rendered_message = frappe.render_template(email_template.response, values_to_render)
-                    send_email_from_template(email_template, rendered_message, rendered_subject)
-                except Exception as e:
-                    frappe.log_error(f"Unable to send an email about insufficient Customer Credits to Customer '{dn_customer}' due to the following error:\n{e}\n\n{warnings=}")
+INVOICING_LOCK_TIMEOUT = 15000         # seconds, same as the job timeout of create_invoices
+INVOICING_MAX_ATTEMPTS = 3              # attempts to process a customer that is locked by another invoicing run
+INVOICING_RETRY_DELAY = 300             # seconds to wait before retrying locked customers
+INVOICING_RETRIES_KEY = "invoicing_retries"     # Redis hash of the work units waiting for a retry
 
-    elif mode == "CarloErba":
-        invoices = make_carlo_erba_invoices(company = company)
-        transmit_carlo_erba_invoices(invoices)
 
-    elif mode == "Collective":
-        # colletive invoices
-        all_invoiceable = get_invoiceable_services(filters={'company': company, 'customer': customer, 'collective_billing': 1})
-        customers = []
+def new_invoicing_summary():
+    return {
+        'customers': 0,
+        'delivery_notes': 0,
+        'invoices': 0,
+        'skipped': 0,
+        'failed': 0,
+        'retried': 0,
+        'locked': [],
+        'duration': 0.0
+    }
 
-        for dn in all_invoiceable:
-            # TODO process other invoicing methods
-            if dn.get('invoicing_method') not in  ["Email", "Post", "Intercompany", "Chorus", "X-Rechnung", "Peppol", "Scientist"]:
-                frappe.log_error("Cannot invoice {0}: \nThe invoicing method '{1}' is not implemented for collective billing".format(dn.get('delivery_note'), dn.get('invoicing_method')), "invoicing.async_create_invoices")
+
+def merge_invoicing_summaries(summaries):
+    """
+    Merge the summaries of several invoicing work units and compute the throughput in invoices per minute.
+    """
+    total = new_invoicing_summary()
+    for summary in summaries:
+        for key in ['customers', 'delivery_notes', 'invoices', 'skipped', 'failed', 'retried']:
+            total[key] += summary.get(key, 0)
+        total['locked'] += summary.get('locked', [])
+        # work units run in parallel: the slowest one determines the duration of the run
+        total['duration'] = max(total['duration'], summary.get('duration', 0.0))
+    total['invoices_per_minute'] = round(total['invoices'] / total['duration'] * 60, 2) if total['duration'] > 0 else 0.0
+    return total
+
+
+def get_invoicing_lock_key(company, customer):
+    return frappe.cache().make_key(f"invoicing_lock::{company}::{customer}")
+
+
+def acquire_invoicing_lock(company, customer, run_id):
+    """
+    Try to lock the given Customer for the given invoicing run. Returns True if the lock was acquired.
+    Prevents collective and individual invoicing runs from invoicing the same Delivery Notes concurrently.
+    """
+    return bool(frappe.cache().set(get_invoicing_lock_key(company, customer), run_id, nx=True, ex=INVOICING_LOCK_TIMEOUT))
+
+
+def release_invoicing_lock(company, customer, run_id):
+    """
+    Release the lock on the given Customer if it is still held by the given invoicing run.
+    """
+    key = get_invoicing_lock_key(company, customer)
+    owner = frappe.cache().get(key)
+    if owner is not None and frappe.safe_decode(owner) == run_id:
+        frappe.cache().delete(key)
+
+
+def get_invoicing_workers():
+    """
+    Return the configured number of parallel invoicing workers and the queue to use (Microsynth Settings).
+    """
+    settings = frappe.get_value("Microsynth Settings", "Microsynth Settings", ['invoicing_workers', 'invoicing_queue'], as_dict=True) or {}
+    return max(cint(settings.get('invoicing_workers')), 1), (settings.get('invoicing_queue') or 'long')
+
+
+def split_work_units(customer_sizes, workers):
+    """
+    Distribute customers onto at most 'workers' work units, balancing the number of Delivery Notes per unit.
+    customer_sizes: dictionary Customer ID -> number of Delivery Notes
+    """
+    units = [ {'customers': [], 'size': 0} for i in range(min(workers, len(customer_sizes))) ]
+    for customer, size in sorted(customer_sizes.items(), key=lambda c: c[1], reverse=True):
+        unit = min(units, key=lambda u: u['size'])
+        unit['customers'].append(customer)
+        unit['size'] += size
+    return [ unit['customers'] for unit in units if len(unit['customers']) > 0 ]
+
+
+def process_individual_invoices(all_invoiceable, mode, company, send_balance_warnings, summary, commit=False):
+    """
+    Create and transmit individual invoices for the given invoiceable Delivery Notes (mode 'Post' or 'Electronic').
+    With commit=True, every Delivery Note is committed on its own.
+    """
+    # prefetch all data required for the decisions, see plan_invoices for a dry run
+    plan = build_invoicing_plan(all_invoiceable)
+    insufficient_credit_warnings = {}
+
+    for dn in all_invoiceable:
+        opened_sales_order = None
+        try:
+            delivery_note_id = dn.get('delivery_note')
+            decision = plan_delivery_note(dn, plan, mode)
+            for warning in decision['warnings']:
+                frappe.log_error(warning, "invoicing.async_create_invoices")
+            for reason in decision['notifications']:
+                send_unable_to_invoice_email(plan, delivery_note_id, reason)
+                #frappe.log_error(f"{reason} Going to skip invoicing. Send an automatic email.", "invoicing.async_create_invoices")
+
+            if decision['action'] == 'error':
+                frappe.throw(decision['reason'])
+
+            if decision['reopen_sales_order']:
+                so_doc = frappe.get_doc("Sales Order", decision['reopen_sales_order'])
+                so_doc.update_status('To Bill')
+                opened_sales_order = so_doc.name
+
+            summary['delivery_notes'] += 1
+            if decision['action'] not in ['invoice', 'punchout_invoice']:
+                summary['skipped'] += 1
+
+            if decision['action'] == 'close_delivery_note':
+                frappe.get_doc("Delivery Note", delivery_note_id).update_status('Closed')
+
+            elif decision['action'] == 'unable_to_invoice':
+                send_unable_to_invoice_email(plan, delivery_note_id, decision['reason'])
+                #frappe.log_error(f"{reason} Going to skip invoicing. Send an automatic email.", "invoicing.async_create_invoices")
+
+            elif decision['action'] == 'punchout_invoice':
+                si = make_punchout_invoice(delivery_note_id)
+                if si:
+                    transmit_sales_invoice(si)
+                    refresh_plan_credit_account_balances(plan, delivery_note_id)
+                    summary['invoices'] += 1
+
+            elif decision['action'] == 'insufficient_credit':
+                if send_balance_warnings:
+                    dn_customer = dn.get('customer')
+                    dn_data = plan['delivery_notes'][delivery_note_id]
+                    if not dn_customer in insufficient_credit_warnings:
+                        insufficient_credit_warnings[dn_customer] = {}
+                    insufficient_credit_warnings[dn_customer][delivery_note_id] = {'total': decision['total'],
+                                                                            'currency': dn.get('currency'),
+                                                                            'credit': decision['credit'],
+                                                                            'customer_name': dn.get('customer_name'),
+                                                                            'web_order_id': dn_data['web_order_id'],
+                                                                            'language': dn_data['language']}
+
+            elif decision['action'] == 'invoice':
+                si = make_invoice(delivery_note_id)
+                transmit_sales_invoice(si)
+                refresh_plan_credit_account_balances(plan, delivery_note_id)
+                summary['invoices'] += 1
+
+        except Exception as err:
+            summary['failed'] += 1
+            message = f"Cannot invoice {dn.get('delivery_note')}: \n{err}\n{traceback.format_exc()}"
+            frappe.log_error(message, "invoicing.async_create_invoices")
+            #print(message)
+        finally:
+            if opened_sales_order:
+                # Close previously opened Sales Order
+                so_doc = frappe.get_doc("Sales Order", opened_sales_order)
+                so_doc.update_status('Closed')
+            if commit:
+                frappe.db.commit()
+
+    if send_balance_warnings:
+        send_insufficient_credit_warnings(plan, insufficient_credit_warnings, company)
+
+
+def send_insufficient_credit_warnings(plan, insufficient_credit_warnings, company):
+    for dn_customer, warnings in insufficient_credit_warnings.items():  # should contain always one customer
+        try:
+            if len(warnings) < 1:
                 continue
+            language = 'en'
+            dn_details = ""
+
+            for delivery_note, values in warnings.items():
+                currency = values['currency']
+                dn_details += f"""{f"Web Order ID {values['web_order_id']} / " if values['web_order_id'] else ''}{delivery_note}: {values['total']} {currency}<br>"""
+                customer_name = values['customer_name']
+                credit = values['credit']
+                language = values['language']  # This will take the language of the arbitrary last Delivery Note, but we do not support multiple languages at once.
+
+            if language == 'de':
+                email_template = get_plan_email_template(plan, "Aufgebrauchtes Guthaben")
+            elif language == 'en':
+                email_template = get_plan_email_template(plan, "Insufficient credit")
+            elif language == 'fr':
+                email_template = get_plan_email_template(plan, "Crédit utilisé")
+            else:
+                email_template = get_plan_email_template(plan, "Insufficient credit")
+
+            rendered_subject = frappe.render_template(email_template.subject, {'customer_id': dn_customer, 'company': company})
+            values_to_render = {
+                'customer_id': dn_customer,
+                'customer_name': customer_name,
+                'credit': credit,
+                'currency': currency,
+                'company': company,
+                'dn_details': dn_details
+            }
+            rendered_message = frappe.render_template(email_template.response, values_to_render)
+            send_email_from_template(email_template, rendered_message, rendered_subject)
+        except Exception as e:
+            frappe.log_error(f"Unable to send an email about insufficient Customer Credits to Customer '{dn_customer}' due to the following error:\n{e}\n\n{warnings=}")
 
-            if (cint(dn.get('collective_billing')) == 1 and
-                (cint(dn.get('is_punchout')) != 1 or dn.get('customer') in ['57022', '57023'] ) and  # allow collective billing for IMP / IMBA despite punchout
-                dn.get('customer') not in customers):
-                customers.append(dn.get('customer'))
 
-        # for each customer, create one invoice per tax template for all dns
-        for c in customers:
-            try:
-                dns = []
-                for dn in all_invoiceable:
-                    if (cint(dn.get('collective_billing')) == 1 and
-                        (cint(dn.get('is_punchout')) != 1 or c in ['57022', '57023'] ) and  # allow collective billing for IMP / IMBA despite punchout
-                        dn.get('customer') == c):
-                        if not is_monthly_collective_run and dn.get('order_customer_collective_billing') == 1:
-                            # if this is not the monthly collective run, only include DNs that are not marked for order customer collective billing
-                            continue
-                        dns.append(dn.get('delivery_note'))
+def get_collective_billing_customers(all_invoiceable, log_errors=True):
+    """
+    Return the Customers with Delivery Notes to invoice collectively.
+    """
+    customers = []
+    for dn in all_invoiceable:
+        # TODO process other invoicing methods
+        if dn.get('invoicing_method') not in  ["Email", "Post", "Intercompany", "Chorus", "X-Rechnung", "Peppol", "Scientist"]:
+            if log_errors:
+                frappe.log_error("Cannot invoice {0}: \nThe invoicing method '{1}' is not implemented for collective billing".format(dn.get('delivery_note'), dn.get('invoicing_method')), "invoicing.async_create_invoices")
+            continue
 
-                invoices = make_collective_invoices(dns)
-                for invoice in invoices:
-                    transmit_sales_invoice(invoice)
+        if (cint(dn.get('collective_billing')) == 1 and
+            (cint(dn.get('is_punchout')) != 1 or dn.get('customer') in ['57022', '57023'] ) and  # allow collective billing for IMP / IMBA despite punchout
+            dn.get('customer') not in customers):
+            customers.append(dn.get('customer'))
+    return customers
 
-            except Exception as err:
-                frappe.log_error("Cannot create collective invoice for customer {0}: \n{1}".format(c, err), "invoicing.async_create_invoices")
+
+def process_collective_invoices(all_invoiceable, customers, is_monthly_collective_run, summary, commit=False):
+    """
+    For each customer, create and transmit one invoice per tax template for all Delivery Notes.
+    With commit=True, every customer is committed on its own.
+    """
+    for c in customers:
+        try:
+            dns = []
+            for dn in all_invoiceable:
+                if (cint(dn.get('collective_billing')) == 1 and
+                    (cint(dn.get('is_punchout')) != 1 or c in ['57022', '57023'] ) and  # allow collective billing for IMP / IMBA despite punchout
+                    dn.get('customer') == c):
+                    if not is_monthly_collective_run and dn.get('order_customer_collective_billing') == 1:
+                        # if this is not the monthly collective run, only include DNs that are not marked for order customer collective billing
+                        continue
+                    dns.append(dn.get('delivery_note'))
+            summary['delivery_notes'] += len(dns)
+
+            invoices = make_collective_invoices(dns)
+            for invoice in invoices:
+                transmit_sales_invoice(invoice)
+                summary['invoices'] += 1
+
+        except Exception as err:
+            summary['failed'] += 1
+            frappe.log_error("Cannot create collective invoice for customer {0}: \n{1}".format(c, err), "invoicing.async_create_invoices")
+        finally:
+            if commit:
+                frappe.db.commit()
+
+
+def process_invoicing_work_unit(mode, company, customers, is_monthly_collective_run=False, send_balance_warnings=False,
+                                run_id=None, unit=0, attempt=1, commit=True):
+    """
+    Process an independent invoicing work unit: invoice all Delivery Notes of the given Customers of one company.
+    Customers that are locked by another invoicing run are retried later in a new background job.
+    Returns the summary of this work unit.
+
+    bench execute microsynth.microsynth.invoicing.process_invoicing_work_unit --kwargs "{ 'mode': 'Electronic', 'company': 'Microsynth AG', 'customers': ['1234'] }"
+    """
+    start = datetime.now()
+    run_id = run_id or frappe.generate_hash(length=10)
+    summary = new_invoicing_summary()
+
+    locked_customers = []
+    busy_customers = []
+    for customer in customers:
+        if acquire_invoicing_lock(company, customer, run_id):
+            locked_customers.append(customer)
+        else:
+            busy_customers.append(customer)
+
+    try:
+        if len(locked_customers) > 0:
+            summary['customers'] = len(locked_customers)
+            # fetch the invoiceable Delivery Notes only after locking to not invoice Delivery Notes invoiced by a concurrent run
+            if mode == "Collective":
+                all_invoiceable = get_invoiceable_services(filters={'company': company, 'customers': locked_customers, 'collective_billing': 1})
+                process_collective_invoices(all_invoiceable, get_collective_billing_customers(all_invoiceable, log_errors=False), is_monthly_collective_run, summary, commit=commit)
+            else:
+                all_invoiceable = get_individual_invoiceable_services(mode, company, None, customers=locked_customers)
+                process_individual_invoices(all_invoiceable, mode, company, send_balance_warnings, summary, commit=commit)
+    finally:
+        for customer in locked_customers:
+            release_invoicing_lock(company, customer, run_id)
+
+    if len(busy_customers) > 0:
+        if attempt < INVOICING_MAX_ATTEMPTS:
+            summary['retried'] += len(busy_customers)
+            schedule_invoicing_retry({
+                'mode': mode,
+                'company': company,
+                'customers': busy_customers,
+                'is_monthly_collective_run': is_monthly_collective_run,
+                'send_balance_warnings': send_balance_warnings,
+                'run_id': run_id,
+                'unit': f"{unit}.{attempt}",
+                'attempt': attempt + 1
+            })
+        else:
+            summary['locked'] += busy_customers
+            frappe.log_error(f"Invoicing run {run_id}: Customers {', '.join(busy_customers)} are locked by another invoicing run and were not invoiced after {attempt} attempts.",
+                             "invoicing.process_invoicing_work_unit")
+
+    summary['duration'] = (datetime.now() - start).total_seconds()
+    store_invoicing_work_unit_summary(run_id, unit, summary)
+    return summary
+
+
+def schedule_invoicing_retry(kwargs):
+    """
+    Store a work unit with Customers that were locked by another invoicing run to be retried after INVOICING_RETRY_DELAY seconds
+    by process_due_invoicing_retries (without blocking a worker in the meantime).
+    """
+    due = (datetime.now() + timedelta(seconds=INVOICING_RETRY_DELAY)).timestamp()
+    frappe.cache().hset(INVOICING_RETRIES_KEY, f"{kwargs['run_id']}::{kwargs['unit']}", {'due': due, 'kwargs': kwargs})
+
+
+def process_due_invoicing_retries():
+    """
+    Enqueue all work units of invoicing runs whose retry is due.
+    Executed by a cronjob every 5 minutes and at the start of every invoicing run.
+
+    bench execute microsynth.microsynth.invoicing.process_due_invoicing_retries
+    """
+    now_ts = datetime.now().timestamp()
+    for retry_id, retry in (frappe.cache().hgetall(INVOICING_RETRIES_KEY) or {}).items():
+        if retry['due'] > now_ts:
+            continue
+        frappe.cache().hdel(INVOICING_RETRIES_KEY, retry_id)
+        enqueue("microsynth.microsynth.invoicing.process_invoicing_work_unit",
+            queue=get_invoicing_workers()[1],
+            timeout=INVOICING_LOCK_TIMEOUT,
+            job_name=f"invoicing_{frappe.safe_decode(retry_id)}",
+            **retry['kwargs'])
+
+
+def get_invoicing_run_pending_key(run_id):
+    return frappe.cache().make_key(f"invoicing_run_pending::{run_id}")
+
+
+def store_invoicing_work_unit_summary(run_id, unit, summary):
+    """
+    Store the summary of a work unit. Once all work units of a run (including retries) are complete, log the summary of the whole run.
+    """
+    frappe.cache().hset(f"invoicing_run::{run_id}", str(unit), summary)
+    pending_key = get_invoicing_run_pending_key(run_id)
+    if frappe.cache().get(pending_key) is None:
+        return      # summary of the run already logged or expired
+    if summary['retried'] > 0:
+        frappe.cache().incrby(pending_key, 1)
+    if frappe.cache().decr(pending_key) <= 0:
+        frappe.cache().delete(pending_key)
+        frappe.log_error(json.dumps(get_invoicing_run_summary(run_id), indent=4, default=str), f"Invoicing run {run_id} summary")
+
+
+def get_invoicing_run_summary(run_id):
+    """
+    Return the merged summary of all finished work units of the given invoicing run.
+
+    bench execute microsynth.microsynth.invoicing.get_invoicing_run_summary --kwargs "{ 'run_id': 'a1b2c3d4e5' }"
+    """
+    unit_summaries = frappe.cache().hgetall(f"invoicing_run::{run_id}") or {}
+    run_summary = merge_invoicing_summaries(unit_summaries.values())
+    run_summary['run_id'] = run_id
+    run_summary['work_units'] = len(unit_summaries)
+    return run_summary
+
+
+def async_create_invoices(mode, company, customer, is_monthly_collective_run=False, parallel=True):
+    """
+    TODO: Rename this function and all its calls since it is not asynchronous itself
+    Invoices are created per Customer in independent work units. If Microsynth Settings define more than one
+    invoicing worker, the work units are processed in parallel background jobs, otherwise directly.
+    With parallel=False, all work units are processed directly and the function returns after all invoices are transmitted
+    (except for Customers locked by another invoicing run, which are retried later).
+    The summary of the run is logged once all work units are done.
+
+    run
+    bench execute microsynth.microsynth.invoicing.async_create_invoices --kwargs "{ 'mode': 'Electronic', 'company': 'Microsynth AG', 'customer': '1234' }"
+    """
+    send_balance_warnings = datetime.today().weekday() == 1  # only on Tuesdays
+    # # Not implemented exceptions to catch cases that are not yet developed
+    # if company != "Microsynth AG":
+    #     frappe.throw("Not implemented: async_create_invoices for company '{0}'".format(company))
+    #     return
+    if mode not in ["Post", "Electronic", "Collective", "CarloErba"]:
+        frappe.throw("Not implemented: async_create_invoices for mode '{0}'".format(mode))
+        return
+    if is_monthly_collective_run and mode != "Collective":
+        frappe.throw(f"async_create_invoices with is_monthly_collective_run=True can only be executed in mode 'Collective', not in mode '{mode}'")
+        return
+
+    if mode == "CarloErba":
+        invoices = make_carlo_erba_invoices(company = company)
+        transmit_carlo_erba_invoices(invoices)
+        return
+
+    # Standard processing: individual invoices, or collective invoices
+    if mode in ["Post", "Electronic"]:
+        all_invoiceable = get_individual_invoiceable_services(mode, company, customer)
+        customer_sizes = {}
+        for dn in all_invoiceable:
+            customer_sizes[dn.get('customer')] = customer_sizes.get(dn.get('customer'), 0) + 1
     else:
-        frappe.throw("Unknown mode '{0}' for async_create_invoices".format(mode))
+        all_invoiceable = get_invoiceable_services(filters={'company': company, 'customer': customer, 'collective_billing': 1})
+        customer_sizes = {}
+        for c in get_collective_billing_customers(all_invoiceable):
+            customer_sizes[c] = len([ dn for dn in all_invoiceable if dn.get('customer') == c ])
 
-    return
+    if len(customer_sizes) == 0:
+        return
+
+    process_due_invoicing_retries()
+
+    run_id = frappe.generate_hash(length=10)
+    workers, queue = get_invoicing_workers()
+    work_units = split_work_units(customer_sizes, workers)
+
+    frappe.cache().set(get_invoicing_run_pending_key(run_id), len(work_units), ex=INVOICING_LOCK_TIMEOUT * INVOICING_MAX_ATTEMPTS)
+    if len(work_units) == 1 or not parallel:
+        for unit, customers in enumerate(work_units):
+            process_invoicing_work_unit(mode, company, customers,
+                                        is_monthly_collective_run=is_monthly_collective_run,
+                                        send_balance_warnings=send_balance_warnings,
+                                        run_id=run_id,
+                                        unit=unit)
+        return run_id
+
+    for unit, customers in enumerate(work_units):
+        enqueue("microsynth.microsynth.invoicing.process_invoicing_work_unit",
+            queue=queue,
+            timeout=INVOICING_LOCK_TIMEOUT,
+            job_name=f"invoicing_{run_id}_{unit}",
+            mode=mode,
+            company=company,
+            customers=customers,
+            is_monthly_collective_run=is_monthly_collective_run,
+            send_balance_warnings=send_balance_warnings,
+            run_id=run_id,
+            unit=unit)
+    return run_id
 
 
 def set_income_accounts(sales_invoice):
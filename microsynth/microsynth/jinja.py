@@ -3,22 +3,96 @@
 # For license information, please see license.txt
 
 import frappe
-from microsynth.microsynth.report.pricing_configurator.pricing_configurator import get_rate
-from frappe.utils import cint
+from frappe.utils import cint, flt
 import unicodedata
 
 """
-Jinja endpoint to get pricelist rate and reference rate for an item
+Jinja endpoint to get pricelist rate and reference rate for an item.
+The rates are served from the per-request rate cache (see prefetch_price_list_rates).
 """
 def get_price_list_rate(item_code, price_list, qty=1):
     data = {
-        'rate': get_rate(item_code, price_list, qty),
-        'reference_rate': get_rate(item_code,
-            frappe.get_value("Price List", price_list, "reference_price_list"),
-            qty)
+        'rate': get_cached_rate(item_code, price_list, qty),
+        'reference_rate': get_cached_rate(item_code, get_cached_reference_price_list(price_list), qty)
     }
     return data
 
+"""
+Returns the rate cache of the current request (print format rendering):
+- reference_price_lists: price_list -> reference_price_list
+- tiers: (price_list, item_code) -> valid Item Prices, sorted like pricing_configurator.get_price_list_rates
+- complete: price lists with all Item Prices loaded
+"""
+def get_price_list_rate_cache():
+    if not frappe.flags.price_list_rate_cache:
+        frappe.flags.price_list_rate_cache = {'reference_price_lists': {}, 'tiers': {}, 'complete': set()}
+    return frappe.flags.price_list_rate_cache
+
+"""
+Invalidate the rate cache, hooked on Item Price and Price List changes
+"""
+def clear_price_list_rate_cache(doc=None, event=None):
+    frappe.flags.price_list_rate_cache = None
+
+def get_cached_reference_price_list(price_list):
+    cache = get_price_list_rate_cache()
+    if price_list not in cache['reference_price_lists']:
+        cache['reference_price_lists'][price_list] = frappe.get_value("Price List", price_list, "reference_price_list")
+    return cache['reference_price_lists'][price_list]
+
+"""
+Jinja endpoint to load the rates of the given items (default: all items) on a price list and its reference price list
+with one query at the start of rendering, e.g.
+{{ prefetch_price_list_rates(doc.selling_price_list, doc.items | map(attribute='item_code') | list) }}
+"""
+def prefetch_price_list_rates(price_list, item_codes=None):
+    cache = get_price_list_rate_cache()
+    price_lists = [p for p in (price_list, get_cached_reference_price_list(price_list)) if p]
+    if not price_lists:
+        return ""
+    values = {'price_lists': price_lists}
+    item_condition = ""
+    if item_codes is not None:
+        values['item_codes'] = list(set(item_codes))
+        if not values['item_codes']:
+            return ""
+        item_condition = "AND `item_code` IN %(item_codes)s"
+    tiers = {}
+    for p in price_lists:
+        for item_code in values.get('item_codes', []):
+            tiers[p, item_code] = []
+    for t in frappe.db.sql("""
+        SELECT `price_list`, `item_code`,
+            IFNULL(`min_qty`, 0) AS `min_qty`,
+            IFNULL(`price_list_rate`, 0) AS `rate`
+        FROM `tabItem Price`
+        WHERE `price_list` IN %(price_lists)s
+            {item_condition}
+            AND (`valid_from` IS NULL OR `valid_from` <= CURDATE())
+            AND (`valid_upto` IS NULL OR `valid_upto` >= CURDATE())
+        ORDER BY `min_qty` DESC, `valid_from` DESC;
+        """.format(item_condition=item_condition), values, as_dict=True):
+        tiers.setdefault((t['price_list'], t['item_code']), []).append(t)
+    cache['tiers'].update(tiers)
+    if item_codes is None:
+        cache['complete'].update(price_lists)
+    return ""
+
+"""
+Same as pricing_configurator.get_rate, but from the rate cache. Items that are not prefetched are loaded on first use.
+"""
+def get_cached_rate(item_code, price_list, qty):
+    if not price_list:
+        return 0
+    cache = get_price_list_rate_cache()
+    if (price_list, item_code) not in cache['tiers'] and price_list not in cache['complete']:
+        prefetch_price_list_rates(price_list, [item_code])
+    qty = flt(qty)
+    for tier in cache['tiers'].get((price_list, item_code), []):
+        if tier['min_qty'] <= qty:
+            return tier['rate']
+    return 0
+
 """
 Jinja endpoint to find destination region classification
 """
@@ -3,6 +3,10 @@
 
 import os
 import re
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import traceback
 import frappe
@@ -256,29 +260,128 @@ def create_analysis_report(content=None):
                 'reference': None}
 
 
-def create_pdf_attachment(analysis_report):
+PDF_CACHE_FOLDER = "pdf_cache"
+PDF_CACHE_MAX_AGE_DAYS = 7
+PDF_RENDER_WORKERS = 4
+
+
+def get_pdf_cache_path(doctype, name, print_format, modified):
     """
-    Creates the PDF file for a given Analysis Report name and attaches the file to the record in the ERP.
+    Returns the path of the cached PDF of the given document version and print format (content-addressed by these keys)
+    """
+    key = hashlib.sha256(f"{doctype}\n{name}\n{print_format}\n{modified}".encode("utf-8")).hexdigest()
+    return os.path.join(frappe.get_site_path("private", PDF_CACHE_FOLDER), f"{key}.pdf")
 
-    bench execute microsynth.microsynth.lab_reporting.create_pdf_attachment --kwargs "{'analysis_report': 'AR-2400001'}"
+
+def write_cached_pdf(cache_path, content):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # write to a temporary file first so that a concurrent reader never gets a partial PDF
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, mode='wb') as file:
+        file.write(content)
+    os.replace(tmp_path, cache_path)
+
+
+def get_cached_pdf(doc, print_format):
+    """
+    Returns the PDF of the given document in the given print format. The PDF is only rendered
+    if the current version of the document (modified) has not been rendered before.
+    """
+    cache_path = get_pdf_cache_path(doc.doctype, doc.name, print_format, doc.modified)
+    if os.path.isfile(cache_path):
+        with open(cache_path, mode='rb') as file:
+            return file.read()
+    content = frappe.get_print(doc.doctype, doc.name, print_format, doc=None, as_pdf=True, no_letterhead=False)
+    write_cached_pdf(cache_path, content)
+    return content
+
+
+def render_pdf_in_thread(site, sites_path, user, doctype, name, print_format):
+    """
+    Render a PDF with an own site connection. wkhtmltopdf runs as separate process per call.
+    """
+    frappe.init(site=site, sites_path=sites_path)
+    try:
+        frappe.connect()
+        frappe.set_user(user)
+        return frappe.get_print(doctype, name, print_format, doc=None, as_pdf=True, no_letterhead=False)
+    finally:
+        frappe.destroy()
+
+
+def render_pdfs(docs, print_format):
+    """
+    Render the PDFs of the given documents that are not yet in the PDF cache in parallel and store them in the cache.
+    """
+    missing = [doc for doc in docs if not os.path.isfile(get_pdf_cache_path(doc.doctype, doc.name, print_format, doc.modified))]
+    if len(missing) == 0:
+        return
+    if len(missing) == 1:
+        get_cached_pdf(missing[0], print_format)
+        return
+    site = frappe.local.site
+    sites_path = frappe.local.sites_path
+    user = frappe.session.user
+    with ThreadPoolExecutor(max_workers=min(PDF_RENDER_WORKERS, len(missing))) as executor:
+        futures = {executor.submit(render_pdf_in_thread, site, sites_path, user, doc.doctype, doc.name, print_format): doc for doc in missing}
+        for future, doc in futures.items():
+            try:
+                content = future.result()
+            except Exception as err:
+                # render it again in the request to get the error where the PDF is used
+                frappe.log_error(f"Unable to render {doc.doctype} '{doc.name}' in parallel: {err}", "lab_reporting.render_pdfs")
+                continue
+            write_cached_pdf(get_pdf_cache_path(doc.doctype, doc.name, print_format, doc.modified), content)
+
+
+def clean_pdf_cache(max_age_days=PDF_CACHE_MAX_AGE_DAYS):
+    """
+    Delete cached PDFs that were not created within the given number of days.
+    Should be run by a daily cronjob:
+    # clean PDF cache
+    15 2 * * * cd /home/frappe/frappe-bench && /usr/local/bin/bench --site erp.microsynth.local execute microsynth.microsynth.lab_reporting.clean_pdf_cache
+
+    bench execute microsynth.microsynth.lab_reporting.clean_pdf_cache --kwargs "{'max_age_days': 7}"
+    """
+    cache_folder = frappe.get_site_path("private", PDF_CACHE_FOLDER)
+    if not os.path.isdir(cache_folder):
+        return
+    threshold = time.time() - max_age_days * 24 * 60 * 60
+    for file_name in os.listdir(cache_folder):
+        file_path = os.path.join(cache_folder, file_name)
+        if os.path.getmtime(file_path) < threshold:
+            os.remove(file_path)
+
+
+def get_analysis_report_sample_name(analysis_report_doc, title):
+    """
+    Returns the sample_name of the single Sample of the given Analysis Report, used for the file name.
     """
-    doctype = printformat = "Analysis Report"
-    analysis_report_doc = frappe.get_doc("Analysis Report", analysis_report)
     if len(analysis_report_doc.sample_details) == 1:
         sample = analysis_report_doc.sample_details[0].sample
-        sample_name = frappe.get_value("Sample", sample, "sample_name")
+        return frappe.get_value("Sample", sample, "sample_name")
     elif len(analysis_report_doc.sample_details) > 1:
-        msg = f"Analysis Report '{analysis_report}' has {len(analysis_report_doc.sample_details)} sample details, but the file naming is only defined for reports with a single sample."
-        frappe.log_error(msg, "lab_reporting.create_pdf_attachment")
-        frappe.throw(msg)
+        msg = f"Analysis Report '{analysis_report_doc.name}' has {len(analysis_report_doc.sample_details)} sample details, but the file naming is only defined for reports with a single sample."
     else:
-        msg = f"Analysis Report '{analysis_report}' has no sample details, but the file naming is only defined for reports with exactly one sample."
-        frappe.log_error(msg, "lab_reporting.create_pdf_attachment")
-        frappe.throw(msg)
+        msg = f"Analysis Report '{analysis_report_doc.name}' has no sample details, but the file naming is only defined for reports with exactly one sample."
+    frappe.log_error(msg, title)
+    frappe.throw(msg)
+
+
+def create_pdf_attachment(analysis_report, analysis_report_doc=None):
+    """
+    Creates the PDF file for a given Analysis Report name and attaches the file to the record in the ERP.
+
+    bench execute microsynth.microsynth.lab_reporting.create_pdf_attachment --kwargs "{'analysis_report': 'AR-2400001'}"
+    """
+    doctype = printformat = "Analysis Report"
+    if not analysis_report_doc:
+        analysis_report_doc = frappe.get_doc("Analysis Report", analysis_report)
+    sample_name = get_analysis_report_sample_name(analysis_report_doc, "lab_reporting.create_pdf_attachment")
     doctype_folder = create_folder(doctype, "Home")
     title_folder = create_folder(sample_name, doctype_folder)
     # TODO: How to set the file name to sample_name?
-    filecontent = frappe.get_print(doctype, analysis_report, printformat, doc=None, as_pdf=True, no_letterhead=False)
+    filecontent = get_cached_pdf(analysis_report_doc, printformat)
     save_and_attach(
         content = filecontent,
         to_doctype = doctype,
@@ -309,7 +412,7 @@ def send_reports(recipient, cc_mails, analysis_reports):
                 web_order_ids.add(analysis_report.web_order_id)
             if analysis_report.contact_display:
                 contact_names.add(analysis_report.contact_display)
-            create_pdf_attachment(analysis_report.name)
+            create_pdf_attachment(analysis_report.name, analysis_report)
             attachments = get_attachments("Analysis Report", analysis_report.name)
             fid = None
             for a in attachments:
@@ -376,24 +479,8 @@ def webshop_upload(contact_id, web_order_id, analysis_reports):
         if not web_order_id:
             frappe.throw(f"Got no Web Order ID and Analysis Report '{analysis_report}' has no Web Order ID. Unable to create a folder.")
 
-        analysis_report_doc = frappe.get_doc("Analysis Report", analysis_report)
-        if len(analysis_report_doc.sample_details) == 1:
-            sample = analysis_report_doc.sample_details[0].sample
-            sample_name = frappe.get_value("Sample", sample, "sample_name")
-        elif len(analysis_report_doc.sample_details) > 1:
-            msg = f"Analysis Report '{analysis_report}' has {len(analysis_report_doc.sample_details)} sample details, but the file naming is only defined for reports with a single sample."
-            frappe.log_error(msg, "lab_reporting.webshop_upload")
-            frappe.throw(msg)
-        else:
-            msg = f"Analysis Report '{analysis_report}' has no sample details, but the file naming is only defined for reports with exactly one sample."
-            frappe.log_error(msg, "lab_reporting.webshop_upload")
-            frappe.throw(msg)
-
-        content_pdf = frappe.get_print(
-            "Analysis Report",
-            analysis_report,
-            print_format="Analysis Report",
-            as_pdf=True)
+        sample_name = get_analysis_report_sample_name(report_doc, "lab_reporting.webshop_upload")
+        content_pdf = get_cached_pdf(report_doc, "Analysis Report")
         path = f"{export_path}/{contact_id}/{web_order_id}"
         if not os.path.exists(path):
             os.makedirs(path)
@@ -422,14 +509,17 @@ def transmit_analysis_reports(content=None):
     if 'sales_order' in content and content['sales_order']:
         if not frappe.db.exists('Sales Order', content['sales_order']):
             return {'success': False, 'message': f"The given Sales Order '{content['sales_order']}' does not exist in the ERP. Please provide a valid or no Sales Order ID."}
+        analysis_report_docs = []
         for report in content['analysis_reports']:
             analysis_report = frappe.get_doc('Analysis Report', report)
+            analysis_report_docs.append(analysis_report)
             if not analysis_report:
                 return {'success': False, 'message': f"Analysis Report '{report}' does not exist in the ERP."}
             if content['sales_order'] != analysis_report.sales_order:
                 return {'success': False, 'message': f"Got Sales Order '{content['sales_order']}', but Analysis Report '{report}' belongs to Sales Order '{analysis_report.sales_order}'."}
         sales_order = frappe.get_doc('Sales Order', content['sales_order'])
         recipient = frappe.get_value('Contact', sales_order.contact_person, 'email_id')
+        render_pdfs(analysis_report_docs, "Analysis Report")
         webshop_upload(sales_order.contact_person, sales_order.web_order_id, content['analysis_reports'])
         # send reports to the contact person of the given Sales Order
         return send_reports(recipient, content['cc_mails'], content['analysis_reports'])
@@ -446,6 +536,7 @@ def transmit_analysis_reports(content=None):
                 reports_per_person[contact_person] = [report]
         if len(reports_per_person) > 1 and 'cc_mails' in content and content['cc_mails'] and len(content['cc_mails']) > 0:
             return {'success': False, 'message': f"Found more than one distinct contact_person and got cc_mails. Are you sure you want to allow this case?"}
+        render_pdfs([frappe.get_doc('Analysis Report', report) for report in content['analysis_reports']], "Analysis Report")
         overall_success = True
         for contact_person, analysis_reports in reports_per_person.items():
             recipient = frappe.get_value('Contact', contact_person, 'email_id')
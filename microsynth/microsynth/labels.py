@@ -8,10 +8,12 @@ import os
 import traceback
 import unicodedata  # part of standard library, no installation required
 import socket
+import time
 from datetime import datetime
 import frappe
-from frappe.utils import formatdate
+from frappe.utils import cint, formatdate
 from microsynth.microsynth.shipping import (
+    SHIPPING_SERVICES,
     get_shipping_service,
     get_shipping_item,
     create_receiver_address_lines,
@@ -29,11 +31,96 @@ UPS_WORLDSHIP_IMPORT_DIR = os.path.join(UPS_BATCH_FILES_BASE_DIR, "UPS Worldship
 UPS_WORLDSHIP_FILENAME = "ups_world_ship_batch.csv"
 
 
+PRINTER_CONNECT_TIMEOUT = 5     # seconds
+PRINTER_SEND_TIMEOUT = 10       # seconds
+PRINTER_MAX_ATTEMPTS = 4
+PRINTER_RETRY_DELAY = 0.5       # seconds, doubled after each failed attempt
+
+
+class LabelSpooler():
+    """
+    Queues raw print jobs and sends them in order over one persistent connection per printer (ip, port).
+    Refused or broken connections are reopened with exponential backoff. Use it as context manager:
+
+        with LabelSpooler() as spooler:
+            spooler.add(ip, port, content, reference)
+            printed, failed = spooler.flush()
+    """
+    def __init__(self, max_attempts=PRINTER_MAX_ATTEMPTS, retry_delay=PRINTER_RETRY_DELAY, line_ending="\r\n"):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.line_ending = line_ending
+        self.connections = {}
+        self.queue = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def add(self, ip, port, content, reference=None):
+        self.queue.append({'printer': (ip, cint(port)), 'content': content, 'reference': reference})
+
+    def get_connection(self, printer):
+        if not printer in self.connections:
+            connection = socket.create_connection(printer, timeout=PRINTER_CONNECT_TIMEOUT)
+            connection.settimeout(PRINTER_SEND_TIMEOUT)
+            self.connections[printer] = connection
+        return self.connections[printer]
+
+    def close_connection(self, printer):
+        connection = self.connections.pop(printer, None)
+        if connection:
+            try:
+                connection.close()
+            except OSError:
+                pass
+
+    def send(self, printer, content):
+        data = (content + self.line_ending).encode("utf-8")
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.get_connection(printer).sendall(data)
+                return
+            except OSError:
+                self.close_connection(printer)
+                if attempt == self.max_attempts:
+                    raise
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+    def flush(self):
+        """
+        Send all queued jobs in order. Returns the list of references of the jobs that the printers accepted
+        and a dictionary reference -> error of the failed jobs. After a printer failed, its remaining jobs are not sent.
+        """
+        printed = []
+        failed = {}
+        failed_printers = {}
+        for job in self.queue:
+            if job['printer'] in failed_printers:
+                failed[job['reference']] = failed_printers[job['printer']]
+                continue
+            try:
+                self.send(job['printer'], job['content'])
+                printed.append(job['reference'])
+            except OSError as err:
+                failed_printers[job['printer']] = err
+                failed[job['reference']] = err
+        self.queue = []
+        return printed, failed
+
+    def close(self):
+        for printer in list(self.connections.keys()):
+            self.close_connection(printer)
+
+
 def print_raw(ip, port, content):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((ip, port))
-    s.sendall((content + "\r\n").encode("utf-8"))
-    s.close()  # TODO: Is this necessary? Remove to avoid connection refused errors?
+    with LabelSpooler() as spooler:
+        spooler.add(ip, port, content)
+        _, failed = spooler.flush()
+    if failed:
+        raise next(iter(failed.values()))
 
 
 def print_test_label_brady():
@@ -228,38 +315,116 @@ def print_contact_shipping_label(address_id, contact_id, customer_id):
 def print_oligo_order_labels(sales_orders):
     """
     Prints the shipping labels from a list of sales order names.
+    All labels are sent in order over one printer connection and label_printed_on is set
+    with one update for all Sales Orders whose label the printer accepted.
 
     bench execute "microsynth.microsynth.labels.print_oligo_order_labels" --kwargs "{'sales_orders': ['SO-BAL-22011340']}"
     """
     #create_ups_batch_file(sales_orders)
 
     settings = frappe.get_doc("Flushbox Settings", "Flushbox Settings")
-
-    for o in sales_orders:
-        warning = ""
-        sales_order = frappe.get_doc("Sales Order", o)
-        try:
-            label_data = get_label_data(sales_order)
-            content = frappe.render_template(NOVEXX_PRINTER_TEMPLATE, label_data)
-            if not sales_order.label_printed_on:
-                # TODO: Add small timeout to avoid connection refused errors?
-                print_raw(settings.label_printer_ip, settings.label_printer_port, content)
-                sales_order.label_printed_on = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                sales_order.save()
-                frappe.db.commit()
-            else:
-                warning = f"Shipping Label for Sales Order {sales_order.name} seems to be already printed on {sales_order.label_printed_on}. Not going to print again. Please make sure that you are in the correct report and refresh it."
-        except Exception as err:
-            msg = "Error printing label for '{0}':\n{1}".format(sales_order.name, err)
-            if str(err) != '[Errno 111] Connection refused':
+    errors = []
+    warnings = []
+
+    with LabelSpooler() as spooler:
+        for o in sales_orders:
+            sales_order = frappe.get_doc("Sales Order", o)
+            if sales_order.label_printed_on:
+                warnings.append(f"Shipping Label for Sales Order {sales_order.name} seems to be already printed on {sales_order.label_printed_on}. Not going to print again. Please make sure that you are in the correct report and refresh it.")
+                continue
+            try:
+                label_data = get_label_data(sales_order)
+                content = frappe.render_template(NOVEXX_PRINTER_TEMPLATE, label_data)
+            except Exception as err:
+                msg = "Error printing label for '{0}':\n{1}".format(sales_order.name, err)
                 frappe.log_error(msg, "print_oligo_order_labels")
-            frappe.throw(msg)
-        if warning:
-            frappe.log_error(warning, "print_oligo_order_labels")
-            frappe.throw(warning)
+                errors.append(msg)
+                continue
+            spooler.add(settings.label_printer_ip, settings.label_printer_port, content, sales_order.name)
+        printed, failed = spooler.flush()
+
+    set_label_printed_on(printed)
+    frappe.db.commit()
+
+    for sales_order, err in failed.items():
+        msg = "Error printing label for '{0}':\n{1}".format(sales_order, err)
+        if not isinstance(err, ConnectionRefusedError):
+            frappe.log_error(msg, "print_oligo_order_labels")
+        errors.append(msg)
+    for warning in warnings:
+        frappe.log_error(warning, "print_oligo_order_labels")
+    if errors or warnings:
+        frappe.throw("<br>".join(errors + warnings))
     return
 
 
+def set_label_printed_on(sales_orders):
+    """
+    Set label_printed_on of the given Sales Orders to now with a single update.
+    """
+    if len(sales_orders) == 0:
+        return
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    frappe.db.sql("""
+        UPDATE `tabSales Order`
+        SET `label_printed_on` = %(timestamp)s,
+            `modified` = %(timestamp)s,
+            `modified_by` = %(user)s
+        WHERE `name` IN %(sales_orders)s;
+        """, {'timestamp': timestamp, 'user': frappe.session.user, 'sales_orders': sales_orders})
+
+
+def benchmark_label_spooler(number_of_labels=200):
+    """
+    Compare printing the given number of labels with one connection per label (previous print_raw)
+    and with the LabelSpooler against a local fake socket printer.
+
+    bench execute microsynth.microsynth.labels.benchmark_label_spooler --kwargs "{'number_of_labels': 200}"
+    """
+    import socketserver
+    import threading
+
+    received = {'bytes': 0}
+
+    class FakePrinterHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            while True:
+                data = self.request.recv(65536)
+                if not data:
+                    break
+                received['bytes'] += len(data)
+
+    class FakePrinter(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = FakePrinter(("127.0.0.1", 0), FakePrinterHandler)
+    ip, port = server.server_address
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    content = "#!A1\n#IMS105/148\n" + "#T4#J105#YN101/3U/45///benchmark label#G\n" * 10 + "#Q1/\n#!P1"
+
+    start = time.perf_counter()
+    for n in range(number_of_labels):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((ip, port))
+        s.sendall((content + "\r\n").encode("utf-8"))
+        s.close()
+    duration_single = time.perf_counter() - start
+    print(f"One connection per label: {number_of_labels} labels in {duration_single:.3f} seconds ({number_of_labels / duration_single:.0f} labels/s)")
+
+    start = time.perf_counter()
+    with LabelSpooler() as spooler:
+        for n in range(number_of_labels):
+            spooler.add(ip, port, content, n)
+        printed, failed = spooler.flush()
+    duration_spooler = time.perf_counter() - start
+    print(f"LabelSpooler: {len(printed)} labels in {duration_spooler:.3f} seconds ({len(printed) / duration_spooler:.0f} labels/s), {len(failed)} failed")
+
+    server.shutdown()
+    server.server_close()
+    return {'single_connection_seconds': duration_single, 'spooler_seconds': duration_spooler}
+
+
 def notify_ups_batchfile_error(msg, title="create_ups_batch_file"):
     """
     Helper function to log and notify the administration about errors in the UPS batch file creation.
@@ -322,136 +487,245 @@ def create_ups_batch_file(sales_orders):
                 ws_file.write(ws_line)
 
 
+UPS_WORLD_SHIP_HEADER = "Contact_Name,Company_or_Name,Country,Address_1,City,Postal_Code,Telephone,Consignee_Email,Packaging_Type,Weight,Length,Width,Height,Description_of_Goods,Service,Reference_1,Anzahl_Pakete,Transportkosten,Steuern_Zoll\n"
+UPS_BATCH_CUTOFF_DATE = "2026-08-14"
+UPS_BATCH_QUERY_SIZE = 500
+
+
+def get_ups_shipping_items():
+    """
+    Returns the Shipping Item Codes whose shipping service is a UPS service
+    """
+    return [item_code for item_code, service in SHIPPING_SERVICES.items() if 'UPS' in service]
+
+
+def iterate_ups_batch_rows(conditions, values):
+    """
+    Yield the Sales Orders matching the given SQL conditions (on `tabSales Order` as `so`) whose last
+    Shipping Item is a UPS service, joined with their shipping Address, Country and Contact.
+    Pages through the result ordered by name to keep the memory bounded.
+    """
+    values = dict(values)
+    values['ups_items'] = get_ups_shipping_items()
+    values['last_name'] = ""
+    values['batch_size'] = UPS_BATCH_QUERY_SIZE
+    while True:
+        rows = frappe.db.sql(f"""
+            SELECT
+                `so`.`name`,
+                `so`.`modified`,
+                `so`.`customer`,
+                `so`.`customer_name`,
+                `so`.`order_customer_display`,
+                `so`.`contact_person`,
+                `so`.`contact_display`,
+                `so`.`contact_phone`,
+                `so`.`contact_email`,
+                `so`.`web_order_id`,
+                `so`.`shipping_address_name`,
+                `shipping_item`.`item_code` AS `shipping_item`,
+                `tabAddress`.`name` AS `address_name`,
+                `tabAddress`.`country`,
+                `tabAddress`.`address_line1`,
+                `tabAddress`.`city`,
+                `tabAddress`.`pincode`,
+                `tabAddress`.`overwrite_company`,
+                `tabCountry`.`code` AS `country_code`,
+                `tabContact`.`full_name` AS `shipping_contact_full_name`
+            FROM `tabSales Order` AS `so`
+            JOIN `tabSales Order Item` AS `shipping_item` ON `shipping_item`.`parent` = `so`.`name`
+                AND `shipping_item`.`parenttype` = "Sales Order"
+                AND `shipping_item`.`idx` = (SELECT MAX(`soi`.`idx`)
+                                             FROM `tabSales Order Item` AS `soi`
+                                             WHERE `soi`.`parent` = `so`.`name`
+                                               AND `soi`.`parenttype` = "Sales Order"
+                                               AND `soi`.`item_group` = "Shipping")
+            LEFT JOIN `tabAddress` ON `tabAddress`.`name` = `so`.`shipping_address_name`
+            LEFT JOIN `tabCountry` ON `tabCountry`.`name` = `tabAddress`.`country`
+            LEFT JOIN `tabContact` ON `tabContact`.`name` = IFNULL(NULLIF(`so`.`shipping_contact`, ''), `so`.`contact_person`)
+            WHERE {conditions}
+              AND `shipping_item`.`item_code` IN %(ups_items)s
+              AND `so`.`name` > %(last_name)s
+            ORDER BY `so`.`name`
+            LIMIT %(batch_size)s;
+            """, values, as_dict=True)
+        for row in rows:
+            yield row
+        if len(rows) < UPS_BATCH_QUERY_SIZE:
+            break
+        values['last_name'] = rows[-1]['name']
+
+
+def get_ups_batch_lines(row):
+    """
+    Returns the batch file line, the WorldShip line (None for Poland) and whether the
+    Sales Order goes to Poland for a row of iterate_ups_batch_rows. Returns None and notifies
+    the administration if data is missing.
+    """
+    if not row.address_name:
+        notify_ups_batchfile_error(f"Shipping Address missing on Sales Order {row.name}", "create_ups_batch_file")
+        return None
+    if not row.customer or not row.contact_person:
+        notify_ups_batchfile_error(f"Customer or Contact missing on Sales Order {row.name}", "create_ups_batch_file")
+        return None
+    # Check if all values exist
+    if not row.country:
+        notify_ups_batchfile_error(f"Country missing on Shipping Address '{row.shipping_address_name}' on Sales Order {row.name}", "create_ups_batch_file")
+        return None
+    if not row.country_code:
+        notify_ups_batchfile_error(f"Country code missing on Country '{row.country}' of Shipping Address '{row.shipping_address_name}' on Sales Order {row.name}", "create_ups_batch_file")
+        return None
+    if not row.contact_display:
+        notify_ups_batchfile_error(f"contact_display missing on Sales Order {row.name}", "create_ups_batch_file")
+        return None
+    if not row.customer_name:
+        notify_ups_batchfile_error(f"customer_name missing on Sales Order {row.name}", "create_ups_batch_file")
+        return None
+    if not row.address_line1:
+        notify_ups_batchfile_error(f"address_line1 missing for Address '{row.address_name}' on Sales Order {row.name}", "create_ups_batch_file")
+        return None
+    if not row.city:
+        notify_ups_batchfile_error(f"City missing for Address '{row.address_name}' on Sales Order {row.name}", "create_ups_batch_file")
+        return None
+    if not row.pincode:
+        notify_ups_batchfile_error(f"Pincode missing for Address '{row.address_name}' on Sales Order {row.name}", "create_ups_batch_file")
+        return None
+    raw_phone = row.contact_phone
+    if not row.contact_phone:
+        notify_ups_batchfile_error(f"contact_phone missing on Sales Order {row.name}, taking 0041717228333 instead", "create_ups_batch_file")
+        raw_phone = '0041717228333'  # default phone number
+    phone = re.sub('[ \+.,\-\/]', '', raw_phone.replace('+', '00').replace('(0)', ''))[:15]
+    if row.contact_phone and not phone:
+        notify_ups_batchfile_error(f"contact_phone on Sales Order {row.name} contains only unallowed characters: '{row.contact_phone}', taking 0041717228333 instead", "create_ups_batch_file")
+        phone = '0041717228333'  # default phone number
+    if row.contact_phone and phone and not phone.isdigit():
+        frappe.log_error(f"WARNING: Cleaned phone='{phone}' on Sales Order {row.name} contains characters that are not digits. The original contact_phone was '{row.contact_phone}'.", "create_ups_batch_file")
+    shipping_service = get_shipping_service(row.shipping_item, row, row.customer)
+    is_express = 'EXP' in shipping_service
+    weight = '"0,1"'
+    country_code = row.country_code.upper()
+    customer_name = sanitize_text((row.overwrite_company or row.order_customer_display or row.customer_name).replace(',', '').replace('–', '-'))[:35]
+    contact_display_source = (row.shipping_contact_full_name or row.contact_display or "")
+    contact_display = sanitize_text(contact_display_source.replace(',', '').replace('–', '-'))[:35]
+    address_line1 = sanitize_text(row.address_line1.replace(',', ''))[:35]
+    city = sanitize_text(row.city.replace(',', ''))[:30]
+    pincode = (row.pincode or "").replace(',', '')[:10]
+    contact_email = (row.contact_email or "")[:50]
+    web_order_id = (row.web_order_id or "").replace(',', '')[:35]
+    line = f"{contact_display},{customer_name},{country_code},{address_line1},,,{city},,{pincode},{phone},,,{contact_email},2,,{weight},36,25,2,,Nukleotides,,,,{'65' if is_express else '11'},,,,,,,,{web_order_id},,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,\n"
+    # Poland must be exported separately; all other countries go to WorldShip.
+    if country_code == "PL":
+        return line, None, True
+    world_ship_line = f"{contact_display},{customer_name},{country_code},{address_line1},{city},{pincode},{phone},{contact_email},CP,0.1,36,25,2,Nukleotides,{'SV' if is_express else 'ST'},{web_order_id},1,SHP,SHP\n"
+    return line, world_ship_line, False
+
+
 def _prepare_ups_batch_lines(sales_orders):
     # Non-Poland lines feed the WorldShip import; Poland lines go to a separate file.
     non_poland_lines = []
     poland_lines = []
-    world_ship_lines = ["Contact_Name,Company_or_Name,Country,Address_1,City,Postal_Code,Telephone,Consignee_Email,Packaging_Type,Weight,Length,Width,Height,Description_of_Goods,Service,Reference_1,Anzahl_Pakete,Transportkosten,Steuern_Zoll\n"]
+    world_ship_lines = [UPS_WORLD_SHIP_HEADER]
     # Mark only successfully prepared UPS orders as exported.
     exported_sales_orders = []
+    if len(sales_orders) == 0:
+        return non_poland_lines, world_ship_lines, poland_lines, exported_sales_orders
 
-    for o in sales_orders:
-        sales_order = frappe.get_doc("Sales Order", o)
-        label_data = get_label_data(sales_order)
-        # TODO: Create a mapping from Shipping Item Codes to UPS Service Types and store it somewhere in the ERP settings
-        if not label_data or not label_data['shipping_service'] or not 'UPS' in label_data['shipping_service']:
-            continue
-        address = frappe.get_doc("Address", sales_order.shipping_address_name)
-        # Check if all values exist
-        if not address.country:
-            notify_ups_batchfile_error(f"Country missing on Shipping Address '{sales_order.shipping_address_name}' on Sales Order {sales_order.name}", "create_ups_batch_file")
-            continue
-        country_code = frappe.get_value("Country", address.country, "code")
-        if not country_code:
-            notify_ups_batchfile_error(f"Country code missing on Country '{address.country}' of Shipping Address '{sales_order.shipping_address_name}' on Sales Order {sales_order.name}", "create_ups_batch_file")
-            continue
-        if not sales_order.contact_display:
-            notify_ups_batchfile_error(f"contact_display missing on Sales Order {sales_order.name}", "create_ups_batch_file")
-            continue
-        if not sales_order.customer_name:
-            notify_ups_batchfile_error(f"customer_name missing on Sales Order {sales_order.name}", "create_ups_batch_file")
-            continue
-        if not address.address_line1:
-            notify_ups_batchfile_error(f"address_line1 missing for Address '{address.name}' on Sales Order {sales_order.name}", "create_ups_batch_file")
-            continue
-        if not address.city:
-            notify_ups_batchfile_error(f"City missing for Address '{address.name}' on Sales Order {sales_order.name}", "create_ups_batch_file")
-            continue
-        if not address.pincode:
-            notify_ups_batchfile_error(f"Pincode missing for Address '{address.name}' on Sales Order {sales_order.name}", "create_ups_batch_file")
+    for row in iterate_ups_batch_rows("`so`.`name` IN %(sales_orders)s", {'sales_orders': sales_orders}):
+        lines = get_ups_batch_lines(row)
+        if not lines:
             continue
-        raw_phone = sales_order.contact_phone
-        if not sales_order.contact_phone:
-            notify_ups_batchfile_error(f"contact_phone missing on Sales Order {sales_order.name}, taking 0041717228333 instead", "create_ups_batch_file")
-            raw_phone = '0041717228333'  # default phone number
-        phone = re.sub('[ \+.,\-\/]', '', raw_phone.replace('+', '00').replace('(0)', ''))[:15]
-        if sales_order.contact_phone and not phone:
-            notify_ups_batchfile_error(f"contact_phone on Sales Order {sales_order.name} contains only unallowed characters: '{sales_order.contact_phone}', taking 0041717228333 instead", "create_ups_batch_file")
-            phone = '0041717228333'  # default phone number
-        if sales_order.contact_phone and phone and not phone.isdigit():
-            frappe.log_error(f"WARNING: Cleaned phone='{phone}' on Sales Order {sales_order.name} contains characters that are not digits. The original contact_phone was '{sales_order.contact_phone}'.", "create_ups_batch_file")
-        is_express = 'EXP' in label_data['shipping_service']
-        weight = '"0,1"'
-        customer_name = sanitize_text((address.overwrite_company or sales_order.order_customer_display or sales_order.customer_name).replace(',', '').replace('–', '-'))[:35]
-        shipping_contact_full_name = frappe.get_value("Contact", sales_order.shipping_contact or sales_order.contact_person, "full_name")
-        contact_display_source = (shipping_contact_full_name or sales_order.contact_display or "")
-        contact_display = sanitize_text(contact_display_source.replace(',', '').replace('–', '-'))[:35]
-        address_line1 = sanitize_text(address.address_line1.replace(',', ''))[:35]
-        city = sanitize_text(address.city.replace(',', ''))[:30]
-        pincode = (address.pincode or "").replace(',', '')[:10]
-        contact_email = (sales_order.contact_email or "")[:50]
-        web_order_id = (sales_order.web_order_id or "").replace(',', '')[:35]
-        line_to_write = f"{contact_display},{customer_name},{country_code.upper()},{address_line1},,,{city},,{pincode},{phone},,,{contact_email},2,,{weight},36,25,2,,Nukleotides,,,,{'65' if is_express else '11'},,,,,,,,{web_order_id},,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,\n"
-        # Poland must be exported separately; all other countries go to WorldShip.
-        if country_code.upper() == "PL":
-            poland_lines.append(line_to_write)
+        line, world_ship_line, is_poland = lines
+        if is_poland:
+            poland_lines.append(line)
         else:
-            non_poland_lines.append(line_to_write)
-            world_ship_lines.append(f"{contact_display},{customer_name},{country_code.upper()},{address_line1},{city},{pincode},{phone},{contact_email},CP,0.1,36,25,2,Nukleotides,{'SV' if is_express else 'ST'},{web_order_id},1,SHP,SHP\n")
-        exported_sales_orders.append(sales_order.name)
+            non_poland_lines.append(line)
+            world_ship_lines.append(world_ship_line)
+        exported_sales_orders.append(row.name)
 
     return non_poland_lines, world_ship_lines, poland_lines, exported_sales_orders
 
 
+def set_shipping_batch_file_exported_on(sales_orders, exported_on):
+    """
+    Mark the given Sales Orders as exported to a UPS batch file with a single update.
+    """
+    if len(sales_orders) == 0:
+        return
+    frappe.db.sql("""
+        UPDATE `tabSales Order`
+        SET `shipping_batch_file_exported_on` = %(exported_on)s,
+            `modified` = %(exported_on)s,
+            `modified_by` = %(user)s
+        WHERE `name` IN %(sales_orders)s;
+        """, {'exported_on': exported_on, 'user': frappe.session.user, 'sales_orders': sales_orders})
+
+
 def create_daily_ups_batch_files():
     """
-    Generate two UPS batch files once per day based on Sales Orders where labels were
-    printed after 14.08.2026 and no batch export timestamp is set yet.
+    Generate two UPS batch files once per day based on submitted UPS Sales Orders after 14.08.2026
+    without batch export timestamp.
+
+    Only Sales Orders modified since the watermark of the previous run (Microsynth Settings) are considered.
+    The watermark stays at the oldest UPS Sales Order that could not be exported so that it is retried
+    the next day. Non-UPS Sales Orders are excluded in the query.
 
     10 11 * * 1-5 cd /home/frappe/frappe-bench && /usr/local/bin/bench --site erp.microsynth.local execute microsynth.microsynth.labels.create_daily_ups_batch_files
 
     bench execute microsynth.microsynth.labels.create_daily_ups_batch_files
     """
     now_dt = frappe.utils.now_datetime()
+    watermark = frappe.db.get_single_value("Microsynth Settings", "ups_batch_export_watermark")
 
-    # Idempotency rule: only orders with a fresh label print and without export timestamp.
+    # Idempotency rule: only orders without export timestamp.
     # Process only orders strictly after 14.08.2026.
-    cutoff_date = "2026-08-14"
-    sales_orders = frappe.db.sql(
-        """
-        SELECT `name`
-        FROM `tabSales Order`
-        WHERE
-            `docstatus` = 1
-            AND DATE(`transaction_date`) > %(cutoff_date)s
-            AND (`shipping_batch_file_exported_on` IS NULL OR `shipping_batch_file_exported_on` = '')
-        """,
-        {"cutoff_date": cutoff_date},
-        as_list=True
-    )
-    sales_orders = [row[0] for row in sales_orders]
-
-    non_poland_lines, world_ship_lines, poland_lines, exported_sales_orders = _prepare_ups_batch_lines(sales_orders)
+    conditions = """`so`.`docstatus` = 1
+        AND DATE(`so`.`transaction_date`) > %(cutoff_date)s
+        AND (`so`.`shipping_batch_file_exported_on` IS NULL OR `so`.`shipping_batch_file_exported_on` = '')"""
+    values = {'cutoff_date': UPS_BATCH_CUTOFF_DATE}
+    if watermark:
+        conditions += " AND `so`.`modified` >= %(watermark)s"
+        values['watermark'] = watermark
+
+    non_poland_count = 0
+    poland_count = 0
+    exported_sales_orders = []
+    next_watermark = now_dt
 
     os.makedirs(UPS_WORLDSHIP_IMPORT_DIR, exist_ok=True)
-    # Always overwrite the fixed WorldShip filename.
-    with open(os.path.join(UPS_WORLDSHIP_IMPORT_DIR, UPS_WORLDSHIP_FILENAME), mode="w") as ws_file:
-        for ws_line in world_ship_lines:
-            ws_file.write(ws_line)
-
     os.makedirs(UPS_BATCH_FILES_BASE_DIR, exist_ok=True)
     poland_file_path = os.path.join(
         UPS_BATCH_FILES_BASE_DIR,
         f"{now_dt.strftime('%Y-%m-%d_%H-%M')}_ups_batch_poland.csv"
     )
-    with open(poland_file_path, mode="w") as file:
-        for line in poland_lines:
-            file.write(line)
-
-    if exported_sales_orders:
-        # Mark all successfully exported UPS sales orders to prevent re-export.
-        exported_on = now_dt.strftime("%Y-%m-%d %H:%M:%S")
-        for so_name in set(exported_sales_orders):
-            so_doc = frappe.get_doc("Sales Order", so_name)
-            so_doc.shipping_batch_file_exported_on = exported_on
-            so_doc.save(ignore_permissions=True)
-        frappe.db.commit()
+    # Always overwrite the fixed WorldShip filename.
+    with open(os.path.join(UPS_WORLDSHIP_IMPORT_DIR, UPS_WORLDSHIP_FILENAME), mode="w") as ws_file, \
+         open(poland_file_path, mode="w") as poland_file:
+        ws_file.write(UPS_WORLD_SHIP_HEADER)
+        for row in iterate_ups_batch_rows(conditions, values):
+            lines = get_ups_batch_lines(row)
+            if not lines:
+                # retry this Sales Order in the next run
+                next_watermark = min(next_watermark, row.modified)
+                continue
+            line, world_ship_line, is_poland = lines
+            if is_poland:
+                poland_file.write(line)
+                poland_count += 1
+            else:
+                ws_file.write(world_ship_line)
+                non_poland_count += 1
+            exported_sales_orders.append(row.name)
+
+    # Mark all successfully exported UPS sales orders to prevent re-export.
+    set_shipping_batch_file_exported_on(exported_sales_orders, now_dt.strftime("%Y-%m-%d %H:%M:%S"))
+    frappe.db.set_value("Microsynth Settings", "Microsynth Settings", "ups_batch_export_watermark", next_watermark)
+    frappe.db.commit()
 
     frappe.logger().info(
         "Daily UPS batch generation finished. Non-PL lines: %s, PL lines: %s, exported Sales Orders: %s",
-        len(non_poland_lines),
-        len(poland_lines),
-        len(set(exported_sales_orders))
+        non_poland_count,
+        poland_count,
+        len(exported_sales_orders)
     )
 
 
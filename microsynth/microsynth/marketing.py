@@ -6,9 +6,14 @@ from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 import frappe
-from frappe.utils import get_url_to_form, nowdate
+from frappe.utils import get_url_to_form, nowdate, now
 
 from microsynth.microsynth.utils import get_customer, send_email_from_template, configure_new_customer
+from microsynth.microsynth.doctype.contact_search_index.contact_search_index import update_contact_search_index
+
+
+CUSTOMER_STATUS_PRIORITY = {'potential': 0, 'former': 1, 'active': 2}
+MARKETING_UPDATE_BATCH_SIZE = 1000
 
 
 def update_marketing_classification(contact_id):
@@ -18,10 +23,7 @@ def update_marketing_classification(contact_id):
     run
     bench execute microsynth.microsynth.marketing.update_marketing_classification --kwargs "{'contact_id': 236203}"
     """
-    sales_orders = get_sales_orders(contact_person=contact_id)
-    update_contact_classification(sales_orders, contact_id)
-    customer = get_customer(contact_id)
-    update_customer_status([customer])
+    recompute_marketing_classification(contacts=[contact_id], customers=[get_customer(contact_id)], verbose=False)
 
 
 def get_sales_orders(start_date=None, end_date=None, contact_person=None):
@@ -71,12 +73,222 @@ def get_contacts(customer_id):
     return frappe.db.sql(sql_query, as_dict=True)
 
 
+def get_contact_classification(last_order_date, one_year_ago):
+    """
+    Derive the Contact Classification from the date of the newest Sales Order of a Contact Person.
+    """
+    if not last_order_date:
+        # Do not change contact.status since webshop is using it
+        return 'Lead'
+    if last_order_date >= one_year_ago:
+        return 'Buyer'
+    return 'Former Buyer'
+
+
+def get_customer_status(contact_classifications):
+    """
+    Derive the Customer Status of all Contacts of a Customer from their Contact Classifications.
+    """
+    if 'Buyer' in contact_classifications:
+        # If at least one Contact of this Customer has Contact Classification 'Buyer',
+        # all Contacts of this Customer get assigned Customer Status 'active'.
+        return 'active'
+    if 'Former Buyer' in contact_classifications:
+        # If no Contact of this Customer has Contact Classification 'Buyer' but at least one Contact of this Customer
+        # has Contact Classification 'Former Buyer', all Contacts of this Customer get assigned Customer Status 'former'.
+        return 'former'
+    # If no Contact of this Customer has Contact Classification 'Buyer' or 'Former Buyer',
+    # all Contacts of this Customer get assigned Customer Status 'potential'.
+    return 'potential'
+
+
+def compute_contact_classifications(contacts=None):
+    """
+    Compute the Contact Classification of the given Contacts (all non-Disabled Contacts if None) with one aggregate query.
+    Returns a dictionary contact -> (current classification, new classification).
+    """
+    if contacts is not None:
+        contacts = list({c for c in contacts if c})
+        if len(contacts) == 0:
+            return {}
+        contact_condition = "`tabContact`.`name` IN %(contacts)s"
+    else:
+        contact_condition = "`tabContact`.`status` != 'Disabled'"
+    rows = frappe.db.sql(f"""
+        SELECT `tabContact`.`name`,
+            `tabContact`.`contact_classification`,
+            MAX(`tabSales Order`.`transaction_date`) AS `last_order_date`
+        FROM `tabContact`
+        LEFT JOIN `tabSales Order` ON `tabSales Order`.`contact_person` = `tabContact`.`name`
+                                  AND `tabSales Order`.`docstatus` = 1
+                                  AND `tabSales Order`.`status` NOT IN ("Closed", "Cancelled")
+        WHERE {contact_condition}
+        GROUP BY `tabContact`.`name`
+        """, {'contacts': contacts}, as_dict=True)
+    one_year_ago = date.today() - relativedelta(months = 12)
+    return { r['name']: (r['contact_classification'], get_contact_classification(r['last_order_date'], one_year_ago)) for r in rows }
+
+
+def compute_customer_statuses(customers=None, contact_classifications=None):
+    """
+    Compute the Customer Status of all non-Disabled Contacts of the given Customers (all Customers if None) with one query.
+    New Contact Classifications that are not written yet can be passed as dictionary contact -> classification.
+    A Contact of several given Customers gets the highest status of these Customers.
+    Returns a dictionary contact -> (current status, new status).
+    """
+    contact_classifications = contact_classifications or {}
+    if customers is not None:
+        customers = list({c for c in customers if c})
+        if len(customers) == 0:
+            return {}
+        customer_condition = "AND `tDLA`.`link_name` IN %(customers)s"
+    else:
+        customer_condition = ""
+    rows = frappe.db.sql(f"""
+        SELECT `tDLA`.`link_name` AS `customer`,
+            `tabContact`.`name` AS `contact`,
+            `tabContact`.`contact_classification`,
+            `tabContact`.`customer_status`
+        FROM `tabContact`
+        JOIN `tabDynamic Link` AS `tDLA` ON `tDLA`.`parent` = `tabContact`.`name`
+                                        AND `tDLA`.`parenttype`  = "Contact"
+                                        AND `tDLA`.`link_doctype` = "Customer"
+        WHERE `tabContact`.`status` != "Disabled"
+            {customer_condition}
+        """, {'customers': customers}, as_dict=True)
+    classifications_by_customer = {}
+    current_statuses = {}
+    for r in rows:
+        classification = contact_classifications.get(r['contact'], r['contact_classification'])
+        classifications_by_customer.setdefault(r['customer'], set()).add(classification)
+        current_statuses[r['contact']] = r['customer_status']
+    new_statuses = {}
+    for r in rows:
+        status = get_customer_status(classifications_by_customer[r['customer']])
+        if not r['contact'] in new_statuses or CUSTOMER_STATUS_PRIORITY[status] > CUSTOMER_STATUS_PRIORITY[new_statuses[r['contact']]]:
+            new_statuses[r['contact']] = status
+    return { contact: (current_statuses[contact], status) for contact, status in new_statuses.items() }
+
+
+def compute_marketing_changes(contacts=None, customers=None):
+    """
+    Compute the changes of Contact Classification (of the given Contacts) and Customer Status (of the Contacts of the given Customers).
+    None means all Contacts or all Customers, an empty list means none.
+    Returns a list of dictionaries with contact, field, old and new value.
+    """
+    changes = []
+    classifications = compute_contact_classifications(contacts) if contacts != [] else {}
+    for contact, (old, new) in classifications.items():
+        if old != new:
+            changes.append({'contact': contact, 'field': 'contact_classification', 'old': old, 'new': new})
+    statuses = compute_customer_statuses(customers, { c: v[1] for c, v in classifications.items() }) if customers != [] else {}
+    for contact, (old, new) in statuses.items():
+        if old != new:
+            changes.append({'contact': contact, 'field': 'customer_status', 'old': old, 'new': new})
+    return changes
+
+
+def apply_marketing_changes(changes):
+    """
+    Write the given changes with one UPDATE per field, value and batch of Contacts and add the Versions in batches.
+    The UPDATE bypasses the Contact hooks, therefore refresh the Contact Search Index of the changed Contacts.
+    """
+    timestamp = now()
+    user = frappe.session.user
+    groups = {}
+    for change in changes:
+        groups.setdefault((change['field'], change['new']), []).append(change['contact'])
+    for (field, value), contacts in groups.items():
+        for i in range(0, len(contacts), MARKETING_UPDATE_BATCH_SIZE):
+            frappe.db.sql(f"""
+                UPDATE `tabContact`
+                SET `{field}` = %(value)s,
+                    `modified` = %(now)s,
+                    `modified_by` = %(user)s
+                WHERE `name` IN %(contacts)s;
+                """, {'value': value, 'now': timestamp, 'user': user, 'contacts': contacts[i:i + MARKETING_UPDATE_BATCH_SIZE]})
+    update_contact_search_index([change['contact'] for change in changes])
+
+    if not frappe.get_meta("Contact").track_changes:
+        return
+    changes_by_contact = {}
+    for change in changes:
+        changes_by_contact.setdefault(change['contact'], []).append([change['field'], change['old'], change['new']])
+    versions = []
+    for contact, changed in changes_by_contact.items():
+        data = json.dumps({'added': [], 'changed': changed, 'removed': [], 'row_changed': []}, indent=1)
+        versions.append((frappe.generate_hash(length=10), timestamp, timestamp, user, user, "Contact", contact, data))
+    for i in range(0, len(versions), MARKETING_UPDATE_BATCH_SIZE):
+        batch = versions[i:i + MARKETING_UPDATE_BATCH_SIZE]
+        frappe.db.sql("""
+            INSERT INTO `tabVersion` (`name`, `creation`, `modified`, `modified_by`, `owner`, `docstatus`, `ref_doctype`, `docname`, `data`)
+            VALUES {values};
+            """.format(values=", ".join(["(%s, %s, %s, %s, %s, 0, %s, %s, %s)"] * len(batch))),
+            [value for version in batch for value in version])
+
+
+def print_marketing_changes(changes):
+    """
+    Print a summary of the given changes (number of Contacts per transition) and the first changes per transition.
+    """
+    transitions = {}
+    for change in changes:
+        transitions.setdefault((change['field'], change['old'], change['new']), []).append(change['contact'])
+    for (field, old, new), contacts in sorted(transitions.items(), key=lambda t: (t[0][0], str(t[0][1]), t[0][2])):
+        print(f"{field}: {old} -> {new}: {len(contacts)} Contacts (e.g. {', '.join(contacts[:10])})")
+
+
+def recompute_marketing_classification(contacts=None, customers=None, dry_run=False, verbose=True):
+    """
+    Recompute Contact Classification of the given Contacts and the Customer Status of all Contacts of the given Customers
+    with a few aggregate queries and apply only the differences. None means all (non-Disabled) Contacts or all Customers.
+    Returns the list of changes (only reported but not written if dry_run).
+
+    run
+    bench execute microsynth.microsynth.marketing.recompute_marketing_classification --kwargs "{'contacts': ['236203'], 'customers': ['8003'], 'dry_run': True}"
+    """
+    start_ts = datetime.now()
+    changes = compute_marketing_changes(contacts, customers)
+    if verbose:
+        print(f"{datetime.now()}: Found {len(changes)} changes of Contact Classification or Customer Status.")
+        print_marketing_changes(changes)
+    if not dry_run and len(changes) > 0:
+        try:
+            apply_marketing_changes(changes)
+            frappe.db.commit()
+        except Exception as err:
+            frappe.db.rollback()
+            msg = f"Unable to apply {len(changes)} marketing classification changes due to the following error:\n{err}"
+            print(msg)
+            frappe.log_error(msg, 'marketing.recompute_marketing_classification')
+    if verbose:
+        elapsed_time = timedelta(seconds=(datetime.now() - start_ts).total_seconds())
+        print(f"{datetime.now()}: Finished recompute_marketing_classification after {elapsed_time} hh:mm:ss{' (dry run)' if dry_run else ''}.")
+    return changes
+
+
+def get_customers_of_contacts(contacts):
+    """
+    Return the set of Customers linked to the given Contacts with one query.
+    """
+    contacts = list({c for c in contacts if c})
+    if len(contacts) == 0:
+        return set()
+    links = frappe.db.sql("""
+        SELECT DISTINCT `link_name`
+        FROM `tabDynamic Link`
+        WHERE `parenttype` = "Contact"
+            AND `link_doctype` = "Customer"
+            AND `parent` IN %(contacts)s
+        """, {'contacts': contacts}, as_dict=True)
+    return { l['link_name'] for l in links }
+
+
 def update_newly_created_contacts(already_updated_contacts, previous_days):
     """
     Called by the function update_new_and_active_contacts.
     Sets the Contact Classification and Customer Status of all new Contacts that are not already processed by the function update_contacts_from_new_orders.
     """
-    customers = set()
     sql_query = f"""
         SELECT `tabContact`.`name` AS `name`
         FROM `tabContact`
@@ -84,16 +296,8 @@ def update_newly_created_contacts(already_updated_contacts, previous_days):
             AND `tabContact`.`status` != "Disabled"
             AND (`tabContact`.`has_webshop_account` = 1 OR `tabContact`.`contact_source` = "Manual")
         """
-    new_contacts = frappe.db.sql(sql_query, as_dict=True)
-
-    for contact in new_contacts:
-        if contact['name'] in already_updated_contacts:
-            continue
-        sales_orders = get_sales_orders(contact_person=contact['name'])
-        update_contact_classification(sales_orders, contact['name'])
-        customer = get_customer(contact['name'])
-        customers.add(customer)
-    update_customer_status(customers)
+    new_contacts = [c['name'] for c in frappe.db.sql(sql_query, as_dict=True) if not c['name'] in already_updated_contacts]
+    recompute_marketing_classification(contacts=new_contacts, customers=get_customers_of_contacts(new_contacts))
 
 
 def update_contacts_from_new_orders(previous_days):
@@ -102,42 +306,12 @@ def update_contacts_from_new_orders(previous_days):
     Sets a Contact to active and Buyer if this Contact is Contact Person of a new Sales Order.
     """
     start_date = date.today() - timedelta(days=previous_days)
-    updated_contact_persons = set()
     new_orders = get_sales_orders(start_date=start_date, end_date=date.today())
     print(f"{datetime.now()}: Going to update Contacts of {len(new_orders)} new Sales Orders...")
-
-    for idx, order in enumerate(new_orders):
-        if order['contact_person'] in updated_contact_persons:
-            continue  # avoid processing Contacts twice
-
-        contact_person = frappe.get_doc('Contact', order['contact_person'])
-
-        if contact_person.contact_classification != 'Buyer':
-            # update Contact Classification
-            contact_person.contact_classification = 'Buyer'
-            contact_person.save()
-
-        # update Customer Status of all Contacts of the corresponding Customer
-        customer_contacts = get_contacts(order['customer'])
-        for contact_id in customer_contacts:
-            contact = frappe.get_doc('Contact', contact_id)
-            if contact.customer_status != 'active':
-                contact.customer_status = 'active'
-                try:
-                    contact.save()
-                except Exception as e:
-                    msg = f"Unable to save Contact {contact.name} due to the following error:\n{e}"
-                    print(msg)
-                    frappe.log_error(msg, 'marketing.update_contacts_from_new_orders')
-
-        updated_contact_persons.add(order['contact_person'])
-        frappe.db.commit()
-
-        if idx % 50 == 0 and idx > 0:
-            perc = round(100 * idx / len(new_orders), 2)
-            print(f"{datetime.now()}: Already updated Contacts of {perc} % ({idx}) of {len(new_orders)} new Sales Orders.")
-
-    return updated_contact_persons
+    contact_persons = { order['contact_person'] for order in new_orders if order['contact_person'] }
+    customers = { order['customer'] for order in new_orders } | get_customers_of_contacts(contact_persons)
+    recompute_marketing_classification(contacts=contact_persons, customers=customers)
+    return contact_persons
 
 
 def update_new_and_active_contacts(previous_days):
@@ -155,7 +329,7 @@ def update_new_and_active_contacts(previous_days):
     print(f"{datetime.now()}: Finished update_new_and_active_contacts after {elapsed_time} hh:mm:ss.")
 
 
-def update_contacts_from_old_orders(days):
+def update_contacts_from_old_orders(days, dry_run=False):
     """
     Updates the two fields Contact.contact_classification and Contact.customer_status
     of Contact Persons from Sales Orders that turned one year old in the last :param days.
@@ -170,167 +344,46 @@ def update_contacts_from_old_orders(days):
 
     orders = get_sales_orders(start_date=start_date, end_date=one_year_ago)
     print(f"{datetime.now()}: Going to update Contacts of {len(orders)} old Sales Orders...")
-
-    # create empty sets (no duplicates)
-    updated_contact_persons = set()
-    customers_to_check = set()
-
-    for idx, order in enumerate(orders):
-        if order['contact_person'] in updated_contact_persons:
-            continue  # avoid processing Contacts twice
-
-        new_orders = get_sales_orders(start_date=one_year_ago, end_date=date.today(), contact_person=order['contact_person'])
-        if len(new_orders) < 1:
-            contact_person = frappe.get_doc('Contact', order['contact_person'])
-            contact_person.contact_classification = 'Former Buyer'
-            contact_person.save()
-        # else: contact_classification should remain 'Buyer'
-
-        customers_to_check.add(order['customer'])
-        updated_contact_persons.add(order['contact_person'])
-
-        if idx % 50 == 0 and idx > 0:
-            perc = round(100 * idx / len(orders), 2)
-            print(f"{datetime.now()}: Already updated Contact Classification of Contact Persons of {perc} % ({idx}) of {len(orders)} old Sales Orders.")
-
-        frappe.db.commit()
-
-    update_customer_status(customers_to_check)
+    contact_persons = { order['contact_person'] for order in orders if order['contact_person'] }
+    customers = { order['customer'] for order in orders }
+    recompute_marketing_classification(contacts=contact_persons, customers=customers, dry_run=dry_run)
     elapsed_time = timedelta(seconds=(datetime.now() - start_ts).total_seconds())
     print(f"{datetime.now()}: Finished update_contacts_from_old_orders after {elapsed_time} hh:mm:ss.")
 
 
-def update_customer_status(customers):
+def update_customer_status(customers, dry_run=False):
     """
     Sets the Customer Status of all Contacts of the given Customers.
     Assumes that the Contact Classification of the Contacts is correctly set.
     """
     print(f"\n{datetime.now()}: Going to update customer_status of Contacts of {len(customers)} Customers...")
+    return recompute_marketing_classification(contacts=[], customers=customers, dry_run=dry_run)
 
-    for idx, customer in enumerate(customers):
-        try:
-            contacts = get_contacts(customer)
-        except Exception as e:
-            msg = f"Got the following error when querying Contacts of the Customer '{customer['name']}':\n{e}"
-            print(msg)
-            frappe.log_error(msg, 'marketing.update_customer_status')
-            continue
-
-        status = {'active': False, 'former': False}
-
-        for contact in contacts:
-            contact_classification = frappe.get_value('Contact', contact['name'], 'contact_classification')
-            if contact_classification == 'Buyer':
-                status['active'] = True
-            elif contact_classification == 'Former Buyer':
-                status['former'] = True
-            # else: Lead or ''
-
-        if status['active']:
-            # If at least one Contact of this Customer has Contact Classification 'Buyer',
-            # all Contacts of this Customer get assigned Customer Status 'active'.
-            customer_status = 'active'
-        elif status['former']:
-            # If no Contact of this Customer has Contact Classification 'Buyer' but at least one Contact of this Customer
-            # has Contact Classification 'Former Buyer', all Contacts of this Customer get assigned Customer Status 'former'.
-            customer_status = 'former'
-        else:
-            # If no Contact of this Customer has Contact Classification 'Buyer' or 'Former Buyer',
-            # all Contacts of this Customer get assigned Customer Status 'potential'.
-            customer_status = 'potential'
-
-        for contact in contacts:
-            contact_doc = frappe.get_doc('Contact', contact['name'])
-            if contact_doc.customer_status != customer_status:
-                contact_doc.customer_status = customer_status
-                #frappe.db.set_value("Contact", contact['name'], "customer_status", customer_status, update_modified = False)
-                try:
-                    contact_doc.save()
-                except Exception as e:
-                    msg = f"Unable to save Contact {contact.name} due to the following error:\n{e}"
-                    print(msg)
-                    frappe.log_error(msg, 'marketing.update_customer_status')
-
-        if idx % 200 == 0 and idx > 0:
-            frappe.db.commit()
-            print(f"{datetime.now()}: Already updated Customer Status of Contacts of {round(100 * idx / len(customers), 2)} % ({idx}) of {len(customers)} Customers.")
-
-    frappe.db.commit()
 
-
-def update_contact_classification(sales_orders, contact_name):
-    """
-    Sets the Contact Classification of the given Contact according to the given Sales Orders.
-    Assumes that the given Sales Orders are sorted by transaction_date descending (newest first).
-    """
-    contact = frappe.get_doc("Contact", contact_name)
-    one_year_ago = date.today() - relativedelta(months = 12)
-    if len(sales_orders) > 0:
-        newest_order = sales_orders[0]
-        if newest_order['transaction_date'] >= one_year_ago:
-            contact_classification = 'Buyer'
-        else:
-            contact_classification = 'Former Buyer'
-    else:
-        # Do not change contact.status since webshop is using it
-        contact_classification = 'Lead'
-
-    #frappe.db.set_value("Contact", contact_name, "contact_classification", contact_classification, update_modified = False)
-    if contact.contact_classification != contact_classification:
-        contact.contact_classification = contact_classification
-        try:
-            contact.save()
-        except Exception as e:
-            msg = f"Unable to save Contact {contact_name} due to the following error:\n{e}"
-            print(msg)
-            frappe.log_error(msg, 'marketing.initialize_contact_classification')
-        frappe.db.commit()
-
-
-def initialize_contact_classification():
+def initialize_contact_classification(dry_run=False):
     """
     Initializes the field Contact.contact_classification for all Contacts that have not Status Disabled.
     """
-    start_ts = datetime.now()
-    contacts = frappe.get_all("Contact", filters={'status': ('!=', 'Disabled')}, fields=['name'])
-    print(f"{datetime.now()}: Going to initialize contact_classification of {len(contacts)} Contacts...")
-
-    for idx, contact in enumerate(contacts):
-        sales_orders = get_sales_orders(contact_person=contact['name'])
-        update_contact_classification(sales_orders, contact['name'])
-
-        if idx % 100 == 0 and idx > 0:
-            frappe.db.commit()
-            perc = round(100 * idx / len(contacts), 2)
-            print(f"{datetime.now()}: Already initialized Contact Classification of {perc} % ({idx}) of all {len(contacts)} Contacts.")
-
-    frappe.db.commit()
-    elapsed_time = timedelta(seconds=(datetime.now() - start_ts).total_seconds())
-    print(f"{datetime.now()}: Finished initialize_contact_classification after {elapsed_time} hh:mm:ss.")
+    return recompute_marketing_classification(contacts=None, customers=[], dry_run=dry_run)
 
 
-def initialize_customer_status():
+def initialize_customer_status(dry_run=False):
     """
     Initializes the field Contact.customer_status for all Contacts of all Customers.
     Assumes the function initialize_contact_classification to be run beforehand.
     """
-    start_ts = datetime.now()
-    customers_dict = frappe.get_all("Customer", fields=['name'])
-    customers_set = set([c['name'] for c in customers_dict])  # convert dict to a set
-    update_customer_status(customers_set)
-    elapsed_time = timedelta(seconds=(datetime.now() - start_ts).total_seconds())
-    print(f"{datetime.now()}: Finished initialize_customer_status after {elapsed_time} hh:mm:ss.")
+    return recompute_marketing_classification(contacts=[], customers=None, dry_run=dry_run)
 
 
-def initialize_marketing_classification():
+def initialize_marketing_classification(dry_run=False):
     """
-    Initializes the two fields Contact.contact_classification and Contact.customer_status.
+    Full rebuild of the two fields Contact.contact_classification and Contact.customer_status of all Contacts.
+    Use dry_run to only print the differences to the current values.
 
     run
-    bench execute microsynth.microsynth.marketing.initialize_marketing_classification
+    bench execute microsynth.microsynth.marketing.initialize_marketing_classification --kwargs "{'dry_run': True}"
     """
-    initialize_contact_classification()
-    initialize_customer_status()
+    return recompute_marketing_classification(contacts=None, customers=None, dry_run=dry_run)
 
 
 def lock_contact_by_name(contact):
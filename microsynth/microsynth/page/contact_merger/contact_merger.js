@@ -79,6 +79,11 @@ frappe.contact_merger = {
         this.page.main.find(".btn-toggle").on('click', function(btn) {
             frappe.contact_merger.toggle(btn.target.id);
         });
+        // select a similar Contact as Contact 2
+        this.page.main.find(".btn-candidate").on('click', function() {
+            document.getElementById("contact_2").value = this.dataset.contact;
+            frappe.contact_merger.display_contact_details();
+        });
         // check and enable merge button
         if ((document.getElementById("contact_1").value)
             && (document.getElementById("contact_2").value)
@@ -10,6 +10,7 @@ import traceback
 import frappe
 from frappe.model.rename_doc import rename_doc
 from microsynth.microsynth.marketing import update_marketing_classification
+from microsynth.microsynth.doctype.contact_search_index.contact_search_index import get_similar_contacts
 
 
 @frappe.whitelist()
@@ -49,6 +50,10 @@ def get_contact_details(contact_1=None, contact_2=None):
             add_address_print(data, 'contact_2', 'address_2')
         add_document_count(data, 'contact_2')
 
+    if data['contact_1'] and not data['contact_2']:
+        # suggest Contacts to merge into Contact 1
+        data['similar_contacts'] = get_similar_contacts(contact_1)
+
     html = frappe.render_template("microsynth/microsynth/page/contact_merger/contact_details.html", data)
     return {'data': data, 'html': html}
 
@@ -3,135 +3,314 @@
 
 import csv
 import json
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import random
+import time
+import traceback
 
+import numpy as np
 import frappe
-from frappe.utils import flt
+from frappe.utils import flt, now
+from frappe.model.meta import get_field_precision
 from microsynth.microsynth.report.pricing_configurator.pricing_configurator import set_rate, get_rate_or_none
 
 
-def change_reference_rate(reference_price_list_name, item_code, min_qty, reference_rate, new_reference_rate, user):
+REFERENCE_RATE_BATCH_SIZE = 500
+
+
+def publish_price_change_progress(current, total, description):
     """
-    Change the rate (price) of the given combination of Item Code and minimum quantity
-    on each customer price list referring to the given reference price list.
-    Thereby, the existing discounts are kept and the new rate is calculated
-    by applying this calculated discount to the new reference rate.
-    Exception: If the reference rate is 0, no discount can be computed and the general discount is used instead.
+    Report the progress to the user that started the (background) job
     """
-    start_ts = datetime.now()
-    negative_discount_warnings = ""
-    try:
-        reference_rate = float(reference_rate)
-        new_reference_rate = float(new_reference_rate)
-    except ValueError:
-        msg = f"Cannot convert '{reference_rate}' or '{new_reference_rate}' to a float ({reference_price_list_name=}, {item_code=}, {min_qty=}). Going to return."
-        print(msg)
-        frappe.log_error(msg, "pricing.change_reference_rate")
-        return negative_discount_warnings
+    if total:
+        frappe.publish_progress(percent=current * 100.0 / total, title="Changing reference rates", description=description)
 
-    current_reference_rate = get_rate_or_none(item_code, reference_price_list_name, min_qty)
-    if current_reference_rate is None:
-        msg = f"No reference rate found for {item_code=}, {reference_price_list_name=}, {min_qty=}. Going to return."
-        print(msg)
-        frappe.log_error(msg, "pricing.change_reference_rate")
-        return negative_discount_warnings
 
-    if abs(reference_rate - new_reference_rate) < 0.0001:
-        #print(f"{reference_rate=} == {new_reference_rate=} -> nothing to do. Going to return.")
-        return negative_discount_warnings
+def load_item_price_tiers(price_lists, item_codes):
+    """
+    Load all Item Prices of the given Items on the given Price Lists with one query into a dictionary
+    (price_list, item_code) -> list of Item Prices, last modified first (the order in which set_rate finds them)
+    """
+    tiers = {}
+    if not price_lists or not item_codes:
+        return tiers
+    for item_price in frappe.db.sql("""
+        SELECT `name`, `price_list`, `item_code`, `item_name`, `currency`,
+            IFNULL(`min_qty`, 0) AS `min_qty`,
+            IFNULL(`price_list_rate`, 0) AS `rate`,
+            `valid_from`, `valid_upto`, `modified`
+        FROM `tabItem Price`
+        WHERE `price_list` IN %(price_lists)s
+            AND `item_code` IN %(item_codes)s
+        ORDER BY `modified` DESC;
+        """, {'price_lists': list(price_lists), 'item_codes': list(item_codes)}, as_dict=True):
+        item_price['old_rate'] = item_price['rate']
+        tiers.setdefault((item_price['price_list'], item_price['item_code']), []).append(item_price)
+    return tiers
 
-    if abs(current_reference_rate - reference_rate) > 0.0001:
-        msg = f"{current_reference_rate=} in the ERP is unequals given {reference_rate=} ({reference_price_list_name=}, {item_code=}, {min_qty=}). Going to return."
-        print(msg)
-        frappe.log_error(msg, "pricing.change_reference_rate")
-        return negative_discount_warnings
 
-    if frappe.get_value('Item', item_code, 'disabled'):
-        msg = f"Item {item_code} is disabled. Unable to change Item Prices with {min_qty=} for reference price list '{reference_price_list_name}'. Going to return."
-        print(msg)
-        frappe.log_error(msg, "pricing.change_reference_rate")
-        return negative_discount_warnings
+def find_valid_tier_rate(tiers, qty, today):
+    """
+    In-memory version of get_rate_or_none: Return the rate of the valid Item Price with the largest minimum quantity <= qty or None
+    """
+    best = None
+    for tier in tiers:
+        if tier['min_qty'] > qty:
+            continue
+        if (tier['valid_from'] and tier['valid_from'] > today) or (tier['valid_upto'] and tier['valid_upto'] < today):
+            continue
+        if best is None or (tier['min_qty'], tier['valid_from'] or date.min) > (best['min_qty'], best['valid_from'] or date.min):
+            best = tier
+    return best['rate'] if best else None
 
-    changes = "pricelist;old_rate;new_rate"
-    counter = 0
 
-    sql_query = """
-        SELECT `name`
-        FROM `tabPrice List`
-        WHERE `reference_price_list` = '{reference_price_list_name}'
-        AND `enabled` = 1
-        ;""".format(reference_price_list_name=reference_price_list_name)
+def set_tier_rate(tiers, price_list, item_code, min_qty, rate, log_index):
+    """
+    In-memory version of set_rate: Change the first Item Price with the given minimum quantity or add a new one
+    """
+    for i, tier in enumerate(tiers):
+        if tier['min_qty'] == min_qty:
+            tier['rate'] = rate
+            tier['changed'] = True
+            tier['log_index'] = log_index
+            # saving sets modified, the changed Item Price is found first afterwards
+            tiers.insert(0, tiers.pop(i))
+            return
+    tiers.insert(0, {
+        'name': None, 'price_list': price_list, 'item_code': item_code, 'item_name': None, 'currency': None,
+        'min_qty': min_qty, 'rate': rate, 'old_rate': None, 'valid_from': None, 'valid_upto': None, 'modified': None,
+        'changed': True, 'log_index': log_index
+    })
 
-    price_lists = frappe.db.sql(sql_query, as_dict=True)
 
-    for price_list in price_lists:
-        customer_rate = get_rate_or_none(item_code, price_list['name'], min_qty)
-        if customer_rate is None:
-            # The combination of item_code and min_qty is not on the customer Price List. Happens.
-            # Do not add the combination of item_code and min_qty to the customer Price List.
+def plan_reference_rate_changes(reference_changes):
+    """
+    Compute all Item Price changes of the given reference rate changes in memory without writing anything.
+    reference_changes is a list of dicts with reference_price_list, item_code, min_qty, reference_rate and new_reference_rate.
+    The changes are computed one after the other as change_reference_rate did it with one database round trip per rate,
+    based on Item Prices and Price Lists loaded at once.
+
+    Returns a dict with
+    - tiers: (price_list, item_code) -> Item Prices, changed ones marked with changed and log_index
+    - logs: one entry per applied reference change (index = log_index) with the Item Price Log values
+    - negative_discount_warnings: CSV lines as before
+    """
+    today = date.today()
+    item_codes = set(c['item_code'] for c in reference_changes)
+    reference_price_lists = set(c['reference_price_list'] for c in reference_changes)
+    dependent_price_lists = {}
+    general_discounts = {}
+    if reference_price_lists:
+        for price_list in frappe.db.sql("""
+            SELECT `name`, `reference_price_list`, IFNULL(`general_discount`, 0) AS `general_discount`
+            FROM `tabPrice List`
+            WHERE `reference_price_list` IN %(reference_price_lists)s
+                AND `enabled` = 1;
+            """, {'reference_price_lists': list(reference_price_lists)}, as_dict=True):
+            dependent_price_lists.setdefault(price_list['reference_price_list'], []).append(price_list['name'])
+            general_discounts[price_list['name']] = price_list['general_discount']
+    disabled_items = set()
+    if item_codes:
+        disabled_items = set(i['name'] for i in frappe.db.sql("""
+            SELECT `name` FROM `tabItem` WHERE `name` IN %(item_codes)s AND `disabled` = 1;
+            """, {'item_codes': list(item_codes)}, as_dict=True))
+    all_price_lists = reference_price_lists.union(general_discounts.keys())
+    tiers = load_item_price_tiers(all_price_lists, item_codes)
+
+    plan = {'tiers': tiers, 'logs': [], 'negative_discount_warnings': ""}
+    for n, change in enumerate(reference_changes):
+        reference_price_list_name = change['reference_price_list']
+        item_code = change['item_code']
+        min_qty = change['min_qty']
+        try:
+            reference_rate = float(change['reference_rate'])
+            new_reference_rate = float(change['new_reference_rate'])
+        except ValueError:
+            msg = f"Cannot convert '{change['reference_rate']}' or '{change['new_reference_rate']}' to a float ({reference_price_list_name=}, {item_code=}, {min_qty=}). Going to return."
+            print(msg)
+            frappe.log_error(msg, "pricing.change_reference_rate")
             continue
 
-        if abs(reference_rate) < 0.0001:  # reference_rate is too close to 0 to calculate the discount (division by 0 issue) -> apply General Discount
-            #msg = f"Unable to change customer Price List rate for item {item_code} with {min_qty=} on Price List '{price_list['name']}' since {reference_rate=} is too close to 0 to divide by it for computing the current discount"
-            #msg = f"WARNING: {reference_rate=} -> Customer Price List rate is set to 0"
-            #frappe.log_error(msg, 'pricing.change_reference_rate')
-            try:
-                general_discount = frappe.get_value("Price List", price_list['name'], "general_discount")
-                new_customer_rate = ((100 - general_discount) / 100) * new_reference_rate
-                new_customer_rate = round(new_customer_rate, 4)
-                set_rate(item_code, price_list['name'], min_qty, new_customer_rate)
-            except Exception as e:
-                msg = f"Got the following exception when trying to save a new customer rate for item {item_code} with minimum quantity {min_qty} on Price List '{price_list['name']}':\n{e}"
-                print(msg)
-                frappe.log_error(msg, 'pricing.change_reference_rate')
-            else:
-                changes += f"\n{price_list['name']};{customer_rate};{new_customer_rate}"
-                counter += 1
+        reference_tiers = tiers.setdefault((reference_price_list_name, item_code), [])
+        current_reference_rate = find_valid_tier_rate(reference_tiers, min_qty, today)
+        if current_reference_rate is None:
+            msg = f"No reference rate found for {item_code=}, {reference_price_list_name=}, {min_qty=}. Going to return."
+            print(msg)
+            frappe.log_error(msg, "pricing.change_reference_rate")
             continue
 
-        discount = (reference_rate - customer_rate) / reference_rate * 100
+        if abs(reference_rate - new_reference_rate) < 0.0001:
+            continue
 
-        if discount < 0:
-            # "customer_price_list;reference_price_list;item_code;min_qty;customer_rate;reference_rate;discount"
-            negative_discount_warnings += f"{price_list['name']};{reference_price_list_name};{item_code};{min_qty};{customer_rate};{reference_rate};{round(discount, 2)}\n"
-            #msg = f"WARNING: {discount=} < 0 for item {item_code} with {min_qty=} on Price List '{price_list['name']}' -> new Customer Price List rate will be higher than reference Price List rate"
-            #frappe.log_error(msg, 'pricing.change_reference_rate')
-            discount = 0
+        if abs(current_reference_rate - reference_rate) > 0.0001:
+            msg = f"{current_reference_rate=} in the ERP is unequals given {reference_rate=} ({reference_price_list_name=}, {item_code=}, {min_qty=}). Going to return."
+            print(msg)
+            frappe.log_error(msg, "pricing.change_reference_rate")
+            continue
 
-        new_customer_rate = ((100 - discount) / 100) * new_reference_rate
-        new_customer_rate = round(new_customer_rate, 4)
-        try:
-            set_rate(item_code, price_list['name'], min_qty, new_customer_rate)
-        except Exception as e:
-            msg = f"Got the following exception when trying to save the new customer rate {new_customer_rate} for item {item_code} with minimum quantity {min_qty} on Price List '{price_list['name']}':\n{e}"
+        if item_code in disabled_items:
+            msg = f"Item {item_code} is disabled. Unable to change Item Prices with {min_qty=} for reference price list '{reference_price_list_name}'. Going to return."
             print(msg)
-            frappe.log_error(msg, 'pricing.change_reference_rate')
-        else:
-            changes += f"\n{price_list['name']};{customer_rate};{new_customer_rate}"
+            frappe.log_error(msg, "pricing.change_reference_rate")
+            continue
+
+        log_index = len(plan['logs'])
+        changes = "pricelist;old_rate;new_rate"
+        counter = 0
+        price_lists = dependent_price_lists.get(reference_price_list_name, [])
+        for price_list_name in price_lists:
+            customer_tiers = tiers.setdefault((price_list_name, item_code), [])
+            customer_rate = find_valid_tier_rate(customer_tiers, min_qty, today)
+            if customer_rate is None:
+                # The combination of item_code and min_qty is not on the customer Price List. Happens.
+                # Do not add the combination of item_code and min_qty to the customer Price List.
+                continue
+
+            if abs(reference_rate) < 0.0001:  # reference_rate is too close to 0 to calculate the discount (division by 0 issue) -> apply General Discount
+                new_customer_rate = ((100 - general_discounts[price_list_name]) / 100) * new_reference_rate
+            else:
+                discount = (reference_rate - customer_rate) / reference_rate * 100
+                if discount < 0:
+                    # "customer_price_list;reference_price_list;item_code;min_qty;customer_rate;reference_rate;discount"
+                    plan['negative_discount_warnings'] += f"{price_list_name};{reference_price_list_name};{item_code};{min_qty};{customer_rate};{reference_rate};{round(discount, 2)}\n"
+                    discount = 0
+                new_customer_rate = ((100 - discount) / 100) * new_reference_rate
+            new_customer_rate = round(new_customer_rate, 4)
+            set_tier_rate(customer_tiers, price_list_name, item_code, min_qty, new_customer_rate, log_index)
+            changes += f"\n{price_list_name};{customer_rate};{new_customer_rate}"
             counter += 1
 
-    # set the new reference rate on the reference price list
-    set_rate(item_code, reference_price_list_name, min_qty, new_reference_rate)
-    # log changes by creating a new Item Price Log
-    end_ts = datetime.now()
-    changes += f"\n\nChanged {counter}/{len(price_lists)} Price Lists referring to '{reference_price_list_name}' in {round((end_ts - start_ts).total_seconds(), 2)} seconds. If not all Price Lists are changed, the combination of item_code and min_qty was not on the customer Price List or see the Error Log in the ERP for all others."
-    max_length = 65_000  # 65_500 is too large
-    if len(changes) > max_length:
-        msg = f"{len(changes)=} -> string is going to be truncated to {max_length} characters. Please revise architecture. ({user=}; {price_list['name']=}; {reference_price_list_name=}; {item_code=}; {min_qty=}; {customer_rate=}; {reference_rate=};)"
+        # set the new reference rate on the reference price list
+        set_tier_rate(reference_tiers, reference_price_list_name, item_code, min_qty, new_reference_rate, log_index)
+        changes += f"\n\nChanged {counter}/{len(price_lists)} Price Lists referring to '{reference_price_list_name}'. If not all Price Lists are changed, the combination of item_code and min_qty was not on the customer Price List."
+        max_length = 65_000  # 65_500 is too large
+        if len(changes) > max_length:
+            msg = f"{len(changes)=} -> string is going to be truncated to {max_length} characters. The change log contains all changes. ({reference_price_list_name=}; {item_code=}; {min_qty=}; {reference_rate=};)"
+            print(msg)
+            frappe.log_error(msg, 'pricing.change_reference_rate')
+        plan['logs'].append({
+            'price_list': reference_price_list_name,
+            'item_code': item_code,
+            'min_qty': min_qty,
+            'original_rate': reference_rate,
+            'new_rate': new_reference_rate,
+            'changes': changes[:max_length]
+        })
+        publish_price_change_progress(n + 1, len(reference_changes), f"Computed {n + 1}/{len(reference_changes)}: {reference_price_list_name} {item_code} {min_qty}")
+    return plan
+
+
+def get_item_price_change_records(plan):
+    """
+    Returns the change records of all changed Item Prices of a plan (format of the change log of change_item_prices_for_sales_manager)
+    """
+    records = []
+    for tiers in plan['tiers'].values():
+        for tier in tiers:
+            if not tier.get('changed') or (tier['name'] and tier['old_rate'] == tier['rate']):
+                continue
+            records.append({
+                "action": "update" if tier['name'] else "create",
+                "item_price": tier['name'],
+                "price_list": tier['price_list'],
+                "item_code": tier['item_code'],
+                "item_name": tier['item_name'],
+                "min_qty": tier['min_qty'],
+                "currency": tier['currency'],
+                "old_rate": tier['old_rate'],
+                "new_rate": tier['rate'],
+                "modified_before_change": tier['modified'],
+                "log_index": tier['log_index']
+            })
+    return records
+
+
+def apply_reference_rate_changes(plan, user):
+    """
+    Write all changed Item Prices of a plan and the Item Price Logs in a single transaction.
+    Existing Item Prices are updated in bulk, new ones are inserted as documents. Returns the change records.
+    """
+    records = get_item_price_change_records(plan)
+    updates = [r for r in records if r['action'] == "update"]
+    creates = [r for r in records if r['action'] == "create"]
+    timestamp = now()
+    try:
+        for i in range(0, len(updates), REFERENCE_RATE_BATCH_SIZE):
+            batch = updates[i:i + REFERENCE_RATE_BATCH_SIZE]
+            frappe.db.sql("""
+                UPDATE `tabItem Price`
+                SET `price_list_rate` = CASE `name` {cases} END,
+                    `modified` = %s,
+                    `modified_by` = %s
+                WHERE `name` IN ({names});
+                """.format(cases=" ".join(["WHEN %s THEN %s"] * len(batch)), names=", ".join(["%s"] * len(batch))),
+                [v for r in batch for v in (r['item_price'], r['new_rate'])] + [timestamp, user] + [r['item_price'] for r in batch])
+            publish_price_change_progress(i + len(batch), len(records), f"Updated {i + len(batch)}/{len(records)} Item Prices")
+        for i, record in enumerate(creates):
+            item_price = frappe.get_doc({
+                'doctype': 'Item Price',
+                'item_code': record['item_code'],
+                'min_qty': record['min_qty'],
+                'price_list': record['price_list'],
+                'price_list_rate': record['new_rate']
+            })
+            item_price.insert()
+            record.update({'item_price': item_price.name, 'item_name': item_price.item_name, 'currency': item_price.currency})
+            publish_price_change_progress(len(updates) + i + 1, len(records), f"Created {i + 1}/{len(creates)} Item Prices")
+        for log_index, log in enumerate(plan['logs']):
+            item_price_log = frappe.get_doc({
+                'doctype': 'Item Price Log',
+                'user': user,
+                'change_log': json.dumps({
+                    "timestamp": timestamp,
+                    "user": user,
+                    "changes": [r for r in records if r['log_index'] == log_index]
+                }, indent=1, default=str)
+            })
+            item_price_log.update(log)
+            item_price_log.insert()
+        frappe.db.commit()
+    except Exception as err:
+        frappe.db.rollback()
+        msg = f"Unable to apply {len(records)} Item Price changes, nothing has been changed:\n{err}\n{traceback.format_exc()}"
         print(msg)
-        frappe.log_error(msg, 'pricing.change_reference_rate')
-    item_price_log = frappe.get_doc({
-        'doctype': 'Item Price Log',
-        'price_list': reference_price_list_name,
+        frappe.log_error(msg, 'pricing.apply_reference_rate_changes')
+        raise
+    for record in records:
+        frappe.cache().delete_value(get_item_price_cache_key(record['price_list'], record['currency'], record['item_code']))
+    return records
+
+
+def print_item_price_changes(records, user=None):
+    for r in records:
+        print(f"{'Would ' + r['action'] if not user else r['action'].capitalize() + 'd'} Item Price {r['item_price'] or '(new)'}: {r['price_list']}, Item {r['item_code']}, Minimum Qty {r['min_qty']}: {r['old_rate']} -> {r['new_rate']}")
+
+
+def change_reference_rate(reference_price_list_name, item_code, min_qty, reference_rate, new_reference_rate, user, dry_run=False):
+    """
+    Change the rate (price) of the given combination of Item Code and minimum quantity
+    on each customer price list referring to the given reference price list.
+    Thereby, the existing discounts are kept and the new rate is calculated
+    by applying this calculated discount to the new reference rate.
+    Exception: If the reference rate is 0, no discount can be computed and the general discount is used instead.
+    All changes are written in one transaction and logged in an Item Price Log (see rollback_item_price_changes).
+
+    bench execute microsynth.microsynth.pricing.change_reference_rate --kwargs "{'reference_price_list_name': 'Sales Prices CHF', 'item_code': '3000', 'min_qty': 1, 'reference_rate': 10.0, 'new_reference_rate': 11.0, 'user': 'firstname.lastname@microsynth.ch', 'dry_run': True}"
+    """
+    start_ts = datetime.now()
+    plan = plan_reference_rate_changes([{
+        'reference_price_list': reference_price_list_name,
         'item_code': item_code,
         'min_qty': min_qty,
-        'original_rate': reference_rate,
-        'new_rate': new_reference_rate,
-        'user': user,
-        'changes': changes[:max_length]
-    })
-    item_price_log.insert()
-    return negative_discount_warnings
+        'reference_rate': reference_rate,
+        'new_reference_rate': new_reference_rate
+    }])
+    if dry_run:
+        print_item_price_changes(get_item_price_change_records(plan))
+    elif plan['logs']:
+        records = apply_reference_rate_changes(plan, user)
+        print(f"Changed {len(records)} Item Prices in {round((datetime.now() - start_ts).total_seconds(), 2)} seconds.")
+    return plan['negative_discount_warnings']
 
 
 def change_single_customer_rates_from_csv(csv_file):
@@ -243,24 +422,25 @@ def change_single_customer_rates_from_csv(csv_file):
     print(f"Finished after {elapsed_time} hh:mm:ss.")
 
 
-def change_rates_from_csv(csv_file, user):
+def change_rates_from_csv(csv_file, user, dry_run=False):
     """
-    Change the reference rate and all dependent customer rates for all entries in the given CSV file
-    using the function change_reference_rate.
+    Change the reference rate and all dependent customer rates for all entries in the given CSV file.
+    All changes are computed at once (see plan_reference_rate_changes) and written in one transaction.
     IMPORTANT: It is expected that the CSV file has a header and exactly the following columns in this order:
     Reference Price List Name, Item Code, Item Name, Minimum Qty, Current Rate, New Rate
     Outputs a CSV file with warnings about negative discounts to the given csv_file path appended by _warnings.csv
+    and a CSV file with all (dry_run: planned) Item Price changes to the given csv_file path appended by _diff.csv
 
     run from bench
-    bench execute microsynth.microsynth.pricing.change_rates_from_csv --kwargs "{'csv_file': '/mnt/erp_share/JPe/testprices.csv', 'user': 'firstname.lastname@microsynth.ch'}"
+    bench execute microsynth.microsynth.pricing.change_rates_from_csv --kwargs "{'csv_file': '/mnt/erp_share/JPe/testprices.csv', 'user': 'firstname.lastname@microsynth.ch', 'dry_run': True}"
     """
     start_ts = datetime.now()
-    # Dry run only to check the CSV file (no changes)
+    reference_changes = []
+    # Check the CSV file (no changes)
     with open(csv_file, 'r') as file:
         print(f"Checking {csv_file} ...")
         csv_reader = csv.reader(file, delimiter=';')
         next(csv_reader)  # skip header
-        no_lines = 0
         for line in csv_reader:
             if len(line) != 6:
                 print(f"Expected line length 6 but was {len(line)} for the following line:\n{line}\n"
@@ -271,42 +451,40 @@ def change_rates_from_csv(csv_file, user):
                       f"Please correct CSV file or add '{line[0]}' here in the code and restart. Going to return.")
                 return
             try:
-                min_qty = int(line[3])
-                reference_rate = float(line[4])
-                new_reference_rate = float(line[5])
+                reference_changes.append({
+                    'reference_price_list': line[0],
+                    'item_code': line[1],  # keep as string since leading zeros are removed when converting it to an integer
+                    # line[2] is Item name and only for human readability
+                    'min_qty': int(line[3]),
+                    'reference_rate': float(line[4]),
+                    'new_reference_rate': float(line[5])
+                })
             except Exception as error:
                 print(f"The following exception occurred during type conversion of min_qty, reference_rate or new_reference_rate:\n{error}\n"
                       f"No Prices are changed. Please correct CSV file and restart. Going to return.")
                 return
-            no_lines += 1
 
-    negative_discount_warnings = ""
-
-    with open(csv_file, 'r') as file:
-        print(f"Changing prices according to {csv_file} ...")
-        csv_reader = csv.reader(file, delimiter=';')
-        next(csv_reader)  # skip header
-        line_counter = 0
-        for line in csv_reader:
-            reference_price_list_name = line[0]
-            item_code = line[1]  # keep as string since leading zeros are removed when converting it to an integer
-            # line[2] is Item name and only for human readability
-            min_qty = int(line[3])
-            reference_rate = float(line[4])
-            new_reference_rate = float(line[5])
-            warnings = change_reference_rate(reference_price_list_name, item_code, min_qty, reference_rate, new_reference_rate, user)
-            negative_discount_warnings += warnings
-            line_counter += 1
-            print(f"Finished line {line_counter}/{no_lines}: {line}")
+    print(f"Computing the price changes of {len(reference_changes)} lines of {csv_file} ...")
+    plan = plan_reference_rate_changes(reference_changes)
 
-    if len(negative_discount_warnings) > 0:
+    if len(plan['negative_discount_warnings']) > 0:
         with open(csv_file + '_warnings.csv', 'w') as warnings_file:
             # header for a CSV file collecting warnings about negative discounts
             warnings_file.write("customer_price_list;reference_price_list;item_code;min_qty;customer_rate;reference_rate;discount\n")
-            warnings_file.write(negative_discount_warnings)
+            warnings_file.write(plan['negative_discount_warnings'])
+
+    if dry_run:
+        records = get_item_price_change_records(plan)
+    else:
+        records = apply_reference_rate_changes(plan, user)
+    with open(csv_file + '_diff.csv', 'w') as diff_file:
+        diff_file.write("action;item_price;price_list;item_code;min_qty;currency;old_rate;new_rate\n")
+        for r in records:
+            diff_file.write(f"{r['action']};{r['item_price'] or ''};{r['price_list']};{r['item_code']};{r['min_qty']};{r['currency'] or ''};{r['old_rate'] if r['old_rate'] is not None else ''};{r['new_rate']}\n")
 
     elapsed_time = timedelta(seconds=(datetime.now() - start_ts).total_seconds())
-    print(f"Finished after {elapsed_time} hh:mm:ss.")
+    print(f"{'Would change' if dry_run else 'Changed'} {len(records)} Item Prices for {len(plan['logs'])}/{len(reference_changes)} lines. "
+          f"See {csv_file}_diff.csv. Finished after {elapsed_time} hh:mm:ss.")
 
 
 def change_rates_from_csv_files(user, file_paths):
@@ -911,34 +1089,112 @@ def max_percentage_diff(a, b):
         return float('inf')
 
 
-def group_price_lists(reference_price_list, tolerance_percentage=2.5, verbose_level=3):
+RATE_MATRIX_CHUNK_SIZE = 16     # columns compared at once, most Price Lists already differ in the first chunk
+
+
+def max_percentage_diffs(a, b):
     """
-    Search for similar Price Lists that refer to the given reference Price List.
+    Element-wise max_percentage_diff of numpy arrays (or scalars), NaN (missing rates) results in NaN
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        difference = np.abs(a - b)
+        diffs = np.maximum((difference / b) * 100.0, (difference / a) * 100.0)
+    return np.where(a == b, 0.0, diffs)
 
-    Verbose levels (higher levels include all smaller levels except level 0):
-    0: Hide all prints
-    1: Print final groups
-    2: Print Price List name that is currently checked
-    3: Print groups for the recently checked Price List
-    4: Print the first reason found why two Price Lists are not similar except missing Items
-    5: Print Items for which there is no Item Price with the same minimim qty on both Price Lists compared
 
-    Note: Our similarity here is not transitive: Example: Let tolerance_percentage = 3.0 and A, B and C Price Lists.
-    If the rates of B are 2 % higher than the rates of A and the rates of C are 2 % higher than the rates of B,
-    then A and B are similar and B and C are similar, but A and C are NOT similar. A Price List (here B) can therefore occur in more than one group.
+def load_price_list_rates(price_list_names):
+    """
+    Returns all Item Prices of the given Price Lists with one query, last modified first (same order as frappe.get_all)
+    """
+    if not price_list_names:
+        return []
+    return frappe.db.sql("""
+        SELECT `name`, `price_list`, `item_code`, `item_name`, `min_qty`, `price_list_rate`, `currency`
+        FROM `tabItem Price`
+        WHERE `price_list` IN %(price_lists)s
+        ORDER BY `modified` DESC;
+        """, {'price_lists': price_list_names}, as_dict=True)
 
-    bench execute microsynth.microsynth.pricing.group_price_lists --kwargs "{'reference_price_list': 'Sales Prices CHF', 'tolerance_percentage': 2.0, 'verbose_level': 3}"
+
+def build_rate_matrix(price_lists, item_prices):
+    """
+    Build a dense rate matrix with one row per Price List and one column per (item_code, min_qty), NaN if there is no Item Price.
+    The matrix contains the first Item Price of a Price List per column (the one an item by item comparison finds first),
+    further Item Prices with the same Item Code and Minimum Qty are returned as duplicates [(row, column, rate)].
+    """
+    rows = {pl['name']: i for i, pl in enumerate(price_lists)}
+    columns = {}
+    rates = {}
+    duplicates = []
+    for ip in item_prices:
+        row = rows.get(ip['price_list'])
+        if row is None or ip['price_list_rate'] is None:
+            continue
+        column = columns.setdefault((ip['item_code'], ip['min_qty']), len(columns))
+        if (row, column) in rates:
+            duplicates.append((row, column, ip['price_list_rate']))
+        else:
+            rates[(row, column)] = ip['price_list_rate']
+    matrix = np.full((len(price_lists), len(columns)), np.nan)
+    if rates:
+        indices = np.array(list(rates.keys()))
+        matrix[indices[:, 0], indices[:, 1]] = list(rates.values())
+    return matrix, duplicates
+
+
+def group_price_list_rates(price_lists, item_prices, tolerance_percentage=2.5, verbose_level=0):
+    """
+    Group the given Price Lists (dicts with name and general_discount) by their Item Prices using a rate matrix.
+
+    Each Price List is compared with all following Price Lists at once: A following Price List is similar if its
+    General Discount differs by at most tolerance_percentage and it has an Item Price with a rate within the
+    tolerance for every Item Price (Item Code and Minimum Qty) of the first one.
+    Returns the same groups as group_price_list_rates_pairwise.
+    """
+    matrix, duplicates = build_rate_matrix(price_lists, item_prices)
+    general_discounts = np.array([flt(pl['general_discount']) for pl in price_lists])
+    duplicates_per_row = {}
+    for row, column, rate in duplicates:
+        duplicates_per_row.setdefault(row, []).append((column, rate))
+    groups = []
+    for i, base_price_list in enumerate(price_lists):
+        if verbose_level > 1:
+            print(f"Checking Price List '{base_price_list['name']}' ({i+1}/{len(price_lists)}) ...")
+        # candidates are the following Price Lists, narrowed down chunk by chunk of columns
+        candidates = i + 1 + np.flatnonzero(np.abs(general_discounts[i] - general_discounts[i + 1:]) <= tolerance_percentage)
+        columns = np.flatnonzero(~np.isnan(matrix[i]))
+        for c in range(0, columns.size, RATE_MATRIX_CHUNK_SIZE):
+            if candidates.size == 0:
+                break
+            chunk = columns[c:c + RATE_MATRIX_CHUNK_SIZE]
+            diffs = max_percentage_diffs(matrix[i, chunk], matrix[np.ix_(candidates, chunk)])
+            candidates = candidates[(diffs <= tolerance_percentage).all(axis=1)]
+        for column, rate in duplicates_per_row.get(i, []):
+            candidates = candidates[max_percentage_diffs(rate, matrix[candidates, column]) <= tolerance_percentage]
+        group = [base_price_list['name']] + [price_lists[j]['name'] for j in candidates]
+        if len(group) > 1:
+            if verbose_level > 2:
+                print(group)
+            groups.append(group)
+    return groups
+
+
+def group_price_list_rates_pairwise(price_lists, item_prices, tolerance_percentage=2.5, verbose_level=0):
+    """
+    Group the given Price Lists by comparing them pair by pair and item by item.
+    Slow, used to print the reasons why Price Lists differ (verbose level 4 and 5) and as reference for group_price_list_rates.
     """
-    price_lists = frappe.db.get_all("Price List", filters={'enabled': 1, 'reference_price_list': reference_price_list}, fields=['name', 'general_discount'])
     groups = []
-    my_fields = ['name', 'price_list', 'item_code', 'item_name', 'min_qty', 'price_list_rate', 'currency']
     already_checked = {}
+    item_prices_per_price_list = {}
+    for ip in item_prices:
+        item_prices_per_price_list.setdefault(ip['price_list'], []).append(ip)
     for i, base_price_list in enumerate(price_lists):
         if verbose_level > 1:
             print(f"Checking Price List '{base_price_list['name']}' ({i+1}/{len(price_lists)}) ...")
         group = [base_price_list['name']]
         already_checked[base_price_list['name']] = [base_price_list['name']]
-        base_item_prices = frappe.db.get_all("Item Price", filters={'price_list': base_price_list['name']}, fields=my_fields)
+        base_item_prices = item_prices_per_price_list.get(base_price_list['name'], [])
         for price_list in price_lists:
             # avoid to compare a pair of Price Lists more than once
             if price_list['name'] in already_checked[base_price_list['name']]:
@@ -951,11 +1207,11 @@ def group_price_lists(reference_price_list, tolerance_percentage=2.5, verbose_le
             else:
                 already_checked[price_list['name']] = [base_price_list['name']]
             # skip Price List if General Discount differs
-            if abs(base_price_list['general_discount'] - price_list['general_discount']) > tolerance_percentage:
+            if abs(flt(base_price_list['general_discount']) - flt(price_list['general_discount'])) > tolerance_percentage:
                 if verbose_level > 3:
                     print(f"General Discount mismatch: {base_price_list['general_discount']} for '{base_price_list['name']}' vs {price_list['general_discount']} for '{price_list['name']}'")
                 continue
-            item_prices = frappe.db.get_all("Item Price", filters={'price_list': price_list['name']}, fields=my_fields)
+            item_prices = item_prices_per_price_list.get(price_list['name'], [])
             list_mismatch = False
             for bip in base_item_prices:
                 rate_mismatch = False
@@ -989,17 +1245,54 @@ def group_price_lists(reference_price_list, tolerance_percentage=2.5, verbose_le
             if verbose_level > 2:
                 print(group)
             groups.append(group)
+    return groups
+
+
+def group_price_lists(reference_price_list, tolerance_percentage=2.5, verbose_level=3):
+    """
+    Search for similar Price Lists that refer to the given reference Price List.
+    All Item Prices are loaded once and compared with a rate matrix, see group_price_list_rates.
+
+    Verbose levels (higher levels include all smaller levels except level 0):
+    0: Hide all prints
+    1: Print final groups
+    2: Print Price List name that is currently checked
+    3: Print groups for the recently checked Price List
+    4: Print the first reason found why two Price Lists are not similar except missing Items (compares item by item, slow)
+    5: Print Items for which there is no Item Price with the same minimim qty on both Price Lists compared
+
+    Note: Our similarity here is not transitive: Example: Let tolerance_percentage = 3.0 and A, B and C Price Lists.
+    If the rates of B are 2 % higher than the rates of A and the rates of C are 2 % higher than the rates of B,
+    then A and B are similar and B and C are similar, but A and C are NOT similar. A Price List (here B) can therefore occur in more than one group.
+
+    bench execute microsynth.microsynth.pricing.group_price_lists --kwargs "{'reference_price_list': 'Sales Prices CHF', 'tolerance_percentage': 2.0, 'verbose_level': 3}"
+    """
+    price_lists = frappe.db.get_all("Price List", filters={'enabled': 1, 'reference_price_list': reference_price_list}, fields=['name', 'general_discount'])
+    item_prices = load_price_list_rates([pl['name'] for pl in price_lists])
+    if verbose_level > 3:
+        groups = group_price_list_rates_pairwise(price_lists, item_prices, tolerance_percentage, verbose_level)
+    else:
+        groups = group_price_list_rates(price_lists, item_prices, tolerance_percentage, verbose_level)
 
     if verbose_level > 0:
         print(f"\nThe rates of all Item Prices on the following Price Lists differ by less than {tolerance_percentage} %:")
+        sales_managers = {}
+        grouped_price_lists = list(set(pl for group in groups for pl in group))
+        if grouped_price_lists:
+            for customer in frappe.db.sql("""
+                SELECT DISTINCT `default_price_list`, `account_manager`
+                FROM `tabCustomer`
+                WHERE `disabled` = 0
+                    AND `default_price_list` IN %(price_lists)s;
+                """, {'price_lists': grouped_price_lists}, as_dict=True):
+                sales_managers.setdefault(customer['default_price_list'], set()).add(customer['account_manager'])
         already_processed_pairs = set()
         for group in groups:
             if len(group) == 2 and frozenset(group) in already_processed_pairs:  # use sets to get rid of the order of elements
                 # a frozenset is a build-in type, immutable and therefore hashable
                 continue  # since the function max_percentage_diff makes our similarity symmetrical (A=B -> B=A), do not list a pair twice
             for i, pl in enumerate(group):
-                all_sales_managers = frappe.db.get_all("Customer", filters={'disabled': 0, 'default_price_list': pl}, fields=['account_manager'])
-                sales_manager_set = set([sm['account_manager'] for sm in all_sales_managers])
+                sales_manager_set = sales_managers.get(pl, set())
                 if i == 0:
                     base_str = f"The rates of Item Prices on the following Price List(s) differ by less than {tolerance_percentage} % from the rates on Price List '{pl}'"
                     if len(sales_manager_set) > 0:
@@ -1027,6 +1320,55 @@ def group_all_price_lists():
         group_price_lists(ref_pl['name'], verbose_level=1)
 
 
+def benchmark_group_price_lists(number_of_price_lists=3000, number_of_items=200, tolerance_percentage=2.5, pairwise_price_lists=300):
+    """
+    Group a synthetic dataset with the rate matrix and compare the groups of the first pairwise_price_lists
+    Price Lists with the item by item comparison. Does not use the database.
+
+    bench execute microsynth.microsynth.pricing.benchmark_group_price_lists --kwargs "{'number_of_price_lists': 3000}"
+    """
+    rng = random.Random(42)
+    reference_rates = [round(rng.uniform(1, 500), 2) for i in range(number_of_items)]
+    price_lists = []
+    item_prices = []
+    for p in range(number_of_price_lists):
+        name = f"Benchmark Price List {p:05d}"
+        # a few discount levels with small deviations lead to groups, missing items and other General Discounts to mismatches
+        discount = rng.choice([0, 5, 10, 15, 20, 30])
+        price_lists.append({'name': name, 'general_discount': rng.choice([0, 0, 0, 5, 10])})
+        for i, reference_rate in enumerate(reference_rates):
+            if rng.random() < 0.02:
+                continue
+            for min_qty in ([1, 10] if i % 10 == 0 else [1]):
+                rate = reference_rate * (100 - discount) / 100 * (1 + rng.uniform(-0.01, 0.01) if rng.random() < 0.3 else 1) / min_qty ** 0.1
+                item_prices.append({'name': f"{name}-{i}-{min_qty}", 'price_list': name, 'item_code': f"{i:05d}", 'item_name': f"Item {i}",
+                                    'min_qty': min_qty, 'price_list_rate': round(rate, 2), 'currency': "CHF"})
+    rng.shuffle(item_prices)
+    print(f"{len(price_lists)} Price Lists with {len(item_prices)} Item Prices")
+
+    start = time.perf_counter()
+    groups = group_price_list_rates(price_lists, item_prices, tolerance_percentage)
+    duration = time.perf_counter() - start
+    print(f"Rate matrix: {len(groups)} groups in {duration:.2f} s")
+
+    subset = price_lists[:pairwise_price_lists]
+    subset_names = set(pl['name'] for pl in subset)
+    subset_item_prices = [ip for ip in item_prices if ip['price_list'] in subset_names]
+    start = time.perf_counter()
+    matrix_groups = group_price_list_rates(subset, subset_item_prices, tolerance_percentage)
+    duration_matrix = time.perf_counter() - start
+    start = time.perf_counter()
+    pairwise_groups = group_price_list_rates_pairwise(subset, subset_item_prices, tolerance_percentage)
+    duration_pairwise = time.perf_counter() - start
+    print(f"{len(subset)} Price Lists: rate matrix {duration_matrix:.2f} s, item by item {duration_pairwise:.2f} s "
+          f"({duration_pairwise / max(duration_matrix, 1e-9):.0f}x)")
+    if matrix_groups != pairwise_groups:
+        print(f"ERROR: The groups differ: {len(matrix_groups)} groups with the rate matrix, {len(pairwise_groups)} groups item by item")
+    else:
+        print(f"OK: {len(matrix_groups)} identical groups")
+    return {'groups': len(groups), 'duration': duration, 'identical': matrix_groups == pairwise_groups}
+
+
 def percentage_discount(ref_rate, cust_rate):
     if ref_rate == cust_rate:
         return 0
@@ -1600,9 +1942,11 @@ def change_item_prices_for_sales_manager(sales_manager, item_code, new_rate, cur
             json.dump(result, f, indent=4, default=str)
 
 
-def rollback_item_price_changes(change_log_json_file, dry_run=False):
+def rollback_item_price_changes(change_log_json_file=None, dry_run=False, item_price_log=None):
     """
-    Roll back changes created by function change_item_prices_for_sales_manager.
+    Roll back changes created by function change_item_prices_for_sales_manager (change_log_json_file)
+    or by function change_reference_rate (change log of the given item_price_log).
+    Item Prices created by the change are deleted.
 
     Safety features:
     - verifies Item Price still exists
@@ -1611,6 +1955,7 @@ def rollback_item_price_changes(change_log_json_file, dry_run=False):
     - avoids overwriting unrelated later modifications
 
     bench execute microsynth.microsynth.pricing.rollback_item_price_changes --kwargs "{'change_log_json_file': '/path/to/change_log.json', 'dry_run': True}"
+    bench execute microsynth.microsynth.pricing.rollback_item_price_changes --kwargs "{'item_price_log': '1a2b3c4d5e', 'dry_run': True}"
     """
     rollback_result = {
         "timestamp": datetime.now().isoformat(),
@@ -1620,8 +1965,11 @@ def rollback_item_price_changes(change_log_json_file, dry_run=False):
         "dry_run": dry_run
     }
 
-    with open(change_log_json_file, "r") as f:
-        change_log = json.load(f)
+    if item_price_log:
+        change_log = json.loads(frappe.get_value("Item Price Log", item_price_log, "change_log") or "{}")
+    else:
+        with open(change_log_json_file, "r") as f:
+            change_log = json.load(f)
 
     for change in change_log.get("changes", []):
         item_price_name = change["item_price"]
@@ -1706,8 +2054,11 @@ def rollback_item_price_changes(change_log_json_file, dry_run=False):
         # Rollback
         if not dry_run:
             item_price_doc = frappe.get_doc("Item Price", item_price_name)
-            item_price_doc.price_list_rate = flt(change["old_rate"])
-            item_price_doc.save()
+            if change.get("action") == "create":
+                item_price_doc.delete()
+            else:
+                item_price_doc.price_list_rate = flt(change["old_rate"])
+                item_price_doc.save()
 
         rollback_result["rolled_back"].append({
             "item_price": item_price_name,
@@ -1716,7 +2067,7 @@ def rollback_item_price_changes(change_log_json_file, dry_run=False):
             "price_list": current.price_list,
             "currency": current.currency,
             "min_qty": current.min_qty,
-            "restored_rate": flt(change["old_rate"]),
+            "restored_rate": None if change.get("action") == "create" else flt(change["old_rate"]),
             "previous_rate": current_rate
         })
 
@@ -1724,3 +2075,116 @@ def rollback_item_price_changes(change_log_json_file, dry_run=False):
         frappe.db.commit()
 
     return rollback_result
+
+
+ITEM_PRICE_CACHE_TTL = 3600     # seconds, safety net for Item Prices changed without document events
+
+
+def get_item_price_cache_key(price_list, currency, item_code):
+    return f"item_price_tiers::{price_list}::{currency}::{item_code}"
+
+
+def get_item_price_tiers(price_list, currency, item_code):
+    """
+    Return all Item Prices (staggered by minimum quantity) of the given Item on the given Price List and Currency.
+    The tiers are cached until an Item Price of this combination changes.
+    """
+    key = get_item_price_cache_key(price_list, currency, item_code)
+    tiers = frappe.cache().get_value(key)
+    if tiers is None:
+        tiers = frappe.db.sql("""
+            SELECT IFNULL(`min_qty`, 0) AS `min_qty`,
+                IFNULL(`price_list_rate`, 0) AS `rate`,
+                `customer`,
+                `uom`,
+                `valid_from`,
+                `valid_upto`
+            FROM `tabItem Price`
+            WHERE `price_list` = %(price_list)s
+                AND `currency` = %(currency)s
+                AND `item_code` = %(item_code)s
+            ;""", {'price_list': price_list, 'currency': currency, 'item_code': item_code}, as_dict=True)
+        frappe.cache().set_value(key, tiers, expires_in_sec=ITEM_PRICE_CACHE_TTL)
+    return tiers
+
+
+def clear_item_price_cache(item_price, event=None):
+    """
+    Hooked on Item Price on_update and on_trash: Invalidate the cached tiers of this Item Price (also the previous ones if it was moved)
+    """
+    frappe.cache().delete_value(get_item_price_cache_key(item_price.price_list, item_price.currency, item_price.item_code))
+    previous = item_price.get_doc_before_save()
+    if previous:
+        frappe.cache().delete_value(get_item_price_cache_key(previous.price_list, previous.currency, previous.item_code))
+
+
+def find_tier_rate(tiers, qty, customer, uom, transaction_date):
+    """
+    Pick the rate of the Item Price tier with the largest minimum quantity reached by qty.
+    Customer-specific Item Prices take precedence over general ones like in a Sales Order.
+    Returns None if no tier applies.
+    """
+    valid_tiers = [t for t in tiers
+        if (not t['valid_from'] or t['valid_from'] <= transaction_date)
+            and (not t['valid_upto'] or t['valid_upto'] >= transaction_date)
+            and (not t['uom'] or t['uom'] == uom)
+            and flt(t['min_qty']) <= flt(qty)]
+    customer_tiers = [t for t in valid_tiers if customer and t['customer'] == customer]
+    candidates = customer_tiers or [t for t in valid_tiers if not t['customer']]
+    if len(candidates) == 0:
+        return None
+    best = sorted(candidates, key=lambda t: (flt(t['min_qty']), t['valid_from'] or datetime.min.date()), reverse=True)[0]
+    return flt(best['rate'])
+
+
+def has_selling_pricing_rules(customer):
+    """
+    Check if an enabled selling Pricing Rule could apply to the given Customer.
+    Only rules bound to a different Customer are excluded, rules for a Customer Group, Territory,
+    Sales Partner, Campaign etc. are not resolved here and always count.
+    """
+    return len(frappe.db.sql("""
+        SELECT `name`
+        FROM `tabPricing Rule`
+        WHERE `disable` = 0
+            AND `selling` = 1
+            AND (IFNULL(`applicable_for`, '') != 'Customer'
+                OR `customer` = %(customer)s)
+        LIMIT 1;""", {'customer': customer})) > 0
+
+
+def resolve_item_prices(customer, currency, price_list, items):
+    """
+    Resolve the rates of the given items (list of dicts with item_code and qty) for the given Customer
+    directly from the staggered Item Prices without creating a Sales Order.
+    Returns a list of dicts with item_code, qty, rate and description or None if the items
+    cannot be resolved this way (Pricing Rules, currency conversion, missing or disabled Items, missing Item Prices).
+
+    bench execute microsynth.microsynth.pricing.resolve_item_prices --kwargs "{'customer': '8003', 'currency': 'CHF', 'price_list': 'Standard Selling CHF', 'items': [{'item_code': '0010', 'qty': 1}]}"
+    """
+    if not price_list or frappe.get_value("Price List", price_list, "currency") != currency:
+        return None
+    if has_selling_pricing_rules(customer):
+        return None
+    item_codes = list({i['item_code'] for i in items})
+    item_details = {}
+    if len(item_codes) > 0:
+        for item in frappe.get_all("Item", filters={'name': ['IN', item_codes]}, fields=['name', 'item_name', 'stock_uom', 'disabled']):
+            item_details[item['name'].lower()] = item
+    precision = get_field_precision(frappe.get_meta("Sales Order Item").get_field("rate"), currency=currency)
+    today = datetime.now().date()
+    item_prices = []
+    for i in items:
+        item = item_details.get(str(i['item_code']).lower())
+        if not item or item['disabled']:
+            return None
+        rate = find_tier_rate(get_item_price_tiers(price_list, currency, item['name']), i['qty'], customer, item['stock_uom'], today)
+        if rate is None:
+            return None
+        item_prices.append({
+            'item_code': i['item_code'],
+            'qty': i['qty'],
+            'rate': flt(rate, precision),
+            'description': item['item_name']
+        })
+    return item_prices
@@ -117,6 +117,12 @@ frappe.query_reports["Customer Finder"] = {
             "fieldname":"include_disabled",
             "label": __("Include disabled Customers (e.g. leads)"),
             "fieldtype": "Check"
+        },
+        {
+            "fieldname": "page",
+            "label": __("Page (500 best matches each)"),
+            "fieldtype": "Int",
+            "default": 1
         }
     ],
     "onload": (report) => {
@@ -5,6 +5,10 @@ from __future__ import unicode_literals
 import frappe
 from frappe import _
 import json
+from frappe.utils import cint
+from microsynth.microsynth.doctype.contact_search_index.contact_search_index import search_contacts
+
+CUSTOMER_FINDER_PAGE_LENGTH = 500
 
 
 def execute(filters=None):
@@ -44,91 +48,23 @@ def get_data(filters):
     else:
         filters = dict(filters)
 
-    criteria = ""
-
-    hasFilters = False
-
-    if not 'include_disabled' in filters:
-        criteria += """ AND `tabCustomer`.`disabled` <> 1 """
-    else:
-        hasFilters = True
-
-    if 'contact_name' in filters:
-        criteria += """ AND `tabContact`.`name` LIKE '%{0}%' """.format(filters['contact_name'])
-        hasFilters = True
-
-    if 'contact_full_name' in filters:
-        criteria += """ AND `tabContact`.`full_name` LIKE '%{0}%' """.format(filters['contact_full_name'])
-        hasFilters = True
-
-    if 'contact_email' in filters:
-        criteria += """ AND `tabContact`.`email_id` LIKE '%{0}%' """.format(filters['contact_email'])
-        hasFilters = True
-
-    if 'customer' in filters:
-        criteria += """ AND `tabCustomer`.`customer_name` LIKE '%{0}%' """.format(filters['customer'])
-        hasFilters = True
-
-    if 'customer_id' in filters:
-        criteria += """ AND `tabCustomer`.`name` = '{0}' """.format(filters['customer_id'])
-        hasFilters = True
-
-    if 'contact_institute' in filters:
-        criteria += """ AND `tabContact`.`institute` LIKE '%{0}%' """.format(filters['contact_institute'])
-        hasFilters = True
-
-    if 'contact_institute_key' in filters:
-        criteria += """ AND `tabContact`.`institute_key` LIKE '%{0}%' """.format(filters['contact_institute_key'])
-        hasFilters = True
-
-    if 'contact_department' in filters:
-        criteria += """ AND `tabContact`.`department` LIKE '%{0}%' """.format(filters['contact_department'])
-        hasFilters = True
-
-    if 'contact_group_leader' in filters:
-        criteria += """ AND `tabContact`.`group_leader` LIKE '%{0}%' """.format(filters['contact_group_leader'])
-        hasFilters = True
-
-    if 'address_country' in filters:
-        criteria += """ AND `tabAddress`.`country` LIKE '%{0}%' """.format(filters['address_country'])
-        hasFilters = True
-
-    if 'address_city' in filters:
-        criteria += """ AND `tabAddress`.`city` LIKE '%{0}%' """.format(filters['address_city'])
-        hasFilters = True
-
-    if 'address_street' in filters:
-        criteria += """ AND `tabAddress`.`address_line1` LIKE '%{0}%' """.format(filters['address_street'])
-        hasFilters = True
-
-    if 'price_list' in filters:
-        criteria += """ AND `tabCustomer`.`default_price_list` LIKE '%{0}%' """.format(filters['price_list'])
-        hasFilters = True
-
-    if 'tax_id' in filters:
-        criteria += """ AND `tabCustomer`.`tax_id` LIKE '%{0}%' """.format(filters['tax_id'])
-        hasFilters = True
-
-    if 'account_manager' in filters:
-        criteria += """ AND `tabCustomer`.`account_manager` LIKE '%{0}%' """.format(filters['account_manager'])
-        hasFilters = True
-
-    if 'contact_status' in filters and filters['contact_status']:
-        criteria += """ AND `tabContact`.`status` = '{0}' """.format(filters['contact_status'])
-        hasFilters = True
-
-    if 'contact_classification' in filters and filters['contact_classification']:
-        criteria += """ AND `tabContact`.`contact_classification` = '{0}' """.format(filters['contact_classification'])
-        hasFilters = True
-
-    if 'customer_status' in filters and filters['customer_status']:
-        criteria += """ AND `tabContact`.`customer_status` = '{0}' """.format(filters['customer_status'])
-        hasFilters = True
+    hasFilters = 'include_disabled' in filters
+    for f in ['contact_name', 'contact_full_name', 'contact_email', 'customer', 'customer_id', 'contact_institute',
+              'contact_institute_key', 'contact_department', 'contact_group_leader', 'address_country', 'address_city',
+              'address_street', 'price_list', 'tax_id', 'account_manager', 'contact_status', 'contact_classification', 'customer_status']:
+        if filters.get(f):
+            hasFilters = True
 
     data = []
 
     if hasFilters:
+        page = max(cint(filters.get('page')), 1)
+        entries = search_contacts(filters, start=(page - 1) * CUSTOMER_FINDER_PAGE_LENGTH, page_length=CUSTOMER_FINDER_PAGE_LENGTH)
+        if not entries:
+            return data
+
         sql_query = """SELECT
+            `tabContact Search Index`.`name` AS `entry`,
             `tabCustomer`.`name` AS `customer_id`,
             `tabCustomer`.`customer_name` AS `customer`,
             `tabAddress`.`address_type` AS `address_type`,
@@ -150,19 +86,20 @@ def get_data(filters):
             `tabContact`.`creation` AS `contact_created`
 
             FROM `tabContact`
-            LEFT JOIN `tabDynamic Link` AS `tDLA` ON `tDLA`.`parent` = `tabContact`.`name`
-                                                AND `tDLA`.`parenttype`  = "Contact"
-                                                AND `tDLA`.`link_doctype` = "Customer"
-            LEFT JOIN `tabCustomer` ON `tabCustomer`.`name` = `tDLA`.`link_name`
+            JOIN `tabContact Search Index` ON `tabContact Search Index`.`contact` = `tabContact`.`name`
+            LEFT JOIN `tabCustomer` ON `tabCustomer`.`name` = `tabContact Search Index`.`customer_id`
             LEFT JOIN `tabAddress` ON `tabContact`.`address` = `tabAddress`.`name`
 
-            WHERE TRUE
-                {criteria}
-        """.format(criteria=criteria)
+            WHERE `tabContact Search Index`.`name` IN %(entries)s
+        """
 
-        fetched_data = frappe.db.sql(sql_query, as_dict = True)
+        fetched_data = {d.entry: d for d in frappe.db.sql(sql_query, {'entries': entries}, as_dict = True)}
 
-        for d in fetched_data:
+        # keep the ranking of the search
+        for entry_name in entries:
+            d = fetched_data.get(entry_name)
+            if not d:
+                continue
             entry = {
                 "customer_id": d.customer_id,
                 "customer": d.customer,
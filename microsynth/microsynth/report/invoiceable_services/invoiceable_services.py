@@ -43,6 +43,10 @@ def get_data(filters=None):
         conditions += " AND `tabCustomer`.`name` = %(customer)s"
         params["customer"] = filters.get("customer")
 
+    if filters.get("customers"):
+        conditions += " AND `tabCustomer`.`name` IN %(customers)s"
+        params["customers"] = filters.get("customers")
+
     if filters.get("exclude_punchout"):
         conditions += " AND `tabDelivery Note`.`is_punchout` != 1"
 
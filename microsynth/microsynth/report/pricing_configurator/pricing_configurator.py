@@ -6,6 +6,9 @@ import frappe
 from frappe import _
 from datetime import datetime
 import json
+from frappe.utils import flt, now
+
+SET_RATES_BATCH_SIZE = 500
 
 
 def execute(filters=None):
@@ -40,26 +43,41 @@ def get_item_prices(price_list):
     Returns the item prices for a given price list. Fields: 'record', 'item_code', 'item_group', 'uom', 'item_name', 'min_qty', 'rate'
     The Item Prices are sorted oldest to newest to show the latest entry in the Pricing Configurator (last entry is choosen).
     """
-    simple_sql_query = """
+    return get_item_prices_of_price_lists([price_list]).get(price_list, [])
+
+
+def get_item_prices_of_price_lists(price_lists):
+    """
+    Returns the valid item prices of enabled items of all given price lists with one query
+    as a dictionary price_list -> item prices (sorted like get_item_prices).
+    """
+    price_lists = [p for p in price_lists if p]
+    item_prices = {p: [] for p in price_lists}
+    if not price_lists:
+        return item_prices
+    data = frappe.db.sql("""
         SELECT
             `tabItem Price`.`name` as record,
+            `tabItem Price`.`price_list`,
             `tabItem Price`.`item_code`,
             `tabItem`.`item_group`,
             `tabItem`.`stock_uom` AS `uom`,
             `tabItem`.`sales_status`,
             `tabItem Price`.`item_name`,
             `tabItem Price`.`min_qty`,
+            `tabItem Price`.`valid_from`,
             `tabItem Price`.`price_list_rate` as rate
         FROM `tabItem Price`
         JOIN `tabItem` ON `tabItem`.`item_code` = `tabItem Price`.`item_code`
-        WHERE `price_list` = "{price_list}"
+        WHERE `price_list` IN %(price_lists)s
             AND `tabItem`.`disabled` = 0
             AND (`tabItem Price`.`valid_from` IS NULL OR `tabItem Price`.`valid_from` <= CURDATE())
             AND (`tabItem Price`.`valid_upto` IS NULL OR `tabItem Price`.`valid_upto` >= CURDATE())
         ORDER BY `tabItem Price`.`item_code` ASC, `tabItem Price`.`valid_from` ASC
-    """.format(price_list=price_list)
-    data = frappe.db.sql(simple_sql_query, as_dict=True)
-    return data
+    """, {'price_lists': price_lists}, as_dict=True)
+    for d in data:
+        item_prices[d.price_list].append(d)
+    return item_prices
 
 
 def get_data(filters):
@@ -79,8 +97,9 @@ def get_data(filters):
         reference_price_list = get_reference_price_list(filters['price_list'])
     # currency = frappe.get_value("Price List", filters['price_list'], "currency")
 
-    raw_customer_prices = get_item_prices(filters['price_list'])
-    raw_reference_prices = get_item_prices(reference_price_list)
+    item_prices = get_item_prices_of_price_lists([filters['price_list'], reference_price_list])
+    raw_customer_prices = item_prices.get(filters['price_list'], [])
+    raw_reference_prices = item_prices.get(reference_price_list, [])
 
     customer_prices = {}
     for p in raw_customer_prices:
@@ -183,61 +202,57 @@ def get_price_list_rates(item_code, price_list, qty):
 def populate_from_reference(price_list, user, item_group=None):
     """
     This will fill up the missing Item Prices from the reference Price List if the reference rate is not 0.
+    All new Item Prices and the cleaning of the Price List are saved in one transaction.
     """
     filters = {
         'price_list': price_list,
     }
     if item_group:
         filters['item_group'] = item_group
-    # get base data
-    data = get_data(filters)
-    print("Number of data sets: {0}".format(len(data)))
     reference_price_list = get_reference_price_list(filters['price_list'])
     if not reference_price_list:
         frappe.log_error(f"Price List '{price_list}' has no reference Price List. Unable to apply 'Populate from reference'.", "pricing_configurator.populate_from_reference")
         return
+    # get base data (all rates of the Price List and its reference with one query)
+    data = get_data(filters)
+    print("Number of data sets: {0}".format(len(data)))
     general_discount = frappe.get_value("Price List", price_list, "general_discount")
     changes = "item_code;min_qty;old_rate;new_rate"
-    # set new prices
+    rates = []
     for d in data:
         if d.get('sales_status') in ["In Preparation", "Discontinued"]:
             changes += f"\nItem {d['item_code']} on reference Price List '{reference_price_list}' has sales status '{d['sales_status']}'. Going to continue."
             continue  # do not populate prices for items with sales status "In Preparation" or "Discontinued"
         if d['reference_rate'] and d['price_list_rate'] is None:  # Do NOT populate a reference rate of 0 to the customers price list.
-            # create new price
-            new_rate = get_rate_or_none(d['item_code'], reference_price_list, d['qty'])
-            if new_rate is None:
-                changes += f"\nThere is no Item Price on reference Price List '{reference_price_list}' for Item {d['item_code']} with minimum quantity <= {d['qty']}. Going to continue."
-                continue
+            # the reference rate of get_data is the valid reference rate for exactly this minimum quantity
+            new_rate = d['reference_rate']
             # rate based on general discount for item groups 3.1 & 3.2
-            group = d.get('item_group')  # frappe.get_value("Item", d['item_code'], "item_group")
+            group = d.get('item_group')
             if "3.1 " in group or "3.2" in group:
                 new_rate = ((100 - general_discount) / 100) * new_rate
-            new_item_price = frappe.get_doc({
-                'doctype': 'Item Price',
-                'item_code': d['item_code'],
+            rates.append({'item_code': d['item_code'], 'min_qty': d['qty'], 'rate': new_rate, 'old_rate': d['price_list_rate']})
+
+    try:
+        errors = set_rates(price_list, rates, update_existing=False)
+        for r in rates:
+            if (r['item_code'], r['min_qty']) in errors:
+                changes += f"\nCannot insert {r['item_code']} in {price_list}: {errors[(r['item_code'], r['min_qty'])]}"
+            else:
+                changes += f"\n{r['item_code']};{r['min_qty']};{r['old_rate']};{r['rate']}"
+        if '\n' in changes:
+            changes += f"\n\nChanges made by function pricing_configurator.populate_from_reference."
+            # Log changes using Item Price Log
+            item_price_log = frappe.get_doc({
+                'doctype': 'Item Price Log',
                 'price_list': price_list,
-                'price_list_rate': new_rate,
-                'min_qty': d['qty']
+                'user': user,
+                'changes': changes
             })
-            try:
-                new_item_price.insert()
-            except Exception as err:
-                changes += f"\nCannot insert {d['item_code']} in {price_list}: {err}"
-            else:
-                changes += f"\n{d['item_code']};{d['qty']};{d['price_list_rate']};{new_rate}"
-    frappe.db.commit()
-
-    if '\n' in changes:
-        changes += f"\n\nChanges made by function pricing_configurator.populate_from_reference."
-        # Log changes using Item Price Log
-        item_price_log = frappe.get_doc({
-            'doctype': 'Item Price Log',
-            'price_list': price_list,
-            'user': user,
-            'changes': changes
-        })
-        item_price_log.insert()
+            item_price_log.insert()
+    except Exception as err:
+        frappe.db.rollback()
+        frappe.log_error(f"Unable to populate Price List '{price_list}' from reference, nothing has been changed:\n{err}", "pricing_configurator.populate_from_reference")
+        raise
 
     clean_price_list(price_list, user)
 
@@ -245,7 +260,8 @@ def populate_from_reference(price_list, user, item_group=None):
 @frappe.whitelist()
 def populate_with_factor(price_list, user, item_group=None, factor=1.0):
     """
-    This will set all rates from the reference price list with a factor
+    This will set all rates from the reference price list with a factor.
+    All changed Item Prices and the cleaning of the Price List are saved in one transaction.
     """
     filters = {
         'price_list': price_list,
@@ -254,35 +270,41 @@ def populate_with_factor(price_list, user, item_group=None, factor=1.0):
         filters['item_group'] = item_group
     if type(factor) == str:
         factor = float(factor)
-    # get base data
-    data = get_data(filters)
     reference_price_list = get_reference_price_list(filters['price_list'])
     if not reference_price_list:
         frappe.log_error(f"Price List '{price_list}' has no reference Price List. Unable to apply 'Populate with factor'.", "pricing_configurator.populate_with_factor")
         return
+    # get base data (all rates of the Price List and its reference with one query)
+    data = get_data(filters)
     changes = "item_code;min_qty;old_rate;new_rate"
-    # set new prices
+    rates = []
     for d in data:
         if d['reference_rate']:
-            reference_rate = get_rate(d['item_code'], reference_price_list, d['qty'])
-            new_rate = factor * reference_rate
-            set_rate(d['item_code'], price_list, d['qty'], new_rate)
+            new_rate = factor * d['reference_rate']
+            rates.append({'item_code': d['item_code'], 'min_qty': d['qty'], 'rate': new_rate})
             changes += f"\n{d['item_code']};{d['qty']};{d['price_list_rate']};{new_rate}"
 
-    changes += f"\n\nChanges made by function pricing_configurator.populate_with_factor using a factor of {factor}."
-    # Log changes using Item Price Log
-    item_price_log = frappe.get_doc({
-        'doctype': 'Item Price Log',
-        'price_list': price_list,
-        'user': user,
-        'changes': changes
-    })
-    item_price_log.insert()
+    try:
+        errors = set_rates(price_list, rates)
+        for (item_code, min_qty), err in errors.items():
+            changes += f"\nCannot insert {item_code} with minimum quantity {min_qty} in {price_list}: {err}"
+        changes += f"\n\nChanges made by function pricing_configurator.populate_with_factor using a factor of {factor}."
+        # Log changes using Item Price Log
+        item_price_log = frappe.get_doc({
+            'doctype': 'Item Price Log',
+            'price_list': price_list,
+            'user': user,
+            'changes': changes
+        })
+        item_price_log.insert()
+    except Exception as err:
+        frappe.db.rollback()
+        frappe.log_error(f"Unable to populate Price List '{price_list}' with factor {factor}, nothing has been changed:\n{err}", "pricing_configurator.populate_with_factor")
+        raise
 
     clean_price_list(price_list, user)
 
 
-
 @frappe.whitelist()
 def set_rate(item_code, price_list, qty, rate):
     """
@@ -314,6 +336,69 @@ def set_rate(item_code, price_list, qty, rate):
     return
 
 
+def set_rates(price_list, rates, update_existing=True):
+    """
+    Bulk version of set_rate without commit: rates is a list of dicts with item_code, min_qty and rate.
+    Existing Item Prices (the first found like set_rate) are updated in batches of SET_RATES_BATCH_SIZE,
+    missing ones are inserted (always inserted if update_existing is False).
+    Returns a dictionary (item_code, min_qty) -> error of the Item Prices that could not be inserted.
+    The caller has to commit (or rollback).
+    """
+    from microsynth.microsynth.pricing import get_item_price_cache_key
+
+    errors = {}
+    if not rates:
+        return errors
+    existing = {}
+    if update_existing:
+        for p in frappe.db.sql("""
+            SELECT `name`, `item_code`, `min_qty`, `currency`
+            FROM `tabItem Price`
+            WHERE `price_list` = %(price_list)s
+                AND `item_code` IN %(item_codes)s
+            ORDER BY `modified` DESC;
+            """, {'price_list': price_list, 'item_codes': list(set(r['item_code'] for r in rates))}, as_dict=True):
+            existing.setdefault((p['item_code'], flt(p['min_qty'])), p)
+
+    updates = []
+    touched = set()
+    for r in rates:
+        item_price = existing.get((r['item_code'], flt(r['min_qty'])))
+        if item_price:
+            updates.append((item_price['name'], r['rate']))
+            touched.add((item_price['currency'], r['item_code']))
+            continue
+        new_item_price = frappe.get_doc({
+            'doctype': 'Item Price',
+            'item_code': r['item_code'],
+            'min_qty': r['min_qty'],
+            'price_list': price_list,
+            'price_list_rate': r['rate']
+        })
+        try:
+            new_item_price.insert()
+        except frappe.ValidationError as err:
+            errors[(r['item_code'], r['min_qty'])] = err
+        else:
+            existing[(r['item_code'], flt(r['min_qty']))] = {'name': new_item_price.name, 'currency': new_item_price.currency}
+
+    for i in range(0, len(updates), SET_RATES_BATCH_SIZE):
+        batch = updates[i:i + SET_RATES_BATCH_SIZE]
+        frappe.db.sql("""
+            UPDATE `tabItem Price`
+            SET `price_list_rate` = CASE `name` {cases} END,
+                `modified` = %s,
+                `modified_by` = %s
+            WHERE `name` IN ({names});
+            """.format(cases=" ".join(["WHEN %s THEN %s"] * len(batch)), names=", ".join(["%s"] * len(batch))),
+            [v for u in batch for v in u] + [now(), frappe.session.user] + [u[0] for u in batch])
+
+    # inserted Item Prices clear the cache on_update
+    for currency, item_code in touched:
+        frappe.cache().delete_value(get_item_price_cache_key(price_list, currency, item_code))
+    return errors
+
+
 @frappe.whitelist()
 def get_discount_items(price_list):
     """
@@ -326,6 +411,7 @@ def get_discount_items(price_list):
 def clean_price_list(price_list, user):
     """
     Corrects rates if there is a lower rate for a smaller quantity.
+    All corrected Item Prices are saved in one transaction (together with not yet committed changes of the caller).
     """
     print("process '{0}'".format(price_list))
 
@@ -336,6 +422,9 @@ def clean_price_list(price_list, user):
         prices[p.item_code, p.min_qty] = p
 
     sorted_prices = sorted(prices.items())
+    if not sorted_prices:
+        frappe.db.commit()
+        return
 
     # initialize memory from first element
     (_, _), memory = sorted_prices[0]
@@ -343,13 +432,14 @@ def clean_price_list(price_list, user):
 
     changes = "item_code;min_qty;old_rate;new_rate"
     orig_len = len(changes)
+    rates = []
 
     for _, item_price in sorted_prices:
 
         if item_price.item_code == memory.item_code:
 
             if item_price.rate > rate_memory and item_price.min_qty > memory.min_qty:
-                set_rate(item_price.item_code, price_list, item_price.min_qty, rate_memory)
+                rates.append({'item_code': item_price.item_code, 'min_qty': item_price.min_qty, 'rate': rate_memory})
                 changes += f"\n{item_price.item_code};{item_price.min_qty};{item_price.rate};{rate_memory}"
                 print("Set rate for item {code}, quantity {qty}: {rate} --> {mem_rate}".format(code=item_price.item_code, qty=str(item_price.min_qty).rjust(6), rate=item_price.rate, mem_rate=rate_memory))
             else:
@@ -360,16 +450,23 @@ def clean_price_list(price_list, user):
 
         memory = item_price
 
-    if (len(changes) > orig_len):
-        changes += f"\n\nChanges made by function pricing_configurator.clean_price_list."
-        # Log changes using Item Price Log
-        item_price_log = frappe.get_doc({
-            'doctype': 'Item Price Log',
-            'price_list': price_list,
-            'user': user,
-            'changes': changes
-        })
-        item_price_log.insert()
+    try:
+        set_rates(price_list, rates)
+        if (len(changes) > orig_len):
+            changes += f"\n\nChanges made by function pricing_configurator.clean_price_list."
+            # Log changes using Item Price Log
+            item_price_log = frappe.get_doc({
+                'doctype': 'Item Price Log',
+                'price_list': price_list,
+                'user': user,
+                'changes': changes
+            })
+            item_price_log.insert()
+        frappe.db.commit()
+    except Exception as err:
+        frappe.db.rollback()
+        frappe.log_error(f"Unable to clean Price List '{price_list}', nothing has been changed:\n{err}", "pricing_configurator.clean_price_list")
+        raise
 
 
 @frappe.whitelist()
@@ -6,8 +6,16 @@ import frappe
 from frappe import _
 from frappe.utils import cint
 import calendar
-from microsynth.microsynth.utils import get_child_territories, get_sql_list
-from microsynth.microsynth.report.sales_overview.sales_overview import calculate_chf_eur, get_exchange_rate, get_item_groups
+from microsynth.microsynth.utils import get_child_territories
+from microsynth.microsynth.report.sales_overview.sales_overview import (
+    calculate_chf_eur,
+    get_company_currencies,
+    get_exchange_rate,
+    get_exchange_rates,
+    get_intercompany_condition,
+    get_item_groups
+)
+from itertools import groupby
 import json
 
 def get_month_number(month):
@@ -79,15 +87,15 @@ def get_item_revenue(filters, month, item_groups, debug=False):
         territory_condition = ""
 
     credit_item_code = frappe.get_value("Microsynth Settings", "Microsynth Settings", "credit_item")
-    last_day = calendar.monthrange(cint(filters.get("fiscal_year")), month)
+    if month:
+        last_day = calendar.monthrange(cint(filters.get("fiscal_year")), month)
+        date_condition = """AND `tabSales Invoice`.`posting_date` BETWEEN "{year}-{month:02d}-01" AND "{year}-{month:02d}-{to_day:02d}" """.format(
+            year=filters.get("fiscal_year"), month=month, to_day=last_day[1])
+    else:
+        # whole fiscal year
+        date_condition = """AND `tabSales Invoice`.`posting_date` BETWEEN "{year}-01-01" AND "{year}-12-31" """.format(year=filters.get("fiscal_year"))
     group_condition = "'{0}'".format("', '".join(item_groups))
 
-    intercompany_condition = ""
-    intercompany_customers = frappe.get_all("Intercompany Settings Company", fields=['customer'])
-    intercompany_customers_list = [entry['customer'] for entry in intercompany_customers]
-    if intercompany_customers_list:
-        intercompany_condition = f" AND `tabSales Invoice`.`customer` NOT IN ({get_sql_list(intercompany_customers_list)}) "
-
     query = """
             SELECT
                 `tabSales Invoice Item`.`parent` AS `sales_invoice`,
@@ -133,13 +141,13 @@ def get_item_revenue(filters, month, item_groups, debug=False):
                 AND (`tabSales Invoice`.`invoicing_method` != 'Intercompany' or `tabSales Invoice`.`invoicing_method` is null)
                 {intercompany_condition}
                 AND `tabSales Invoice Item`.`item_code` <> '{credit_item_code}'
-                AND `tabSales Invoice`.`posting_date` BETWEEN "{year}-{month:02d}-01" AND "{year}-{month:02d}-{to_day:02d}"
+                {date_condition}
                 {company_condition}
                 {territory_condition}
                 AND `tabSales Invoice Item`.`item_group` IN ({group_condition})
             ORDER BY `tabSales Invoice`.`posting_date`, `tabSales Invoice`.`posting_time`, `tabSales Invoice`.`name`, `tabSales Invoice Item`.`idx`;
-        """.format(company_condition=company_condition, year=filters.get("fiscal_year"), month=month, to_day=last_day[1],
-            territory_condition=territory_condition, group_condition=group_condition, intercompany_condition=intercompany_condition, credit_item_code=credit_item_code)
+        """.format(company_condition=company_condition, date_condition=date_condition,
+            territory_condition=territory_condition, group_condition=group_condition, intercompany_condition=get_intercompany_condition(), credit_item_code=credit_item_code)
     items = frappe.db.sql(query, as_dict=True)
 
     return items
@@ -156,14 +164,16 @@ def get_revenue_details(filters, debug=False):
         m = get_month_number(filters.get("month"))
         exchange_rate = get_exchange_rate(filters.get("fiscal_year"), m)
         records = get_item_revenue(filters, m, item_groups, debug)
-        details = calculate_chf_eur(exchange_rate, records)
+        details = calculate_chf_eur(exchange_rate, records, get_company_currencies())
 
     else:
+        # one query for the whole year, the records are sorted by posting date and therefore grouped by month
         details = []
-        for m in range(1, 12 + 1):
-            exchange_rate = get_exchange_rate(filters.get("fiscal_year"), m)
-            records = get_item_revenue(filters, month = m, item_groups=item_groups, debug=debug)
-            details += calculate_chf_eur(exchange_rate, records)
+        exchange_rates = get_exchange_rates(filters.get("fiscal_year"))
+        company_currency = get_company_currencies()
+        records = get_item_revenue(filters, month=None, item_groups=item_groups, debug=debug)
+        for m, month_records in groupby(records, key=lambda r: r['month']):
+            details += calculate_chf_eur(exchange_rates[m], list(month_records), company_currency)
 
     return details
 
@@ -8,6 +8,7 @@ from datetime import date
 from frappe.utils import cint
 import calendar
 from microsynth.microsynth.utils import get_child_territories, get_sql_list
+from microsynth.microsynth.doctype.revenue_fact.revenue_fact import get_revenue_facts
 
 MONTHS = {
     1: _("January"),
@@ -110,6 +111,8 @@ def get_data(filters, debug=False):
     else:
         elapsed_month = date.today().month - 1
 
+    revenues = get_monthly_revenues(filters)
+
     output = []
     group_count = 0
     total = {
@@ -152,7 +155,7 @@ def get_data(filters, debug=False):
         base = 0
         for m in range (1, 13):
             key = 'month{0}'.format(m)
-            _revenue[key] = get_revenue(filters, m, query_groups, debug)[filters.get("reporting_type").lower()]
+            _revenue[key] = sum_monthly_revenues(revenues, query_groups, m)[filters.get("reporting_type").lower()]
             if not key in group_sums:
                 group_sums[key] = _revenue[key]
             else:
@@ -185,6 +188,107 @@ def get_data(filters, debug=False):
 
     return output
 
+def get_monthly_revenues(filters):
+    """
+    Read the Revenue Facts of the fiscal year with one query and calculate CHF and EUR like calculate_chf_eur.
+    Returns a dictionary item_group -> month -> {'chf', 'eur', 'qty'}
+    """
+    if filters.get("territory"):
+        territories = get_child_territories(filters.get("territory"))
+    else:
+        territories = None
+    company_currency = get_company_currencies()
+    exchange_rates = get_exchange_rates(filters.get("fiscal_year"))
+    revenues = {}
+    for fact in get_revenue_facts(filters.get("fiscal_year"), company=filters.get("company"), territories=territories):
+        exchange_rate = exchange_rates[fact['month']]
+        if company_currency[fact['company']] == "CHF":
+            chf = fact['base_net_amount']
+            eur = fact['converted_amount'] + fact['exchange_rate_amount'] / exchange_rate
+        elif company_currency[fact['company']] == "EUR":
+            chf = fact['converted_amount'] + fact['exchange_rate_amount'] * exchange_rate
+            eur = fact['base_net_amount']
+        else:
+            frappe.throw(
+                title='Company currency error',
+                msg=f"Invalid currency {company_currency[fact['company']]} of company '{fact['company']}'"
+            )
+        month_revenue = revenues.setdefault(fact['item_group'], {}).setdefault(fact['month'], {'chf': 0, 'eur': 0, 'qty': 0})
+        month_revenue['chf'] += chf
+        month_revenue['eur'] += eur
+        month_revenue['qty'] += fact['qty']
+    return revenues
+
+
+def sum_monthly_revenues(revenues, item_groups, month):
+    revenue = {'chf': 0, 'eur': 0, 'qty': 0}
+    for item_group in item_groups:
+        month_revenue = revenues.get(item_group, {}).get(month)
+        if month_revenue:
+            for key in revenue.keys():
+                revenue[key] += month_revenue[key]
+    return revenue
+
+
+def verify_revenue_facts(fiscal_year, company=None, territory=None, tolerance=0.01):
+    """
+    Compare the revenues from the Revenue Facts with the revenues from the Sales Invoice Items (get_revenue)
+    for all item groups and months. Prints and returns the differences.
+
+    bench execute microsynth.microsynth.report.sales_overview.sales_overview.verify_revenue_facts --kwargs "{'fiscal_year': '2026', 'company': 'Microsynth AG', 'territory': 'Switzerland'}"
+    """
+    filters = {
+        'company': company,
+        'territory': territory,
+        'fiscal_year': fiscal_year,
+        'customer_credit_revenue': "Credit allocation"
+    }
+    revenues = get_monthly_revenues(filters)
+    company_currency = get_company_currencies()
+    exchange_rates = get_exchange_rates(fiscal_year)
+    differences = []
+    for item_group in get_item_groups():
+        for m in range(1, 13):
+            expected = get_revenue(filters, m, [item_group], company_currency=company_currency, exchange_rate=exchange_rates[m])
+            actual = sum_monthly_revenues(revenues, [item_group], m)
+            for currency in ['chf', 'eur']:
+                if abs(expected[currency] - actual[currency]) > tolerance:
+                    differences.append({'item_group': item_group, 'month': m, 'currency': currency, 'expected': expected[currency], 'actual': actual[currency]})
+                    print(f"{item_group}, {fiscal_year}-{m:02d}: {currency.upper()} {expected[currency]:.2f} from the Sales Invoices, but {actual[currency]:.2f} from the Revenue Facts")
+    print(f"Found {len(differences)} differences.")
+    return differences
+
+
+def get_company_currencies():
+    company_currency = {}
+    for c in frappe.get_all("Company", fields=['name', 'default_currency']):
+        company_currency[c['name']] = c['default_currency']
+    return company_currency
+
+
+def get_exchange_rates(year):
+    """
+    Returns a dictionary month -> exchange rate (EUR → CHF) of the given year, see get_exchange_rate
+    """
+    exchange_rates = {}
+    rates = frappe.db.sql("""
+        SELECT MONTH(`date`) AS `month`, IFNULL(`exchange_rate`, 1) AS `exchange_rate`
+        FROM `tabCurrency Exchange`
+        WHERE `date` LIKE %(year)s
+          AND `from_currency` = "EUR"
+          AND `to_currency` = "CHF"
+        ORDER BY `date`
+        ;
+    """, {'year': f"{year}-%"}, as_dict=True)
+    for rate in rates:
+        if not rate['month'] in exchange_rates:
+            exchange_rates[rate['month']] = rate['exchange_rate']
+    for m in range(1, 13):
+        if not m in exchange_rates:
+            exchange_rates[m] = 1
+    return exchange_rates
+
+
 def get_exchange_rate(year, month):
     exchange_rate = frappe.db.sql("""
         SELECT IFNULL(`exchange_rate`, 1) AS `exchange_rate`
@@ -201,11 +305,11 @@ def get_exchange_rate(year, month):
     return exchange_rate
 
 
-def get_revenue(filters, month, item_groups, debug=False):
+def get_revenue(filters, month, item_groups, debug=False, company_currency=None, exchange_rate=None):
     """
     Fetch a list of documents (Items or Sales Invoices) and calculate the sum.
     """
-    details = get_revenue_details(filters, month, item_groups, debug=False)
+    details = get_revenue_details(filters, month, item_groups, debug=False, company_currency=company_currency, exchange_rate=exchange_rate)
 
     # create sums per chf and eur to show as total in the report
     revenue = {'eur': 0, 'chf': 0}
@@ -221,14 +325,13 @@ def get_revenue(filters, month, item_groups, debug=False):
     return revenue
 
 
-def calculate_chf_eur(exchange_rate, details):
+def calculate_chf_eur(exchange_rate, details, company_currency=None):
     """
     Add CHF and EUR columns to the raw data. Use the invoice conversion rate for
     CHF → EUR and EUR → CHF conversions.
     """
-    company_currency = {}
-    for c in frappe.get_all("Company", fields=['name', 'default_currency']):
-        company_currency[c['name']] = c['default_currency']
+    if not company_currency:
+        company_currency = get_company_currencies()
 
     for i in details:
         if company_currency[i['company']] == "CHF":
@@ -260,16 +363,18 @@ def calculate_chf_eur(exchange_rate, details):
     return details
 
 
-def get_revenue_details(filters, month, item_groups, debug=False):
+def get_revenue_details(filters, month, item_groups, debug=False, company_currency=None, exchange_rate=None):
     """
     Get raw document list depending on variant including CHF and EUR columns.
+    Callers that need several months or item groups pass the company currencies and the exchange rate of the month.
     """
     details = get_item_revenues(filters, month, item_groups, debug)
     # details = get_invoice_revenues(filters, month, item_groups, debug)
 
-    exchange_rate = get_exchange_rate(filters.get("fiscal_year"), month)
+    if exchange_rate is None:
+        exchange_rate = get_exchange_rate(filters.get("fiscal_year"), month)
 
-    details = calculate_chf_eur(exchange_rate, details)
+    details = calculate_chf_eur(exchange_rate, details, company_currency)
 
     return details
 
@@ -4,7 +4,7 @@
 from __future__ import unicode_literals
 #import frappe
 from frappe import _
-from microsynth.microsynth.report.sales_overview.sales_overview import get_revenue_details, get_ngs_groups, get_genetic_analysis_groups
+from microsynth.microsynth.report.sales_overview.sales_overview import get_revenue_details, get_ngs_groups, get_genetic_analysis_groups, get_company_currencies
 
 def execute(filters=None):
     columns = get_columns(filters)
@@ -33,5 +33,5 @@ def get_data(filters):
         query_groups = get_genetic_analysis_groups()
     else:
         query_groups = [ filters.get("item_groups") ]
-    data = get_revenue_details(filters, month=filters.get('month'), item_groups=query_groups, debug=False)
+    data = get_revenue_details(filters, month=filters.get('month'), item_groups=query_groups, debug=False, company_currency=get_company_currencies())
     return data
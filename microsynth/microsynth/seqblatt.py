@@ -8,7 +8,7 @@ import traceback
 from datetime import datetime
 
 import frappe
-from frappe.utils import get_url_to_form
+from frappe.utils import get_url_to_form, now
 from erpnext.selling.doctype.sales_order.sales_order import make_delivery_note
 
 from microsynth.microsynth.naming_series import get_naming_series
@@ -44,6 +44,31 @@ def check_and_get_label(label):
         return {'success': True, 'message': "OK", 'label': sequencing_labels[0]}
 
 
+def get_labels_by_barcode_and_item(pairs, fields):
+    """
+    Fetch all Sequencing Labels matching the given (barcode, item) pairs with a single tuple-IN query
+    that can use the (label_id, item) index. Returns a list of dictionaries with the keys 'barcode', 'item' and the given fields.
+
+    bench execute microsynth.microsynth.seqblatt.get_labels_by_barcode_and_item --kwargs "{'pairs': [['MY004450', '6030'], ['MY004449', '6030']], 'fields': ['status']}"
+    """
+    if not pairs:
+        return []
+
+    # Build tuple-based condition
+    values = [v for pair in pairs for v in pair]
+    tuple_conditions = ', '.join(['(%s, %s)'] * len(pairs))
+    columns = ''.join([f",\n            `{field}`" for field in fields])
+
+    sql = f"""
+        SELECT
+            `item`,
+            `label_id` AS `barcode`{columns}
+        FROM `tabSequencing Label`
+        WHERE (`label_id`, `item`) IN ({tuple_conditions});
+    """
+    return frappe.db.sql(sql, values, as_dict=True)
+
+
 def check_and_get_labels(labels):
     """
     Batch-fetch Sequencing Labels from the ERP based on barcode and item pairs.
@@ -83,25 +108,7 @@ def check_and_get_labels(labels):
         # All were incomplete → nothing to query
         return label_map
 
-    # Build tuple-based condition
-    values = [v for pair in valid_pairs for v in pair]
-    tuple_conditions = ', '.join(['(%s, %s)'] * len(valid_pairs))
-
-    sql = f"""
-        SELECT
-            name,
-            item,
-            label_id AS barcode,
-            status,
-            registered,
-            contact,
-            registered_to,
-            sales_order,
-            customer
-        FROM `tabSequencing Label`
-        WHERE (label_id, item) IN ({tuple_conditions});
-    """
-    results = frappe.db.sql(sql, values, as_dict=True)
+    results = get_labels_by_barcode_and_item(valid_pairs, ['name', 'status', 'registered', 'contact', 'registered_to', 'sales_order', 'customer'])
 
     for row in results:
         key_str = f"{row['barcode']}|{row['item']}"
@@ -120,9 +127,84 @@ def check_and_get_labels(labels):
     return label_map
 
 
+def get_labels_used_in_other_sales_orders(erp_labels):
+    """
+    Set-wise check whether Sequencing Labels are used in open Sales Orders (DocStatus <= 1)
+    other than the one they were ordered with. Returns the set of the names of all used labels.
+
+    bench execute microsynth.microsynth.seqblatt.get_labels_used_in_other_sales_orders --kwargs "{'erp_labels': [{'name': 'SL000000001', 'sales_order': 'SO-BAL-24000001'}]}"
+    """
+    label_sales_orders = { l['name']: l['sales_order'] for l in erp_labels if l.get('sales_order') }
+    if len(label_sales_orders) == 0:
+        return set()
+
+    samples = frappe.db.sql("""
+        SELECT DISTINCT
+            `tabSample`.`sequencing_label` AS `label`,
+            `tabSample Link`.`parent` AS `sales_order`
+        FROM `tabSample Link`
+        LEFT JOIN `tabSample` ON `tabSample Link`.`sample` = `tabSample`.`name`
+        LEFT JOIN `tabSales Order` ON `tabSales Order`.`name` = `tabSample Link`.`parent`
+        WHERE `tabSample`.`sequencing_label` IN %(labels)s
+            AND `tabSample Link`.`parenttype` = "Sales Order"
+            AND `tabSales Order`.`docstatus` <= 1;
+        """, {'labels': list(label_sales_orders.keys())}, as_dict=True)
+
+    return { s['label'] for s in samples if s['sales_order'] != label_sales_orders[s['label']] }
+
+
+def bulk_set_label_status(erp_labels, target_status):
+    """
+    Set the status of the given Sequencing Labels (as returned by check_and_get_labels) with a single UPDATE
+    and create the Versions of the changed labels in one batch instead of saving each label.
+    """
+    if len(erp_labels) == 0:
+        return
+
+    allowed_statuses = (frappe.get_meta("Sequencing Label").get_field("status").options or "").split("\n")
+    if target_status not in allowed_statuses:
+        frappe.throw(f"Status '{target_status}' is not allowed for Sequencing Labels. Allowed values are {', '.join(allowed_statuses)}.")
+
+    timestamp = now()
+    user = frappe.session.user
+    frappe.db.sql("""
+        UPDATE `tabSequencing Label`
+        SET `status` = %(status)s,
+            `modified` = %(now)s,
+            `modified_by` = %(user)s
+        WHERE `name` IN %(labels)s;
+        """, {'status': target_status, 'now': timestamp, 'user': user, 'labels': [l['name'] for l in erp_labels]})
+
+    # Sequencing Label tracks changes: add a Version for each label with a changed status
+    versions = []
+    versioned_labels = set()
+    for erp_label in erp_labels:
+        if erp_label['status'] == target_status or erp_label['name'] in versioned_labels:
+            continue
+        versioned_labels.add(erp_label['name'])
+        data = json.dumps({
+            'added': [],
+            'changed': [['status', erp_label['status'], target_status]],
+            'removed': [],
+            'row_changed': []
+        }, indent=1)
+        versions.append((frappe.generate_hash(length=10), timestamp, timestamp, user, user, "Sequencing Label", erp_label['name'], data))
+
+    batch_size = 500
+    for i in range(0, len(versions), batch_size):
+        batch = versions[i:i + batch_size]
+        frappe.db.sql("""
+            INSERT INTO `tabVersion` (`name`, `creation`, `modified`, `modified_by`, `owner`, `docstatus`, `ref_doctype`, `docname`, `data`)
+            VALUES {values};
+            """.format(values=", ".join(["(%s, %s, %s, %s, %s, 0, %s, %s, %s)"] * len(batch))),
+            [value for version in batch for value in version])
+
+
 def process_label_status_change(labels, target_status, required_current_statuses=None, check_not_used=False, stop_on_first_failure=False):
     """
     Unified handler to change the status of sequencing labels, with options for validation and strict failure handling.
+    All labels are fetched, validated and updated set-wise, see check_and_get_labels, get_labels_used_in_other_sales_orders
+    and bulk_set_label_status.
 
     Parameters:
         labels (list): A list of dictionaries representing labels.
@@ -152,7 +234,6 @@ def process_label_status_change(labels, target_status, required_current_statuses
         return {'success': False, 'message': "Please provide at least one Label", 'labels': None}
 
     success = True
-    disabled_customers = []
 
     try:
         # Normalize and deduplicate
@@ -164,7 +245,9 @@ def process_label_status_change(labels, target_status, required_current_statuses
         label_lookup = check_and_get_labels(normalized)
         processed_labels = []
         labels_to_process = []
-        customers_to_enable = set()
+
+        if check_not_used:
+            used_labels = get_labels_used_in_other_sales_orders([ l for l in label_lookup.values() if "error" not in l ])
 
         for label in normalized:
             key = (label["barcode"], label["item"])
@@ -205,61 +288,27 @@ def process_label_status_change(labels, target_status, required_current_statuses
                     return {'success': False, 'message': erp_label['message'], 'labels': None}
                 continue
 
-            if check_not_used:
-                sql_query = """
-                    SELECT `tabSample`.`name` AS `sample`
-                    FROM `tabSample Link`
-                    LEFT JOIN `tabSample` ON `tabSample Link`.`sample` = `tabSample`.`name`
-                    LEFT JOIN `tabSales Order` ON `tabSales Order`.`name` = `tabSample Link`.`parent`
-                    WHERE `tabSample`.`sequencing_label` = %s
-                        AND `tabSample Link`.`parent` != %s
-                        AND `tabSample Link`.`parenttype` = "Sales Order"
-                        AND `tabSales Order`.`docstatus` <= 1;
-                """
-                samples = frappe.db.sql(sql_query, (erp_label['barcode'], erp_label['sales_order']), as_dict=True)
-                if samples:
-                    erp_label['message'] = f"Label '{erp_label['barcode']}' is used in open Sales Orders other than {erp_label['sales_order']}."
-                    processed_labels.append(erp_label)
-                    success = False
-                    if stop_on_first_failure:
-                        return {'success': False, 'message': erp_label['message'], 'labels': None}
-                    continue
-
-            if erp_label.get('customer'):
-                customers_to_enable.add(erp_label['customer'])
+            if check_not_used and erp_label['name'] in used_labels:
+                erp_label['message'] = f"Label '{erp_label['barcode']}' is used in open Sales Orders other than {erp_label['sales_order']}."
+                processed_labels.append(erp_label)
+                success = False
+                if stop_on_first_failure:
+                    return {'success': False, 'message': erp_label['message'], 'labels': None}
+                continue
 
             labels_to_process.append(erp_label)
 
-        # Batch enable Customers (only fetch and modify disabled ones)
-        if customers_to_enable:
-            disabled_customers_to_enable = frappe.get_all("Customer", filters={"name": ["in", list(customers_to_enable)], "disabled": 1}, fields=["name"])
-            for c in disabled_customers_to_enable:
-                customer_doc = frappe.get_doc("Customer", c.name)
-                customer_doc.disabled = 0
-                customer_doc.save(ignore_permissions=True, ignore_version=True)  # Do not create a version.
-                disabled_customers.append(c.name)
-
-        # Set label statuses
+        # Set label statuses. The UPDATE does not validate links, so disabled Customers need not be enabled temporarily.
+        bulk_set_label_status(labels_to_process, target_status)
         for erp_label in labels_to_process:
-            #frappe.db.set_value("Sequencing Label", erp_label['name'], "status", target_status)  # would be much faster, but no validation
-            label_doc = frappe.get_doc("Sequencing Label", erp_label['name'])
-            label_doc.status = target_status
-            label_doc.save(ignore_permissions=True)
             processed_labels.append({
-                "item": label_doc.item,
-                "barcode": label_doc.label_id,
-                "status": label_doc.status,
+                "item": erp_label['item'],
+                "barcode": erp_label['barcode'],
+                "status": target_status,
                 "message": "OK"
             })
 
-        # Disable previously disabled Customers
-        for customer in disabled_customers:
-            customer_doc = frappe.get_doc("Customer", customer)
-            customer_doc.disabled = 1
-            customer_doc.save(ignore_permissions=True, ignore_version=True)  # Do not create a version.
-
         frappe.db.commit()
-        #message = f"The following Customers were temporarily enabled and are now disabled again: {','.join(disabled_customers)}" if disabled_customers else "OK"
 
         if not processed_labels:
             return {
@@ -275,7 +324,7 @@ def process_label_status_change(labels, target_status, required_current_statuses
         }
 
     except Exception as err:
-        msg = f"Error setting labels to '{target_status}':\n{labels=}\n\n {err}\n\n{disabled_customers=}"
+        msg = f"Error setting labels to '{target_status}':\n{labels=}\n\n {err}"
         frappe.log_error(f"{msg}\n\n{traceback.format_exc()}", f"process_label_status_change")
         return {'success': False, 'message': msg, 'labels': None}
 
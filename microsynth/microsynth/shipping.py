@@ -3,13 +3,16 @@
 # For license information, please see license.txt
 
 import frappe
-from frappe.utils import nowdate, add_months
+from frappe.utils import cint, nowdate, now, add_months
 from frappe.utils.password import get_decrypted_password
 import json
 import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from urllib import request, parse
-from urllib.error import URLError
+from urllib.error import HTTPError, URLError
 
 
 TRACKING_URLS = {
@@ -417,6 +420,65 @@ def add_shipping_items_to_countries(country_to_code, code_to_rate, threshold, pr
             print(f"Successfully added Shipping Item {item_code} with rate {rate}, threshold {threshold} and {preferred_express=} to Country {country}.")
 
 
+UPS_TOKEN_CACHE_KEY = "ups_oauth_token"
+UPS_TOKEN_EXPIRY_MARGIN = 120           # seconds, refresh the token before it expires
+UPS_DELIVERY_UPDATE_BATCH_SIZE = 200
+
+
+class UPSAuthenticationError(Exception):
+    pass
+
+
+class UPSConnectionError(Exception):
+    pass
+
+
+class RateLimiter():
+    """
+    Thread-safe limiter that spaces the calls of acquire() at least 1 / requests_per_second seconds apart.
+    """
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second and requests_per_second > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def acquire(self):
+        with self.lock:
+            current = time.monotonic()
+            slot = max(current, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > current:
+            time.sleep(slot - current)
+
+
+class UPSTokenProvider():
+    """
+    Holds the UPS OAuth token shared by the poller threads and requests a new one once it
+    expired or was rejected. Does not access the database or the cache.
+    """
+    def __init__(self, client_id, client_secret, token_url, merchant_id, token=None, expires_at=0):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self.merchant_id = merchant_id
+        self.token = token
+        self.expires_at = expires_at
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if not self.token or time.time() >= self.expires_at:
+                result = request_ups_oauth_token(self.client_id, self.client_secret, self.token_url, self.merchant_id)
+                self.token = result.get('access_token')
+                self.expires_at = time.time() + cint(result.get('expires_in') or 3600) - UPS_TOKEN_EXPIRY_MARGIN
+            return self.token
+
+    def invalidate(self, token):
+        with self.lock:
+            if self.token == token:
+                self.token = None
+
+
 def get_ups_settings():
     """
     Fetch UPS OAuth credentials and API base URL from settings.
@@ -430,23 +492,24 @@ def get_ups_settings():
 def fetch_pending_tracking_codes():
     """
     Fetch tracking codes that are missing a delivery date and were created in the last 3 months.
+    The oldest shipments come first since they are most likely delivered.
     """
     three_months_ago = add_months(nowdate(), -3)
     query = """
-        SELECT `name`, `tracking_code`
+        SELECT `name`, `tracking_code`, `shipping_date`
         FROM `tabTracking Code`
         WHERE `tracking_code` LIKE %s
           AND `shipping_date` IS NOT NULL
           AND `delivery_date` IS NULL
           AND `creation` > %s
-        ORDER BY `creation` DESC
+        ORDER BY `shipping_date` ASC
     """
     return frappe.db.sql(query, ("1ZH%", three_months_ago), as_dict=True)
 
 
-def get_ups_oauth_token(client_id: str, client_secret: str, token_url: str, merchant_id: str) -> str:
+def request_ups_oauth_token(client_id: str, client_secret: str, token_url: str, merchant_id: str) -> dict:
     """
-    Retrieve UPS OAuth2 access token using client credentials.
+    Request a UPS OAuth2 access token using client credentials. Returns the response including access_token and expires_in.
     """
     data = parse.urlencode({'grant_type': 'client_credentials'}).encode()
     headers = {
@@ -460,14 +523,40 @@ def get_ups_oauth_token(client_id: str, client_secret: str, token_url: str, merc
     try:
         with request.urlopen(req, timeout=15) as response:
             raw = response.read().decode()
-            result = json.loads(raw)
-            return result.get('access_token')
+            return json.loads(raw)
     except URLError as e:
         raise Exception(f"Failed to get UPS OAuth token: {e}") from e
     except json.JSONDecodeError:
         raise Exception(f"Invalid JSON response from UPS OAuth endpoint: {raw}")
 
 
+def get_ups_oauth_token(client_id: str, client_secret: str, token_url: str, merchant_id: str) -> str:
+    """
+    Retrieve UPS OAuth2 access token using client credentials.
+    """
+    return request_ups_oauth_token(client_id, client_secret, token_url, merchant_id).get('access_token')
+
+
+def get_ups_token_provider(client_id, client_secret, token_url, merchant_id):
+    """
+    Returns a UPSTokenProvider initialised with the token cached from a previous run if it is still valid.
+    """
+    cached = frappe.cache().get_value(UPS_TOKEN_CACHE_KEY) or {}
+    return UPSTokenProvider(client_id, client_secret, token_url, merchant_id,
+                            token=cached.get('token'), expires_at=cached.get('expires_at') or 0)
+
+
+def cache_ups_token(token_provider):
+    """
+    Cache the current token of the given UPSTokenProvider until it expires.
+    """
+    expires_in = int(token_provider.expires_at - time.time())
+    if token_provider.token and expires_in > 0:
+        frappe.cache().set_value(UPS_TOKEN_CACHE_KEY,
+                                 {'token': token_provider.token, 'expires_at': token_provider.expires_at},
+                                 expires_in_sec=expires_in)
+
+
 def call_ups_tracking_api(tracking_code: str, url: str, access_token: str, merchant_id: str) -> dict:
     """
     Calls the UPS Tracking API using the provided OAuth2 access token.
@@ -490,12 +579,42 @@ def call_ups_tracking_api(tracking_code: str, url: str, access_token: str, merch
     try:
         with request.urlopen(req, timeout=15) as response:
             return json.loads(response.read().decode())
-    except URLError as e:
+    except HTTPError as e:
+        if e.code == 401:
+            raise UPSAuthenticationError(f"UPS tracking API rejected the access token: {e}") from e
         raise Exception(f"UPS tracking API error: {e}") from e
+    except (URLError, ConnectionResetError) as e:
+        raise UPSConnectionError(f"UPS tracking API error: {e}") from e
     except json.JSONDecodeError as e:
         raise Exception(f"Failed to parse UPS tracking response for {tracking_code}") from e
 
 
+def extract_delivery_datetime(response_json: dict):
+    """
+    Extract delivery datetime from the UPS tracking API response. Raises an exception if the response cannot be parsed.
+    """
+    if "Fault" in response_json:
+        raise Exception(f"UPS API returned error: {json.dumps(response_json['Fault'], indent=2)}")
+    shipment = response_json["TrackResponse"]["Shipment"]
+    packages = shipment["Package"]
+    if not isinstance(packages, list):
+        packages = [packages]
+
+    for package in packages:
+        activities = package.get("Activity", [])
+        if not isinstance(activities, list):
+            activities = [activities]
+
+        for activity in activities:
+            status = activity["Status"]["Description"].lower()
+            if "delivered" in status:
+                date_str = activity.get("Date")  # e.g., '20250626'
+                time_str = activity.get("Time", "000000")  # e.g., '144152'
+                if date_str:
+                    return datetime.strptime(date_str + time_str, "%Y%m%d%H%M%S")
+    return None
+
+
 def parse_delivery_datetime(response_json: dict):
     """
     Extract delivery datetime from the UPS tracking API response.
@@ -503,23 +622,7 @@ def parse_delivery_datetime(response_json: dict):
     if "Fault" in response_json:
         raise Exception(f"UPS API returned error: {json.dumps(response_json['Fault'], indent=2)}")
     try:
-        shipment = response_json["TrackResponse"]["Shipment"]
-        packages = shipment["Package"]
-        if not isinstance(packages, list):
-            packages = [packages]
-
-        for package in packages:
-            activities = package.get("Activity", [])
-            if not isinstance(activities, list):
-                activities = [activities]
-
-            for activity in activities:
-                status = activity["Status"]["Description"].lower()
-                if "delivered" in status:
-                    date_str = activity.get("Date")  # e.g., '20250626'
-                    time_str = activity.get("Time", "000000")  # e.g., '144152'
-                    if date_str:
-                        return datetime.strptime(date_str + time_str, "%Y%m%d%H%M%S")
+        return extract_delivery_datetime(response_json)
     except Exception as e:
         msg = f"Error parsing delivery datetime: {e}\nRaw response:\n{json.dumps(response_json, indent=2)}"
         frappe.log_error(msg, title="UPS Delivery Date Parsing Error")
@@ -527,40 +630,222 @@ def parse_delivery_datetime(response_json: dict):
     return None
 
 
+def poll_ups_tracking_code(tracking_code, url, merchant_id, token_provider, rate_limiter):
+    """
+    Request the status of one tracking code. Requests a new token once if the current one is rejected
+    and retries once if the connection failed (e.g. reset by the server).
+    Runs in a worker thread and must therefore not access the database. Returns (delivery_datetime, error).
+    """
+    for _ in range(2):
+        token = token_provider.get()
+        rate_limiter.acquire()
+        try:
+            response_json = call_ups_tracking_api(tracking_code, url, token, merchant_id)
+            return extract_delivery_datetime(response_json), None
+        except UPSAuthenticationError as e:
+            token_provider.invalidate(token)
+            error = str(e)
+        except UPSConnectionError as e:
+            error = str(e)
+        except Exception as e:
+            return None, str(e)
+    return None, error
+
+
+def poll_ups_tracking_codes(tracking_codes, url, merchant_id, token_provider, requests_per_second=5, parallel_requests=4):
+    """
+    Poll the UPS Tracking API for the given list of dictionaries with a tracking_code with a pool of threads,
+    limited to the given number of requests per second. Yields (tracking_code, delivery_datetime, error)
+    in the order of the given tracking codes.
+    """
+    rate_limiter = RateLimiter(requests_per_second)
+    with ThreadPoolExecutor(max_workers=max(cint(parallel_requests), 1)) as executor:
+        results = executor.map(
+            lambda tc: poll_ups_tracking_code(tc['tracking_code'], url, merchant_id, token_provider, rate_limiter),
+            tracking_codes)
+        for tracking_code, (delivery_datetime, error) in zip(tracking_codes, results):
+            yield tracking_code, delivery_datetime, error
+
+
+def set_tracking_code_delivery_dates(deliveries):
+    """
+    Set the delivery_date of Tracking Codes without delivery date from a dictionary Tracking Code name -> delivery datetime
+    with one update per batch and add the Versions.
+    """
+    timestamp = now()
+    user = frappe.session.user
+    names = list(deliveries.keys())
+    for i in range(0, len(names), UPS_DELIVERY_UPDATE_BATCH_SIZE):
+        batch = names[i:i + UPS_DELIVERY_UPDATE_BATCH_SIZE]
+        # only Tracking Codes that still have no delivery date are updated and versioned
+        batch = [r[0] for r in frappe.db.sql("""
+            SELECT `name`
+            FROM `tabTracking Code`
+            WHERE `name` IN %(names)s
+              AND `delivery_date` IS NULL;
+            """, {'names': batch})]
+        if len(batch) == 0:
+            continue
+        values = []
+        for name in batch:
+            values += [name, deliveries[name]]
+        frappe.db.sql("""
+            UPDATE `tabTracking Code`
+            SET `delivery_date` = CASE `name` {cases} END,
+                `modified` = %s,
+                `modified_by` = %s
+            WHERE `name` IN ({names});
+            """.format(cases=" ".join(["WHEN %s THEN %s"] * len(batch)), names=", ".join(["%s"] * len(batch))),
+            values + [timestamp, user] + batch)
+
+        versions = []
+        for name in batch:
+            data = json.dumps({
+                'added': [],
+                'changed': [['delivery_date', None, deliveries[name].strftime("%Y-%m-%d %H:%M:%S")]],
+                'removed': [],
+                'row_changed': []
+            }, indent=1)
+            versions.append((frappe.generate_hash(length=10), timestamp, timestamp, user, user, "Tracking Code", name, data))
+        frappe.db.sql("""
+            INSERT INTO `tabVersion` (`name`, `creation`, `modified`, `modified_by`, `owner`, `docstatus`, `ref_doctype`, `docname`, `data`)
+            VALUES {values};
+            """.format(values=", ".join(["(%s, %s, %s, %s, %s, 0, %s, %s, %s)"] * len(versions))),
+            [value for version in versions for value in version])
+
+
 def update_ups_delivery_dates(request_limit: int = None):
     """
+    Polls the UPS Tracking API for all pending UPS tracking codes (oldest shipments first) with parallel requests,
+    limited by the Shipment Tracking Settings, and stores the delivery dates in batches.
+    Returns the size of the backlog, the number of polled, delivered and failed tracking codes and the throughput.
+
     Should be run once per night by a daily cronjob:
     # Status request for UPS tracking codes without a delivery date
-    30 3 * * * cd /home/frappe/frappe-bench && /usr/local/bin/bench --site erp.microsynth.local execute microsynth.microsynth.shipping.update_ups_delivery_dates --kwargs "{'request_limit': 50}"
+    30 3 * * * cd /home/frappe/frappe-bench && /usr/local/bin/bench --site erp.microsynth.local execute microsynth.microsynth.shipping.update_ups_delivery_dates
 
     bench execute microsynth.microsynth.shipping.update_ups_delivery_dates --kwargs "{'request_limit': 1}"
     """
+    start = time.perf_counter()
     url, token_url, client_id, client_secret, merchant_id = get_ups_settings()
-    access_token = get_ups_oauth_token(client_id, client_secret, token_url, merchant_id)
-    #print("Access token:", access_token)
+    settings = frappe.get_single("Shipment Tracking Settings")
+    token_provider = get_ups_token_provider(client_id, client_secret, token_url, merchant_id)
     tracking_codes = fetch_pending_tracking_codes()
+    backlog = len(tracking_codes)
+    if request_limit:
+        tracking_codes = tracking_codes[:cint(request_limit)]
+
+    deliveries = {}
+    delivered = 0
+    errors = []
+    for tracking_code, delivery_datetime, error in poll_ups_tracking_codes(tracking_codes, url, merchant_id, token_provider,
+                                                                           requests_per_second=settings.requests_per_second,
+                                                                           parallel_requests=settings.parallel_requests):
+        code = tracking_code['tracking_code']
+        if error:
+            error_msg = f"Error updating {code}: {error}"
+            errors.append(error_msg)
+            print(f"❌ {error_msg}")
+        elif delivery_datetime:
+            deliveries[tracking_code['name']] = delivery_datetime
+            delivered += 1
+            print(f"✅ Delivered: {code} on {delivery_datetime}")
+            if len(deliveries) >= UPS_DELIVERY_UPDATE_BATCH_SIZE:
+                set_tracking_code_delivery_dates(deliveries)
+                frappe.db.commit()
+                deliveries = {}
+        else:
+            print(f"⏳ Still in transit: {code}")
+    set_tracking_code_delivery_dates(deliveries)
+    frappe.db.commit()
+    cache_ups_token(token_provider)
+
+    duration = time.perf_counter() - start
+    if errors:
+        frappe.log_error(title="UPS Tracking Update Failed", message="\n".join(errors))
+    report = {
+        'backlog': backlog,
+        'polled': len(tracking_codes),
+        'delivered': delivered,
+        'errors': len(errors),
+        'remaining': backlog - delivered,
+        'duration': round(duration, 1),
+        'requests_per_second': round(len(tracking_codes) / duration, 2) if duration > 0 else None
+    }
+    print(f"Backlog: {backlog} tracking codes, polled {report['polled']} in {report['duration']} seconds "
+          f"({report['requests_per_second']} requests/s), {delivered} delivered, {len(errors)} errors, {report['remaining']} remaining.")
+    return report
 
-    for i, tracking_code in enumerate(tracking_codes):
-        if request_limit and i >= request_limit:
-            break
 
-        code = tracking_code["tracking_code"]
-        try:
-            response_json = call_ups_tracking_api(code, url, access_token, merchant_id)
-            delivery_datetime = parse_delivery_datetime(response_json)
+def test_ups_poller(number_of_codes=200, requests_per_second=50, parallel_requests=8):
+    """
+    Run poll_ups_tracking_codes against a local stub of the UPS OAuth and Tracking endpoints.
+    The stub delivers every second tracking code and rejects the first token once to exercise the refresh.
 
-            if delivery_datetime:
-                doc = frappe.get_doc("Tracking Code", tracking_code["name"])
-                doc.delivery_date = delivery_datetime
-                doc.save(ignore_permissions=True)
-                frappe.db.commit()
-                print(f"✅ Delivered: {code} on {delivery_datetime}")
+    bench execute microsynth.microsynth.shipping.test_ups_poller --kwargs "{'number_of_codes': 200}"
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    state = {'tokens': 0, 'requests': 0}
+    lock = threading.Lock()
+
+    class StubUPSHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = self.rfile.read(cint(self.headers.get('Content-Length')))
+            if self.path == "/token":
+                with lock:
+                    state['tokens'] += 1
+                    token = f"token-{state['tokens']}"
+                self.send_json(200, {'access_token': token, 'expires_in': "14399"})
+                return
+            if self.headers.get('Authorization') == "Bearer token-1":
+                self.send_json(401, {'response': {'errors': [{'code': "250002", 'message': "Invalid Authentication Information."}]}})
+                return
+            with lock:
+                state['requests'] += 1
+            code = json.loads(body)['TrackRequest']['InquiryNumber']
+            if int(code[-1]) % 2 == 0:
+                activity = {'Status': {'Description': "DELIVERED"}, 'Date': "20261017", 'Time': "101500"}
             else:
-                print(f"⏳ Still in transit: {code}")
-        except Exception as e:
-            error_msg = f"Error updating {code}: {e}"
-            frappe.log_error(title="UPS Tracking Update Failed", message=error_msg)
-            print(f"❌ {error_msg}")
+                activity = {'Status': {'Description': "In Transit"}, 'Date': "20261016", 'Time': "080000"}
+            self.send_json(200, {'TrackResponse': {'Shipment': {'Package': {'Activity': [activity]}}}})
+
+    class StubUPSServer(ThreadingHTTPServer):
+        # the default listen backlog of 5 resets connections when many threads poll without rate limit
+        request_queue_size = 128
+
+    server = StubUPSServer(("127.0.0.1", 0), StubUPSHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    tracking_codes = [{'name': f"TC-{i}", 'tracking_code': f"1ZH{i:015d}"} for i in range(number_of_codes)]
+    token_provider = UPSTokenProvider("client", "secret", f"{base_url}/token", "merchant")
+
+    start = time.perf_counter()
+    results = list(poll_ups_tracking_codes(tracking_codes, f"{base_url}/track", "merchant", token_provider,
+                                           requests_per_second=requests_per_second, parallel_requests=parallel_requests))
+    duration = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+
+    delivered = [tc for tc, delivery_datetime, error in results if delivery_datetime]
+    errors = [error for tc, delivery_datetime, error in results if error]
+    expected_delivered = [tc for tc in tracking_codes if int(tc['tracking_code'][-1]) % 2 == 0]
+    success = (delivered == expected_delivered and len(errors) == 0 and state['tokens'] == 2
+               and all(delivery_datetime == datetime(2026, 10, 17, 10, 15) for tc, delivery_datetime, error in results if delivery_datetime))
+    print(f"Polled {len(results)} tracking codes in {duration:.2f} seconds ({len(results) / duration:.1f} requests/s, limit {requests_per_second}), "
+          f"{len(delivered)} delivered, {len(errors)} errors, {state['tokens']} tokens requested: {'OK' if success else 'FAILED'}")
+    return success
 
 
 def validate_customer_shipping_items(doc, method):
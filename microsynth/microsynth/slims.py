@@ -6,131 +6,291 @@
 #
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 import frappe
 from frappe import _
-from frappe.utils import cint
+from frappe.utils import cint, now
 from frappe.utils.password import get_decrypted_password
+import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
-# check a person ID in SLIMS
-def get_customer(person_id):
-    # get configuration
+SLIMS_BATCH_SIZE = 1000
+
+
+def get_slims_config():
+    """
+    Read the SLIMS Settings and decrypt the password once
+    """
     config = frappe.get_doc("SLIMS Settings", "SLIMS Settings")
-    # endpoint
+    config.decrypted_password = get_decrypted_password("SLIMS Settings", "SLIMS Settings", "password")
+    return config
+
+def get_slims_session(config, parallel_requests=1):
+    """
+    Create one HTTP session with a connection pool for all requests to SLIMS
+    """
+    session = requests.Session()
+    session.auth = HTTPBasicAuth(config.username, config.decrypted_password)
+    session.verify = cint(config.verify_ssl) == 1
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(parallel_requests, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def lookup_customer(session, config, person_id):
+    """
+    Return (primary key or None, error message or None) of the SLIMS customer with the given person ID.
+    Does not access the database and can therefore run in a worker thread.
+    """
     endpoint = "{host}/slimsrest/rest/Customer?cstm_cf_personId={person_id}".format(host=config.endpoint, person_id=person_id)
-    # get customer data
-    res = requests.get(
-        endpoint,
-        verify=cint(config.verify_ssl),
-        auth=HTTPBasicAuth(
-            config.username,
-            get_decrypted_password("SLIMS Settings", "SLIMS Settings", "password")
-        )
-    )
+    res = session.get(endpoint)
     # parse feedback
     if res.status_code == 200:
         content = res.json()
         if len(content['entities']) == 0:
-            return None
+            return None, None
         elif len(content['entities']) > 1:
-            frappe.log_error( _("Requested SLIMS customer for person_id {0} returned multiple results").format(person_id), _("SLIMS") )
+            return content['entities'][0]['pk'], _("Requested SLIMS customer for person_id {0} returned multiple results").format(person_id)
         # return the first hit
-        return content['entities'][0]['pk']
+        return content['entities'][0]['pk'], None
     else:
-        frappe.log_error( _("SLIMS error {0} - {1} on get customer {2}").format(res.status_code, res.text, person_id), _("SLIMS") )
-        return None
+        return None, _("SLIMS error {0} - {1} on get customer {2}").format(res.status_code, res.text, person_id)
 
-def create_update_slims_customer(person_id):
-    # get configuration
-    config = frappe.get_doc("SLIMS Settings", "SLIMS Settings")
-    # check if customer exists
-    primary_key = get_customer(person_id)
-    # fetch customer record
-    if not frappe.db.exists("Contact", person_id):
-        frappe.throw( _("Contact {0} not found.").format(person_id) )
-    contact = frappe.get_doc("Contact", person_id)
-    customer = None
-    for r in contact.links:
-        if r.link_doctype == "Customer":
-            customer = frappe.get_doc("Customer", r.link_name)
-            break
-
-    if contact.address and frappe.db.exists("Address", person_id):
+# check a person ID in SLIMS
+def get_customer(person_id):
+    config = get_slims_config()
+    primary_key, error = lookup_customer(get_slims_session(config), config, person_id)
+    if error:
+        frappe.log_error(error, _("SLIMS"))
+    return primary_key
 
-        address = frappe.get_doc("Address", contact.address or person_id)
+def send_slims_customer(session, config, person_id, customer_data):
+    """
+    Create or update the SLIMS customer of the given person ID. Returns a tuple (success, list of error messages).
+    Does not access the database and can therefore run in a worker thread.
+    """
+    errors = []
+    # check if customer exists
+    primary_key, error = lookup_customer(session, config, person_id)
+    if error:
+        errors.append(error)
+    # send customer record
+    headers = {'content-type': 'application/json'}
+    if primary_key:
+        # update
+        endpoint = "{host}/slimsrest/rest/Customer/{primary_key}".format(host=config.endpoint, primary_key=primary_key)
+        res = session.post(endpoint, data=json.dumps(customer_data), headers=headers)
+    else:
+        # create
+        endpoint = "{host}/slimsrest/rest/Customer".format(host=config.endpoint)
+        res = session.put(endpoint, data=json.dumps(customer_data), headers=headers)
+    # parse feedback
+    if res.status_code != 200:
+        errors.append(_("SLIMS error {0} - {1} on create/update customer with person_id {2}").format(res.status_code, res.text, person_id))
+        return False, errors
+    return True, errors
 
-        if len(contact.email_ids)>1:
-            snd_mail = contact.email_ids[1].email_id
-        else:
-            snd_mail = ""
+def get_slims_customer_data(person_ids):
+    """
+    Build the SLIMS customer records of the given Contacts with a few queries.
+    Returns a dictionary person_id -> customer record, Contacts without a valid shipping address are omitted.
+    """
+    customer_data = {}
+    person_ids = list(set(person_ids))
+    for i in range(0, len(person_ids), SLIMS_BATCH_SIZE):
+        batch = person_ids[i:i + SLIMS_BATCH_SIZE]
+        contacts = frappe.db.sql("""
+            SELECT `tabContact`.`name`,
+                `tabContact`.`salutation`,
+                `tabContact`.`designation`,
+                `tabContact`.`first_name`,
+                `tabContact`.`last_name`,
+                `tabContact`.`institute`,
+                `tabContact`.`department`,
+                `tabContact`.`room`,
+                `tabContact`.`group_leader`,
+                `tabContact`.`email_id`,
+                `tabContact`.`phone`,
+                `tabAddress`.`address_type`,
+                `tabAddress`.`address_line1`,
+                `tabAddress`.`pincode`,
+                `tabAddress`.`city`,
+                `tabAddress`.`country`
+            FROM `tabContact`
+            JOIN `tabAddress` ON `tabAddress`.`name` = `tabContact`.`address`
+            JOIN `tabAddress` AS `tPersonAddress` ON `tPersonAddress`.`name` = `tabContact`.`name`
+            WHERE `tabContact`.`name` IN %(contacts)s;
+            """, {'contacts': batch}, as_dict=True)
+        # first linked Customer of each Contact
+        customers = {}
+        for link in frappe.db.sql("""
+            SELECT `tabDynamic Link`.`parent` AS `contact`,
+                `tabCustomer`.`customer_name`,
+                `tabCustomer`.`disabled`
+            FROM `tabDynamic Link`
+            JOIN `tabCustomer` ON `tabCustomer`.`name` = `tabDynamic Link`.`link_name`
+            WHERE `tabDynamic Link`.`parenttype` = "Contact"
+                AND `tabDynamic Link`.`link_doctype` = "Customer"
+                AND `tabDynamic Link`.`parent` IN %(contacts)s
+            ORDER BY `tabDynamic Link`.`idx` ASC;
+            """, {'contacts': batch}, as_dict=True):
+            if not link['contact'] in customers:
+                customers[link['contact']] = link
+        # second email address of each Contact
+        email_ids = {}
+        for email in frappe.db.sql("""
+            SELECT `parent`, `email_id`
+            FROM `tabContact Email`
+            WHERE `parenttype` = "Contact"
+                AND `parent` IN %(contacts)s
+            ORDER BY `idx` ASC;
+            """, {'contacts': batch}, as_dict=True):
+            email_ids.setdefault(email['parent'], []).append(email['email_id'])
 
-        if address.address_type == "Shipping":
-            customer_data = {
-                "cstm_name": "{lastname}_{person_id}".format(lastname=contact.last_name, person_id=person_id),
+        for contact in contacts:
+            if contact['address_type'] != "Shipping":
+                continue        # billing contact
+            person_id = contact['name']
+            customer = customers.get(person_id)
+            emails = email_ids.get(person_id, [])
+            snd_mail = emails[1] if len(emails) > 1 else ""
+            customer_data[person_id] = {
+                "cstm_name": "{lastname}_{person_id}".format(lastname=contact['last_name'], person_id=person_id),
                 "cstm_cf_personId": "{person_id}".format(person_id=person_id),
                 #"cstm_cf_userName": "{user}".format(user=contact.webshop_user),    # will not work - variable not implemente
-                "cstm_cf_salutation": "{salutation}".format(salutation=contact.salutation or ""),
-                "cstm_cf_title": "{title}".format(title=contact.designation or ""),
-                "cstm_cf_firstName": "{firstname}".format(firstname=contact.first_name or ""),
-                "cstm_cf_lastName": "{lastname}".format(lastname=contact.last_name or ""),
-                "cstm_cf_institute": "{institute}".format(institute=contact.institute or ""),
-                "cstm_cf_department": "{department}".format(department=contact.department or ""),
-                "cstm_cf_houseRoom": "{room}".format(room=contact.room or ""),
-                "cstm_cf_groupLeader": "{groupleader}".format(groupleader=contact.group_leader or ""),
-                "cstm_cf_universityCompany": "{customer_name}".format(customer_name=customer.customer_name or "") if customer else "",
-                "cstm_cf_street": "{street}".format(street=address.address_line1 or ""),
-                "cstm_cf_zipCode": "{zipcode}".format(zipcode=address.pincode or ""),
-                "cstm_cf_town": "{town}".format(town=address.city or ""),
-                "cstm_cf_country": "{country}".format(country=address.country or ""),
-                "cstm_cf_email": "{email}".format(email=contact.email_id or ""),
+                "cstm_cf_salutation": "{salutation}".format(salutation=contact['salutation'] or ""),
+                "cstm_cf_title": "{title}".format(title=contact['designation'] or ""),
+                "cstm_cf_firstName": "{firstname}".format(firstname=contact['first_name'] or ""),
+                "cstm_cf_lastName": "{lastname}".format(lastname=contact['last_name'] or ""),
+                "cstm_cf_institute": "{institute}".format(institute=contact['institute'] or ""),
+                "cstm_cf_department": "{department}".format(department=contact['department'] or ""),
+                "cstm_cf_houseRoom": "{room}".format(room=contact['room'] or ""),
+                "cstm_cf_groupLeader": "{groupleader}".format(groupleader=contact['group_leader'] or ""),
+                "cstm_cf_universityCompany": "{customer_name}".format(customer_name=customer['customer_name'] or "") if customer else "",
+                "cstm_cf_street": "{street}".format(street=contact['address_line1'] or ""),
+                "cstm_cf_zipCode": "{zipcode}".format(zipcode=contact['pincode'] or ""),
+                "cstm_cf_town": "{town}".format(town=contact['city'] or ""),
+                "cstm_cf_country": "{country}".format(country=contact['country'] or ""),
+                "cstm_cf_email": "{email}".format(email=contact['email_id'] or ""),
                 "cstm_cf_secondEmail": "{snd_mail}".format(snd_mail=snd_mail or ""),
                 #"cstm_cf_phoneCountry": "0041",
-                "cstm_cf_phone": "{phone}".format(phone=contact.phone or ""),
-                "cstm_active": (not customer.disabled) if customer else 0
+                "cstm_cf_phone": "{phone}".format(phone=contact['phone'] or ""),
+                "cstm_active": (not customer['disabled']) if customer else 0
             }
-            # send customer record
-            headers = {'content-type': 'application/json'}
-            if primary_key:
-                # update
-                endpoint = "{host}/slimsrest/rest/Customer/{primary_key}".format(host=config.endpoint, primary_key=primary_key)
-                res = requests.post(
-                    endpoint,
-                    data=json.dumps(customer_data),
-                    verify=cint(config.verify_ssl),
-                    auth=HTTPBasicAuth(
-                        config.username,
-                        get_decrypted_password("SLIMS Settings", "SLIMS Settings", "password")
-                    ),
-                    headers=headers
-                )
-                print("updating")
-            else:
-                # create
-                endpoint = "{host}/slimsrest/rest/Customer".format(host=config.endpoint)
-                res = requests.put(
-                    endpoint,
-                    data=json.dumps(customer_data),
-                    verify=cint(config.verify_ssl),
-                    auth=HTTPBasicAuth(
-                        config.username,
-                        get_decrypted_password("SLIMS Settings", "SLIMS Settings", "password")
-                    ),
-                    headers=headers
-                )
-                print("creating")
-
-            # parse feedback
-            if res.status_code != 200:
-                frappe.log_error( _("SLIMS error {0} - {1} on create/update customer with person_id {2}").format(res.status_code, res.text, person_id), _("SLIMS") )
-        else:
-            print("is billing contact")
-    else:
-        print("contact without valid address")
+    return customer_data
+
+def get_payload_hash(customer_data):
+    return hashlib.sha256(json.dumps(customer_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+def get_sent_payload_hashes(person_ids):
+    """
+    Return a dictionary person_id -> hash of the customer record that was last sent to SLIMS
+    """
+    hashes = {}
+    person_ids = list(set(person_ids))
+    for i in range(0, len(person_ids), SLIMS_BATCH_SIZE):
+        for log in frappe.get_all("SLIMS Sync Log",
+            filters={'contact': ['IN', person_ids[i:i + SLIMS_BATCH_SIZE]]},
+            fields=['contact', 'payload_hash']):
+            hashes[log['contact']] = log['payload_hash']
+    return hashes
+
+def store_sent_payload_hashes(hashes):
+    """
+    Insert or update the SLIMS Sync Log entries for the given dictionary person_id -> payload hash
+    """
+    timestamp = now()
+    user = frappe.session.user
+    rows = [(person_id, timestamp, timestamp, user, user, person_id, payload_hash, timestamp) for person_id, payload_hash in hashes.items()]
+    for i in range(0, len(rows), SLIMS_BATCH_SIZE):
+        batch = rows[i:i + SLIMS_BATCH_SIZE]
+        frappe.db.sql("""
+            INSERT INTO `tabSLIMS Sync Log` (`name`, `creation`, `modified`, `owner`, `modified_by`, `contact`, `payload_hash`, `last_sync`)
+            VALUES {values}
+            ON DUPLICATE KEY UPDATE
+                `payload_hash` = VALUES(`payload_hash`),
+                `last_sync` = VALUES(`last_sync`),
+                `modified` = VALUES(`modified`),
+                `modified_by` = VALUES(`modified_by`);
+            """.format(values=", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(batch))),
+            [value for row in batch for value in row])
+
+def get_changed_slims_customers(customer_data, sent_hashes):
+    """
+    Return a dictionary person_id -> (customer record, payload hash) of the records whose hash differs from the sent one
+    """
+    changed = {}
+    for person_id, data in customer_data.items():
+        payload_hash = get_payload_hash(data)
+        if sent_hashes.get(person_id) != payload_hash:
+            changed[person_id] = (data, payload_hash)
+    return changed
+
+def send_slims_customers(config, changed, debug=False):
+    """
+    Send the given dictionary person_id -> (customer record, payload hash) to SLIMS with one pooled session and
+    at most SLIMS Settings.parallel_requests at the same time. Returns a dictionary person_id -> payload hash
+    of the records SLIMS accepted. Errors are logged.
+    """
+    parallel_requests = max(cint(config.get('parallel_requests')), 1)
+    session = get_slims_session(config, parallel_requests)
+    successful = {}
+    with ThreadPoolExecutor(max_workers=parallel_requests) as executor:
+        futures = { executor.submit(send_slims_customer, session, config, person_id, data): person_id for person_id, (data, payload_hash) in changed.items() }
+        for count, future in enumerate(as_completed(futures), start=1):
+            person_id = futures[future]
+            try:
+                success, errors = future.result()
+            except Exception as err:
+                success, errors = False, [_("SLIMS error {0} on create/update customer with person_id {1}").format(err, person_id)]
+            for error in errors:
+                frappe.log_error(error, _("SLIMS"))
+            if success:
+                # only remember the sent data if SLIMS accepted it
+                successful[person_id] = changed[person_id][1]
+            if debug:
+                print("Sent {0} to SLIMS... ({1}%)".format(person_id, int(100 * count / len(changed))))
+    session.close()
+    return successful
+
+def send_changed_slims_customers(person_ids, force=False, debug=False):
+    """
+    Send the customer records of the given Contacts to SLIMS if they changed since they were last sent (or always if force).
+    Returns the number of sent records.
+    """
+    config = get_slims_config()
+    customer_data = get_slims_customer_data(person_ids)
+    sent_hashes = {} if force else get_sent_payload_hashes(customer_data.keys())
+    changed = get_changed_slims_customers(customer_data, sent_hashes)
+    if debug:
+        print("{0} of {1} modified records with a valid address changed their SLIMS data".format(len(changed), len(customer_data)))
+    if len(changed) == 0:
+        return 0
+    successful = send_slims_customers(config, changed, debug)
+    store_sent_payload_hashes(successful)
+    return len(successful)
+
+def create_update_slims_customer(person_id):
+    if not frappe.db.exists("Contact", person_id):
+        frappe.throw( _("Contact {0} not found.").format(person_id) )
+    customer_data = get_slims_customer_data([person_id])
+    if not person_id in customer_data:
+        print("contact without valid shipping address")
+        return
+    config = get_slims_config()
+    session = get_slims_session(config)
+    success, errors = send_slims_customer(session, config, person_id, customer_data[person_id])
+    if success:
+        store_sent_payload_hashes({person_id: get_payload_hash(customer_data[person_id])})
+    for error in errors:
+        frappe.log_error(error, _("SLIMS"))
+    session.close()
     return
 
-def sync(debug=False):
+def sync(debug=False, force=False):
     # get configuration
     config = frappe.get_doc("SLIMS Settings", "SLIMS Settings")
     if cint(config.enabled) == 1:
@@ -141,12 +301,8 @@ def sync(debug=False):
         changed_records = get_modified_records(last_sync)
         if debug == True and len(changed_records) == 0:
             print("no records to sync")
-        count = 0
-        for record in changed_records:
-            if debug:
-                count += 1
-                print("Sending {0} to SLIMS... ({1}%)".format(record, int(100*count/len(changed_records))))
-            create_update_slims_customer(record)
+        # only send records with changed SLIMS data
+        send_changed_slims_customers(changed_records, force=force, debug=debug)
         # update last sync timestamp
         config.last_sync = start_sync
         config.save(ignore_permissions=True)
@@ -184,3 +340,121 @@ def get_modified_records(change_datetime):
     for r in changed_records:
         contacts.append(r['contact'])
     return contacts
+
+def test_slims_stub(number_of_customers=50, parallel_requests=4):
+    """
+    Run get_slims_session, lookup_customer, send_slims_customer and the sending of changed records against a local
+    stub of the SLIMS REST API. The stub knows every second person ID, one twice, and fails for one person ID.
+    The Error Log of the failing person ID is rolled back.
+
+    bench execute microsynth.microsynth.slims.test_slims_stub --kwargs "{'number_of_customers': 50}"
+    """
+    import base64
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    failing = str(number_of_customers - 1)
+    known = {str(i): 1000 + i for i in range(0, number_of_customers, 2) if str(i) != failing}
+    state = {'unauthorized': 0, 'created': [], 'updated': [], 'lookups': 0}
+    lock = threading.Lock()
+    expected_auth = "Basic " + base64.b64encode(b"slims-user:slims-password").decode()
+
+    class StubSLIMSHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def check_auth(self):
+            if self.headers.get('Authorization') != expected_auth:
+                with lock:
+                    state['unauthorized'] += 1
+                self.send_json(401, {'message': "Unauthorized"})
+                return False
+            return True
+
+        def do_GET(self):
+            if not self.check_auth():
+                return
+            person_id = self.path.split("cstm_cf_personId=")[-1]
+            with lock:
+                state['lookups'] += 1
+            if person_id == "error":
+                self.send_json(500, {'message': "Internal Server Error"})
+            elif person_id == "twice":
+                self.send_json(200, {'entities': [{'pk': 1}, {'pk': 2}]})
+            elif person_id in known:
+                self.send_json(200, {'entities': [{'pk': known[person_id]}]})
+            else:
+                self.send_json(200, {'entities': []})
+
+        def do_POST(self):
+            # update
+            if not self.check_auth():
+                return
+            record = json.loads(self.rfile.read(cint(self.headers.get('Content-Length'))))
+            with lock:
+                state['updated'].append((int(self.path.split("/")[-1]), record['cstm_cf_personId']))
+            self.send_json(200, {'entities': [record]})
+
+        def do_PUT(self):
+            # create
+            if not self.check_auth():
+                return
+            record = json.loads(self.rfile.read(cint(self.headers.get('Content-Length'))))
+            if record['cstm_cf_personId'] == failing:
+                self.send_json(400, {'message': "Bad Request"})
+                return
+            with lock:
+                state['created'].append(record['cstm_cf_personId'])
+            self.send_json(200, {'entities': [record]})
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubSLIMSHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = frappe._dict({
+        'endpoint': f"http://127.0.0.1:{server.server_address[1]}",
+        'username': "slims-user",
+        'decrypted_password': "slims-password",
+        'verify_ssl': 0,
+        'parallel_requests': parallel_requests
+    })
+    checks = {}
+    session = get_slims_session(config)
+    checks['lookup known'] = lookup_customer(session, config, "0") == (1000, None)
+    checks['lookup unknown'] = lookup_customer(session, config, "1") == (None, None)
+    primary_key, error = lookup_customer(session, config, "twice")
+    checks['lookup multiple'] = primary_key == 1 and error is not None
+    primary_key, error = lookup_customer(session, config, "error")
+    checks['lookup error'] = primary_key is None and "500" in error
+    checks['send update'] = send_slims_customer(session, config, "2", {'cstm_cf_personId': "2"}) == (True, []) and state['updated'] == [(1002, "2")]
+    checks['send create'] = send_slims_customer(session, config, "3", {'cstm_cf_personId': "3"}) == (True, []) and state['created'] == ["3"]
+    session.close()
+    checks['authenticated'] = state['unauthorized'] == 0
+
+    # unchanged records (same hash as sent) are skipped, the failing record is not remembered
+    state['created'], state['updated'] = [], []
+    customer_data = {str(i): {'cstm_cf_personId': str(i), 'cstm_cf_lastName': f"Name {i}"} for i in range(number_of_customers)}
+    sent_hashes = {person_id: get_payload_hash(data) for person_id, data in customer_data.items() if int(person_id) % 5 == 0}
+    sent_hashes["1"] = "outdated"
+    changed = get_changed_slims_customers(customer_data, sent_hashes)
+    checks['skip unchanged'] = set(changed.keys()) == set(p for p in customer_data if int(p) % 5 != 0)
+    successful = send_slims_customers(config, changed)
+    frappe.db.rollback()
+    checks['send changed'] = (set(successful.keys()) == set(changed.keys()) - {failing}
+                              and all(successful[p] == changed[p][1] for p in successful)
+                              and sorted(state['created'] + [p for pk, p in state['updated']]) == sorted(successful.keys())
+                              and all(known[p] == pk for pk, p in state['updated']))
+    checks['authenticated'] = checks['authenticated'] and state['unauthorized'] == 0
+    server.shutdown()
+    server.server_close()
+
+    success = all(checks.values())
+    print(f"Sent {len(successful)} of {len(changed)} changed records ({len(customer_data) - len(changed)} unchanged skipped), "
+          f"{state['lookups']} lookups: {'OK' if success else 'FAILED ' + str([c for c, ok in checks.items() if not ok])}")
+    return success
@@ -3,7 +3,122 @@ import re
 from datetime import datetime
 import frappe
 from frappe import _
-from frappe.utils import flt
+from frappe.utils import flt, getdate
+
+
+TAX_MATRIX_VERSION_KEY = "tax_matrix_version"
+compiled_tax_matrices = {}      # site -> compiled Tax Matrix of this process, see get_compiled_tax_matrix
+
+
+def normalize_tax_key(value):
+    """
+    Normalize a value like the database compares it (case-insensitive, trailing spaces ignored)
+    """
+    return str(value).rstrip().lower()
+
+
+def get_tax_matrix_version():
+    version = frappe.cache().get_value(TAX_MATRIX_VERSION_KEY)
+    if not version:
+        version = frappe.generate_hash(length=10)
+        frappe.cache().set_value(TAX_MATRIX_VERSION_KEY, version)
+    return version
+
+
+def bump_tax_matrix_version():
+    frappe.cache().set_value(TAX_MATRIX_VERSION_KEY, frappe.generate_hash(length=10))
+
+
+def clear_compiled_tax_matrix(doc=None, event=None, *args):
+    """
+    Hooked on Tax Matrix, Sales Taxes and Charges Template and Country changes:
+    Every process recompiles the Tax Matrix on its next use.
+
+    The version is bumped now and again after the commit. Otherwise another process could compile the
+    uncommitted (old) Tax Matrix after the bump and keep it under the new version.
+    """
+    bump_tax_matrix_version()
+    if hasattr(frappe.db, 'after_commit'):
+        frappe.db.after_commit.add(bump_tax_matrix_version)
+    else:
+        frappe.enqueue("microsynth.microsynth.taxes.bump_tax_matrix_version", queue='short', enqueue_after_commit=True)
+
+
+def compile_tax_matrix():
+    """
+    Load the Tax Matrix, its alternative and purchase tax templates, the sales tax templates with their taxes
+    and the EU countries into lookup dictionaries (keys normalized with normalize_tax_key).
+    """
+    matrix = {
+        'entries': {},          # (company, category) -> [(country, sales_taxes_template)] ordered by idx
+        'purchase_templates': {},   # (purchase_company, sales_tax_template) -> purchase_tax_template
+        'alternatives': {},     # tax_template -> [(valid_from, alternative_tax_template)] latest first
+        'templates': {},        # sales tax template -> {name, taxes}
+        'defaults': {},         # company -> default sales tax template
+        'eu_countries': set()
+    }
+    for e in frappe.db.sql("""
+        SELECT `company`, `country`, `category`, `sales_taxes_template`
+        FROM `tabTax Matrix Entry`
+        WHERE `company` IS NOT NULL AND `country` IS NOT NULL AND `category` IS NOT NULL
+        ORDER BY `idx` ASC;""", as_dict=True):
+        matrix['entries'].setdefault((normalize_tax_key(e['company']), normalize_tax_key(e['category'])), []).append(
+            (normalize_tax_key(e['country']), e['sales_taxes_template']))
+    for m in frappe.db.sql("""
+        SELECT `purchase_company`, `sales_tax_template`, `purchase_tax_template`
+        FROM `tabTax Matrix Template Mapping`
+        WHERE `purchase_company` IS NOT NULL AND `sales_tax_template` IS NOT NULL
+        ORDER BY `idx` ASC;""", as_dict=True):
+        matrix['purchase_templates'].setdefault((normalize_tax_key(m['purchase_company']), normalize_tax_key(m['sales_tax_template'])), m['purchase_tax_template'])
+    for a in frappe.db.sql("""
+        SELECT `tax_template`, `alternative_tax_template`, `valid_from`
+        FROM `tabAlternative Tax Template`
+        WHERE `tax_template` IS NOT NULL AND `valid_from` IS NOT NULL
+        ORDER BY `valid_from` DESC, `idx` ASC;""", as_dict=True):
+        matrix['alternatives'].setdefault(normalize_tax_key(a['tax_template']), []).append((a['valid_from'], a['alternative_tax_template']))
+    for t in frappe.db.sql("""
+        SELECT `name`, `company`, `is_default`
+        FROM `tabSales Taxes and Charges Template`
+        ORDER BY `modified` DESC;""", as_dict=True):
+        matrix['templates'][normalize_tax_key(t['name'])] = {'name': t['name'], 'taxes': []}
+        if t['is_default'] and t['company']:
+            matrix['defaults'].setdefault(normalize_tax_key(t['company']), t['name'])
+    for tax in frappe.db.sql("""
+        SELECT `parent`, `charge_type`, `account_head`, `description`, `cost_center`, `rate`
+        FROM `tabSales Taxes and Charges`
+        WHERE `parenttype` = "Sales Taxes and Charges Template"
+        ORDER BY `parent`, `idx` ASC;""", as_dict=True):
+        template = matrix['templates'].get(normalize_tax_key(tax.pop('parent')))
+        if template:
+            template['taxes'].append(tax)
+    for c in frappe.db.sql("""SELECT `name` FROM `tabCountry` WHERE `eu` = 1;""", as_dict=True):
+        matrix['eu_countries'].add(normalize_tax_key(c['name']))
+    return matrix
+
+
+def get_compiled_tax_matrix():
+    """
+    Returns the compiled Tax Matrix of this process. It is only recompiled if the version in the cache changed.
+    """
+    version = get_tax_matrix_version()
+    compiled = compiled_tax_matrices.get(frappe.local.site)
+    if not compiled or compiled['version'] != version:
+        compiled = compile_tax_matrix()
+        compiled['version'] = version
+        compiled_tax_matrices[frappe.local.site] = compiled
+    return compiled
+
+
+def get_tax_template_taxes(tax_template):
+    """
+    Returns the name and the taxes (charge_type, account_head, description, cost_center, rate) of a sales tax template
+    """
+    template = get_compiled_tax_matrix()['templates'].get(normalize_tax_key(tax_template))
+    if not template:
+        # raises the same error as before if the template does not exist
+        template = frappe.get_doc("Sales Taxes and Charges Template", tax_template)
+        return template.name, template.taxes
+    return template['name'], template['taxes']
 
 
 def find_tax_template(company, customer, shipping_address, category):
@@ -13,37 +128,27 @@ def find_tax_template(company, customer, shipping_address, category):
     run
     bench execute microsynth.microsynth.taxes.find_tax_template --kwargs "{'company':'Microsynth France SAS', 'customer':'37662251', 'shipping_address':'230803', 'category':'Material'}"
     """
-
+    matrix = get_compiled_tax_matrix()
     # if the customer is "Individual" (B2C), always apply default tax template (with VAT)
     if frappe.get_value("Customer", customer, "customer_type") == "Individual":
-        default = frappe.get_all("Sales Taxes and Charges Template",
-            filters={'company': company, 'is_default': 1},
-            fields=['name']
-        )
-        if default and len(default) > 0:
-            return default[0]['name']
+        default = matrix['defaults'].get(normalize_tax_key(company))
+        if default:
+            return default
         else:
             frappe.log_error(f"Could not find default tax template for company '{company}'\ncustomer '{customer}' has customer_type='Individual'", "taxes.find_tax_template")
             return None
     else:
         country = frappe.get_value("Address", shipping_address, "country")
-        if frappe.get_value("Country", country, "eu"):
+        countries = [normalize_tax_key(country), "%"]
+        eu_pattern = ""
+        if normalize_tax_key(country) in matrix['eu_countries']:
+            countries.append("eu")
             eu_pattern = """ OR `country` = "EU" """
-        else:
-            eu_pattern = ""
-        find_tax_record = frappe.db.sql("""SELECT `sales_taxes_template`
-            FROM `tabTax Matrix Entry`
-            WHERE `company` = "{company}"
-              AND (`country` = "{country}" OR `country` = "%" {eu_pattern})
-              AND `category` = "{category}"
-            ORDER BY `idx` ASC;""".format(
-            company=company, country=country, category=category, eu_pattern=eu_pattern),
-            as_dict=True)
-        if len(find_tax_record) > 0:
-            return find_tax_record[0]['sales_taxes_template']
-        else:
-            frappe.log_error(f"Could not find sales tax template entry in the Tax Matrix for Customer '{customer}'\n{company=}, {country=}, {category=}, {eu_pattern=}", "taxes.find_tax_template")
-            return None
+        for entry_country, sales_taxes_template in matrix['entries'].get((normalize_tax_key(company), normalize_tax_key(category)), []):
+            if entry_country in countries:
+                return sales_taxes_template
+        frappe.log_error(f"Could not find sales tax template entry in the Tax Matrix for Customer '{customer}'\n{company=}, {country=}, {category=}, {eu_pattern=}", "taxes.find_tax_template")
+        return None
 
 
 def find_purchase_tax_template(sales_tax_template, company):
@@ -52,14 +157,9 @@ def find_purchase_tax_template(sales_tax_template, company):
 
     bench execute microsynth.microsynth.taxes.find_purchase_tax_template --kwargs "{'sales_tax_template': 'BAL Export (220) - BAL', 'company':'Microsynth France SAS'}"
     """
-    purchase_tax_records = frappe.db.sql(f"""
-        SELECT `purchase_tax_template`
-        FROM `tabTax Matrix Template Mapping`
-        WHERE `purchase_company` = "{company}"
-            AND `sales_tax_template` = "{sales_tax_template}"
-        ORDER BY `idx` ASC;""", as_dict=True)
-    if len(purchase_tax_records) > 0:
-        return purchase_tax_records[0]['purchase_tax_template']
+    purchase_tax_template = get_compiled_tax_matrix()['purchase_templates'].get((normalize_tax_key(company), normalize_tax_key(sales_tax_template)))
+    if purchase_tax_template:
+        return purchase_tax_template
     else:
         frappe.log_error(f"Could not find purchase tax template entry in the Tax Matrix for Sales Tax Template '{sales_tax_template}' targetting {company=}", "taxes.find_purchase_tax_template")
         return None
@@ -67,23 +167,21 @@ def find_purchase_tax_template(sales_tax_template, company):
 
 def get_alternative_tax_template(tax_template, date):
     """
+    Returns the alternative tax template valid at the given date (the one with the latest valid from date) or the given tax template.
+
     run
     bench execute microsynth.microsynth.taxes.get_alternative_tax_template --kwargs "{'tax_template':'BAL CH MwSt 7.7% (302) - BAL'}"
     """
-    if type(date) == datetime:
-        date = date.strftime("%Y-%m-%d")
-    query = """
-        SELECT `alternative_tax_template`, `valid_from`
-        FROM `tabAlternative Tax Template`
-        WHERE `tax_template` = '{tax_template}'
-        AND `valid_from` <='{current_date}'
-    """.format(tax_template = tax_template, current_date = date)
-
-    alternative_templates = frappe.db.sql(query, as_dict=True)
-    if len(alternative_templates) > 0:
-        return alternative_templates[0].alternative_tax_template
-    else:
+    if not date:
+        return tax_template
+    try:
+        date = getdate(date)
+    except Exception:
         return tax_template
+    for valid_from, alternative_tax_template in get_compiled_tax_matrix()['alternatives'].get(normalize_tax_key(tax_template), []):
+        if valid_from <= date:
+            return alternative_tax_template
+    return tax_template
 
 
 def set_alternative_tax_template(self, event):
@@ -124,11 +222,10 @@ def set_alternative_tax_template(self, event):
         frappe.log_error (f"Cannot process doctype '{self.doctype}'", "taxes.set_alternative_tax_template")
         return
 
-    tax_template = frappe.get_doc("Sales Taxes and Charges Template", template_name)
-    self.taxes_and_charges = tax_template.name
+    self.taxes_and_charges, taxes = get_tax_template_taxes(template_name)
     self.taxes = []
 
-    for tax in tax_template.taxes:
+    for tax in taxes:
         new_tax = { 'charge_type': tax.charge_type,
                     'account_head': tax.account_head,
                     'description': tax.description,
@@ -214,10 +311,10 @@ def update_taxes(doc, event=None):
 
     doc.taxes_and_charges = taxes
 
-    tax_template = frappe.get_doc("Sales Taxes and Charges Template", taxes)
+    _, tax_template_taxes = get_tax_template_taxes(taxes)
 
     doc.taxes = []
-    for t in tax_template.taxes:
+    for t in tax_template_taxes:
         doc.append("taxes", {
             'charge_type': t.charge_type,
             'account_head': t.account_head,
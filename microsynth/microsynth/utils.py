@@ -7,9 +7,11 @@ import re
 import frappe
 import json
 from datetime import datetime, date, timedelta
-from frappe.utils import flt, rounded, get_url_to_form, nowdate
+from frappe.utils import flt, rounded, get_url_to_form, nowdate, now
 from frappe.core.doctype.communication.email import make
+from frappe.model.naming import getseries
 from erpnextswiss.scripts.crm_tools import get_primary_customer_contact
+from microsynth.microsynth.doctype.contact_search_index.contact_search_index import get_potential_duplicates
 
 
 def get_customer(contact):
@@ -365,6 +367,222 @@ def create_sample(sample):
     return sample_doc.name
 
 
+BULK_INSERT_BATCH_SIZE = 500
+OLIGO_FIELDS = ['substance_type', 'sequence', 'scale', 'purification', 'phys_cond', 'data_sheet', 'aliquots']
+
+
+def get_existing_item_codes(item_codes):
+    """
+    Return the set of the given Item Codes (lowercase) that exist with one query.
+    """
+    item_codes = list(set(item_codes))
+    if len(item_codes) == 0:
+        return set()
+    return { i['name'].lower() for i in frappe.get_all("Item", filters={'name': ['IN', item_codes]}, fields=['name']) }
+
+
+def get_item_names(item_codes):
+    """
+    Return a dictionary Item Code -> Item Name for the given Item Codes with one query.
+    """
+    item_codes = list(set(item_codes))
+    if len(item_codes) == 0:
+        return {}
+    return { i['name']: i['item_name'] for i in frappe.get_all("Item", filters={'name': ['IN', item_codes]}, fields=['name', 'item_name']) }
+
+
+def get_names_by_web_id(doctype, web_ids):
+    """
+    Return a dictionary web_id -> name of the most recently modified document of the given DocType for each web_id.
+    """
+    web_ids = list({ w for w in web_ids if w })
+    if len(web_ids) == 0:
+        return {}
+    names = {}
+    for d in frappe.get_all(doctype, filters={'web_id': ['IN', web_ids]}, fields=['name', 'web_id'], order_by='modified desc'):
+        if not d['web_id'] in names:
+            names[d['web_id']] = d['name']
+    return names
+
+
+def reserve_series_names(prefix, digits, count):
+    """
+    Reserve count consecutive names of the given naming series prefix (e.g. "OLIGO", 6 for autoname "OLIGO.######").
+    Uses the same tabSeries counter and name format as autoname (e.g. OLIGO000123): getseries locks the counter and
+    returns the first number, the remaining numbers are reserved with a single update.
+    """
+    prefix = prefix.split('.')[0]
+    first = int(getseries(prefix, digits))
+    if count > 1:
+        frappe.db.sql("""UPDATE `tabSeries` SET `current` = `current` + %s WHERE `name` = %s""", (count - 1, prefix))
+    return [f"{prefix}{first + n:0{digits}d}" for n in range(count)]
+
+
+def bulk_insert_rows(doctype, rows):
+    """
+    Insert the given rows (list of dictionaries with identical keys) into the table of the given DocType in batches.
+    """
+    if len(rows) == 0:
+        return
+    columns = list(rows[0].keys())
+    column_string = ", ".join([f"`{c}`" for c in columns])
+    for i in range(0, len(rows), BULK_INSERT_BATCH_SIZE):
+        batch = rows[i:i + BULK_INSERT_BATCH_SIZE]
+        placeholders = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(batch))
+        values = [row[c] for row in batch for c in columns]
+        frappe.db.sql(f"""INSERT INTO `tab{doctype}` ({column_string}) VALUES {placeholders}""", values)
+
+
+def bulk_insert_with_items(doctype, prefix, digits, records, child_doctype, item_names):
+    """
+    Insert new documents of the given DocType with their child table items in batches, bypassing the ORM.
+    records is a list of (values, items) tuples. Returns the list of the new document names in the same order.
+    The values have to contain the fetch_from fields (e.g. item_name of the items is set here),
+    there is no validate since the Oligo and Sample controllers do not implement one.
+    """
+    if len(records) == 0:
+        return []
+    names = reserve_series_names(prefix, digits, len(records))
+    timestamp = now()
+    user = frappe.session.user
+    standard = {'creation': timestamp, 'modified': timestamp, 'owner': user, 'modified_by': user, 'docstatus': 0}
+    parent_rows = []
+    child_rows = []
+    for name, (values, items) in zip(names, records):
+        parent_rows.append(dict(name=name, idx=0, **standard, **values))
+        for idx, i in enumerate(items or [], start=1):
+            child_rows.append(dict(
+                name=frappe.generate_hash(length=10),
+                parent=name,
+                parenttype=doctype,
+                parentfield='items',
+                idx=idx,
+                **standard,
+                item_code=i['item_code'],
+                item_name=item_names.get(i['item_code']),
+                qty=i['qty']
+            ))
+    bulk_insert_rows(doctype, parent_rows)
+    bulk_insert_rows(child_doctype, child_rows)
+    return names
+
+
+def create_oligos(oligos):
+    """
+    Bulk version of create_oligo: Resolve all web_ids with one query, update existing Oligos
+    and insert the new Oligos with their items in batches. Returns the Oligo names in the given order.
+    """
+    existing = get_names_by_web_id("Oligo", [o.get('web_id') for o in oligos])
+    item_names = get_item_names([i['item_code'] for o in oligos for i in (o.get('items') or [])])
+    oligo_names = [None] * len(oligos)
+    new_records = []
+    new_positions = []
+    new_by_web_id = {}
+    for n, o in enumerate(oligos):
+        if o.get('web_id') and o['web_id'] in existing:
+            oligo_names[n] = create_oligo(o)
+        elif o.get('web_id') and o['web_id'] in new_by_web_id:
+            # the same new oligo occurs twice: insert it once and update it like create_oligo would
+            r = new_by_web_id[o['web_id']]
+            new_records[r] = get_new_oligo_record(o, new_records[r])
+            new_positions.append((n, r))
+        else:
+            if o.get('web_id'):
+                new_by_web_id[o['web_id']] = len(new_records)
+            new_positions.append((n, len(new_records)))
+            new_records.append(get_new_oligo_record(o))
+    new_names = bulk_insert_with_items("Oligo", "OLIGO", 6, new_records, "Oligo Item", item_names)
+    for n, r in new_positions:
+        oligo_names[n] = new_names[r]
+    return oligo_names
+
+
+def get_new_oligo_record(oligo, previous_record=None):
+    """
+    Return a tuple (values, items) for a new Oligo, optionally updating the given previous record.
+    """
+    if previous_record:
+        values, items = previous_record
+        values = dict(values)
+    else:
+        values = {
+            'oligo_name': oligo.get('name'),
+            'web_id': oligo.get('web_id'),
+            'status': 'Open'
+        }
+        for field in OLIGO_FIELDS:
+            values[field] = None
+        items = None
+    if 'name' in oligo:
+        values['oligo_name'] = oligo['name']
+    if 'status' in oligo:
+        values['status'] = oligo['status']
+    for field in OLIGO_FIELDS:
+        if field in oligo:
+            values[field] = oligo[field]
+    if 'items' in oligo:
+        items = oligo['items']
+    return (values, items)
+
+
+def get_labels_by_label_id_and_item(pairs):
+    """
+    Return a dictionary (label_id, item) -> list of Sequencing Label names for the given pairs with one query.
+    """
+    pairs = list({ p for p in pairs if p[0] and p[1] })
+    if len(pairs) == 0:
+        return {}
+    labels = {}
+    for label in frappe.db.sql("""
+        SELECT `name`, `label_id`, `item`
+        FROM `tabSequencing Label`
+        WHERE (`label_id`, `item`) IN %(pairs)s
+        ;""", {'pairs': pairs}, as_dict=True):
+        labels.setdefault((label['label_id'], label['item']), []).append(label)
+    return labels
+
+
+def create_samples(samples):
+    """
+    Bulk version of create_sample: Resolve all web_ids and Sequencing Labels with one query each, update existing Samples
+    and insert the new Samples with their items in batches. Returns the Sample names in the given order.
+    """
+    existing = get_names_by_web_id("Sample", [s.get('sample_web_id') for s in samples])
+    labels = get_labels_by_label_id_and_item([(s.get('sequencing_label'), s.get('label_item_code')) for s in samples])
+    item_names = get_item_names([i['item_code'] for s in samples for i in (s.get('items') or [])])
+    sample_names = [None] * len(samples)
+    new_records = []
+    new_positions = []
+    new_by_web_id = {}
+    for n, s in enumerate(samples):
+        if s.get('sample_web_id') and s['sample_web_id'] in existing:
+            sample_names[n] = create_sample(s)
+            continue
+        matching_labels = labels.get((s.get('sequencing_label'), s.get('label_item_code')), [])
+        label = matching_labels[0] if len(matching_labels) == 1 else None
+        values = {
+            'sample_name': s['name'],
+            'web_id': s['sample_web_id'] if 'sample_web_id' in s else s.get('web_id'),
+            'sequencing_label': label['name'] if label else None,
+            'sequencing_label_id': label['label_id'] if label else None
+        }
+        if s.get('sample_web_id') and s['sample_web_id'] in new_by_web_id:
+            # the same new sample occurs twice: insert it once with the last name and items like create_sample
+            record = new_records[new_by_web_id[s['sample_web_id']]]
+            record[0]['sample_name'] = s['name']
+            new_records[new_by_web_id[s['sample_web_id']]] = (record[0], s.get('items') if 'items' in s else record[1])
+            new_positions.append((n, new_by_web_id[s['sample_web_id']]))
+            continue
+        if s.get('sample_web_id'):
+            new_by_web_id[s['sample_web_id']] = len(new_records)
+        new_positions.append((n, len(new_records)))
+        new_records.append((values, s.get('items')))
+    new_names = bulk_insert_with_items("Sample", "SAMPLE", 6, new_records, "Sample Item", item_names)
+    for n, r in new_positions:
+        sample_names[n] = new_names[r]
+    return sample_names
+
+
 def find_label(label_barcode, item):
     """
     Find a Sequencing Label by its barcode and item.
@@ -2910,24 +3128,7 @@ def get_potential_contact_duplicates(contact_id):
     bench execute microsynth.microsynth.utils.get_potential_contact_duplicates --kwargs "{'contact_id': '215856'}"
     """
     contact = frappe.get_doc("Contact", contact_id)
-    address_type = frappe.get_value("Address", contact.address, "address_type")
-    contacts = frappe.db.sql(f"""
-        SELECT `tabContact`.`name`,
-            `tabContact`.`first_name`,
-            `tabContact`.`last_name`,
-            `tabContact`.`institute`
-        FROM `tabContact`
-        LEFT JOIN `tabAddress` ON `tabContact`.`address` = `tabAddress`.`name`
-        WHERE `tabContact`.`status` != 'Disabled'
-            AND (`tabContact`.`email_id` = '{contact.email_id}'
-                OR (`tabContact`.`first_name` = '{contact.first_name}'
-                    AND `tabContact`.`last_name` = '{contact.last_name}'
-                )
-            )
-            AND `tabAddress`.`address_type` = '{address_type}'
-            AND `tabContact`.`name` != '{contact.name}'
-        """, as_dict=True)
-    return contacts
+    return get_potential_duplicates(contact)
 
 
 def set_module_for_one_user(module, user):
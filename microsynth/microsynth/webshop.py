@@ -9,10 +9,13 @@ import frappe
 import json
 import base64
 from frappe.desk.form.linked_with import get_linked_docs
+from frappe.utils import flt
 from microsynth.microsynth.utils import (
     get_customer,
     create_oligo,
-    create_sample,
+    create_oligos,
+    create_samples,
+    get_existing_item_codes,
     get_express_shipping_item,
     get_billing_address,
     configure_new_customer,
@@ -29,10 +32,12 @@ from microsynth.microsynth.marketing import lock_contact_by_name
 from microsynth.microsynth.naming_series import get_naming_series
 from microsynth.microsynth.invoicing import set_income_accounts
 from microsynth.microsynth.shipping import create_receiver_address_lines
+from microsynth.microsynth.pricing import resolve_item_prices
 from datetime import date, datetime, timedelta
 from erpnextswiss.scripts.crm_tools import get_primary_customer_address
 from erpnext.selling.doctype.sales_order.sales_order import make_sales_invoice
 import traceback
+import time
 
 
 @frappe.whitelist(allow_guest=True)
@@ -1192,49 +1197,99 @@ def get_item_prices(content, client="webshop"):
     if frappe.db.exists("Customer", content['customer']):
         if not 'currency' in content or not content['currency'] or content['currency'] == "-":
             content['currency'] = frappe.get_value("Customer", content['customer'], "default_currency")
-        # create virtual sales order to compute prices
-        so = frappe.get_doc({
-            'doctype': "Sales Order",
-            'customer': content['customer'],
-            'currency': content['currency'],
-            'delivery_date': date.today(),
-            'selling_price_list': frappe.get_value("Customer", content['customer'], "default_price_list")
-        })
-        meta = {
-            "price_list": so.selling_price_list,
-            "currency": so.currency
-        }
-        for i in content['items']:
-            if frappe.db.exists("Item", i['item_code']):
-                so.append('items', {
-                    'item_code': i['item_code'],
-                    'qty': i['qty']
-                })
-            else:
-                return {'success': False, 'internal_message': 'Item {0} not found'.format(i['item_code']), 'message': 'Failed to get item prices', 'quotation': None}
-        # extend values
-        so.company = frappe.get_value("Customer", content['customer'], 'default_company') or frappe.defaults.get_global_default('company')
-        try:
-            so.set_missing_values()
-            so.validate()
-        except Exception as err:
-            msg = f"Error getting item prices for customer {content['customer']}: {err}. Check ERP Error Log for details."
-            frappe.log_error(f"{msg}\n\n\n{traceback.format_exc()}", "webshop.get_item_prices")
-            return {'success': False, 'message': 'Failed to get item prices', 'internal_message': msg, 'quotation': None}
-        # pick prices
-        item_prices = []
-        for i in so.items:
-            item_prices.append({
-                'item_code': i.item_code,
-                'qty': i.qty,
-                'rate': i.rate,
-                'description': i.item_name
-            })
-        return {'success': True, 'message': "OK", 'internal_message': 'OK', 'item_prices': item_prices, 'meta': meta }
+        # resolve the rates directly from the (cached) Item Prices if possible
+        price_list = frappe.get_value("Customer", content['customer'], "default_price_list")
+        item_prices = resolve_item_prices(content['customer'], content['currency'], price_list, content['items'])
+        if item_prices is not None:
+            meta = {
+                "price_list": price_list,
+                "currency": content['currency']
+            }
+            return {'success': True, 'message': "OK", 'internal_message': 'OK', 'item_prices': item_prices, 'meta': meta }
+        return get_item_prices_from_sales_order(content)
     else:
         return {'success': False, 'message': 'Failed to get item prices', 'internal_message': 'Customer not found', 'quotation': None}
 
 
+def get_item_prices_from_sales_order(content):
+    """
+    Compute the item prices with a virtual Sales Order (fallback of get_item_prices if the prices cannot be resolved directly).
+    Expects an existing customer and the currency in content.
+    """
+    # create virtual sales order to compute prices
+    so = frappe.get_doc({
+        'doctype': "Sales Order",
+        'customer': content['customer'],
+        'currency': content['currency'],
+        'delivery_date': date.today(),
+        'selling_price_list': frappe.get_value("Customer", content['customer'], "default_price_list")
+    })
+    meta = {
+        "price_list": so.selling_price_list,
+        "currency": so.currency
+    }
+    for i in content['items']:
+        if frappe.db.exists("Item", i['item_code']):
+            so.append('items', {
+                'item_code': i['item_code'],
+                'qty': i['qty']
+            })
+        else:
+            return {'success': False, 'internal_message': 'Item {0} not found'.format(i['item_code']), 'message': 'Failed to get item prices', 'quotation': None}
+    # extend values
+    so.company = frappe.get_value("Customer", content['customer'], 'default_company') or frappe.defaults.get_global_default('company')
+    try:
+        so.set_missing_values()
+        so.validate()
+    except Exception as err:
+        msg = f"Error getting item prices for customer {content['customer']}: {err}. Check ERP Error Log for details."
+        frappe.log_error(f"{msg}\n\n\n{traceback.format_exc()}", "webshop.get_item_prices")
+        return {'success': False, 'message': 'Failed to get item prices', 'internal_message': msg, 'quotation': None}
+    # pick prices
+    item_prices = []
+    for i in so.items:
+        item_prices.append({
+            'item_code': i.item_code,
+            'qty': i.qty,
+            'rate': i.rate,
+            'description': i.item_name
+        })
+    return {'success': True, 'message': "OK", 'internal_message': 'OK', 'item_prices': item_prices, 'meta': meta }
+
+
+def compare_item_prices(customers, items, quantities=None):
+    """
+    Differential test: Compare the directly resolved item prices with the prices of a virtual Sales Order
+    for all combinations of the given Customers, Item Codes and quantities. Prints and returns the mismatches.
+
+    bench execute microsynth.microsynth.webshop.compare_item_prices --kwargs "{'customers': ['8003', '37662'], 'items': ['0010', '0050', '3000']}"
+    """
+    quantities = quantities or [1, 10, 100]
+    mismatches = []
+    resolved_count = 0
+    for customer in customers:
+        currency = frappe.get_value("Customer", customer, "default_currency")
+        price_list = frappe.get_value("Customer", customer, "default_price_list")
+        for item_code in items:
+            for qty in quantities:
+                content = {'customer': customer, 'currency': currency, 'items': [{'item_code': item_code, 'qty': qty}]}
+                resolved = resolve_item_prices(customer, currency, price_list, content['items'])
+                if resolved is None:
+                    continue    # get_item_prices falls back to the virtual Sales Order anyway
+                resolved_count += 1
+                reference = get_item_prices_from_sales_order(content)
+                if not reference['success']:
+                    mismatches.append({'customer': customer, 'item_code': item_code, 'qty': qty, 'resolved': resolved[0]['rate'], 'sales_order': reference['internal_message']})
+                    continue
+                if abs(flt(resolved[0]['rate']) - flt(reference['item_prices'][0]['rate'])) > 0.0001 \
+                    or resolved[0]['description'] != reference['item_prices'][0]['description']:
+                    mismatches.append({'customer': customer, 'item_code': item_code, 'qty': qty, 'resolved': resolved[0], 'sales_order': reference['item_prices'][0]})
+    for m in mismatches:
+        print(f"Mismatch: {m}")
+    print(f"Compared {resolved_count} resolved prices, found {len(mismatches)} mismatches.")
+    return mismatches
+
+
 def apply_discount(quotation, sales_order):
     if not quotation:
         return sales_order
@@ -1243,7 +1298,7 @@ def apply_discount(quotation, sales_order):
     elif sales_order.total == quotation.total:
         sales_order.discount_amount = quotation.discount_amount
     else:
-        frappe.log_error(f"Unable to apply discount on {sales_order.name}. Mismatch between quotation and sales order: {sales_order.total=} != {quotation.total=}", "webshop.apply_discount")
+        frappe.log_error(f"Unable to apply discount of Quotation {quotation.name} on the Sales Order of Web Order ID {sales_order.web_order_id}. Mismatch between quotation and sales order: {sales_order.total=} != {quotation.total=}", "webshop.apply_discount")
     return sales_order
 
 
@@ -1252,6 +1307,8 @@ def place_order(content, client="webshop"):
     """
     Place an order
     """
+    phases = {}
+    phase_start = time.perf_counter()
     # prepare parameters
     if type(content) == str:
         content = json.loads(content)
@@ -1442,26 +1499,34 @@ def place_order(content, client="webshop"):
         quotation = None
         qtn_doc = None
 
+    phase_start = record_phase(phases, "validation", phase_start)
+
+    # check all Item Codes of the order with one query
+    existing_item_codes = get_existing_item_codes(
+        [i['item_code'] for o in content.get('oligos', []) for i in o.get('items', [])]
+        + [i['item_code'] for s in content.get('samples', []) for i in s.get('items', [])]
+        + [i['item_code'] for i in content['items']])
+
     # create oligos
     if 'oligos' in content:
         consolidated_item_qtys = {}
         for o in content['oligos']:
             if not 'web_id' in o:
                 return {'success': False, 'internal_message': "web_id missing: {0}".format(o), 'message': 'Failed to create Sales Order', 'reference': None}
-            # create or update oligo
-            oligo_name = create_oligo(o)
-            so_doc.append('oligos', {
-                'oligo': oligo_name
-            })
             # insert positions (add to consolidated)
             for i in o['items']:
-                if not frappe.db.exists("Item", i['item_code']):
+                if not str(i['item_code']).lower() in existing_item_codes:
                     return {'success': False, 'internal_message': "invalid item: {0}".format(i['item_code']),
                         'message': 'Failed to create Sales Order', 'reference': None}
                 if i['item_code'] in consolidated_item_qtys:
                     consolidated_item_qtys[i['item_code']] = consolidated_item_qtys[i['item_code']] + i['qty']
                 else:
                     consolidated_item_qtys[i['item_code']] = i['qty']
+        # create or update all oligos at once
+        for oligo_name in create_oligos(content['oligos']):
+            so_doc.append('oligos', {
+                'oligo': oligo_name
+            })
 
         # apply consolidated items
         for item, qty in consolidated_item_qtys.items():
@@ -1476,21 +1541,21 @@ def place_order(content, client="webshop"):
     if 'samples' in content:
         consolidated_item_qtys = {}
         for s in content['samples']:
-            # create or update sample
-            sample_name = create_sample(s)
-            # create sample record
-            so_doc.append('samples', {
-                'sample': sample_name
-            })
             # insert positions (add to consolidated)
             for i in s['items']:
-                if not frappe.db.exists("Item", i['item_code']):
+                if not str(i['item_code']).lower() in existing_item_codes:
                     return {'success': False, 'internal_message': "invalid item: {0}".format(i['item_code']),
                         'message': 'Failed to create Sales Order', 'reference': None}
                 if i['item_code'] in consolidated_item_qtys:
                     consolidated_item_qtys[i['item_code']] += i['qty']
                 else:
                     consolidated_item_qtys[i['item_code']] = i['qty']
+        # create or update all samples at once
+        for sample_name in create_samples(content['samples']):
+            # create sample record
+            so_doc.append('samples', {
+                'sample': sample_name
+            })
 
         # apply consolidated items
         for item, qty in consolidated_item_qtys.items():
@@ -1501,9 +1566,11 @@ def place_order(content, client="webshop"):
             }
             so_doc.append('items', _item)
 
+    phase_start = record_phase(phases, "oligo creation", phase_start)
+
     # append items
     for i in content['items']:
-        if not frappe.db.exists("Item", i['item_code']):
+        if not str(i['item_code']).lower() in existing_item_codes:
             return {'success': False, 'message': 'Failed to create place order', 'internal_message': "invalid item: {0}".format(i['item_code']),
                 'reference': None}
         item_detail = {
@@ -1517,6 +1584,17 @@ def place_order(content, client="webshop"):
             item_detail['price_list_rate'] = i['rate']
         so_doc.append('items', item_detail)
 
+    # in case of drop-shipment, mark item positions for drop shipment (prevent actual delivery)
+    if is_drop_shipment and intercompany_supplier:
+        supplier = intercompany_supplier['supplier']
+        if not supplier:
+            err = f"No supplier found for {so_doc.product_type}."
+            return {'success': False, 'internal_message': err, 'message': 'Failed to create Sales Order', 'reference': None}
+        for i in so_doc.items:
+            i.delivered_by_supplier = 1
+            i.supplier = supplier
+    phase_start = record_phase(phases, "items", phase_start)
+
     # append taxes
     if so_doc.product_type in ["Oligos", "Material"]:
         category = "Material"
@@ -1530,20 +1608,12 @@ def place_order(content, client="webshop"):
         taxes_template = frappe.get_doc("Sales Taxes and Charges Template", taxes)
         for t in taxes_template.taxes:
             so_doc.append("taxes", t)
-    # in case of drop-shipment, mark item positions for drop shipment (prevent actual delivery)
-    if is_drop_shipment and intercompany_supplier:
-        supplier = intercompany_supplier['supplier']
-        if not supplier:
-            err = f"No supplier found for {so_doc.product_type}."
-            return {'success': False, 'internal_message': err, 'message': 'Failed to create Sales Order', 'reference': None}
-        for i in so_doc.items:
-            i.delivered_by_supplier = 1
-            i.supplier = supplier
+    phase_start = record_phase(phases, "tax lookup", phase_start)
 
-    # save
+    # compute prices and totals in memory to resolve all remaining values before the first save
     try:
-        so_doc.insert(ignore_permissions=True)
-
+        so_doc.set_missing_values()
+        so_doc.calculate_taxes_and_totals()
     except Exception as err:
         msg = f"Error placing order {content['web_order_id'] if 'web_order_id' in content else None} for account {contact.name}: {err}. Check ERP Error Log for details."
         frappe.log_error(f"{msg}\n\n\n{traceback.format_exc()}", "webshop.place_order")
@@ -1567,16 +1637,26 @@ def place_order(content, client="webshop"):
         so_doc.hold_order = 1
 
     # quotation rate override: if an item has a rate in the quotation, always take this
-    #    (note: has to be post insert, otherwise frappe will override 0 rates)
+    #    (note: set rate and price_list_rate, otherwise frappe will override 0 rates)
     if quotation:
         for item in so_doc.items:                                   # loop through all items in sales order
             if item.item_code in quotation_rate:                    # check if this item had a quotation rate
                 item.rate = quotation_rate[item.item_code]
                 item.price_list_rate = quotation_rate[item.item_code]
-        so_doc.save()
+        so_doc.calculate_taxes_and_totals()
         so_doc = apply_discount(qtn_doc, so_doc)
+    phase_start = record_phase(phases, "pricing", phase_start)
+
+    # save
+    try:
+        so_doc.insert(ignore_permissions=True)
+        phase_start = record_phase(phases, "insert", phase_start)
+
+    except Exception as err:
+        msg = f"Error placing order {content['web_order_id'] if 'web_order_id' in content else None} for account {contact.name}: {err}. Check ERP Error Log for details."
+        frappe.log_error(f"{msg}\n\n\n{traceback.format_exc()}", "webshop.place_order")
+        return {'success': False, 'message': 'Failed to place order', 'internal_message': msg, 'reference': None}
 
-    so_doc.save()
     try:
         so_doc.submit()
 
@@ -1599,6 +1679,8 @@ def place_order(content, client="webshop"):
                 intercompany_customer_name=get_customer_from_company(so_doc.company),
                 supplier_company=drop_shipment_manufacturer)
         frappe.db.commit()
+        record_phase(phases, "submit", phase_start)
+        report_slow_order(so_doc.name, content.get('web_order_id'), phases)
         return {
             'success': True,
             'message': 'Sales Order created',
@@ -1616,6 +1698,28 @@ def place_order(content, client="webshop"):
         return {'success': False, 'message': 'Failed to place order', 'internal_message': msg, 'reference': None}
 
 
+def record_phase(phases, phase, phase_start):
+    """
+    Store the duration of the given phase since phase_start and return the start of the next phase.
+    """
+    now = time.perf_counter()
+    phases[phase] = now - phase_start
+    return now
+
+
+def report_slow_order(sales_order, web_order_id, phases):
+    """
+    Log the phase durations of place_order to the Error Log if the total exceeds the threshold in the Microsynth Settings.
+    """
+    threshold = flt(frappe.get_value("Microsynth Settings", "Microsynth Settings", "place_order_latency_threshold"))
+    total = sum(phases.values())
+    if threshold <= 0 or total <= threshold:
+        return
+    details = "\n".join([f"{phase}: {duration:.3f} s" for phase, duration in phases.items()])
+    frappe.log_error(f"Placing Sales Order {sales_order} (Web Order ID {web_order_id}) took {total:.3f} s "
+                     f"(threshold {threshold} s):\n{details}", "webshop.place_order latency")
+
+
 def place_dropship_order(sales_order, intercompany_customer_name, supplier_company):
     """
     Create a dropship order for the given sales order.
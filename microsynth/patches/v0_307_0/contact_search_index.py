@@ -0,0 +1,15 @@
+import frappe
+from microsynth.microsynth.doctype.contact_search_index.contact_search_index import rebuild_contact_search_index, FULLTEXT_INDEX
+
+def execute():
+    print("Build Contact Search Index...")
+
+    frappe.reload_doc("Microsynth", "doctype", "Contact Search Index")
+    rebuild_contact_search_index()
+    frappe.db.add_index("Contact Search Index", ["contact"], "contact_index")
+    frappe.db.add_index("Contact Search Index", ["contact_email"], "contact_email_index")
+    frappe.db.add_index("Contact Search Index", ["last_name", "first_name"], "last_name_first_name_index")
+    frappe.db.add_index("Contact Search Index", ["customer_id"], "customer_id_index")
+    frappe.db.sql(f"""ALTER TABLE `tabContact Search Index` ADD FULLTEXT INDEX `{FULLTEXT_INDEX}` (`trigrams`);""")
+
+    return
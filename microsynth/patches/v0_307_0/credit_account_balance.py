@@ -0,0 +1,12 @@
+import frappe
+from microsynth.microsynth.credits import rebuild_credit_account_balances
+
+def execute():
+    print("Create Credit Account Balance ledger...")
+
+    frappe.reload_doc("Microsynth", "doctype", "Credit Account Balance")
+    frappe.db.add_index("Credit Account Balance", ["credit_account", "date"], "credit_account_date_index")
+
+    rebuild_credit_account_balances()
+
+    return
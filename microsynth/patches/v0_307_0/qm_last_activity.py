@@ -0,0 +1,12 @@
+import frappe
+from microsynth.qms.doctype.qm_last_activity.qm_last_activity import rebuild_last_activities
+
+def execute():
+    print("Build QM Last Activities from submitted QM Log Book entries...")
+
+    frappe.reload_doc("QMS", "doctype", "QM Last Activity")
+    rebuild_last_activities()
+    frappe.db.add_index("QM Last Activity", ["document_type", "document_name"], "document_index")
+    frappe.db.add_index("QM Log Book", ["document_name", "entry_type"], "document_name_entry_type_index")
+
+    return
@@ -0,0 +1,11 @@
+import frappe
+from microsynth.microsynth.doctype.revenue_fact.revenue_fact import rebuild_revenue_facts
+
+def execute():
+    print("Build Revenue Facts from submitted Sales Invoices...")
+
+    frappe.reload_doc("Microsynth", "doctype", "Revenue Fact")
+    rebuild_revenue_facts()
+    frappe.db.add_index("Revenue Fact", ["year", "company", "item_group"], "year_company_item_group_index")
+
+    return
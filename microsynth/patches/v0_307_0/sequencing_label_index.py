@@ -0,0 +1,9 @@
+import frappe
+
+def execute():
+    print("Add composite index (label_id, item) to Sequencing Label...")
+
+    frappe.reload_doc("Microsynth", "doctype", "Sequencing Label")
+    frappe.db.add_index("Sequencing Label", ["label_id", "item"], "label_id_item_index")
+
+    return
@@ -0,0 +1,17 @@
+import frappe
+
+def execute():
+    print("Set Label Number on Sequencing Labels...")
+
+    frappe.reload_doc("Microsynth", "doctype", "Sequencing Label")
+    frappe.db.sql("""
+        UPDATE `tabSequencing Label`
+        SET `label_number` = CASE
+            WHEN REGEXP_SUBSTR(`label_id`, '[0-9]+$') = '' OR REGEXP_SUBSTR(`label_id`, '[0-9]+$') IS NULL THEN 0
+            WHEN CHAR_LENGTH(TRIM(LEADING '0' FROM REGEXP_SUBSTR(`label_id`, '[0-9]+$'))) > 12 THEN NULL
+            ELSE CAST(REGEXP_SUBSTR(`label_id`, '[0-9]+$') AS UNSIGNED)
+        END
+        ;""")
+    frappe.db.add_index("Sequencing Label", ["label_number", "item"], "label_number_item_index")
+
+    return
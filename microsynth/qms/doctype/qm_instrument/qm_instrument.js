@@ -105,11 +105,11 @@ frappe.ui.form.on('QM Instrument', {
         }
 
         // If the instrument class is A, a (Re-)Qualification is required every 2 years
-        // If the instrument class is F, a Verification is required each year and a Calibration every 5 years
+        // If the instrument class is P, a Verification is required each year and a Calibration every 5 years
         // If the instrument class if T or W, a Verification is required each year
         // If the instrument is overdue, show an red alert in the dashboard
         // If the instrument is due the next 30 days, show an orange alert in the dashboard
-        if (!frm.doc.__islocal && frm.doc.instrument_class && ['A', 'F', 'T', 'W'].includes(frm.doc.instrument_class.charAt(0))) {
+        if (!frm.doc.__islocal && frm.doc.instrument_class && ['A', 'P', 'T', 'W'].includes(frm.doc.instrument_class.charAt(0))) {
             frappe.call({
                 'method': "microsynth.qms.doctype.qm_instrument.qm_instrument.get_due_qualifications",
                 'args': {
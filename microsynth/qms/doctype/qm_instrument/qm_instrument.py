@@ -3,12 +3,14 @@
 # For license information, please see license.txt
 
 import csv
-from datetime import datetime, timedelta
+from datetime import datetime
 import frappe
-from frappe.utils import get_url_to_form, getdate
+from frappe.utils import get_url_to_form
 from frappe.model.document import Document
 from microsynth.qms.doctype.qm_document.qm_document import get_valid_version
 from microsynth.microsynth.purchasing import get_location_path_string, get_or_create_single_location
+from microsynth.qms.doctype.qm_last_activity.qm_last_activity import get_last_activities
+from microsynth.qms.due_dates import get_instrument_due_events
 
 
 class QMInstrument(Document):
@@ -184,43 +186,13 @@ def get_due_qualifications(instrument_name, instrument_class, acquisition_date):
     Returns a list of due qualification/verification/calibration events for the given instrument.
     Each item: {qualification_type, due_date}
     """
-    def get_last_entry_date(entry_type):
-        return frappe.db.get_value(
-            "QM Log Book",
-            {
-                "document_type": "QM Instrument",
-                "document_name": instrument_name,
-                "entry_type": entry_type,
-                "docstatus": 1
-            },
-            "date",
-            order_by="date desc"
-        )
-
-    def to_date(value):
-        return getdate(value) if value else None
-
-    def get_due_date(entry_type, interval_days):
-        last_date = get_last_entry_date(entry_type)
-        base_date = to_date(last_date) or acquisition_date
-        return (base_date + timedelta(days=interval_days)).strftime("%Y-%m-%d")
-
-    # ensure acquisition_date is a date object
-    acquisition_date = to_date(acquisition_date)
-    iclass = instrument_class[0] if instrument_class else None
-
-    rules = {
-        'A': [("(Re-)Qualification", 2 * 365)],
-        'P': [("Verification", 365), ("Calibration", 5 * 365)],
-        'T': [("Verification", 365)],
-        'W': [("Verification", 365)],
-    }
+    activities = get_last_activities("QM Instrument", [instrument_name]).get(instrument_name, {})
     return [
         {
-            "qualification_type": entry_type,
-            "due_date": get_due_date(entry_type, days)
+            "qualification_type": event['qualification_type'],
+            "due_date": event['due_date'].strftime("%Y-%m-%d") if event['due_date'] else None
         }
-        for entry_type, days in rules.get(iclass, [])
+        for event in get_instrument_due_events(instrument_class, acquisition_date, activities)
     ]
 
 
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Microsynth
+// For license information, please see license.txt
+
+frappe.ui.form.on('QM Last Activity', {
+	// refresh: function(frm) {
+
+	// }
+});
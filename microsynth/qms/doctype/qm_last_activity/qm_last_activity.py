@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Microsynth
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+import hashlib
+from frappe.model.document import Document
+from frappe.utils import now
+
+# only submitted QM Log Book entries with one of these status count as activity
+COUNTED_STATUSES = ('To Review', 'Closed')
+
+
+class QMLastActivity(Document):
+    pass
+
+
+def get_last_activity_name(document_type, document_name, entry_type):
+    """
+    Returns the name of the QM Last Activity of the given key, same as SHA1(CONCAT_WS(...)) in rebuild_last_activities
+    """
+    key = "|".join([document_type or "", document_name or "", entry_type or ""])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def update_last_activity(document_type, document_name, entry_type):
+    """
+    Recompute the QM Last Activity of the given document and entry type from the QM Log Book.
+    Called on_submit, on_update_after_submit and on_cancel of a QM Log Book entry.
+    """
+    if not document_type or not document_name or not entry_type:
+        return
+    values = {
+        'name': get_last_activity_name(document_type, document_name, entry_type),
+        'document_type': document_type,
+        'document_name': document_name,
+        'entry_type': entry_type,
+        'statuses': COUNTED_STATUSES,
+        'now': now(),
+        'user': frappe.session.user
+    }
+    activity = frappe.db.sql("""
+        SELECT
+            MAX(`date`) AS `last_date`,
+            MIN(`date`) AS `first_date`,
+            SUBSTRING_INDEX(GROUP_CONCAT(`name` ORDER BY `date` DESC, `name` DESC), ',', 1) AS `last_log_book`
+        FROM `tabQM Log Book`
+        WHERE `document_type` = %(document_type)s
+            AND `document_name` = %(document_name)s
+            AND `entry_type` = %(entry_type)s
+            AND `docstatus` = 1
+            AND `status` IN %(statuses)s
+            AND `date` IS NOT NULL;
+        """, values, as_dict=True)
+    if not activity or not activity[0]['last_date']:
+        frappe.db.sql("""DELETE FROM `tabQM Last Activity` WHERE `name` = %(name)s;""", values)
+        return
+    values.update(activity[0])
+    frappe.db.sql("""
+        INSERT INTO `tabQM Last Activity`
+            (`name`, `creation`, `modified`, `modified_by`, `owner`, `docstatus`,
+             `document_type`, `document_name`, `entry_type`, `last_date`, `first_date`, `last_log_book`)
+        VALUES (%(name)s, %(now)s, %(now)s, %(user)s, %(user)s, 0,
+                %(document_type)s, %(document_name)s, %(entry_type)s, %(last_date)s, %(first_date)s, %(last_log_book)s)
+        ON DUPLICATE KEY UPDATE
+            `last_date` = VALUES(`last_date`),
+            `first_date` = VALUES(`first_date`),
+            `last_log_book` = VALUES(`last_log_book`),
+            `modified` = VALUES(`modified`),
+            `modified_by` = VALUES(`modified_by`);
+        """, values)
+
+
+def rebuild_last_activities():
+    """
+    Rebuild the QM Last Activities from all submitted QM Log Book entries.
+
+    bench execute microsynth.qms.doctype.qm_last_activity.qm_last_activity.rebuild_last_activities
+    """
+    frappe.db.sql("""DELETE FROM `tabQM Last Activity`;""")
+    frappe.db.sql("""
+        INSERT INTO `tabQM Last Activity`
+            (`name`, `creation`, `modified`, `modified_by`, `owner`, `docstatus`,
+             `document_type`, `document_name`, `entry_type`, `last_date`, `first_date`, `last_log_book`)
+        SELECT
+            SHA1(CONCAT_WS('|', `document_type`, `document_name`, `entry_type`)),
+            %(now)s, %(now)s, %(user)s, %(user)s, 0,
+            `document_type`,
+            `document_name`,
+            `entry_type`,
+            MAX(`date`),
+            MIN(`date`),
+            SUBSTRING_INDEX(GROUP_CONCAT(`name` ORDER BY `date` DESC, `name` DESC), ',', 1)
+        FROM `tabQM Log Book`
+        WHERE `docstatus` = 1
+            AND `status` IN %(statuses)s
+            AND `date` IS NOT NULL
+            AND `document_type` IS NOT NULL
+            AND `document_name` IS NOT NULL
+            AND `entry_type` IS NOT NULL
+        GROUP BY `document_type`, `document_name`, `entry_type`;
+        """, {'now': now(), 'user': frappe.session.user, 'statuses': COUNTED_STATUSES})
+    frappe.db.commit()
+
+
+def get_last_activities(document_type, document_names=None):
+    """
+    Returns the QM Last Activities of the given document type (and documents) as a dictionary
+    document_name -> entry_type -> {last_date, first_date, last_log_book}
+    """
+    values = {'document_type': document_type, 'document_names': document_names}
+    condition = "AND `document_name` IN %(document_names)s" if document_names else ""
+    if document_names is not None and not document_names:
+        return {}
+    activities = {}
+    for a in frappe.db.sql(f"""
+        SELECT `document_name`, `entry_type`, `last_date`, `first_date`, `last_log_book`
+        FROM `tabQM Last Activity`
+        WHERE `document_type` = %(document_type)s
+            {condition};
+        """, values, as_dict=True):
+        activities.setdefault(a['document_name'], {})[a['entry_type']] = a
+    return activities
@@ -14,6 +14,7 @@ from frappe.utils import formatdate
 from frappe.model.document import Document
 from microsynth.qms.doctype.qm_instrument.qm_instrument import get_due_qualifications, is_gmp
 from microsynth.qms.signing import sign
+from microsynth.qms.doctype.qm_last_activity.qm_last_activity import update_last_activity
 
 
 SITE_COMPANY_MAP = {
@@ -47,10 +48,20 @@ class QMLogBook(Document):
                 self.status = "Closed"
             self.save()
             frappe.db.commit()
+        update_last_activity(self.document_type, self.document_name, self.entry_type)
+
+    def on_update_after_submit(self):
+        # date, entry_type and status can be changed after submit
+        before = self.get_doc_before_save()
+        if before and before.entry_type != self.entry_type:
+            update_last_activity(self.document_type, self.document_name, before.entry_type)
+        if not before or any(before.get(f) != self.get(f) for f in ['date', 'entry_type', 'status']):
+            update_last_activity(self.document_type, self.document_name, self.entry_type)
 
     def on_cancel(self):
         self.status = "Cancelled"
         self.save()
+        update_last_activity(self.document_type, self.document_name, self.entry_type)
         frappe.db.commit()
 
 
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Microsynth
+# For license information, please see license.txt
+#
+# Due dates of QM Instruments and QM Computerised Systems based on the QM Last Activities
+#
+
+from frappe.utils import add_months, getdate
+from microsynth.qms.doctype.qm_last_activity.qm_last_activity import get_last_activities
+
+# Time interval constants (single source of truth)
+REQUALIFICATION_INTERVAL_MONTHS = 24
+VERIFICATION_INTERVAL_MONTHS = 12
+CALIBRATION_INTERVAL_MONTHS = 60
+AUDIT_TRAIL_REVIEW = "Audit Trail Review"
+
+# Rules per instrument class letter:
+# - entry_type: the required QM Log Book entry type
+# - months: interval after the last activity of one of the entry types in counts
+# - first_of: the first activity of these entry types is the base if none of counts happened yet
+# - initial: without any activity, due on the acquisition date instead of one interval after it
+# The first entry type in counts wins if two activities have the same date.
+INSTRUMENT_RULES = {
+    'A': [
+        {'entry_type': "(Re-)Qualification", 'months': REQUALIFICATION_INTERVAL_MONTHS, 'counts': ["(Re-)Qualification"]}
+    ],
+    'P': [
+        {'entry_type': "Verification", 'months': VERIFICATION_INTERVAL_MONTHS, 'counts': ["Calibration", "Verification"], 'initial': True},
+        {'entry_type': "Calibration", 'months': CALIBRATION_INTERVAL_MONTHS, 'counts': ["Calibration"], 'first_of': ["Verification"], 'initial': True}
+    ],
+    'T': [
+        {'entry_type': "Verification", 'months': VERIFICATION_INTERVAL_MONTHS, 'counts': ["Verification"]}
+    ],
+    'W': [
+        {'entry_type': "Verification", 'months': VERIFICATION_INTERVAL_MONTHS, 'counts': ["Verification"]}
+    ]
+}
+
+
+def get_instrument_due_events(instrument_class, acquisition_date, activities):
+    """
+    Returns the due events of an instrument as a list of {qualification_type, last_date, last_type, due_date}.
+    activities are the QM Last Activities of the instrument (entry_type -> {last_date, first_date, ...}).
+    """
+    acquisition_date = getdate(acquisition_date) if acquisition_date else None
+    events = []
+    for rule in INSTRUMENT_RULES.get((instrument_class or " ")[0], []):
+        last_date = last_type = None
+        for entry_type in rule['counts']:
+            activity = activities.get(entry_type)
+            if activity and (not last_date or getdate(activity['last_date']) > last_date):
+                last_date = getdate(activity['last_date'])
+                last_type = entry_type
+        if last_date:
+            due_date = add_months(last_date, rule['months'])
+        else:
+            first_dates = [getdate(activities[t]['first_date']) for t in rule.get('first_of', []) if t in activities]
+            if first_dates:
+                due_date = add_months(min(first_dates), rule['months'])
+            elif acquisition_date:
+                due_date = acquisition_date if rule.get('initial') else add_months(acquisition_date, rule['months'])
+            else:
+                due_date = None
+        events.append({
+            'qualification_type': rule['entry_type'],
+            'last_date': last_date,
+            'last_type': last_type,
+            'due_date': getdate(due_date) if due_date else None
+        })
+    return events
+
+
+def get_next_due_event(events):
+    """
+    Returns the event that is due first. On the same due date the later rule wins (a Calibration covers a Verification).
+    """
+    dated = [(event['due_date'], i, event) for i, event in enumerate(events) if event['due_date']]
+    if not dated:
+        return events[-1] if events else None
+    earliest = min(d[0] for d in dated)
+    return [d[2] for d in dated if d[0] == earliest][-1]
+
+
+def get_instrument_compliance(instruments):
+    """
+    Returns the instruments (dicts with at least name, instrument_class and acquisition_date) with their next
+    due event: requirement_type, last_activity_date, last_activity_type and due_date. Instruments without rules are skipped.
+    """
+    activities = get_last_activities("QM Instrument", [i['name'] for i in instruments])
+    compliance = []
+    for instrument in instruments:
+        events = get_instrument_due_events(instrument['instrument_class'], instrument['acquisition_date'], activities.get(instrument['name'], {}))
+        event = get_next_due_event(events)
+        if not event:
+            continue
+        # show the latest activity of any rule (e.g. the last Verification if a Calibration is due)
+        last = max(events, key=lambda e: e['last_date'] or getdate("1900-01-01"))
+        instrument.update({
+            'requirement_type': event['qualification_type'],
+            'last_activity_date': last['last_date'] or instrument['acquisition_date'],
+            'last_activity_type': last['last_type'] or event['qualification_type'],
+            'due_date': event['due_date']
+        })
+        compliance.append(instrument)
+    return compliance
+
+
+def get_audit_trail_review_due_dates(systems):
+    """
+    Adds last_atr_date and due_date to the given computerised systems (dicts with at least name, creation and atr_frequency).
+    An Audit Trail Review is due atr_frequency months after the last one or the creation of the system.
+    """
+    activities = get_last_activities("QM Computerised System", [s['name'] for s in systems])
+    for system in systems:
+        activity = activities.get(system['name'], {}).get(AUDIT_TRAIL_REVIEW)
+        system['last_atr_date'] = getdate(activity['last_date']) if activity else None
+        system['due_date'] = add_months(system['last_atr_date'] or getdate(system['creation']), system['atr_frequency'] or 0)
+    return systems
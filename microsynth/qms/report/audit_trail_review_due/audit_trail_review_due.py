@@ -3,6 +3,8 @@
 
 from __future__ import unicode_literals
 import frappe
+from frappe.utils import getdate
+from microsynth.qms.due_dates import get_audit_trail_review_due_dates
 
 
 def get_columns():
@@ -22,35 +24,8 @@ def get_columns():
 	]
 
 
-def get_conditions(filters):
-	view = (filters or {}).get("view")
-	due_date_expression = """DATE_ADD(
-				COALESCE(`last_atr`.`last_atr_date`, DATE(`tabQM Computerised System`.`creation`)),
-				INTERVAL `tabQM Computerised System`.`atr_frequency` MONTH
-			)"""
-
-	if view == "All ATR-managed systems":
-		return ""
-
-	# default: systems due today or overdue
-	return f"AND {due_date_expression} <= CURDATE()"
-
-
 def get_data(filters):
-	conditions = get_conditions(filters)
-
-	return frappe.db.sql(f"""
-		WITH `last_atr` AS (
-			SELECT
-				`tabQM Log Book`.`document_name`,
-				MAX(`tabQM Log Book`.`date`) AS `last_atr_date`
-			FROM `tabQM Log Book`
-			WHERE `tabQM Log Book`.`docstatus` = 1
-				AND `tabQM Log Book`.`document_type` = 'QM Computerised System'
-				AND `tabQM Log Book`.`entry_type` = 'Audit Trail Review'
-				AND `tabQM Log Book`.`status` IN ('To Review', 'Closed')
-			GROUP BY `tabQM Log Book`.`document_name`
-		)
+	systems = frappe.db.sql("""
 		SELECT
 			`tabQM Computerised System`.`name`,
 			`tabQM Computerised System`.`cs_name`,
@@ -59,22 +34,22 @@ def get_data(filters):
 			`tabQM Computerised System`.`gamp5_class`,
 			`tabQM Computerised System`.`regulatory_classification`,
 			`tabQM Computerised System`.`atr_frequency`,
-			`last_atr`.`last_atr_date`,
-			DATE_ADD(
-				COALESCE(`last_atr`.`last_atr_date`, DATE(`tabQM Computerised System`.`creation`)),
-				INTERVAL `tabQM Computerised System`.`atr_frequency` MONTH
-			) AS `due_date`,
+			`tabQM Computerised System`.`creation`,
 			`tabQM Computerised System`.`qm_process`,
 			`tabQM Computerised System`.`company`,
 			`tabQM Computerised System`.`responsible_user`
 		FROM `tabQM Computerised System`
-		LEFT JOIN `last_atr`
-			ON `last_atr`.`document_name` = `tabQM Computerised System`.`name`
 		WHERE `tabQM Computerised System`.`status` != 'Decommissioned'
 			AND COALESCE(`tabQM Computerised System`.`atr_frequency`, 0) > 0
-			{conditions}
-		ORDER BY `due_date` ASC, `tabQM Computerised System`.`name` ASC
-	""", filters, as_dict=True)
+	""", as_dict=True)
+	data = get_audit_trail_review_due_dates(systems)
+
+	if (filters or {}).get("view") != "All ATR-managed systems":
+		# default: systems due today or overdue
+		today = getdate()
+		data = [d for d in data if d['due_date'] <= today]
+	data.sort(key=lambda d: (d['due_date'], d['name']))
+	return data
 
 def execute(filters=None):
 	if not filters:
@@ -2,12 +2,15 @@
 # For license information, please see license.txt
 
 import frappe
+from datetime import timedelta
+from frappe.utils import getdate
+from microsynth.qms.due_dates import INSTRUMENT_RULES, get_instrument_compliance
 
-# Time interval constants (single source of truth)
-REQUALIFICATION_INTERVAL_MONTHS = 24
-VERIFICATION_INTERVAL_MONTHS = 12
-CALIBRATION_INTERVAL_YEARS = 5
 REQUALIFICATION_LOOKAHEAD_WEEKS = 6
+# requirement types shown in the report for the required QM Log Book entry type
+REQUIREMENT_TYPES = {
+    "(Re-)Qualification": "Requalification"
+}
 
 
 def get_columns():
@@ -29,130 +32,55 @@ def get_columns():
     ]
 
 
-def get_conditions(filters):
+def matches_filters(row, filters):
     requirement_type = filters.get("requirement_type")
+    today = getdate()
+    due_date = row['due_date']
+    requalification_due = row['requirement_type'] == 'Requalification' and due_date \
+        and due_date <= today + timedelta(weeks=REQUALIFICATION_LOOKAHEAD_WEEKS)
 
     if requirement_type == "Requalification in next 6 weeks":
-        return f"""AND `requirement_type` = 'Requalification' AND `due_date` <= DATE_ADD(CURDATE(), INTERVAL {REQUALIFICATION_LOOKAHEAD_WEEKS} WEEK)"""
+        return bool(requalification_due)
 
     if requirement_type == "Verification due":
-        return """AND `requirement_type` = 'Verification'"""
+        return row['requirement_type'] == 'Verification'
 
     if requirement_type == "Calibration due":
-        return """AND `requirement_type` = 'Calibration'"""
+        return row['requirement_type'] == 'Calibration'
 
     if requirement_type == "Overdue":
-        return "AND `due_date` < CURDATE()"
+        return bool(due_date and due_date < today)
     # default
-    return f""" AND (
-        (`requirement_type` = 'Requalification'
-            AND `due_date` <= DATE_ADD(CURDATE(), INTERVAL {REQUALIFICATION_LOOKAHEAD_WEEKS} WEEK))
-        OR `requirement_type` IN ('Verification','Calibration')
-    )"""
+    return bool(requalification_due or row['requirement_type'] in ('Verification', 'Calibration'))
 
 
 def get_data(filters):
-    conditions = get_conditions(filters)
-    return frappe.db.sql(f"""
-        WITH
-        `logbook_agg` AS (
-            SELECT
-                `tabQM Log Book`.`document_name`,
-                MAX(CASE WHEN `tabQM Log Book`.`entry_type` = '(Re-)Qualification' THEN `tabQM Log Book`.`date` END) AS `last_requalification`,
-                MAX(CASE WHEN `tabQM Log Book`.`entry_type` = 'Verification' THEN `tabQM Log Book`.`date` END) AS `last_verification`,
-                MAX(CASE WHEN `tabQM Log Book`.`entry_type` = 'Calibration' THEN `tabQM Log Book`.`date` END) AS `last_calibration`,
-                MAX(CASE WHEN `tabQM Log Book`.`entry_type` IN ('Verification','Calibration') THEN `tabQM Log Book`.`date` END) AS `last_verification_or_calibration`,
-                SUBSTRING_INDEX(
-                    GROUP_CONCAT(
-                        CASE
-                            WHEN `tabQM Log Book`.`entry_type` IN ('Verification','Calibration') THEN `tabQM Log Book`.`entry_type`
-                        END
-                        ORDER BY `tabQM Log Book`.`date` DESC
-                    ),
-                    ',',
-                    1
-                ) AS `last_verification_or_calibration_type`,
-                MAX(`tabQM Log Book`.`date`) AS `last_logbook_date`,
-                SUBSTRING_INDEX(GROUP_CONCAT(`tabQM Log Book`.`entry_type` ORDER BY `tabQM Log Book`.`date` DESC), ',', 1) AS `last_logbook_type`,
-                MIN(CASE WHEN `tabQM Log Book`.`entry_type` = 'Verification' THEN `tabQM Log Book`.`date` END) AS `oldest_verification_date`
-            FROM `tabQM Log Book`
-            WHERE `tabQM Log Book`.`docstatus` = 1
-                AND `tabQM Log Book`.`status` IN ('To Review','Closed')
-            GROUP BY `tabQM Log Book`.`document_name`
-        ),
-        `instrument_base` AS (
-            SELECT
-                `tabQM Instrument`.`name`,
-                `tabQM Instrument`.`instrument_name`,
-                `tabQM Instrument`.`instrument_class`,
-                LEFT(`tabQM Instrument`.`instrument_class`, 1) AS `class_letter`,
-                `tabQM Instrument`.`qm_process`,
-                `tabQM Instrument`.`site`,
-                `tabQM Instrument`.`manufacturer`,
-                `tabQM Instrument`.`serial_no`,
-                `tabQM Instrument`.`supplier`,
-                `tabQM Instrument`.`supplier_name`,
-                `tabQM Instrument`.`status`,
-                `tabQM Instrument`.`acquisition_date`,
-                COALESCE(`logbook_agg`.`last_requalification`, `tabQM Instrument`.`acquisition_date`) AS `last_requalification_date`,
-                COALESCE(`logbook_agg`.`last_verification`, `tabQM Instrument`.`acquisition_date`) AS `last_verification_date`,
-                `logbook_agg`.`last_calibration` AS `last_calibration_date`,
-                `logbook_agg`.`last_verification_or_calibration` AS `last_verification_or_calibration`,
-                COALESCE(`logbook_agg`.`last_verification_or_calibration`, `tabQM Instrument`.`acquisition_date`) AS `last_verification_or_calibration_date`,
-                `logbook_agg`.`last_verification_or_calibration_type`,
-                `logbook_agg`.`last_logbook_date`,
-                `logbook_agg`.`last_logbook_type`,
-                `logbook_agg`.`oldest_verification_date`
-            FROM `tabQM Instrument`
-            LEFT JOIN `logbook_agg` ON `logbook_agg`.`document_name` = `tabQM Instrument`.`name`
-            WHERE `tabQM Instrument`.`status` != 'Disposed'
-                AND LEFT(`tabQM Instrument`.`instrument_class`, 1) IN ('A','P','T','W')
-        ),
-        `instrument_eval` AS (
-            SELECT *,
-                CASE
-                    WHEN `class_letter` = 'A' THEN 'Requalification'
-                    WHEN `class_letter` IN ('T','W') THEN 'Verification'
-                    WHEN `class_letter` = 'P' AND (
-                        (`last_calibration_date` IS NOT NULL
-                            AND YEAR(CURDATE()) - YEAR(`last_calibration_date`) >= {CALIBRATION_INTERVAL_YEARS})
-                        OR (`last_calibration_date` IS NULL
-                            AND `oldest_verification_date` IS NOT NULL
-                            AND YEAR(CURDATE()) - YEAR(`oldest_verification_date`) >= {CALIBRATION_INTERVAL_YEARS})
-                        OR (`last_calibration_date` IS NULL
-                            AND `oldest_verification_date` IS NULL)
-                    ) THEN 'Calibration'
-                    ELSE 'Verification'
-                END AS `requirement_type`,
-                CASE
-                    WHEN `class_letter` = 'A' THEN `last_requalification_date`
-                    WHEN `class_letter` IN ('T','W') THEN `last_verification_date`
-                    WHEN `class_letter` = 'P' THEN COALESCE(`last_verification_or_calibration`, `acquisition_date`)
-                    ELSE `last_verification_or_calibration_date`
-                END AS `last_activity_date`,
-                CASE
-                    WHEN `class_letter` = 'A' THEN '(Re-)Qualification'
-                    WHEN `class_letter` IN ('T','W') THEN 'Verification'
-                    WHEN `class_letter` = 'P' THEN COALESCE(`last_verification_or_calibration_type`, 'Calibration')
-                    ELSE 'Verification'
-                END AS `last_activity_type`,
-                CASE
-                    WHEN `class_letter` = 'A' THEN DATE_ADD(`last_requalification_date`, INTERVAL {REQUALIFICATION_INTERVAL_MONTHS} MONTH)
-                    WHEN `class_letter` IN ('T','W') THEN DATE_ADD(`last_verification_date`, INTERVAL {VERIFICATION_INTERVAL_MONTHS} MONTH)
-                    WHEN `class_letter` = 'P' AND `last_verification_or_calibration` IS NULL THEN `acquisition_date`
-                    WHEN `class_letter` = 'P' THEN DATE_ADD(`last_verification_or_calibration`, INTERVAL {VERIFICATION_INTERVAL_MONTHS} MONTH)
-                    ELSE DATE_ADD(`last_verification_or_calibration_date`, INTERVAL {VERIFICATION_INTERVAL_MONTHS} MONTH)
-                END AS `due_date`
-            FROM `instrument_base`
-        )
-        SELECT *
-        FROM `instrument_eval`
-        WHERE TRUE
-        {conditions}
-        ORDER BY
-            `due_date` ASC,
-            `name` ASC
-    """, filters, as_dict=True)
+    instruments = frappe.db.sql("""
+        SELECT
+            `tabQM Instrument`.`name`,
+            `tabQM Instrument`.`instrument_name`,
+            `tabQM Instrument`.`instrument_class`,
+            `tabQM Instrument`.`qm_process`,
+            `tabQM Instrument`.`site`,
+            `tabQM Instrument`.`manufacturer`,
+            `tabQM Instrument`.`serial_no`,
+            `tabQM Instrument`.`supplier`,
+            `tabQM Instrument`.`supplier_name`,
+            `tabQM Instrument`.`status`,
+            `tabQM Instrument`.`acquisition_date`
+        FROM `tabQM Instrument`
+        WHERE `tabQM Instrument`.`status` != 'Disposed'
+            AND LEFT(`tabQM Instrument`.`instrument_class`, 1) IN %(class_letters)s
+        """, {'class_letters': list(INSTRUMENT_RULES.keys())}, as_dict=True)
+
+    data = []
+    for row in get_instrument_compliance(instruments):
+        row['requirement_type'] = REQUIREMENT_TYPES.get(row['requirement_type'], row['requirement_type'])
+        if matches_filters(row, filters):
+            data.append(row)
+    # instruments without due date first, as with ORDER BY in SQL
+    data.sort(key=lambda r: (r['due_date'] is not None, r['due_date'] or "", r['name']))
+    return data
 
 
 def execute(filters=None):